@@ -26,12 +26,30 @@ module.exports = {
   EMBEDDING_API_URL_REMOTE: process.env.EMBEDDING_API_URL_REMOTE || 'http://60.51.17.97:9701/v1',
   EMBEDDING_MODEL: process.env.EMBEDDING_MODEL || 'embedding_model',
   EMBEDDING_CONTEXT_SIZE: parseInt(process.env.EMBEDDING_CONTEXT_SIZE) || 40960,
+  // Approximate nearest-neighbour index service (vlm/vector_index_server.py), empty disables it
+  VECTOR_INDEX_URL: process.env.VECTOR_INDEX_URL || '',
+  
+  // Persistent capture daemon (vlm/capture_daemon.py, listens on http://localhost:8891), empty falls back to one ffmpeg spawn per frame
+  CAPTURE_DAEMON_URL: process.env.CAPTURE_DAEMON_URL || '',
+  // Seconds between frames the daemon decodes per camera, and oldest frame accepted from it
+  CAPTURE_DAEMON_INTERVAL: parseFloat(process.env.CAPTURE_DAEMON_INTERVAL || '1'),
+  CAPTURE_DAEMON_MAX_AGE: parseFloat(process.env.CAPTURE_DAEMON_MAX_AGE || '10'),
   
   // Vision Model Configuration
   VISION_API_URL: process.env.VISION_API_URL || 'http://192.168.50.118:7601/v1',
   VISION_API_URL_REMOTE: process.env.VISION_API_URL_REMOTE || 'http://60.51.17.97:7601/v1',
   VISION_MODEL: process.env.VISION_MODEL || 'vision_model',
   VISION_CONTEXT_SIZE: parseInt(process.env.VISION_CONTEXT_SIZE) || 40960,
+  // Greedy decoding (0) keeps JSON answers deterministic and enables speculative decoding
+  VISION_TEMPERATURE: parseFloat(process.env.VISION_TEMPERATURE || '0'),
+  // Follow the capture interval the VLM server recommends per camera instead of the fixed one
+  ADAPTIVE_CAPTURE_INTERVAL: process.env.ADAPTIVE_CAPTURE_INTERVAL !== 'false',
+  // Ask the VLM server's CPU pre-screen (/v1/prescreen) before queueing a frame for the full model
+  PRESCREEN_ENABLED: process.env.PRESCREEN_ENABLED === 'true',
+  // Let the VLM server fold a camera's repeated answers into events and store only the frame that opens one
+  EVENT_AGGREGATION: process.env.EVENT_AGGREGATION === 'true',
+  // Seconds between bulk updates of the stored events' end time and frame count
+  EVENT_SYNC_INTERVAL: parseFloat(process.env.EVENT_SYNC_INTERVAL || '15'),
   
   // Legacy VLM Configuration (keep for backward compatibility)
   VLM_API_URL: process.env.VLM_API_URL || 'http://localhost:8881/v1/chat/completions',
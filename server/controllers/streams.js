@@ -2,6 +2,7 @@
 const Stream = require('../models/Stream');
 const Prompt = require('../models/Prompt');
 const VisionResult = require('../models/VisionResult');
+const frameCapture = require('../services/frameCapture');
 const { logger } = require('../utils/logger');
 const handlers = require('../websocket/handlers');
 const { getIO } = require('../websocket/server');
@@ -106,6 +107,7 @@ exports.updateStream = async (req, res, next) => {
         // Stop recording if stream became inactive or has error
         logger.info(`Stream ${stream._id} became ${stream.status}, stopping recording...`);
         await hlsRecorder.stopRecording(stream._id.toString());
+        await frameCapture.releaseStream(stream._id.toString(), stream.url);
       }
     }
 
@@ -133,6 +135,7 @@ exports.deleteStream = async (req, res, next) => {
     }
 
     await Stream.deleteOne({ _id: req.params.id });
+    await frameCapture.releaseStream(stream._id.toString(), stream.url);
 
     // Also delete all prompts associated with this stream
     await Prompt.deleteMany({ streamId: req.params.id });
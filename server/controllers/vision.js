@@ -13,6 +13,7 @@ const path = require('path');
 const fs = require('fs');
 const threadManager = require('../services/threadManager');
 const embeddingService = require('../services/embeddingService');
+const visionProcessor = require('../services/visionProcessor');
 
 // Initialize embedding model based on configuration
 (async () => {
@@ -270,23 +271,41 @@ exports.searchResults = async (req, res, next) => {
         if (embedding) {
           searchMethod = 'semantic';
           
-          // Get results with embeddings - approach more similar to searchResults.js
-          // First, get documents that have embeddings
-          const candidateResults = await VisionResult.find({
-            ...filter,
-            embedding: { $exists: true, $ne: null }
-          })
-          .sort({ timestamp: -1 })
-          .limit(parsedLimit * 5) // Get more candidates to filter semantically
-          .populate(['streamId', 'promptId'])
-          .lean();
+          // Nearest documents from the vector index, scored over the whole collection
+          let candidateResults;
+          const hits = await embeddingService.searchIndex(embedding, {
+            streamId,
+            fromDate,
+            toDate,
+            limit: (skip + parsedLimit) * 5,
+            threshold: parseFloat(similarity),
+          });
+          if (hits) {
+            const scores = new Map(hits.map(hit => [hit.id, hit.score]));
+            candidateResults = (await VisionResult.find({ ...filter, _id: { $in: [...scores.keys()] } })
+              .populate(['streamId', 'promptId'])
+              .lean())
+              .map(doc => ({ ...doc, _similarity: scores.get(String(doc._id)) }));
+          } else {
+            // Without the index, score the most recent documents that have embeddings
+            candidateResults = await VisionResult.find({
+              ...filter,
+              embedding: { $exists: true, $ne: null }
+            })
+            .sort({ timestamp: -1 })
+            .limit(parsedLimit * 5) // Get more candidates to filter semantically
+            .populate(['streamId', 'promptId'])
+            .lean();
+          }
           
           if (candidateResults.length > 0) {
             // Calculate similarity for each result (like in searchResults.js)
             const resultsWithSimilarity = candidateResults
-              .filter(doc => Array.isArray(doc.embedding) && doc.embedding.length > 0)
+              .filter(doc => doc._similarity !== undefined || (Array.isArray(doc.embedding) && doc.embedding.length > 0))
               .map(doc => {
-                const similarity = embeddingService.cosineSimilarity(embedding, doc.embedding);
+                const similarity = doc._similarity !== undefined
+                  ? doc._similarity
+                  : embeddingService.cosineSimilarity(embedding, doc.embedding);
                 return { ...doc, _similarity: similarity };
               })
               .filter(doc => doc._similarity >= parseFloat(similarity)) // Apply similarity threshold
@@ -368,7 +387,102 @@ exports.searchResults = async (req, res, next) => {
     next(err);
   }
 };
+/**
+ * Visual search: frames whose image matches a text, from the vision server's frame index
+ * Query: q, streamId, fromDate, toDate, limit, similarity
+ */
+exports.searchFrames = async (req, res, next) => {
+  try {
+    const { q, streamId, fromDate, toDate, limit = 20, similarity } = req.query;
+    if (!q || !q.trim()) {
+      return res.status(400).json({ message: 'q is required' });
+    }
+    const startTime = Date.now();
+    const hits = await visionProcessor.searchFrames({ text: q.trim() }, {
+      streamId,
+      fromDate,
+      toDate,
+      limit: parseInt(limit),
+      threshold: similarity !== undefined ? parseFloat(similarity) : undefined,
+    });
+    await sendFrameHits(res, hits, startTime);
+  } catch (err) {
+    logger.error(`Frame search error: ${err.stack}`);
+    next(err);
+  }
+};
+
+/**
+ * Visual search: frames that look like the frame of a vision result
+ * Query: streamId, fromDate, toDate, limit, similarity
+ */
+exports.findSimilarFrames = async (req, res, next) => {
+  try {
+    const { resultId } = req.params;
+    const { streamId, fromDate, toDate, limit = 20, similarity } = req.query;
+    const startTime = Date.now();
+    const hits = await visionProcessor.searchFrames({ id: resultId }, {
+      streamId,
+      fromDate,
+      toDate,
+      limit: parseInt(limit),
+      threshold: similarity !== undefined ? parseFloat(similarity) : undefined,
+    });
+    await sendFrameHits(res, hits, startTime);
+  } catch (err) {
+    logger.error(`Similar frames error: ${err.stack}`);
+    next(err);
+  }
+};
+
 // Helper functions
+async function sendFrameHits(res, hits, startTime) {
+  if (!hits) {
+    return res.status(503).json({ message: 'Frame index unavailable' });
+  }
+  // Frames the server indexed without a saved result (dropped or failed analyses) are skipped
+  const scores = new Map(hits.filter(hit => mongoose.Types.ObjectId.isValid(hit.id)).map(hit => [hit.id, hit.score]));
+  const docs = await VisionResult.find({ _id: { $in: [...scores.keys()] } })
+    .populate(['streamId', 'promptId'])
+    .lean();
+  // A frame merged into an event (EVENT_AGGREGATION) is found through the event's result covering its time
+  const found = new Set(docs.map(doc => String(doc._id)));
+  const merged = hits.filter(hit => !found.has(hit.id) && hit.timestamp && mongoose.Types.ObjectId.isValid(hit.stream));
+  if (merged.length) {
+    const events = await VisionResult.find({
+      $or: merged.map(hit => ({
+        streamId: hit.stream,
+        timestamp: { $lte: new Date(hit.timestamp * 1000) },
+        eventEnd: { $gte: new Date(hit.timestamp * 1000) }
+      }))
+    }).populate(['streamId', 'promptId']).lean();
+    for (const event of events) {
+      const start = new Date(event.timestamp).getTime() / 1000;
+      const end = new Date(event.eventEnd).getTime() / 1000;
+      const best = Math.max(...merged
+        .filter(hit => hit.stream === String(event.streamId._id || event.streamId) && hit.timestamp >= start && hit.timestamp <= end)
+        .map(hit => hit.score));
+      const id = String(event._id);
+      if (Number.isFinite(best) && !(scores.get(id) >= best)) {
+        scores.set(id, best);
+      }
+      if (!found.has(id)) {
+        found.add(id);
+        docs.push(event);
+      }
+    }
+  }
+  const results = docs
+    .map(doc => ({ ...doc, _similarity: scores.get(String(doc._id)) }))
+    .sort((a, b) => b._similarity - a._similarity);
+  res.status(200).json({
+    docs: formatResults(results),
+    totalDocs: results.length,
+    searchMethod: 'visual',
+    executionTime: Date.now() - startTime
+  });
+}
+
 function formatResults(results) {
   return results.map(result => {
     // Determine event type based on detections
@@ -647,7 +761,8 @@ exports.processStreamFrame = async (req, res, next) => {
       logger.debug(`Attempting to queue frame for stream ${streamId} with prompt ${promptId}`);
       jobId = await frameProcessor.queueFrame(streamId, promptId, {
         forceProcess,
-        priority: 5
+        priority: 5,
+        priorityClass: 'alert' // Requested by a user, serve ahead of the periodic analysis
       });
       
       logger.debug(`Queue result: ${jobId ? `Job ID: ${jobId}` : 'Job skipped'}`);
@@ -800,7 +915,10 @@ exports.generateLiveDescription = async (req, res, next) => {
       
       // Process with vision model
       logger.info(`Processing frame with vision model for live description`);
-      const result = await visionProcessor.processImage(base64Image, prompt);
+      const result = await visionProcessor.processImage(base64Image, prompt, {
+        priority: 'alert',
+        streamId
+      });
       
       // Extract description from result
       let description = 'No description available';
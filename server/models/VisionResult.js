@@ -57,6 +57,17 @@ const VisionResultSchema = new mongoose.Schema({
     type: Date,
     default: Date.now,
   },
+  // Frames the vision server merged into this result's event (EVENT_AGGREGATION), and the last one's time
+  frameCount: {
+    type: Number,
+    default: 1,
+  },
+  eventEnd: {
+    type: Date,
+  },
+  eventClosed: {
+    type: Boolean,
+  },
   metadata: {
     type: mongoose.Schema.Types.Mixed,
     recordingFolder: String, // Store the HLS recording folder name
@@ -24,6 +24,10 @@ router.get('/streams/:streamId/results', authenticate, visionController.getStrea
 // Search vision results across all streams
 router.get('/search', authenticate, visionController.searchResults);
 
+// Visual search over analysed frames: by text, or frames that look like a result's frame
+router.get('/frames/search', authenticate, visionController.searchFrames);
+router.get('/results/:resultId/similar', authenticate, visionController.findSimilarFrames);
+
 // embedding-specific routes
 router.post('/embedding', authenticate, visionController.generateEmbedding);
 router.post('/backfill-embeddings', authenticate, visionController.backfillEmbeddings);
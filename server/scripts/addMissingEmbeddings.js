@@ -2,13 +2,13 @@
 const mongoose = require('mongoose');
 const { connectDB } = require('../config/database');
 const { logger } = require('../utils/logger');
-const { generateEmbedding } = require('../services/embeddingService');
+const { batchGenerateEmbeddings } = require('../services/embeddingService');
 const VisionResult = require('../models/VisionResult');
 
 // Set strictQuery to suppress the deprecation warning
 mongoose.set('strictQuery', false);
 
-const batchSize = 50; // Process records in batches to avoid memory issues
+const batchSize = 500; // Records embedded per batch request
 
 /**
  * Add embeddings to records that don't have them
@@ -39,8 +39,10 @@ const addMissingEmbeddings = async () => {
     let successCount = 0;
     let failedCount = 0;
     
-    // Process in batches to avoid memory issues
+    // Process in batches to avoid memory issues, paging by _id so records
+    // that fail to embed are not fetched again
     let hasMoreRecords = true;
+    let lastId = null;
     
     while (hasMoreRecords) {
       // Get batch of records without embeddings
@@ -50,58 +52,48 @@ const addMissingEmbeddings = async () => {
           { embedding: null },
           { embedding: [] }
         ],
-        result: { $exists: true, $ne: null, $ne: '' }
-      }).limit(batchSize);
+        result: { $exists: true, $ne: null, $ne: '' },
+        ...(lastId ? { _id: { $gt: lastId } } : {})
+      })
+      .sort({ _id: 1 })
+      .limit(batchSize)
+      .select({ _id: 1, result: 1 })
+      .lean();
       
       if (records.length === 0) {
         hasMoreRecords = false;
         continue;
       }
+      lastId = records[records.length - 1]._id;
       
       logger.info(`Processing batch of ${records.length} records`);
       
-      // Process each record in the batch
-      for (const record of records) {
-        try {
-          // Get the text to embed from the result field based on your schema
-          const textToEmbed = record.result;
-          
-          if (!textToEmbed) {
-            logger.warn(`Record ${record._id} has no text to embed, skipping`);
-            processedCount++;
-            failedCount++;
-            continue;
-          }
-          
-          // Generate embedding
-          const embedding = await generateEmbedding(textToEmbed);
-          
-          if (!embedding) {
+      try {
+        // One embedding request for the whole batch
+        const embeddings = await batchGenerateEmbeddings(records.map(record => record.result));
+        
+        const updates = [];
+        records.forEach((record, i) => {
+          if (!embeddings[i]) {
             logger.warn(`Failed to generate embedding for record ${record._id}`);
-            processedCount++;
             failedCount++;
-            continue;
-          }
-          
-          // Update the record with the embedding
-          await VisionResult.updateOne(
-            { _id: record._id },
-            { $set: { embedding: embedding } }
-          );
-          
-          successCount++;
-          processedCount++;
-          
-          // Log progress periodically
-          if (processedCount % 10 === 0 || processedCount === totalMissing) {
-            logger.info(`Progress: ${processedCount}/${totalMissing} records processed (${successCount} successful, ${failedCount} failed)`);
+            return;
           }
-        } catch (err) {
-          logger.error(`Error processing record ${record._id}: ${err.message}`);
-          processedCount++;
-          failedCount++;
+          updates.push({
+            updateOne: { filter: { _id: record._id }, update: { $set: { embedding: embeddings[i] } } }
+          });
+        });
+        
+        if (updates.length > 0) {
+          await VisionResult.bulkWrite(updates, { ordered: false });
         }
+        successCount += updates.length;
+      } catch (err) {
+        logger.error(`Error processing batch ending at ${lastId}: ${err.message}`);
+        failedCount += records.length;
       }
+      processedCount += records.length;
+      logger.info(`Progress: ${processedCount}/${totalMissing} records processed (${successCount} successful, ${failedCount} failed)`);
     }
     
     logger.info(`Embedding generation complete. Total: ${totalMissing}, Successful: ${successCount}, Failed: ${failedCount}`);
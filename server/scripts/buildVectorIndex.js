@@ -0,0 +1,70 @@
+// server/scripts/buildVectorIndex.js
+const axios = require('axios');
+const mongoose = require('mongoose');
+const { connectDB } = require('../config/database');
+const { logger } = require('../utils/logger');
+const { VECTOR_INDEX_URL } = require('../config/env');
+const VisionResult = require('../models/VisionResult');
+
+// Set strictQuery to suppress the deprecation warning
+mongoose.set('strictQuery', false);
+
+const batchSize = 500; // Vectors sent to the index per request
+
+/**
+ * Load every stored embedding into the vector index service.
+ * Safe to re-run: ids already in the index are replaced.
+ */
+const buildVectorIndex = async () => {
+  try {
+    if (!VECTOR_INDEX_URL) {
+      logger.error('VECTOR_INDEX_URL is not set');
+      process.exit(1);
+    }
+
+    await connectDB();
+    logger.info('Connected to MongoDB');
+
+    const filter = { embedding: { $exists: true, $ne: null, $not: { $size: 0 } } };
+    const total = await VisionResult.countDocuments(filter);
+    logger.info(`Indexing ${total} records with embeddings`);
+
+    const cursor = VisionResult.find(filter)
+      .select({ _id: 1, embedding: 1, streamId: 1, timestamp: 1 })
+      .lean()
+      .cursor();
+
+    let batch = [];
+    let indexedCount = 0;
+    const flush = async () => {
+      if (batch.length === 0) {
+        return;
+      }
+      await axios.post(`${VECTOR_INDEX_URL}/v1/vectors`, { items: batch }, { timeout: 60000 });
+      indexedCount += batch.length;
+      batch = [];
+      logger.info(`Progress: ${indexedCount}/${total} records indexed`);
+    };
+
+    for await (const record of cursor) {
+      batch.push({
+        id: String(record._id),
+        vector: record.embedding,
+        stream: record.streamId ? String(record.streamId) : null,
+        timestamp: record.timestamp ? new Date(record.timestamp).getTime() / 1000 : null,
+      });
+      if (batch.length >= batchSize) {
+        await flush();
+      }
+    }
+    await flush();
+
+    logger.info(`Vector index build complete. Indexed: ${indexedCount}`);
+    process.exit(0);
+  } catch (err) {
+    logger.error(`Error building vector index: ${err.message}`);
+    process.exit(1);
+  }
+};
+
+buildVectorIndex();
@@ -2,13 +2,14 @@
 const mongoose = require('mongoose');
 const { connectDB } = require('../config/database');
 const { logger } = require('../utils/logger');
-const { generateEmbedding } = require('../services/embeddingService');
+const { batchGenerateEmbeddings } = require('../services/embeddingService');
 const VisionResult = require('../models/VisionResult');
 
 // Set strictQuery to suppress the deprecation warning
 mongoose.set('strictQuery', false);
 
-const batchSize = 25; // Smaller batch size to better visualize output
+const batchSize = 500; // Records embedded per batch request
+const verbose = process.argv.includes('--verbose'); // Print every text and embedding
 
 /**
  * Recreate embeddings for all records with text content
@@ -34,81 +35,69 @@ const recreateEmbeddings = async () => {
     let successCount = 0;
     let failedCount = 0;
     
-    // Process in batches
+    // Process in batches, paging by _id (skip gets slower with every page)
     let hasMoreRecords = true;
-    let skip = 0;
+    let lastId = null;
     
     while (hasMoreRecords) {
       // Get batch of records
       const records = await VisionResult.find({ 
-        result: { $exists: true, $ne: null, $ne: '' }
+        result: { $exists: true, $ne: null, $ne: '' },
+        ...(lastId ? { _id: { $gt: lastId } } : {})
       })
-      .skip(skip)
-      .limit(batchSize);
+      .sort({ _id: 1 })
+      .limit(batchSize)
+      .select({ _id: 1, result: 1 })
+      .lean();
       
       if (records.length === 0) {
         hasMoreRecords = false;
         continue;
       }
+      lastId = records[records.length - 1]._id;
       
-      logger.info(`Processing batch of ${records.length} records (${skip + 1} to ${skip + records.length})`);
+      logger.info(`Processing batch of ${records.length} records (${processedCount + 1} to ${processedCount + records.length})`);
       
-      // Process each record in the batch
-      for (const record of records) {
-        try {
-          const textToEmbed = record.result;
-          
-          if (!textToEmbed) {
-            logger.warn(`Record ${record._id} has no text to embed, skipping`);
-            processedCount++;
-            failedCount++;
-            continue;
-          }
-          
-          // Print original text to console
-          console.log('\n-----------------------------------------------');
-          console.log(`RECORD ID: ${record._id}`);
-          console.log('TEXT CONTENT:');
-          console.log(textToEmbed);
-          
-          // Generate embedding
-          const embedding = await generateEmbedding(textToEmbed);
-          
+      try {
+        // One embedding request for the whole batch
+        const embeddings = await batchGenerateEmbeddings(records.map(record => record.result));
+        
+        const updates = [];
+        records.forEach((record, i) => {
+          const embedding = embeddings[i];
           if (!embedding || embedding.length === 0) {
             logger.warn(`Failed to generate embedding for record ${record._id}`);
-            processedCount++;
             failedCount++;
-            continue;
+            return;
           }
           
-          // Print embedding details
-          console.log('\nEMBEDDING DETAILS:');
-          console.log(`Dimensions: ${embedding.length}`);
-          console.log(`First 5 values: [${embedding.slice(0, 5).join(', ')}]`);
-          console.log(`Last 5 values: [${embedding.slice(-5).join(', ')}]`);
-          console.log('-----------------------------------------------');
-          
-          // Update the record with the new embedding
-          await VisionResult.updateOne(
-            { _id: record._id },
-            { $set: { embedding: embedding } }
-          );
-          
-          successCount++;
-          processedCount++;
-          
-          // Log progress periodically
-          if (processedCount % 10 === 0 || processedCount === totalRecords) {
-            logger.info(`Progress: ${processedCount}/${totalRecords} records processed (${successCount} successful, ${failedCount} failed)`);
+          if (verbose) {
+            console.log('\n-----------------------------------------------');
+            console.log(`RECORD ID: ${record._id}`);
+            console.log('TEXT CONTENT:');
+            console.log(record.result);
+            console.log('\nEMBEDDING DETAILS:');
+            console.log(`Dimensions: ${embedding.length}`);
+            console.log(`First 5 values: [${embedding.slice(0, 5).join(', ')}]`);
+            console.log(`Last 5 values: [${embedding.slice(-5).join(', ')}]`);
+            console.log('-----------------------------------------------');
           }
-        } catch (err) {
-          logger.error(`Error processing record ${record._id}: ${err.message}`);
-          processedCount++;
-          failedCount++;
+          
+          updates.push({
+            updateOne: { filter: { _id: record._id }, update: { $set: { embedding: embedding } } }
+          });
+        });
+        
+        if (updates.length > 0) {
+          await VisionResult.bulkWrite(updates, { ordered: false });
         }
+        successCount += updates.length;
+      } catch (err) {
+        logger.error(`Error processing batch ending at ${lastId}: ${err.message}`);
+        failedCount += records.length;
       }
-      
-      skip += records.length;
+      processedCount += records.length;
+      logger.info(`Progress: ${processedCount}/${totalRecords} records processed (${successCount} successful, ${failedCount} failed)`);
     }
     
     logger.info(`\n=== EMBEDDING RECREATION COMPLETE ===`);
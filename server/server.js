@@ -7,6 +7,7 @@ const { PORT } = require('./config/env');
 const autoProcessor = require('./services/autoProcessor');
 const threadManager = require('./services/threadManager');
 const hlsRecorder = require('./services/hlsRecorder');
+const eventSync = require('./services/eventSync');
 
 // Create HTTP server
 const server = http.createServer(app);
@@ -26,6 +27,8 @@ server.listen(PORT, async () => {
 
     await threadManager.start();
     logger.info('Thread manager started');
+
+    eventSync.start();
   } catch (error) {
     logger.error(`Error starting services: ${error.message}`);
   }
@@ -52,6 +55,7 @@ app.on('ready', async () => {
 process.on('SIGTERM', () => {
   logger.info('SIGTERM signal received');
   autoProcessor.stop();
+  eventSync.stop();
   // Stop all recordings on shutdown
   hlsRecorder.stopAllRecordings();
   threadManager.stopAllThreads().then(() => {
@@ -63,6 +67,7 @@ process.on('SIGTERM', () => {
 process.on('SIGINT', () => {
   logger.info('SIGINT signal received');
   autoProcessor.stop();
+  eventSync.stop();
   // Stop all recordings on shutdown
   hlsRecorder.stopAllRecordings();
   threadManager.stopAllThreads().then(() => {
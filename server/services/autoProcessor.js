@@ -1,9 +1,11 @@
 // server/services/autoProcessor.js
 const { logger } = require('../utils/logger');
+const config = require('../config/env');
 const Stream = require('../models/Stream');
 const frameCapture = require('./frameCapture');
 const frameProcessor = require('./frameProcessor');
 const hlsRecorder = require('./hlsRecorder');
+const visionProcessor = require('./visionProcessor');
 
 class AutoProcessor {
   constructor() {
@@ -49,8 +51,25 @@ class AutoProcessor {
     
     logger.info(`Setting up auto-processing for stream ${stream._id} with interval ${interval}ms`);
     
-    // Create an interval
-    const timerId = setInterval(async () => {
+    // Each capture schedules the next one, at the interval the vision server
+    // recommends for this camera under the current load when it has one
+    const entry = { timerId: null, stopped: false, interval };
+    const scheduleNext = async () => {
+      if (config.ADAPTIVE_CAPTURE_INTERVAL) {
+        const recommended = await visionProcessor.getRecommendedInterval(stream._id.toString(), entry.interval * 2);
+        if (recommended) {
+          if (Math.abs(recommended * 1000 - entry.interval) >= 1000) {
+            logger.debug(`Stream ${stream._id} capture interval now ${recommended}s (configured ${interval / 1000}s)`);
+          }
+          entry.interval = recommended * 1000;
+        }
+      }
+      if (!entry.stopped) {
+        entry.timerId = setTimeout(capture, entry.interval);
+      }
+    };
+    
+    const capture = async () => {
       try {
         // Skip if stream status is not active
         if (stream.status !== 'active') {
@@ -85,8 +104,11 @@ class AutoProcessor {
         const jobId = await frameProcessor.queueFrame(
           stream._id.toString(),
           promptId.toString(),
-          frameBuffer,
-          { cooldown: interval / 1000 / 2 } // Set cooldown to half the interval
+          {
+            cooldown: entry.interval / 1000 / 2, // Set cooldown to half the interval
+            staleAfter: entry.interval, // The next capture supersedes this frame
+            priorityClass: 'live'
+          }
         );
         
         if (jobId) {
@@ -94,11 +116,15 @@ class AutoProcessor {
         }
       } catch (error) {
         logger.error(`Auto-processing error for stream ${stream._id}: ${error.message}`);
+      } finally {
+        await scheduleNext();
       }
-    }, interval);
+    };
+    
+    entry.timerId = setTimeout(capture, interval);
     
     // Store the timer
-    this.activeStreams.set(stream._id.toString(), timerId);
+    this.activeStreams.set(stream._id.toString(), entry);
   }
   
   // Stop processing for a stream
@@ -106,7 +132,9 @@ class AutoProcessor {
     const id = streamId.toString();
     
     if (this.activeStreams.has(id)) {
-      clearInterval(this.activeStreams.get(id));
+      const entry = this.activeStreams.get(id);
+      entry.stopped = true;
+      clearTimeout(entry.timerId);
       this.activeStreams.delete(id);
       logger.info(`Stopped auto-processing for stream ${id}`);
     }
@@ -136,6 +164,7 @@ async updateStreamStatus(streamId, newStatus) {
     } else if (newStatus === 'inactive' || newStatus === 'error') {
       // Stop recording when stream becomes inactive or has an error
       hlsRecorder.stopRecording(streamId);
+      await frameCapture.releaseStream(streamId, stream.url);
     }
     
     return true;
@@ -174,8 +203,9 @@ async updateStreamStatus(streamId, newStatus) {
   
   // Stop all processing
   stop() {
-    for (const [streamId, timerId] of this.activeStreams.entries()) {
-      clearInterval(timerId);
+    for (const [streamId, entry] of this.activeStreams.entries()) {
+      entry.stopped = true;
+      clearTimeout(entry.timerId);
       logger.info(`Stopped auto-processing for stream ${streamId}`);
     }
     
@@ -6,6 +6,7 @@ const { logger } = require('../utils/logger');
 const EMBEDDING_API = process.env.EMBEDDING_API_URL || process.env.EMBEDDING_API_URL_REMOTE || process.env.OLLAMA_API_URL || 'http://localhost:11434/api';
 const EMBEDDING_MODEL = process.env.EMBEDDING_MODEL || process.env.LEGACY_EMBEDDING_MODEL || 'embedding_model';
 const IS_OPENAI_COMPATIBLE = process.env.EMBEDDING_API_URL || process.env.EMBEDDING_API_URL_REMOTE;
+const { VECTOR_INDEX_URL } = require('../config/env');
 
 /**
  * Generate embeddings for a text using Nomic Embed Text model via Ollama
@@ -104,6 +105,66 @@ function cosineSimilarity(vecA, vecB) {
   return dotProduct / (Math.sqrt(normA) * Math.sqrt(normB));
 }
 
+/**
+ * Add an embedding to the vector index service
+ * @param {string} id - Document id
+ * @param {number[]} embedding - Embedding vector
+ * @param {string} [streamId] - Stream the document belongs to
+ * @param {Date} [timestamp] - Document time
+ * @returns {Promise<boolean>} - True when the index accepted the vector
+ */
+async function indexEmbedding(id, embedding, streamId, timestamp) {
+  if (!VECTOR_INDEX_URL || !Array.isArray(embedding) || embedding.length === 0) {
+    return false;
+  }
+  try {
+    await axios.post(`${VECTOR_INDEX_URL}/v1/vectors`, {
+      items: [{
+        id: String(id),
+        vector: embedding,
+        stream: streamId ? String(streamId) : null,
+        timestamp: timestamp ? new Date(timestamp).getTime() / 1000 : null,
+      }]
+    }, { timeout: 5000 });
+    return true;
+  } catch (error) {
+    logger.warn(`Failed to index embedding for ${id}: ${error.message}`);
+    return false;
+  }
+}
+
+/**
+ * Query the vector index service for the nearest documents
+ * @param {number[]} embedding - Query embedding vector
+ * @param {Object} options - Search options
+ * @param {string} [options.streamId] - Only documents of this stream
+ * @param {Date|string} [options.fromDate] - Only documents at or after this time
+ * @param {Date|string} [options.toDate] - Only documents at or before this time
+ * @param {number} options.limit - Max results to return
+ * @param {number} [options.threshold] - Minimum similarity
+ * @returns {Promise<Array<{id: string, score: number}>|null>} - Hits, or null when the index is unavailable
+ */
+async function searchIndex(embedding, options) {
+  if (!VECTOR_INDEX_URL) {
+    return null;
+  }
+  const { streamId, fromDate, toDate, limit = 20, threshold } = options;
+  try {
+    const response = await axios.post(`${VECTOR_INDEX_URL}/v1/vectors/search`, {
+      vector: embedding,
+      k: limit,
+      stream: streamId ? String(streamId) : undefined,
+      since: fromDate ? new Date(fromDate).getTime() / 1000 : undefined,
+      until: toDate ? new Date(toDate).getTime() / 1000 : undefined,
+      threshold,
+    }, { timeout: 5000 });
+    return response.data.data;
+  } catch (error) {
+    logger.warn(`Vector index search failed, falling back to scanning documents: ${error.message}`);
+    return null;
+  }
+}
+
 /**
  * Find similar documents by embedding vector (for MongoDB without vector search capability)
  * @param {Object} options - Search options
@@ -120,7 +181,24 @@ async function findSimilarDocuments(model, options) {
     throw new Error('Valid embedding required for similarity search');
   }
   
-  // First, get documents that have embeddings
+  // Ask the vector index for the nearest ids across the whole collection
+  const hits = await searchIndex(embedding, {
+    streamId: filter.streamId,
+    fromDate: filter.timestamp && filter.timestamp.$gte,
+    toDate: filter.timestamp && filter.timestamp.$lte,
+    limit: limit * 2, // Headroom for other filter fields
+    threshold,
+  });
+  if (hits) {
+    const scores = new Map(hits.map(hit => [hit.id, hit.score]));
+    const indexedDocuments = await model.find({ ...filter, _id: { $in: [...scores.keys()] } });
+    return indexedDocuments
+      .map(doc => ({ ...doc.toObject(), _similarity: scores.get(String(doc._id)) }))
+      .sort((a, b) => b._similarity - a._similarity)
+      .slice(0, limit);
+  }
+  
+  // Without the index, get documents that have embeddings
   const documents = await model.find({ 
     ...filter, 
     embedding: { $exists: true, $ne: null }
@@ -143,18 +221,67 @@ async function findSimilarDocuments(model, options) {
     }));
 }
 
-// Batch process multiple documents to generate embeddings
+// Texts sent per request to an OpenAI-compatible /embeddings endpoint
+const EMBEDDING_BATCH_SIZE = parseInt(process.env.EMBEDDING_BATCH_SIZE) || 256;
+
+/**
+ * Unpack a base64 string of little-endian float32 values
+ * @param {string} data
+ * @returns {number[]}
+ */
+function decodeBase64Embedding(data) {
+  const buffer = Buffer.from(data, 'base64');
+  const floats = new Float32Array(buffer.buffer, buffer.byteOffset, buffer.byteLength / 4);
+  return Array.from(floats);
+}
+
+/**
+ * Generate embeddings for many texts
+ * OpenAI-compatible endpoints receive the texts in lists of EMBEDDING_BATCH_SIZE and
+ * answer with base64 float32 vectors; Ollama gets one request per text.
+ * @param {string[]} texts
+ * @returns {Promise<Array<number[]|null>>} - One embedding (or null) per text, in order
+ */
 async function batchGenerateEmbeddings(texts) {
-  const results = [];
-  for (const text of texts) {
-    const embedding = await generateEmbedding(text);
-    results.push(embedding);
+  const results = new Array(texts.length).fill(null);
+  if (!IS_OPENAI_COMPATIBLE) {
+    for (let i = 0; i < texts.length; i++) {
+      results[i] = await generateEmbedding(texts[i]);
+    }
+    return results;
+  }
+  
+  const positions = texts.map((text, i) => (text ? i : -1)).filter(i => i >= 0);
+  for (let start = 0; start < positions.length; start += EMBEDDING_BATCH_SIZE) {
+    const chunk = positions.slice(start, start + EMBEDDING_BATCH_SIZE);
+    try {
+      const response = await axios.post(`${EMBEDDING_API}/embeddings`, {
+        model: EMBEDDING_MODEL,
+        input: chunk.map(i => texts[i]),
+        encoding_format: 'base64',
+      }, {
+        timeout: 300000, // Large batches on a busy GPU
+        headers: { 'Content-Type': 'application/json' },
+      });
+      for (const item of response.data.data) {
+        results[chunk[item.index]] = typeof item.embedding === 'string'
+          ? decodeBase64Embedding(item.embedding)
+          : item.embedding;
+      }
+    } catch (error) {
+      logger.warn(`Batch embedding of ${chunk.length} texts failed (${error.message}), embedding one at a time`);
+      for (const i of chunk) {
+        results[i] = await generateEmbedding(texts[i]);
+      }
+    }
   }
   return results;
 }
 
 module.exports = {
   generateEmbedding,
+  indexEmbedding,
+  searchIndex,
   findSimilarDocuments,
   batchGenerateEmbeddings,
   cosineSimilarity
@@ -0,0 +1,133 @@
+// server/services/eventSync.js
+const { logger } = require('../utils/logger');
+const mongoose = require('mongoose');
+const visionProcessor = require('./visionProcessor');
+const VisionResult = require('../models/VisionResult');
+const { EVENT_AGGREGATION, EVENT_SYNC_INTERVAL } = require('../config/env');
+
+// Syncs an update waits for its result to be stored before it is dropped
+const MAX_ATTEMPTS = 20;
+
+/**
+ * Applies the vision server's event updates to the stored results.
+ *
+ * With EVENT_AGGREGATION the vision server folds consecutive equivalent
+ * answers of a camera into one event; only the frame that opens an event
+ * is stored, under the event's id. The end time and frame count of the
+ * frames merged into it since are fetched here every EVENT_SYNC_INTERVAL
+ * seconds and written in one bulk write, instead of one document,
+ * embedding and broadcast per frame.
+ *
+ * An update can arrive before the result that opened its event is saved.
+ * Such updates are kept and applied on the next syncs, up to MAX_ATTEMPTS,
+ * so the final frame count and end time of an event are not lost.
+ */
+class EventSync {
+  constructor(intervalSeconds = EVENT_SYNC_INTERVAL) {
+    this.intervalMs = intervalSeconds * 1000;
+    // Cursor of the last update applied; 0 fetches everything the server still has
+    this.cursor = 0;
+    // Event id -> { event, attempts } of updates whose result was not found yet
+    this.pending = new Map();
+    this.timer = null;
+    this.syncing = false;
+  }
+
+  start() {
+    if (!EVENT_AGGREGATION || this.timer) {
+      return;
+    }
+    logger.info(`Event sync started, every ${this.intervalMs / 1000}s`);
+    this.timer = setInterval(() => this.sync(), this.intervalMs);
+  }
+
+  stop() {
+    if (this.timer) {
+      clearInterval(this.timer);
+      this.timer = null;
+    }
+  }
+
+  /**
+   * Fetch the events changed since the last sync and update their results
+   * @returns {Promise<number>} Number of results updated
+   */
+  async sync() {
+    if (this.syncing) {
+      return 0;
+    }
+    this.syncing = true;
+    let updated = 0;
+    try {
+      let more = true;
+      while (more) {
+        const batch = await visionProcessor.eventUpdates(this.cursor);
+        if (!batch) {
+          break;
+        }
+        // A newer update of an event replaces the one still waiting
+        for (const event of batch.events) {
+          if (mongoose.Types.ObjectId.isValid(event.id)) {
+            this.pending.set(event.id, { event, attempts: 0 });
+          }
+        }
+        this.cursor = batch.cursor;
+        more = batch.more;
+      }
+      updated = await this.applyPending();
+      if (updated) {
+        logger.debug(`Event sync updated ${updated} results`);
+      }
+    } catch (error) {
+      logger.error(`Event sync failed: ${error.message}`);
+    } finally {
+      this.syncing = false;
+    }
+    return updated;
+  }
+
+  /**
+   * Write the waiting updates whose result exists; the others wait for the next sync
+   * @returns {Promise<number>} Number of results updated
+   */
+  async applyPending() {
+    if (!this.pending.size) {
+      return 0;
+    }
+    const ids = [...this.pending.keys()];
+    const stored = await VisionResult.find({ _id: { $in: ids } }).select('_id').lean();
+    const found = new Set(stored.map(doc => String(doc._id)));
+
+    // Updates carry the whole event, so one applied twice changes nothing
+    const operations = [];
+    for (const id of ids) {
+      const entry = this.pending.get(id);
+      if (found.has(id)) {
+        const { event } = entry;
+        operations.push({
+          updateOne: {
+            filter: { _id: id },
+            update: {
+              $set: {
+                eventEnd: new Date(event.end * 1000),
+                frameCount: event.frames,
+                eventClosed: event.closed,
+              },
+            },
+          },
+        });
+        this.pending.delete(id);
+      } else if (++entry.attempts >= MAX_ATTEMPTS) {
+        logger.warn(`Event ${id} has no stored result after ${MAX_ATTEMPTS} syncs, dropping its update`);
+        this.pending.delete(id);
+      }
+    }
+    if (!operations.length) {
+      return 0;
+    }
+    const result = await VisionResult.bulkWrite(operations, { ordered: false });
+    return result.modifiedCount || 0;
+  }
+}
+
+module.exports = new EventSync();
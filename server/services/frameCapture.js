@@ -1,13 +1,21 @@
 // server/services/frameCapture.js
 const { spawn } = require('child_process');
+const crypto = require('crypto');
+const axios = require('axios');
 const { logger } = require('../utils/logger');
 const path = require('path');
 const fs = require('fs').promises;
 const { existsSync } = require('fs');
 const Stream = require('../models/Stream');
 const hlsRecorder = require('./hlsRecorder');
+const { CAPTURE_DAEMON_URL, CAPTURE_DAEMON_INTERVAL, CAPTURE_DAEMON_MAX_AGE } = require('../config/env');
 
 class FrameCapture {
+  constructor() {
+    // Stream id -> URL registered with the capture daemon
+    this.daemonStreams = new Map();
+  }
+
   /**
  * Capture a single frame from a stream, prioritizing local HLS recordings for RTSP streams
  * @param {string} streamUrl - The stream URL
@@ -20,6 +28,14 @@ class FrameCapture {
     console.info(`Stream URL starts with rtsp://: ${streamUrl.startsWith('rtsp://')}`);
     console.info(`Stream URL type: ${typeof streamUrl}`);
 
+    if (CAPTURE_DAEMON_URL && streamUrl) {
+      try {
+        return await this.captureFrameFromDaemon(options.streamId, streamUrl, options);
+      } catch (error) {
+        console.warn(`Capture daemon has no frame, falling back: ${error.message}`);
+      }
+    }
+
     // Check if the URL is RTSP and if we should prioritize local HLS recordings
     if (streamUrl && streamUrl.startsWith('rtsp://') && options.streamId) {
       console.info('Condition passed! Trying to capture from local HLS recording');
@@ -43,6 +59,94 @@ class FrameCapture {
     return this.captureFrameFromRemote(streamUrl, options);
   }
 
+  /**
+   * Take the latest frame the capture daemon holds for a stream, registering the stream on first use
+   * @param {string} streamId - The stream ID; streams without one are keyed by their URL
+   * @param {string} streamUrl - The stream URL
+   * @param {Object} options - Credentials and timeout, as for captureFrameFromRemote
+   * @returns {Promise<Buffer>} - The captured frame as a buffer
+   */
+  async captureFrameFromDaemon(streamId, streamUrl, options = {}) {
+    const id = this.daemonStreamId(streamId, streamUrl);
+    let url = streamUrl;
+    if (options.username && options.password && url.startsWith('rtsp://') && !url.includes('@')) {
+      const urlObj = new URL(url);
+      urlObj.username = options.username;
+      urlObj.password = options.password;
+      url = urlObj.toString();
+    }
+    const timeout = options.timeout || 10000;
+
+    if (this.daemonStreams.get(id) !== url) {
+      await axios.put(`${CAPTURE_DAEMON_URL}/streams/${encodeURIComponent(id)}`, {
+        url,
+        mode: 'interval',
+        interval: CAPTURE_DAEMON_INTERVAL
+      }, { timeout });
+      this.daemonStreams.set(id, url);
+      logger.info(`Registered stream ${id} with the capture daemon`);
+    }
+
+    // A freshly registered stream needs a moment to connect and decode its first keyframe
+    const deadline = Date.now() + timeout;
+    for (;;) {
+      try {
+        const response = await axios.get(`${CAPTURE_DAEMON_URL}/streams/${encodeURIComponent(id)}/frame.jpg`, {
+          params: { max_age: CAPTURE_DAEMON_MAX_AGE },
+          responseType: 'arraybuffer',
+          timeout
+        });
+        return Buffer.from(response.data);
+      } catch (error) {
+        const status = error.response?.status;
+        if (status === 404) {
+          // The daemon restarted and forgot the stream
+          this.daemonStreams.delete(id);
+        }
+        if (status !== 503 || Date.now() + 500 > deadline) {
+          throw error;
+        }
+        await new Promise(resolve => setTimeout(resolve, 500));
+      }
+    }
+  }
+
+  /**
+   * Id of a stream at the capture daemon; streams captured without an id are keyed by their URL
+   */
+  daemonStreamId(streamId, streamUrl) {
+    return streamId
+      ? String(streamId)
+      : `url-${crypto.createHash('sha1').update(streamUrl).digest('hex').slice(0, 16)}`;
+  }
+
+  /**
+   * Stop the capture daemon's connection and decoder of a stream that is stopped or deleted
+   * @param {string} streamId - The stream ID
+   * @param {string} streamUrl - The stream URL, for registrations made without the ID
+   */
+  async releaseStream(streamId, streamUrl) {
+    if (!CAPTURE_DAEMON_URL) {
+      return;
+    }
+    const ids = [this.daemonStreamId(streamId, streamUrl)];
+    if (streamId && streamUrl) {
+      ids.push(this.daemonStreamId(null, streamUrl));
+    }
+    for (const id of ids) {
+      this.daemonStreams.delete(id);
+      try {
+        await axios.delete(`${CAPTURE_DAEMON_URL}/streams/${encodeURIComponent(id)}`, { timeout: 5000 });
+        logger.info(`Released stream ${id} at the capture daemon`);
+      } catch (error) {
+        // 404: never registered, or the daemon restarted since
+        if (error.response?.status !== 404) {
+          logger.warn(`Could not release stream ${id} at the capture daemon: ${error.message}`);
+        }
+      }
+    }
+  }
+
   async captureFrameFromHls(streamId) {
     try {
       // Convert streamId to string if it's not already
@@ -437,6 +541,17 @@ class FrameCapture {
         throw new Error(`Stream not found: ${streamId}`);
       }
 
+      if (CAPTURE_DAEMON_URL) {
+        try {
+          return await this.captureFrameFromDaemon(streamId, stream.url, {
+            username: stream.credentials?.username,
+            password: stream.credentials?.password
+          });
+        } catch (error) {
+          logger.warn(`Capture daemon has no frame for stream ${streamId}, falling back: ${error.message}`);
+        }
+      }
+
       // Check if the stream is RTSP to prioritize local HLS
       const isRtsp = stream.url.startsWith('rtsp://');
 
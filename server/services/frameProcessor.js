@@ -2,6 +2,7 @@
 const { logger } = require('../utils/logger');
 const visionProcessor = require('./visionProcessor');
 const VisionResult = require('../models/VisionResult');
+const mongoose = require('mongoose');
 const Stream = require('../models/Stream');
 const Prompt = require('../models/Prompt');
 const fs = require('fs').promises;
@@ -11,6 +12,7 @@ const Queue = require('bull');
 const sharp = require('sharp'); // Using sharp for image processing instead of OpenCV
 const frameCapture = require('./frameCapture');
 const embeddingService = require('./embeddingService');
+const { EVENT_AGGREGATION, PRESCREEN_ENABLED } = require('../config/env');
 
 // In frameProcessor.js, update this:
 const { createBullRedisClient } = require('../config/redis');
@@ -120,26 +122,41 @@ class FrameProcessor {
         );
 
         const startTime = Date.now();
-        const result = await this.processFrameWithAPI(
-          streamId,
-          promptId,
-          frameBuffer,
-          options
-        );
+        let result;
+        try {
+          result = await this.processFrameWithAPI(
+            streamId,
+            promptId,
+            frameBuffer,
+            options
+          );
+        } catch (error) {
+          // A stale frame is dropped for good, retrying it would only be staler
+          if (error.code === 'DEADLINE_EXCEEDED') {
+            logger.info(`Dropped stale frame for stream ${streamId} (job ${job.id})`);
+            return null;
+          }
+          throw error;
+        }
         const processingTime = Date.now() - startTime;
 
         logger.info(
           `Processed frame for stream ${streamId} in ${processingTime}ms`
         );
 
-        // Save result to database
-        await this.saveResult(
-          streamId,
-          promptId,
-          result,
-          processingTime,
-          frameBuffer
-        );
+        // A frame merged into the stream's open event is only counted there; the event's result is already stored
+        if (result.event?.action === 'merged') {
+          logger.debug(`Frame for stream ${streamId} merged into event ${result.event.id} (${result.event.frames} frames)`);
+        } else {
+          // Save result to database
+          await this.saveResult(
+            streamId,
+            promptId,
+            result,
+            processingTime,
+            frameBuffer
+          );
+        }
 
         // Update last processed time for this stream
         lastProcessedTime[streamId] = Date.now();
@@ -304,6 +321,21 @@ class FrameProcessor {
         return null;
       }
 
+      // Frames the CPU pre-screen finds unremarkable never reach the full model; the cooldown is not started
+      if (PRESCREEN_ENABLED && !options.forceProcess) {
+        const screen = await visionProcessor.prescreen(frameBuffer.toString('base64'), streamId);
+        if (!screen.escalate) {
+          logger.info(`Pre-screen passed over frame for stream ${streamId} (${JSON.stringify(screen.scores)})`);
+          return null;
+        }
+        logger.info(`Pre-screen escalated frame for stream ${streamId}: ${screen.reasons.join(', ')}`);
+      }
+
+      // A frame older than the capture interval is stale, let the VLM drop it
+      if (options.staleAfter) {
+        options.deadline = (Date.now() + options.staleAfter) / 1000;
+      }
+
       // Convert Buffer to base64 string for redis serialization
       const frameBase64 = frameBuffer.toString('base64');
       logger.info(
@@ -353,10 +385,21 @@ class FrameProcessor {
       // Convert buffer to base64
       const base64Image = frameBuffer.toString('base64');
 
+      // The result is saved under the id the vision server indexes the frame under
+      const frameId = new mongoose.Types.ObjectId();
+
       // Send to OpenAI API
       const apiResult = await visionProcessor.processImage(
         base64Image,
-        prompt.content
+        prompt.content,
+        {
+          priority: options.priorityClass || 'live',
+          deadline: options.deadline,
+          streamId,
+          frameId,
+          // Repeated answers of the stream to this prompt become one stored event
+          ...(EVENT_AGGREGATION && { eventKey: promptId })
+        }
       );
 
       // Important: Handle both string and object content formats
@@ -364,6 +407,9 @@ class FrameProcessor {
       return {
         content: apiResult.content, // Could now be a JSON object or string
         usage: apiResult.usage,
+        event: apiResult.event,
+        // An event opened by this frame is named after it, so event updates find the stored result
+        frameId,
         imageBuffer: frameBuffer // Make sure frameBuffer is passed through correctly
       };
     } catch (error) {
@@ -472,6 +518,7 @@ class FrameProcessor {
       }
   
       const visionResult = new VisionResult({
+        ...(result.frameId && { _id: result.frameId }),
         streamId,
         promptId,
         result: stringResponse,
@@ -492,6 +539,11 @@ class FrameProcessor {
       await visionResult.save();
       logger.info(`Saved vision result for stream ${streamId}`);
   
+      if (embedding) {
+        // Not awaited: a slow or missing index must not hold up the frame
+        embeddingService.indexEmbedding(visionResult._id, embedding, streamId, visionResult.timestamp);
+      }
+  
       const globalIo = getIO();
       if (globalIo) {
         broadcastStreamPromptEvent(globalIo, streamId, promptId, visionResult);
@@ -506,6 +558,7 @@ class FrameProcessor {
       // Instead of throwing error, return a partial result without the image
       // Note: We're not generating an embedding for the error case
       const visionResult = new VisionResult({
+        ...(result.frameId && { _id: result.frameId }),
         streamId,
         promptId,
         result: typeof result.content === 'string' ? result.content :
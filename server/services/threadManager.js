@@ -257,7 +257,7 @@ class ThreadManager {
       const interval = setInterval(async () => {
         try {
           // Process a frame
-          await this._processFrame(threadId, streamId, promptId);
+          await this._processFrame(threadId, streamId, promptId, safeInterval);
         } catch (error) {
           logger.error(`Error in processing loop for thread ${threadId}: ${error.message}`);
           
@@ -285,7 +285,7 @@ class ThreadManager {
       
       // Process a frame immediately with error handling
       try {
-        await this._processFrame(threadId, streamId, promptId);
+        await this._processFrame(threadId, streamId, promptId, safeInterval);
       } catch (immediateError) {
         logger.error(`Error in immediate frame processing for thread ${threadId}: ${immediateError.message}`);
       }
@@ -297,7 +297,7 @@ class ThreadManager {
     }
   }
   
-  async _processFrame(threadId, streamId, promptId) {
+  async _processFrame(threadId, streamId, promptId, interval) {
     try {
       logger.debug(`Processing frame for thread ${threadId}`);
       
@@ -315,7 +315,9 @@ class ThreadManager {
         username: stream.credentials?.username,
         password: stream.credentials?.password,
         timeout: 15000,
-        streamId: streamId
+        streamId: streamId,
+        staleAfter: interval,
+        priorityClass: 'live'
       });
       
       logger.debug(`Queued frame for thread ${threadId}, job ID: ${jobId || 'skipped'}`);
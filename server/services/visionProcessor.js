@@ -12,11 +12,16 @@ class VisionProcessor {
     this.endpoint = config.VISION_API_URL || config.VISION_API_URL_REMOTE || config.VLM_API_URL;
     this.model = config.VISION_MODEL || config.VLM_MODEL;
     this.maxTokens = config.VISION_CONTEXT_SIZE || config.VLM_MAX_TOKENS;
+    this.temperature = config.VISION_TEMPERATURE;
     
     // Use chat/completions endpoint for OpenAI-compatible APIs
     if (config.VISION_API_URL || config.VISION_API_URL_REMOTE) {
       this.endpoint = this.endpoint + (this.endpoint.endsWith('/') ? '' : '/') + 'chat/completions';
     }
+    this.apiBase = this.endpoint.replace(/\/chat\/completions\/?$/, '');
+    
+    // Latest capture interval the server recommended per stream: { seconds, at }
+    this.recommendedIntervals = new Map();
     
     this.headers = {
       'Content-Type': 'application/json',
@@ -26,13 +31,29 @@ class VisionProcessor {
     logger.info(`VisionProcessor initialized with endpoint: ${this.endpoint}, model: ${this.model}`);
   }
 
-  async processImage(imageBase64, prompt) {
+  /**
+   * Analyse an image with the vision model
+   * @param {string} imageBase64 - JPEG frame as base64
+   * @param {string} prompt - Prompt text
+   * @param {Object} options - Scheduling hints for the VLM server
+   * @param {string} options.priority - 'alert', 'live' or 'report'
+   * @param {number} options.deadline - Unix time (seconds) after which the result is stale
+   * @param {string} options.streamId - Camera stream, for fair sharing between cameras
+   * @param {string} options.frameId - Id the server indexes the frame under for visual search
+   * @param {string} options.eventKey - Fold the answer into the stream's events for this key (the prompt)
+   */
+  async processImage(imageBase64, prompt, options = {}) {
     try {
       logger.info('Processing image...');
       const response = await axios.post(
         this.endpoint,
         {
           model: this.model,
+          ...(options.priority && { priority: options.priority }),
+          ...(options.deadline && { deadline: options.deadline }),
+          ...(options.streamId && { stream_id: String(options.streamId) }),
+          ...(options.frameId && { frame_id: String(options.frameId) }),
+          ...(options.eventKey && { event_key: String(options.eventKey) }),
           messages: [
             {
               role: "user",
@@ -48,22 +69,44 @@ class VisionProcessor {
               ]
             }
           ],
-          max_tokens: this.maxTokens
+          max_tokens: this.maxTokens,
+          temperature: this.temperature
         },
         { headers: this.headers }
       );
 
+      const recommended = parseFloat(response.headers['x-recommended-interval']);
+      if (options.streamId && Number.isFinite(recommended)) {
+        this.recommendedIntervals.set(String(options.streamId), { seconds: recommended, at: Date.now() });
+      }
+
       const rawContent = response.data.choices[0].message.content;
       
       // Extract and parse JSON content from the model's response
       const parsedContent = this.extractJsonFromResponse(rawContent);
 
+      // 'opened' when the answer starts a new event, 'merged' when the stream's open event already covers it
+      const event = response.headers['x-event-action'] ? {
+        id: response.headers['x-event-id'],
+        action: response.headers['x-event-action'],
+        reason: response.headers['x-event-reason'],
+        frames: parseInt(response.headers['x-event-frames'], 10)
+      } : null;
+
       return {
         content: parsedContent,
         usage: response.data.usage,
+        event,
         processingTime: response.data.created - response.data.created
       };
     } catch (error) {
+      const errorType = error.response?.data?.error?.type;
+      if (error.response?.status === 408 && (errorType === 'deadline_exceeded' || errorType === 'superseded')) {
+        logger.info(`Vision API dropped the frame before analysis (${errorType})`);
+        const expired = new Error('Frame expired before analysis');
+        expired.code = 'DEADLINE_EXCEEDED';
+        throw expired;
+      }
       logger.error(`Vision API error: ${error.message}`);
       if (error.response) {
         logger.error(`Vision API response error: ${JSON.stringify(error.response.data)}`);
@@ -72,6 +115,112 @@ class VisionProcessor {
     }
   }
 
+  /**
+   * Ask the vision server's CPU pre-screen whether a frame is worth the full model
+   * @param {string} imageBase64 - JPEG frame as base64
+   * @param {string} streamId - Camera stream, for the periodic description sample
+   * @returns {Promise<{escalate: boolean, reasons: string[], scores: Object}>} Escalates when the pre-screen is unavailable
+   */
+  async prescreen(imageBase64, streamId) {
+    try {
+      const response = await axios.post(`${this.apiBase}/prescreen`, {
+        image: imageBase64,
+        ...(streamId && { stream_id: String(streamId) })
+      }, {
+        headers: this.headers,
+        timeout: 5000
+      });
+      return response.data;
+    } catch (error) {
+      // Never lose a frame because the pre-screen is down
+      logger.warn(`Pre-screen unavailable, sending the frame to the full model: ${error.message}`);
+      return { escalate: true, reasons: ['unavailable'], scores: {} };
+    }
+  }
+
+  /**
+   * Search the vision server's index of analysed frames by appearance
+   * @param {Object} query - One of text, image (base64) or id (an indexed frame)
+   * @param {Object} options - Search options
+   * @param {string} [options.streamId] - Only frames of this stream
+   * @param {Date|string} [options.fromDate] - Only frames at or after this time
+   * @param {Date|string} [options.toDate] - Only frames at or before this time
+   * @param {number} options.limit - Max results to return
+   * @param {number} [options.threshold] - Minimum similarity
+   * @returns {Promise<Array<{id: string, score: number}>|null>} Hits (empty when the frame is not indexed), or null when the index is unavailable
+   */
+  async searchFrames(query, options = {}) {
+    const { streamId, fromDate, toDate, limit = 20, threshold } = options;
+    try {
+      const response = await axios.post(`${this.apiBase}/frames/search`, {
+        ...query,
+        k: limit,
+        stream: streamId ? String(streamId) : undefined,
+        since: fromDate ? new Date(fromDate).getTime() / 1000 : undefined,
+        until: toDate ? new Date(toDate).getTime() / 1000 : undefined,
+        threshold,
+      }, {
+        headers: this.headers,
+        timeout: 10000
+      });
+      return response.data.data;
+    } catch (error) {
+      if (error.response?.status === 404) {
+        return [];
+      }
+      logger.warn(`Frame search unavailable: ${error.response?.data?.detail || error.message}`);
+      return null;
+    }
+  }
+
+  /**
+   * Events the vision server changed since a cursor (frames merged, events closed)
+   * @param {number} after - Cursor returned by the previous call, 0 for everything the server still has
+   * @returns {Promise<{cursor: number, events: Array, more: boolean}|null>} Updates, or null when the server is unreachable
+   */
+  async eventUpdates(after) {
+    try {
+      const response = await axios.get(`${this.apiBase}/events/updates`, {
+        params: { after },
+        headers: this.headers,
+        timeout: 10000
+      });
+      return response.data;
+    } catch (error) {
+      logger.warn(`Event updates unavailable: ${error.response?.data?.detail || error.message}`);
+      return null;
+    }
+  }
+
+  /**
+   * Capture interval the vision server recommends for a stream under the current load
+   * @param {string} streamId - Camera stream
+   * @param {number} maxAgeMs - Age after which the value from the last answer is refreshed from the server
+   * @returns {Promise<number|null>} Seconds between captures, or null if the server has no recommendation
+   */
+  async getRecommendedInterval(streamId, maxAgeMs) {
+    const id = String(streamId);
+    const latest = this.recommendedIntervals.get(id);
+    if (latest && Date.now() - latest.at <= maxAgeMs) {
+      return latest.seconds;
+    }
+    try {
+      const response = await axios.get(`${this.apiBase}/streams/${encodeURIComponent(id)}/interval`, {
+        headers: this.headers,
+        timeout: 2000
+      });
+      const seconds = response.data?.interval;
+      if (typeof seconds !== 'number') {
+        return null;
+      }
+      this.recommendedIntervals.set(id, { seconds, at: Date.now() });
+      return seconds;
+    } catch (error) {
+      logger.debug(`No recommended interval for stream ${id}: ${error.message}`);
+      return null;
+    }
+  }
+
   /**
    * Extract valid JSON from the model's response text
    * @param {string} text - The text response from the LLM
@@ -9,7 +9,12 @@ from fastapi.middleware.cors import CORSMiddleware
 from contextlib import asynccontextmanager
 import time
 import json
+import asyncio
 from transformers import AutoModel, AutoTokenizer
+from fastapi.responses import FileResponse, JSONResponse
+from profiler import is_admin, parse_options, profiler
+import tracing
+from tracing import Trace, input_sizes
 
 # Global variables for model and tokenizer
 model = None
@@ -99,6 +104,8 @@ async def retrieve_model(model_id: str):
 # Chat completion endpoint
 @app.post("/v1/chat/completions")
 async def chat_completion(request: Request):
+    trace = Trace("chat.completions", request.headers.get("X-Trace-Id"))
+    streaming = False
     try:
         # Check if model is loaded
         if model is None or tokenizer is None:
@@ -106,6 +113,8 @@ async def chat_completion(request: Request):
             
         # Parse request data
         data = await request.json()
+        trace.request_body = data
+        trace.set(**input_sizes(data.get("messages", [])))
         
         model_name = data.get("model", "openbmb/MiniCPM-V-2_6-int4")
         messages = data.get("messages", [])
@@ -139,7 +148,8 @@ async def chat_completion(request: Request):
                         image_url = item["image_url"]
                         if isinstance(image_url, dict) and "url" in image_url:
                             if image_url["url"].startswith("data:image"):
-                                image = decode_base64_image(image_url["url"])
+                                with trace.span("decode"):
+                                    image = decode_base64_image(image_url["url"])
                                 images_in_message.append(image)
                                 # If this is the first image we've seen, use it as the main image
                                 if main_image is None:
@@ -155,6 +165,16 @@ async def chat_completion(request: Request):
         if stream:
             # For streaming responses, we need to implement a streaming response
             async def generate_stream():
+                try:
+                    async for chunk in stream_chunks():
+                        yield chunk
+                except BaseException as e:
+                    trace.set(error=type(e).__name__)
+                    raise
+                finally:
+                    tracing.sink.finish(trace)
+            
+            async def stream_chunks():
                 gen = model.chat(
                     image=main_image,  # Pass the main image
                     msgs=processed_msgs,
@@ -167,9 +187,13 @@ async def chat_completion(request: Request):
                 
                 chunk_id = f"chatcmpl-{int(time.time())}"
                 completion_tokens = 0
+                texts = []
                 
+                # chat() hides the prefill/decode split, so generation is one span
+                started = time.time()
                 for new_text in gen:
                     completion_tokens += 1
+                    texts.append(new_text)
                     chunk = {
                         "id": chunk_id,
                         "object": "chat.completion.chunk",
@@ -186,6 +210,9 @@ async def chat_completion(request: Request):
                         ]
                     }
                     yield f"data: {json.dumps(chunk)}\n\n"
+                trace.add_span("generate", started, time.time())
+                trace.set(completion_tokens=completion_tokens)
+                trace.response_texts = ["".join(texts)]
                 
                 # Send the final chunk with finish_reason
                 final_chunk = {
@@ -205,22 +232,27 @@ async def chat_completion(request: Request):
                 yield "data: [DONE]\n\n"
             
             from fastapi.responses import StreamingResponse
-            return StreamingResponse(generate_stream(), media_type="text/event-stream")
+            streaming = True
+            return StreamingResponse(generate_stream(), media_type="text/event-stream",
+                                     headers={"X-Trace-Id": trace.trace_id})
         else:
-            # Non-streaming response
-            response = model.chat(
-                image=main_image,  # Pass the main image
-                msgs=processed_msgs,
-                tokenizer=tokenizer,
-                sampling=temperature > 0,
-                temperature=temperature,
-                max_tokens=max_tokens,
-                stream=False
-            )
+            # Non-streaming response, recorded while an admin capture window is open
+            with profiler.job(), trace.span("generate"):
+                response = model.chat(
+                    image=main_image,  # Pass the main image
+                    msgs=processed_msgs,
+                    tokenizer=tokenizer,
+                    sampling=temperature > 0,
+                    temperature=temperature,
+                    max_tokens=max_tokens,
+                    stream=False
+                )
         
             # Approximate token count
             completion_tokens = len(tokenizer.encode(response))
             prompt_tokens = sum(len(tokenizer.encode(str(msg.get("content", "")))) for msg in messages)
+            trace.set(prompt_tokens=prompt_tokens, completion_tokens=completion_tokens)
+            trace.response_texts = [response]
             
             # Create response object
             chat_completion = {
@@ -245,10 +277,59 @@ async def chat_completion(request: Request):
                 }
             }
             
-            return chat_completion
+            return JSONResponse(chat_completion, headers={"X-Trace-Id": trace.trace_id})
         
     except Exception as e:
+        trace.set(error=type(e).__name__)
         raise HTTPException(status_code=500, detail=f"Error generating response: {str(e)}")
+    finally:
+        # A streamed response finishes its trace when the last chunk is sent
+        if not streaming:
+            tracing.sink.finish(trace)
+
+# Admin-only profiling of the next N requests or S seconds (see profiler.py)
+def require_admin(request: Request):
+    if not is_admin(request.client.host if request.client else None, request.headers):
+        raise HTTPException(status_code=403, detail="Admin access required")
+
+@app.post("/admin/profile")
+async def start_profile(request: Request):
+    require_admin(request)
+    body = await request.json() if await request.body() else {}
+    try:
+        session = profiler.start(**parse_options(body))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except RuntimeError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    if body.get("wait"):
+        await asyncio.to_thread(session.done.wait)
+        return session.info()
+    return JSONResponse(session.info(), status_code=202)
+
+@app.get("/admin/profile")
+async def get_profile(request: Request):
+    require_admin(request)
+    status = profiler.status()
+    if status is None:
+        raise HTTPException(status_code=404, detail="No profile has been recorded")
+    return status
+
+@app.delete("/admin/profile")
+async def stop_profile(request: Request):
+    require_admin(request)
+    if profiler.session is None:
+        raise HTTPException(status_code=404, detail="No profile is running")
+    session = await asyncio.to_thread(profiler.stop)
+    return session.info()
+
+@app.get("/admin/profile/{profile_id}/{kind}")
+async def download_profile(profile_id: str, kind: str, request: Request):
+    require_admin(request)
+    session = profiler.last
+    if session is None or session.id != profile_id or kind not in session.files:
+        raise HTTPException(status_code=404, detail=f"No {kind} for profile '{profile_id}'")
+    return FileResponse(session.files[kind], media_type="application/json" if kind == "trace" else "text/plain")
 
 # Basic health check endpoint
 @app.get("/health")
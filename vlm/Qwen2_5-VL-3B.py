@@ -1,24 +1,43 @@
 # qwen_vl_api.py
 import os
 import base64
+import asyncio
 import uvicorn
 import logging
 from typing import List, Literal, Optional, Union, Dict, Any
 from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import FileResponse, JSONResponse, StreamingResponse
 from pydantic import BaseModel, Field
-import torch
-from transformers import Qwen2_5_VLForConditionalGeneration, AutoProcessor
-from PIL import Image
-import io
 import time
 import json
-import requests
+import uuid
 from contextlib import asynccontextmanager
 
-# Import utility for processing vision information
-from qwen_vl_utils import process_vision_info
+from qwen_backend import IMAGE_MAX_WIDTH, continuous, estimate_memory, load_session_messages, run_batch, run_completion, run_continuous, run_session_turn
+from continuous_batching import CONTINUOUS_BATCHING
+from admission import AdmissionController
+from embeddings import EmbeddingModel, encode_base64
+from coalescing import SingleFlight, request_key
+from result_cache import ResultCache, result_key
+from scheduler import DEFAULT_PRIORITY, PRIORITY_CLASSES, DeadlineExceeded, InferenceScheduler, Superseded
+from sessions import SessionBusy, SessionStore
+from metrics import metrics
+from pacing import CapturePacer, frame_thumbnail
+from roi import RoiStore
+from mosaic import MosaicPacker, mosaic_frame
+from model_manager import ModelManager
+from clip_encoder import ClipEncoder, decode_image
+from prescreen import create_prescreen
+from frame_index import create_frame_index, frame_source
+from vector_index import NPROBE
+from frame_ring import FrameOverwritten, pin_refs
+from frame_ring import reader as frame_ring_reader
+from profiler import is_admin, parse_options, profiler
+from event_aggregator import events
+import speculative
+import tracing
+from tracing import Trace, input_sizes
 
 # Configure logging
 logging.basicConfig(
@@ -31,9 +50,20 @@ logger = logging.getLogger("qwen-vl-api")
 # Define the lifespan context manager
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    # Load model on startup
-    load_model()
+    # Load the default model on startup; others are loaded in the background on demand
+    manager.start()
+    speculative.load_draft_model()
+    if prescreen.scorer is not None:
+        # The CPU scorer loads beside the VLM; frames are escalated until it is ready
+        asyncio.get_running_loop().run_in_executor(None, prescreen.scorer.prepare)
+    if frame_index is not None:
+        frame_index.start()
+    reaper = asyncio.create_task(reap_sessions())
     yield
+    reaper.cancel()
+    result_cache.close()
+    if frame_index is not None:
+        await asyncio.to_thread(frame_index.close)
     # Clean up resources if needed
     # This section runs on shutdown
 
@@ -48,59 +78,80 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-model = None
-processor = None
+# GPU work runs on a dedicated thread so the event loop keeps accepting
+# requests, and identical requests can attach to a generation in progress.
+# The scheduler orders waiting requests by priority class and deadline,
+# shares the GPU fairly between camera streams and batches compatible
+# requests while they fit the memory budget.
+scheduler = InferenceScheduler(admission=AdmissionController())
+inflight = SingleFlight()
+# Resident models; every model job goes through it so it runs on the model it was submitted for
+manager = ModelManager(scheduler)
+# Finished answers, shared with the other replicas when RESULT_CACHE_REDIS_URL is set
+result_cache = ResultCache()
+# Capture intervals that keep the cameras' total load just under capacity
+pacer = CapturePacer(scheduler)
+# Per-camera regions of interest and 4K tiling, applied before the frame is encoded
+roi = RoiStore()
 
-def load_model():
-    global model, processor
-    if model is None:  # Only load if not already loaded
-        logger.info("Loading Qwen2.5-VL-3B model...")
-        model = Qwen2_5_VLForConditionalGeneration.from_pretrained(
-            "Qwen2.5-VL-3B-Instruct", torch_dtype="auto", device_map="auto"
-        )
-        processor = AutoProcessor.from_pretrained("Qwen2.5-VL-3B-Instruct")
-        logger.info("Model loaded successfully!")
-
-
-# Define model metadata
-MODEL_ID = "Qwen2.5-VL-3B-Instruct"
-MODEL_METADATA = {
-    "id": MODEL_ID,
-    "object": "model",
-    "created": int(time.time()),
-    "owned_by": "alibaba",
-    "permission": [],
-    "root": MODEL_ID,
-    "parent": None,
-}
-
-# Function to resize image to a smaller size
-def resize_image(image_path):
-    try:
-        img = Image.open(image_path)
-        # Convert to RGB if needed
-        if img.mode in ('P', 'RGBA', 'LA'):
-            img = img.convert('RGB')
-        
-        # Calculate new height to maintain aspect ratio
-        width, height = img.size
-        new_width = 800
-        
-        # Only resize if the image is larger than the target width
-        if width > new_width:
-            new_height = int((height / width) * new_width)
-            # Resize image maintaining aspect ratio
-            resized_img = img.resize((new_width, new_height), Image.LANCZOS)
-            # Save the resized image
-            resized_img.save(image_path, format="JPEG")
-            logger.info(f"Resized image from {width}x{height} to {new_width}x{new_height}: {image_path}")
-        else:
-            logger.info(f"No resize needed, image already {width}x{height}: {image_path}")
-            
-        return image_path
-    except Exception as e:
-        logger.error(f"Error resizing image {image_path}: {e}")
-        return None
+def batch_job(max_tokens, temperature):
+    """Function and batching options of a non-streamed generation"""
+    if CONTINUOUS_BATCHING:
+        # Joins the running decode batch at the next step, whatever its length and sampling
+        return run_continuous, {"batch_key": "continuous", "continuous": True}
+    return run_batch, {"batch_key": (max_tokens, temperature)}
+
+# Frames of low-detail cameras share one analysis as cells of a grid image
+async def run_single(messages, max_tokens, temperature, priority, deadline, stream, model):
+    fn, batching = batch_job(max_tokens, temperature)
+    job = manager.submit(
+        model, fn, messages, max_tokens, temperature, None, None,
+        priority=priority,
+        deadline=deadline,
+        expected_tokens=max_tokens,
+        stream=stream,
+        memory=estimate_memory(messages, max_tokens),
+        **batching,
+    )
+    return await asyncio.wrap_future(job.future)
+
+mosaic = MosaicPacker(run_single, width=IMAGE_MAX_WIDTH)
+# Loaded on the first /v1/embeddings request
+embedding_model = EmbeddingModel()
+# CPU image-text model and the frame pre-screen that runs on it before the VLM
+clip_encoder = ClipEncoder()
+prescreen = create_prescreen(clip_encoder)
+# Analysed frames embedded by the same model, searchable by image or text without describing them again
+frame_index = create_frame_index(clip_encoder)
+# Conversations whose KV cache stays on the server between turns
+sessions = SessionStore()
+session_flights = SingleFlight()
+
+async def reap_sessions():
+    while True:
+        await asyncio.sleep(60)
+        sessions.reap()
+
+
+def prompt_text(messages):
+    """Concatenated text parts of the messages, used to estimate the answer length"""
+    texts = []
+    for message in messages:
+        content = message.get("content")
+        if isinstance(content, str):
+            texts.append(content)
+        elif isinstance(content, list):
+            texts.extend(part.get("text", "") for part in content if part.get("type") == "text")
+    return "\n".join(texts)
+
+@app.exception_handler(DeadlineExceeded)
+async def deadline_exception_handler(request: Request, exc: DeadlineExceeded):
+    logger.info(f"Request expired before inference: {exc}")
+    error_type = "superseded" if isinstance(exc, Superseded) else "deadline_exceeded"
+    return JSONResponse(
+        status_code=408,
+        content={"error": {"message": str(exc), "type": error_type}},
+    )
 
 # Custom exception handler
 @app.exception_handler(Exception)
@@ -114,273 +165,599 @@ async def generic_exception_handler(request: Request, exc: Exception):
 @app.get("/v1/models")
 async def list_models():
     """OpenAI-compatible endpoint to list available models"""
-    logger.info("Models list requested")
+    logger.debug("Models list requested")
     return {
         "object": "list",
-        "data": [MODEL_METADATA],
+        "data": manager.models(),
     }
 
 @app.get("/v1/models/{model_id}")
 async def get_model(model_id: str):
     """OpenAI-compatible endpoint to get model information"""
-    logger.info(f"Model information requested for: {model_id}")
-    if model_id.lower() == MODEL_ID or model_id.lower() == "Qwen2.5-VL-3B-Instruct":
-        return MODEL_METADATA
-    else:
-        raise HTTPException(status_code=404, detail=f"Model '{model_id}' not found")
+    logger.debug(f"Model information requested for: {model_id}")
+    for model in manager.models():
+        if model["id"].lower() == model_id.lower():
+            return model
+    raise HTTPException(status_code=404, detail=f"Model '{model_id}' not found")
+
+@app.get("/admin/models")
+async def get_model_status():
+    """Resident models, loads in progress or failed, and the registry"""
+    return manager.status()
+
+@app.post("/admin/models/{model_id}/load")
+async def load_model_in_background(model_id: str, request: Request):
+    """Load a model while the current ones keep serving; with "default": true it takes over once warm"""
+    body = await request.json() if await request.body() else {}
+    try:
+        status = manager.load(model_id, path=body.get("path"), make_default=bool(body.get("default", False)))
+    except ValueError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    return JSONResponse({"id": model_id, "status": status, "default": manager.default},
+                        status_code=202 if status == "loading" else 200)
+
+@app.delete("/admin/models/{model_id}")
+async def unload_model(model_id: str):
+    try:
+        unloaded = manager.unload(model_id)
+    except ValueError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    if not unloaded:
+        raise HTTPException(status_code=404, detail=f"Model '{model_id}' is not resident")
+    return {"id": model_id, "unloaded": True}
+
+def require_admin(request: Request):
+    if not is_admin(request.client.host if request.client else None, request.headers):
+        raise HTTPException(status_code=403, detail="Admin access required")
+
+@app.post("/admin/profile")
+async def start_profile(request: Request):
+    """Record the next N jobs or S seconds with the torch profiler and Python sampling; "wait": true returns the summary"""
+    require_admin(request)
+    body = await request.json() if await request.body() else {}
+    try:
+        session = profiler.start(**parse_options(body))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except RuntimeError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    if body.get("wait"):
+        await asyncio.to_thread(session.done.wait)
+        return session.info()
+    return JSONResponse(session.info(), status_code=202)
+
+@app.get("/admin/profile")
+async def get_profile(request: Request):
+    """The running capture window, or the last one with its summary"""
+    require_admin(request)
+    status = profiler.status()
+    if status is None:
+        raise HTTPException(status_code=404, detail="No profile has been recorded")
+    return status
+
+@app.delete("/admin/profile")
+async def stop_profile(request: Request):
+    """Close the running capture window now and write its files"""
+    require_admin(request)
+    if profiler.session is None:
+        raise HTTPException(status_code=404, detail="No profile is running")
+    session = await asyncio.to_thread(profiler.stop)
+    return session.info()
+
+@app.get("/admin/profile/{profile_id}/{kind}")
+async def download_profile(profile_id: str, kind: Literal["trace", "summary"], request: Request):
+    """Chrome trace or hotspot summary of a finished capture window"""
+    require_admin(request)
+    session = profiler.last
+    if session is None or session.id != profile_id or kind not in session.files:
+        raise HTTPException(status_code=404, detail=f"No {kind} for profile '{profile_id}'")
+    return FileResponse(session.files[kind], media_type="application/json" if kind == "trace" else "text/plain")
 
 @app.post("/v1/chat/completions")
 async def create_chat_completion(request: Request):
+    # Get the raw request body
+    body = await request.json()
+    trace = Trace("chat.completions", request.headers.get("X-Trace-Id"))
+    
+    # Unknown names go to the default model; a registered one that is not loaded yet answers 503
+    model_name = manager.resolve(body.get("model"))
+    messages = body.get("messages", [])
+    max_tokens = body.get("max_tokens", 256)
+    temperature = body.get("temperature", 0.7)
+    n = body.get("n", 1)
+    stream = body.get("stream", False)
+    # Scheduling hints: priority class and the unix time after which the answer is stale
+    priority = body.get("priority", DEFAULT_PRIORITY)
+    deadline = body.get("deadline")
+    # Camera stream the frame belongs to, for fair sharing between cameras
+    stream_id = body.get("stream_id") or request.headers.get("X-Stream-Id")
+    
+    # One trace per request replaces the per-step log lines; slow requests keep their body for replay
+    trace.request_body = body
+    trace.set(model=model_name, max_tokens=max_tokens, temperature=temperature, stream=stream,
+              priority=priority, stream_id=stream_id, **input_sizes(messages))
+    
+    if priority not in PRIORITY_CLASSES:
+        raise HTTPException(status_code=400, detail=f"Invalid priority '{priority}', expected one of {list(PRIORITY_CLASSES)}")
+    if deadline is not None:
+        deadline = float(deadline)
+    # Frames named as ring://<camera> become the camera's current frame, read from shared memory later
     try:
-        # Get the raw request body
-        body = await request.json()
-        logger.info(f"Received request with model: {body.get('model', 'Qwen2.5-VL-3B-Instruct')}")
-        
-        model_name = body.get("model", "Qwen2.5-VL-3B-Instruct")
-        messages = body.get("messages", [])
-        max_tokens = body.get("max_tokens", 256)
-        temperature = body.get("temperature", 0.7)
-        n = body.get("n", 1)
-        stream = body.get("stream", False)
-        
-        logger.info(f"Request parameters: max_tokens={max_tokens}, temperature={temperature}, n={n}, stream={stream}")
-        
-        if stream:
-            logger.warning("Streaming requested but not supported")
-            raise HTTPException(status_code=400, detail="Streaming is not supported yet")
-        
-        # Convert OpenAI-style messages to Qwen format
-        logger.info(f"Converting {len(messages)} messages to Qwen format")
-        qwen_messages = []
-        temp_files = []  # Track temporary files for cleanup
-        
-        for i, message in enumerate(messages):
-            role = message.get("role")
-            content = message.get("content")
-            
-            logger.info(f"Processing message {i+1} with role: {role}")
-            
-            if isinstance(content, str):
-                logger.debug(f"Simple text message: {content[:50]}...")
-                qwen_messages.append({
-                    "role": role,
-                    "content": [{"type": "text", "text": content}]
-                })
-            else:  # List of content parts
-                logger.info(f"Processing multipart message with {len(content)} parts")
-                qwen_content = []
-                for j, part in enumerate(content):
-                    part_type = part.get("type")
-                    logger.info(f"Processing part {j+1} of type: {part_type}")
-                    
-                    if part_type == "text":
-                        text_content = part.get("text", "")
-                        logger.debug(f"Text content: {text_content[:50]}...")
-                        qwen_content.append({"type": "text", "text": text_content})
-                    
-                    elif part_type == "image":
-                        logger.info("Processing direct image object")
-                        image_data = part.get("image", None)
-                        if image_data:
-                            temp_img_path = f"temp_img_{time.time()}.jpg"
-                            logger.info(f"Saving image to temporary file: {temp_img_path}")
-                            with open(temp_img_path, "wb") as img_file:
-                                img_file.write(base64.b64decode(image_data))
-                            
-                            # Resize image to smaller size
-                            temp_img_path = resize_image(temp_img_path)
-                            temp_files.append(temp_img_path)
-                            
-                            qwen_content.append({
-                                "type": "image",
-                                "image": temp_img_path
-                            })
-                    
-                    elif part_type == "image_url":
-                        logger.info("Processing image_url object")
-                        image_url = part.get("image_url", {})
-                        
-                        if isinstance(image_url, dict):
-                            url = image_url.get("url", "")
-                            logger.info(f"Image URL: {url[:100]}...")
-                            
-                            if url.startswith("data:"):
-                                logger.info("Processing base64 data URL")
-                                try:
-                                    # Extract the base64 part
-                                    img_data = url.split(",", 1)[1]
-                                    temp_img_path = f"temp_img_{time.time()}.jpg"
-                                    logger.info(f"Saving base64 image to: {temp_img_path}")
-                                    with open(temp_img_path, "wb") as img_file:
-                                        img_file.write(base64.b64decode(img_data))
-                                    
-                                    # Resize image to smaller size
-                                    temp_img_path = resize_image(temp_img_path)
-                                    temp_files.append(temp_img_path)
-                                    
-                                    qwen_content.append({
-                                        "type": "image",
-                                        "image": temp_img_path
-                                    })
-                                except Exception as e:
-                                    logger.error(f"Error processing base64 image: {e}", exc_info=True)
-                                    raise HTTPException(status_code=400, detail=f"Invalid base64 image: {str(e)}")
-                            else:
-                                # Regular URL - download or use directly
-                                try:
-                                    # For URLs, you might want to download the image first
-                                    if url.startswith(("http://", "https://")):
-                                        logger.info(f"Downloading image from URL: {url}")
-                                        response = requests.get(url, stream=True)
-                                        if response.status_code == 200:
-                                            temp_img_path = f"temp_img_{time.time()}.jpg"
-                                            logger.info(f"Saving downloaded image to: {temp_img_path}")
-                                            with open(temp_img_path, "wb") as img_file:
-                                                for chunk in response.iter_content(1024):
-                                                    img_file.write(chunk)
-                                            
-                                            # Resize image to smaller size
-                                            temp_img_path = resize_image(temp_img_path)
-                                            temp_files.append(temp_img_path)
-                                            
-                                            qwen_content.append({
-                                                "type": "image",
-                                                "image": temp_img_path
-                                            })
-                                        else:
-                                            logger.error(f"Failed to download image, status code: {response.status_code}")
-                                            raise HTTPException(status_code=400, detail=f"Failed to download image from URL: {url}")
-                                    else:
-                                        # Local file path
-                                        logger.info(f"Using local image file: {url}")
-                                        # Resize local image file
-                                        url = resize_image(url)
-                                        qwen_content.append({
-                                            "type": "image",
-                                            "image": url
-                                        })
-                                except Exception as e:
-                                    logger.error(f"Error processing image URL: {e}", exc_info=True)
-                                    raise HTTPException(status_code=400, detail=f"Error processing image URL: {str(e)}")
-                
-                qwen_messages.append({
-                    "role": role,
-                    "content": qwen_content
-                })
-        
-        # Prepare input for the model
-        logger.info("Applying chat template")
-        text = processor.apply_chat_template(
-            qwen_messages, tokenize=False, add_generation_prompt=True
-        )
-        
-        # Process vision inputs
-        logger.info("Processing vision information")
-        image_inputs, video_inputs = process_vision_info(qwen_messages)
-
-        logger.info("Preparing inputs for the model")
-        inputs = processor(
-            text=[text],
-            images=image_inputs,
-            videos=video_inputs,
-            padding=True,
-            return_tensors="pt",
-        )
+        messages = pin_refs(messages, frame_ring_reader)
+    except (FrameOverwritten, ValueError) as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    
+    headers = {"X-Trace-Id": trace.trace_id}
+    if frame_index is not None:
+        # Embedded in batches off the request path; the caller keeps the id to find the frame again
+        source = frame_source(messages)
+        frame_id = str(body.get("frame_id") or request.headers.get("X-Frame-Id") or uuid.uuid4().hex)
+        if source is not None and frame_index.submit(frame_id, source, stream_id, body.get("timestamp")):
+            headers["X-Frame-Id"] = frame_id
+    if stream_id:
+        # Camera frames feed the scene-change rate; the answer tells the producer when to send the next one
+        pacer.observe(stream_id, await asyncio.to_thread(frame_thumbnail, messages))
+        interval = pacer.recommend(stream_id)
+        if interval is not None:
+            headers["X-Recommended-Interval"] = str(interval)
+        # Only the camera's regions of interest (or changed tiles) become visual tokens
+        with trace.span("roi") as attrs:
+            messages, visual = await asyncio.to_thread(roi.apply, stream_id, messages, IMAGE_MAX_WIDTH)
+            attrs["applied"] = visual is not None
+        if visual is not None:
+            trace.set(visual_tokens_before=visual["before"], visual_tokens_after=visual["after"])
+            headers["X-Visual-Tokens"] = f"{visual['before']}->{visual['after']}"
+    
+    # Low-detail cameras wait briefly to be analysed together with other cameras in one grid image
+    use_mosaic = not stream and n == 1 and mosaic.enabled(stream_id, body.get("mosaic"))
+    
+    # A frame another request (or replica) already answered is served from the cache;
+    # grid-cell answers are cached apart from full-detail ones, "cache": false skips it
+    cache_key = None
+    if not stream and body.get("cache", True) is not False:
+        cache_key = result_key(messages, model=model_name, max_tokens=max_tokens, temperature=temperature, n=n, mosaic=use_mosaic)
+    if cache_key is not None:
+        with trace.span("cache") as attrs:
+            cached, tier = await result_cache.get(cache_key)
+            attrs["hit"] = tier
+        if cached is not None:
+            trace.set(cache=tier)
+            trace.response_texts = cached["output_texts"]
+            tracing.sink.finish(trace)
+            observe_event(body, request, stream_id, cached, headers)
+            return JSONResponse(build_response(cached, model_name), headers={**headers, "X-Cache": f"hit-{tier}"})
+    
+    if use_mosaic:
+        frame = await asyncio.to_thread(mosaic_frame, messages)
+        if frame is not None:
+            try:
+                with trace.span("mosaic") as attrs:
+                    result = await mosaic.submit(frame, messages, stream_id, max_tokens, temperature, priority, deadline, model_name)
+                    attrs.update(result.get("mosaic", {"cells": 1}))
+                trace.response_texts = result["output_texts"]
+                if cache_key is not None:
+                    result_cache.put(cache_key, result)
+                observe_event(body, request, stream_id, result, headers)
+                return JSONResponse(build_response(result, model_name), headers=headers)
+            except BaseException as e:
+                trace.set(error=type(e).__name__)
+                raise
+            finally:
+                tracing.sink.finish(trace)
+    
+    # Requests for the same image, prompt and parameters share one generation
+    key = request_key(messages, model=model_name, max_tokens=max_tokens, temperature=temperature, n=n)
+    flight, leader = inflight.join(key)
+    text = prompt_text(messages)
+    trace.set(coalesced=not leader)
+    trace.queued_at = time.time()
+    if leader:
+        # Streamed requests run alone so their tokens can be sent as they are generated
+        fn, batching = (run_completion, {}) if stream else batch_job(max_tokens, temperature)
+        try:
+            flight.job = manager.submit(
+                model_name, fn,
+                messages, max_tokens, temperature, flight.publish, trace,
+                priority=priority,
+                deadline=deadline,
+                expected_tokens=scheduler.lengths.expected(text, max_tokens),
+                stream=stream_id,
+                memory=estimate_memory(messages, max_tokens),
+                **batching,
+            )
+        except BaseException as e:
+            # Unloaded since resolve() or a full queue: no job will ever finish this flight
+            inflight.abandon(flight, e)
+            trace.set(error=type(e).__name__)
+            tracing.sink.finish(trace)
+            raise
+        inflight.run(flight, asyncio.wrap_future(flight.job.future))
+    else:
+        logger.debug(f"Attached to in-flight generation {key[:12]}")
+        flight.job = scheduler.promote(flight.job, priority, deadline)
+    
+    if stream:
+        return StreamingResponse(stream_completion(flight, model_name, trace), media_type="text/event-stream", headers=headers)
+    
+    try:
+        with trace.span("wait"):
+            result = await flight.wait()
+        if leader:
+            scheduler.lengths.update(text, result["completion_tokens"])
+            if cache_key is not None:
+                result_cache.put(cache_key, result)
+        with trace.span("response"):
+            response = build_response(result, model_name)
+        trace.response_texts = result["output_texts"]
+    except BaseException as e:
+        trace.set(error=type(e).__name__)
+        raise
+    finally:
+        tracing.sink.finish(trace)
+    observe_event(body, request, stream_id, result, headers)
+    return JSONResponse(response, headers=headers)
 
-        # Handle None values
-        image_inputs = image_inputs if image_inputs is not None else []
-        video_inputs = video_inputs if video_inputs is not None else None
-        logger.info(f"Processed {len(image_inputs)} images and {len(video_inputs or [])} videos")
-        
-        # Move inputs to the appropriate device
-        device = next(model.parameters()).device
-        logger.info(f"Moving inputs to device: {device}")
-        inputs = {k: v.to(device) for k, v in inputs.items()}
-        #inputs = inputs.to("cuda")
-        
-        # Generate response
-        logger.info(f"Generating response with max_new_tokens={max_tokens}, temperature={temperature}")
-        start_time = time.time()
-        generated_ids = model.generate(
-            **inputs, 
-            max_new_tokens=max_tokens
-        )
-        generation_time = time.time() - start_time
-        logger.info(f"Response generated in {generation_time:.2f} seconds")
-        
-        # Decode the generated tokens
-        logger.info("Decoding generated tokens")
-        generated_ids_trimmed = [
-            out_ids[len(in_ids):] for in_ids, out_ids in zip(inputs["input_ids"], generated_ids)
-        ]
-        
-        output_texts = processor.batch_decode(
-            generated_ids_trimmed, skip_special_tokens=True, clean_up_tokenization_spaces=False
-        )
+def observe_event(body, request, stream_id, result, headers):
+    """Fold a camera's answer into its current event when the caller asked for it with event_key"""
+    key = body.get("event_key")
+    if key is None or not stream_id or not result.get("output_texts"):
+        return
+    # The caller's id for the frame names the event it opens, so the stored result can be updated later
+    event = events.observe(stream_id, str(key), result["output_texts"][0], body.get("timestamp"),
+                           body.get("frame_id") or request.headers.get("X-Frame-Id"))
+    headers["X-Event-Id"] = str(event["event_id"])
+    headers["X-Event-Action"] = event["action"]
+    headers["X-Event-Frames"] = str(event["frames"])
+    if event["reason"]:
+        headers["X-Event-Reason"] = event["reason"]
 
-        # Clean up temporary image files
-        logger.info(f"Cleaning up {len(temp_files)} temporary files")
-        for temp_file in temp_files:
-            try:
-                os.remove(temp_file)
-                logger.debug(f"Removed temporary file: {temp_file}")
-            except Exception as e:
-                logger.warning(f"Error removing temp file {temp_file}: {e}")
-        
-        # Create response
-        logger.info("Creating API response")
-        choices = []
-        for i, output_text in enumerate(output_texts):
-            logger.debug(f"Output text {i+1}: {output_text[:100]}...")
-            choices.append({
-                "index": i,
-                "message": {
-                    "role": "assistant",
-                    "content": output_text
-                },
-                "finish_reason": "stop"
-            })
-        
-        # Estimate token counts (this is a simplification)
-        prompt_tokens = len(inputs["input_ids"][0])
-        completion_tokens = sum(len(ids) for ids in generated_ids_trimmed)
-        total_tokens = prompt_tokens + completion_tokens
-        logger.info(f"Token usage - prompt: {prompt_tokens}, completion: {completion_tokens}, total: {total_tokens}")
-        
-        response = {
-            "id": f"chatcmpl-{int(time.time())}",
-            "object": "chat.completion",
+def build_response(result, model_name):
+    """Create the OpenAI-compatible response for a finished generation"""
+    choices = []
+    for i, output_text in enumerate(result["output_texts"]):
+        logger.debug(f"Output text {i+1}: {output_text[:100]}...")
+        choices.append({
+            "index": i,
+            "message": {
+                "role": "assistant",
+                "content": output_text
+            },
+            "finish_reason": "stop"
+        })
+    
+    prompt_tokens = result["prompt_tokens"]
+    completion_tokens = result["completion_tokens"]
+    return {
+        "id": f"chatcmpl-{int(time.time())}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": model_name,
+        "choices": choices,
+        "usage": {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens
+        }
+    }
+
+async def stream_completion(flight, model_name, trace=None):
+    """Server-sent events for a generation, shared by every subscriber of the flight"""
+    chunk_id = f"chatcmpl-{int(time.time())}"
+    
+    def make_chunk(delta, finish_reason=None):
+        return {
+            "id": chunk_id,
+            "object": "chat.completion.chunk",
             "created": int(time.time()),
             "model": model_name,
-            "choices": choices,
-            "usage": {
-                "prompt_tokens": prompt_tokens,
-                "completion_tokens": completion_tokens,
-                "total_tokens": total_tokens
-            }
+            "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]
         }
-        
-        # Clear GPU memory after generation
-        del inputs
-        del generated_ids
-        del generated_ids_trimmed
-        torch.cuda.empty_cache()
-        logger.info("Cleared GPU memory after generation")
-
-        logger.info("Request completed successfully")
-        return response
     
+    texts = []
+    try:
+        async for text in flight.stream():
+            texts.append(text)
+            yield f"data: {json.dumps(make_chunk({'content': text}))}\n\n"
+    except HTTPException as e:
+        yield f"data: {json.dumps({'error': {'message': e.detail, 'type': 'HTTPException'}})}\n\n"
+    except DeadlineExceeded as e:
+        error_type = "superseded" if isinstance(e, Superseded) else "deadline_exceeded"
+        yield f"data: {json.dumps({'error': {'message': str(e), 'type': error_type}})}\n\n"
+    else:
+        yield f"data: {json.dumps(make_chunk({}, 'stop'))}\n\n"
+    finally:
+        if trace is not None:
+            trace.response_texts = ["".join(texts)]
+            tracing.sink.finish(trace)
+    yield "data: [DONE]\n\n"
+
+@app.post("/v1/sessions")
+async def create_session(request: Request):
+    """Start a conversation whose images and KV cache stay on the server between turns"""
+    body = await request.json() if await request.body() else {}
+    messages = body.get("messages", [])
+    if not isinstance(messages, list):
+        raise HTTPException(status_code=400, detail="messages must be a list")
+    # Earlier messages (e.g. a system prompt) are prefilled with the first turn
+    model_id = manager.resolve(body.get("model"))
+    qwen_messages = await asyncio.to_thread(load_session_messages, messages)
+    session = sessions.create(qwen_messages)
+    session.model_id = model_id
+    logger.info(f"Created session {session.id}")
+    return session.info()
+
+@app.get("/v1/sessions/{session_id}")
+async def get_session(session_id: str):
+    session = sessions.get(session_id)
+    if session is None:
+        raise HTTPException(status_code=404, detail=f"Session '{session_id}' not found")
+    return session.info()
+
+@app.delete("/v1/sessions/{session_id}")
+async def delete_session(session_id: str):
+    if not sessions.remove(session_id):
+        raise HTTPException(status_code=404, detail=f"Session '{session_id}' not found")
+    return {"id": session_id, "object": "session", "deleted": True}
+
+@app.post("/v1/sessions/{session_id}/messages")
+async def create_session_message(session_id: str, request: Request):
+    """Answer the next user message of a session; only the new message is prefilled"""
+    body = await request.json()
+    trace = Trace("sessions.messages", request.headers.get("X-Trace-Id"))
+    
+    content = body.get("content")
+    max_tokens = body.get("max_tokens", 256)
+    temperature = body.get("temperature", 0.7)
+    stream = body.get("stream", False)
+    priority = body.get("priority", DEFAULT_PRIORITY)
+    if not content:
+        raise HTTPException(status_code=400, detail="content is required")
+    if priority not in PRIORITY_CLASSES:
+        raise HTTPException(status_code=400, detail=f"Invalid priority '{priority}', expected one of {list(PRIORITY_CLASSES)}")
+    
+    try:
+        session = sessions.checkout(session_id)
+    except SessionBusy as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    if session is None:
+        raise HTTPException(status_code=404, detail=f"Session '{session_id}' not found")
+    
+    # A session stays on the model it was created for; if that model was unloaded, the
+    # conversation continues on the default model and its KV cache is rebuilt
+    if not manager.is_resident(session.model_id):
+        session.drop_cache()
+        session.model_id = manager.default
+    model_name = session.model_id
+    message = {"role": "user", "content": content}
+    trace.request_body = body
+    trace.set(model=model_name, session_id=session_id, turn=session.turns, max_tokens=max_tokens,
+              temperature=temperature, stream=stream, priority=priority, **input_sizes([message]))
+    text = prompt_text([message])
+    # A checked out session has no other turn running, so this request always leads its flight
+    flight, _ = session_flights.join(session_id)
+    trace.queued_at = time.time()
+    flight.job = manager.submit(
+        model_name, run_session_turn,
+        session, message, max_tokens, temperature, flight.publish if stream else None, trace,
+        priority=priority,
+        expected_tokens=scheduler.lengths.expected(text, max_tokens),
+        stream=body.get("stream_id") or "sessions",
+    )
+    future = asyncio.wrap_future(flight.job.future)
+    # The session is released when the turn ends, even if the client went away
+    future.add_done_callback(lambda _: sessions.checkin(session))
+    session_flights.run(flight, future)
+    
+    headers = {"X-Trace-Id": trace.trace_id, "X-Session-Id": session_id}
+    if stream:
+        return StreamingResponse(stream_completion(flight, model_name, trace), media_type="text/event-stream", headers=headers)
+    
+    try:
+        with trace.span("wait"):
+            result = await flight.wait()
+        scheduler.lengths.update(text, result["completion_tokens"])
+        with trace.span("response"):
+            response = build_response(result, model_name)
+            response["session_id"] = session_id
+            response["usage"]["prompt_tokens_details"] = {"cached_tokens": result["cached_tokens"]}
+    except BaseException as e:
+        trace.set(error=type(e).__name__)
+        raise
+    finally:
+        tracing.sink.finish(trace)
+    return JSONResponse(response, headers=headers)
+
+@app.post("/v1/embeddings")
+async def create_embeddings(request: Request):
+    """OpenAI-compatible embeddings for one text or a list of texts"""
+    body = await request.json()
+    inputs = body.get("input")
+    encoding_format = body.get("encoding_format", "float")
+    if isinstance(inputs, str):
+        inputs = [inputs]
+    if not isinstance(inputs, list) or not inputs or not all(isinstance(text, str) for text in inputs):
+        raise HTTPException(status_code=400, detail="input must be a string or a non-empty list of strings")
+    if encoding_format not in ("float", "base64"):
+        raise HTTPException(status_code=400, detail="encoding_format must be 'float' or 'base64'")
+    priority = body.get("priority", "report")
+    if priority not in PRIORITY_CLASSES:
+        raise HTTPException(status_code=400, detail=f"Invalid priority '{priority}', expected one of {list(PRIORITY_CLASSES)}")
+    
+    # Backfills are background work: they share the GPU with frames at report priority,
+    # and are never superseded however many callers send at once
+    job = scheduler.submit(
+        embedding_model.embed, inputs,
+        priority=priority,
+        expected_tokens=0,
+        stream="embeddings",
+        supersede=False,
+    )
+    vectors, tokens = await asyncio.wrap_future(job.future)
+    metrics.inc("embedding_inputs_total", len(inputs))
+    
+    data = []
+    for i, vector in enumerate(vectors):
+        embedding = encode_base64(vector) if encoding_format == "base64" else vector.tolist()
+        data.append({"object": "embedding", "index": i, "embedding": embedding})
+    return {
+        "object": "list",
+        "data": data,
+        "model": body.get("model", embedding_model.name),
+        "usage": {"prompt_tokens": tokens, "total_tokens": tokens},
+    }
+
+@app.post("/v1/prescreen")
+async def prescreen_frame(request: Request):
+    """Whether a frame is worth the VLM, from the CPU scorer's per-flag suspicion scores"""
+    body = await request.json()
+    image = body.get("image")
+    if not isinstance(image, str) or not image:
+        raise HTTPException(status_code=400, detail="image must be a base64 image or data URL")
+    stream_id = body.get("stream_id") or request.headers.get("X-Stream-Id")
+    if prescreen.scorer is None:
+        return {"escalate": True, "reasons": ["disabled"], "scores": {}}
+    try:
+        img = await asyncio.to_thread(decode_image, image)
     except Exception as e:
-        logger.error(f"Error generating completion: {str(e)}", exc_info=True)
-        if isinstance(e, HTTPException):
-            raise e
-        raise HTTPException(status_code=500, detail=f"Error generating completion: {str(e)}")
+        raise HTTPException(status_code=400, detail=f"Invalid image: {e}")
+    # Off the inference thread: the scorer runs on the CPU next to the GPU work
+    return await asyncio.to_thread(prescreen.screen, img, stream_id)
+
+@app.get("/v1/prescreen")
+async def prescreen_stats():
+    """Pass rate and thresholds of the pre-screen"""
+    return prescreen.stats()
+
+def require_frame_index():
+    if frame_index is None:
+        raise HTTPException(status_code=503, detail="Frame index is disabled, set FRAME_INDEX_ENABLED=true")
+    return frame_index
+
+@app.post("/v1/frames")
+async def index_frames(request: Request):
+    """Embed and index frames in batches, e.g. to backfill saved captures"""
+    index = require_frame_index()
+    body = await request.json()
+    items = body.get("items", [])
+    if not items:
+        raise HTTPException(status_code=400, detail="items is required")
+    try:
+        entries = [(str(item["id"]), item["image"], item.get("stream"), float(item.get("timestamp") or time.time()))
+                   for item in items]
+    except (KeyError, TypeError, ValueError) as e:
+        raise HTTPException(status_code=400, detail=f"Invalid items: {e}")
+    added = await asyncio.to_thread(index.add, entries)
+    return {"added": added, "skipped": len(entries) - added, "frames": len(index.index)}
+
+@app.post("/v1/frames/search")
+async def search_frames(request: Request):
+    """Frames most similar to an image, a text or an indexed frame, optionally within a stream and time range"""
+    index = require_frame_index()
+    body = await request.json()
+    threshold = body.get("threshold")
+    try:
+        hits = await asyncio.to_thread(
+            index.search,
+            image=body.get("image"),
+            text=body.get("text"),
+            frame_id=body.get("id"),
+            k=int(body.get("k", 10)),
+            nprobe=int(body.get("nprobe", NPROBE)),
+            stream=body.get("stream"),
+            since=body.get("since"),
+            until=body.get("until"),
+            exact=bool(body.get("exact", False)),
+        )
+    except RuntimeError as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    except KeyError as e:
+        raise HTTPException(status_code=404, detail=f"Frame {e} is not indexed")
+    except FrameOverwritten as e:
+        raise HTTPException(status_code=410, detail=str(e))
+    except (ValueError, OSError) as e:
+        raise HTTPException(status_code=400, detail=f"Invalid query: {e}")
+    if threshold is not None:
+        hits = [hit for hit in hits if hit["score"] >= float(threshold)]
+    metrics.inc("frame_index_searches_total")
+    return {"object": "list", "data": hits}
+
+@app.get("/v1/frames/stats")
+async def frame_index_stats():
+    return require_frame_index().stats()
+
+@app.get("/v1/events/updates")
+async def event_updates(after: int = 0, limit: int = 1000):
+    """Events changed since the cursor, for the storage writer to apply in one bulk write"""
+    return events.updates(after, limit)
+
+@app.get("/v1/events/stats")
+async def event_stats():
+    return events.stats()
+
+@app.get("/v1/batching/stats")
+async def batching_stats():
+    """Continuous batching: throughput, running and waiting sequences, KV page use and preemptions"""
+    return continuous.stats()
 
 @app.get("/health")
 async def health_check():
-    logger.info("Health check requested")
+    logger.debug("Health check requested")
     return {"status": "ok"}
 
+@app.put("/v1/streams/{stream_id}/weight")
+async def set_stream_weight(stream_id: str, request: Request):
+    """Change the share of inference time a camera stream gets under load"""
+    body = await request.json()
+    try:
+        weight = float(body.get("weight"))
+        scheduler.set_weight(stream_id, weight)
+    except (TypeError, ValueError) as e:
+        raise HTTPException(status_code=400, detail=f"Invalid weight: {e}")
+    logger.info(f"Stream {stream_id} weight set to {weight}")
+    return {"stream_id": stream_id, "weight": weight}
+
+@app.get("/v1/streams/intervals")
+async def get_capture_intervals():
+    """Recommended capture interval of every active camera, with the capacity they share"""
+    return pacer.snapshot()
+
+@app.get("/v1/streams/{stream_id}/interval")
+async def get_capture_interval(stream_id: str):
+    """Recommended seconds between captures of a camera; null until the server has measured its capacity"""
+    return pacer.info(stream_id)
+
+@app.get("/v1/streams/{stream_id}/roi")
+async def get_stream_roi(stream_id: str):
+    """Regions of interest and tiling mode of a camera"""
+    settings = roi.get(stream_id)
+    if settings is None:
+        raise HTTPException(status_code=404, detail=f"No regions of interest for stream '{stream_id}'")
+    return {"stream_id": stream_id, **settings}
+
+@app.put("/v1/streams/{stream_id}/roi")
+async def set_stream_roi(stream_id: str, request: Request):
+    """Set the regions of interest (relative rects or polygons) and tiling mode of a camera"""
+    body = await request.json()
+    try:
+        roi.set(stream_id, body)
+    except (TypeError, ValueError, KeyError) as e:
+        raise HTTPException(status_code=400, detail=f"Invalid regions of interest: {e}")
+    logger.info(f"Stream {stream_id} regions of interest updated")
+    return {"stream_id": stream_id, **roi.get(stream_id)}
+
+@app.delete("/v1/streams/{stream_id}/roi")
+async def delete_stream_roi(stream_id: str):
+    """Send the camera's whole frames again"""
+    if roi.get(stream_id) is None:
+        raise HTTPException(status_code=404, detail=f"No regions of interest for stream '{stream_id}'")
+    roi.set(stream_id, None)
+    return {"stream_id": stream_id, "deleted": True}
+
+@app.get("/metrics")
+async def get_metrics():
+    """Counters, gauges and summaries collected by the server"""
+    return metrics.snapshot()
+
 if __name__ == "__main__":
     logger.info("Starting Qwen2.5-VL API server on port 8881")
     uvicorn.run("Qwen2_5-VL-3B:app", host="0.0.0.0", port=8881, log_level="info")
\ No newline at end of file
@@ -5,14 +5,12 @@ import io
 import os
 import tempfile
 import json
-from openai import OpenAI
+import requests
 from PIL import Image
 
-# Initialize OpenAI client with the local Qwen API
-client = OpenAI(
-    api_key="not-needed",  # Not used but required by the client
-    base_url="http://localhost:8000/v1"  # Point to your local Qwen2.5-VL API
-)
+# Local Qwen2.5-VL API. The conversation lives in a server-side session, so
+# every turn only sends the new message and the server keeps the KV cache
+API_BASE = "http://localhost:8000/v1"
 
 def encode_image_to_base64(image_path):
     """Convert an image file to base64 encoding"""
@@ -26,27 +24,41 @@ def process_uploaded_files(files):
         image_paths.append(file.name)
     return image_paths
 
-def chat_with_qwen(message, files, chat_history=None):
-    """Send a message and optional images to the Qwen2.5-VL API and return the response"""
-    if chat_history is None:
-        chat_history = []
-    
-    # Prepare messages from chat history
+def create_session(chat_history):
+    """Start a server-side session, replaying the text of an earlier conversation if there is one"""
     messages = []
     for human_msg, ai_msg in chat_history:
         messages.append({"role": "user", "content": human_msg})
         messages.append({"role": "assistant", "content": ai_msg})
+    response = requests.post(f"{API_BASE}/sessions", json={"messages": messages})
+    response.raise_for_status()
+    return response.json()["id"]
+
+def send_turn(session_id, request_json):
+    """Post one user message to the session; None when the server no longer has the session"""
+    response = requests.post(f"{API_BASE}/sessions/{session_id}/messages", json=request_json)
+    if response.status_code == 404:
+        return None
+    response.raise_for_status()
+    return response.json()
+
+def chat_with_qwen(message, files, chat_history=None, session=None):
+    """Send a message and the newly uploaded images to the session and return the response"""
+    if chat_history is None:
+        chat_history = []
+    if session is None:
+        session = {"id": None, "sent_files": []}
     
-    # Prepare the current message
-    current_message = {"role": "user"}
+    # Images already sent in an earlier turn are part of the session
+    new_files = [file for file in (files or []) if file.name not in session["sent_files"]]
     
     # Create content with images and text (putting text at the end)
-    if files and len(files) > 0:
+    if new_files:
         content = []
         
         # Add image file names and the images themselves first
         file_names = []
-        for file in files:
+        for file in new_files:
             try:
                 file_name = os.path.basename(file.name)
                 file_names.append(file_name)
@@ -62,19 +74,14 @@ def chat_with_qwen(message, files, chat_history=None):
         files_info = "Files: " + ", ".join(file_names)
         user_message = f"{files_info}\n\n{message}" if file_names else message
         content.append({"type": "text", "text": user_message})
-        
-        current_message["content"] = content
     else:
         # Text-only message
-        current_message["content"] = message
-    
-    # Add current message to the list
-    messages.append(current_message)
+        content = message
     
     # Create request JSON for display
     request_json = {
         "model": "qwen2.5-vl",
-        "messages": messages,
+        "content": content,
         "max_tokens": 512,
         "temperature": 0.7
     }
@@ -83,27 +90,34 @@ def chat_with_qwen(message, files, chat_history=None):
     formatted_json = json.dumps(request_json, indent=2)
     
     try:
-        # Call the API
-        response = client.chat.completions.create(
-            model="qwen2.5-vl",
-            messages=messages,
-            max_tokens=512
-        )
+        if session["id"] is None:
+            session["id"] = create_session(chat_history)
+        response = send_turn(session["id"], request_json)
+        if response is None:
+            # The server evicted the idle session: start over with the text history and resend every image
+            session = {"id": create_session(chat_history), "sent_files": []}
+            return chat_with_qwen(message, files, chat_history, session)
         
         # Extract the response text
-        ai_message = response.choices[0].message.content
+        ai_message = response["choices"][0]["message"]["content"]
+        session["sent_files"].extend(file.name for file in new_files)
         
         # Update chat history
         chat_history.append((message, ai_message))
-        return "", files, chat_history, formatted_json
+        return "", files, chat_history, formatted_json, session
         
     except Exception as e:
-        return "", files, chat_history + [(message, f"Error: {str(e)}")], formatted_json
+        return "", files, chat_history + [(message, f"Error: {str(e)}")], formatted_json, session
 
-def clear_conversation():
+def clear_conversation(session=None):
     """Clear the conversation history but keep uploaded files"""
+    if session and session["id"]:
+        try:
+            requests.delete(f"{API_BASE}/sessions/{session['id']}")
+        except Exception as e:
+            print(f"Error deleting session {session['id']}: {e}")
     # Return empty chat history but keep files and images
-    return [], None, [], None
+    return [], None, [], None, None
 
 # Create the Gradio interface
 with gr.Blocks(title="Qwen2.5-VL Chat Interface") as demo:
@@ -124,26 +138,27 @@ with gr.Blocks(title="Qwen2.5-VL Chat Interface") as demo:
             submit_button = gr.Button("Send")
             
             json_output = gr.JSON(label="Request JSON", visible=True)
+            session_state = gr.State(None)
     
     # Set up the interaction
     submit_button.click(
         chat_with_qwen,
-        inputs=[text_input, file_output, chatbot],
-        outputs=[text_input, file_output, chatbot, json_output]
+        inputs=[text_input, file_output, chatbot, session_state],
+        outputs=[text_input, file_output, chatbot, json_output, session_state]
     )
     
     # Also allow Enter key to submit
     text_input.submit(
         chat_with_qwen,
-        inputs=[text_input, file_output, chatbot],
-        outputs=[text_input, file_output, chatbot, json_output]
+        inputs=[text_input, file_output, chatbot, session_state],
+        outputs=[text_input, file_output, chatbot, json_output, session_state]
     )
     
-    # Clear conversation button - only clears chat history
+    # Clear conversation button - clears chat history and ends the server session
     clear_button.click(
         clear_conversation,
-        inputs=[],
-        outputs=[chatbot, file_output, image_output, json_output]
+        inputs=[session_state],
+        outputs=[chatbot, file_output, image_output, json_output, session_state]
     )
 
 if __name__ == "__main__":
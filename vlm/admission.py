@@ -0,0 +1,186 @@
+# vlm/admission.py
+"""
+Memory-budget admission control for the inference thread.
+
+Each request gets a memory estimate from its image pixels and token
+budget. The scheduler only adds a request to the running batch while the
+probe's current usage plus the estimates of the batch fit the configured
+budget. When a generation still runs out of memory, the batch size is
+halved and grown back one step after a run of successful batches
+(additive increase, multiplicative decrease), so the server degrades to
+smaller batches instead of failing under load.
+
+The probe is pluggable: ``CudaMemoryProbe`` reads the CUDA caching
+allocator, ``RssMemoryProbe`` reads the resident set size of the process
+for CPU deployments.
+
+Configuration (environment variables):
+    MEMORY_BUDGET_MB          budget for the process (default: 90% of the
+                              GPU, or 80% of system RAM on CPU)
+    MAX_BATCH_SIZE            upper bound of the adaptive batch size (default: 8)
+    KV_BYTES_PER_TOKEN        KV cache bytes per token (default: Qwen2.5-VL-3B in bf16)
+    VISION_BYTES_PER_PIXEL    vision encoder activation bytes per input pixel (default: 400)
+"""
+
+import logging
+import os
+import threading
+from typing import Optional
+
+from metrics import metrics
+
+logger = logging.getLogger("admission")
+
+# 36 layers x 2 (key, value) x 2 KV heads x 128 head dim x 2 bytes
+KV_BYTES_PER_TOKEN = int(os.environ.get("KV_BYTES_PER_TOKEN", str(36 * 2 * 2 * 128 * 2)))
+VISION_BYTES_PER_PIXEL = int(os.environ.get("VISION_BYTES_PER_PIXEL", "400"))
+MAX_BATCH_SIZE = int(os.environ.get("MAX_BATCH_SIZE", "8"))
+
+# Pixels covered by one visual token of Qwen2.5-VL (28 x 28 after patch merging)
+PIXELS_PER_VISUAL_TOKEN = 28 * 28
+
+
+class MemoryProbe:
+    """Reports memory in use and the total available to the process, in bytes."""
+
+    def used(self) -> int:
+        raise NotImplementedError
+
+    def total(self) -> int:
+        raise NotImplementedError
+
+
+class CudaMemoryProbe(MemoryProbe):
+    """Memory held by live tensors on a CUDA device (cached free blocks are reusable)."""
+
+    def __init__(self, device: int = 0):
+        import torch
+        self.torch = torch
+        self.device = device
+
+    def used(self) -> int:
+        return self.torch.cuda.memory_allocated(self.device)
+
+    def total(self) -> int:
+        return self.torch.cuda.get_device_properties(self.device).total_memory
+
+
+class RssMemoryProbe(MemoryProbe):
+    """Resident set size of this process, for CPU-only deployments."""
+
+    def used(self) -> int:
+        with open("/proc/self/statm") as f:
+            resident_pages = int(f.read().split()[1])
+        return resident_pages * os.sysconf("SC_PAGE_SIZE")
+
+    def total(self) -> int:
+        return os.sysconf("SC_PHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+
+
+def default_probe() -> MemoryProbe:
+    """CUDA probe when a GPU is available, process RSS otherwise."""
+    try:
+        import torch
+        if torch.cuda.is_available():
+            return CudaMemoryProbe()
+    except ImportError:
+        pass
+    return RssMemoryProbe()
+
+
+def estimate_request_bytes(pixels: int, prompt_tokens: int, max_tokens: int) -> int:
+    """
+    Estimate the peak memory a request adds on top of the model weights.
+
+    Args:
+        pixels: Total pixels of the request's images after resizing.
+        prompt_tokens: Text tokens of the prompt.
+        max_tokens: Maximum tokens to generate.
+    """
+    visual_tokens = pixels // PIXELS_PER_VISUAL_TOKEN
+    sequence = prompt_tokens + visual_tokens + max_tokens
+    return sequence * KV_BYTES_PER_TOKEN + pixels * VISION_BYTES_PER_PIXEL
+
+
+def is_out_of_memory(exc: BaseException) -> bool:
+    """True for CUDA out-of-memory errors and host allocation failures."""
+    if isinstance(exc, MemoryError):
+        return True
+    try:
+        import torch
+        if isinstance(exc, torch.cuda.OutOfMemoryError):
+            return True
+    except (ImportError, AttributeError):
+        pass
+    return "out of memory" in str(exc).lower()
+
+
+class AdmissionController:
+    """
+    Decide how many requests may run together.
+
+    Args:
+        probe: Memory probe, ``default_probe()`` when omitted.
+        budget_bytes: Budget for the whole process, ``MEMORY_BUDGET_MB`` or a
+            fraction of the probe's total when omitted.
+        max_batch_size: Upper bound of the adaptive batch size.
+        grow_after: Successful batches needed before the batch size grows.
+    """
+
+    def __init__(self, probe: Optional[MemoryProbe] = None, budget_bytes: Optional[int] = None,
+                 max_batch_size: int = MAX_BATCH_SIZE, grow_after: int = 10):
+        self.probe = probe or default_probe()
+        if budget_bytes is None:
+            budget_mb = os.environ.get("MEMORY_BUDGET_MB")
+            if budget_mb:
+                budget_bytes = int(float(budget_mb) * 1024 * 1024)
+            else:
+                fraction = 0.9 if isinstance(self.probe, CudaMemoryProbe) else 0.8
+                budget_bytes = int(self.probe.total() * fraction)
+        self.budget_bytes = budget_bytes
+        self.max_batch_size = max(1, max_batch_size)
+        self.batch_size = self.max_batch_size
+        self.grow_after = grow_after
+        self._successes = 0
+        self._lock = threading.Lock()
+        metrics.set("admission_budget_bytes", self.budget_bytes)
+        metrics.set("admission_batch_size", self.batch_size)
+
+    def headroom(self) -> int:
+        """Bytes that may still be committed to new work."""
+        used = self.probe.used()
+        metrics.set("admission_memory_used_bytes", used)
+        return self.budget_bytes - used
+
+    def fits(self, committed_bytes: int) -> bool:
+        """True when work needing ``committed_bytes`` in total can run now."""
+        return committed_bytes <= self.headroom()
+
+    def record_success(self) -> None:
+        with self._lock:
+            self._successes += 1
+            if self._successes >= self.grow_after and self.batch_size < self.max_batch_size:
+                self.batch_size += 1
+                self._successes = 0
+                logger.info(f"Batch size raised to {self.batch_size}")
+            metrics.set("admission_batch_size", self.batch_size)
+
+    def record_oom(self, batch_len: int) -> None:
+        """Shrink the batch size after an out-of-memory failure of ``batch_len`` requests."""
+        with self._lock:
+            self.batch_size = max(1, min(self.batch_size, batch_len) // 2)
+            self._successes = 0
+            metrics.inc("admission_oom_total")
+            metrics.set("admission_batch_size", self.batch_size)
+        logger.warning(f"Out of memory with {batch_len} requests, batch size lowered to {self.batch_size}")
+        release_cached_memory()
+
+
+def release_cached_memory() -> None:
+    """Return cached allocator blocks to the device, only worth it after an OOM."""
+    try:
+        import torch
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+    except ImportError:
+        pass
@@ -0,0 +1,229 @@
+# vlm/bench_continuous.py
+"""
+Continuous batching against static batching, on the CPU with a small model.
+
+Runs the continuous batching engine (continuous_batching.py) with its
+paged KV cache (paged_kv_cache.py) on a small text-only causal LM, e.g.
+SmolLM2-135M-Instruct or Qwen2.5-0.5B-Instruct, so the engine can be
+checked and measured without a GPU or the VLM:
+
+    --check   greedy answers of the engine are compared token by token
+              with ``model.generate`` run on each prompt alone; the
+              engine runs with a small pool so that some sequences are
+              preempted and prefilled again on the way
+    default   a mix of short answers (yes/no, a few JSON fields) and long
+              descriptions is generated once in padded static batches of
+              ``--batch`` requests and once by the engine, through an
+              InferenceScheduler as in the server, and the wall time,
+              tokens per second, mean batch size, KV page use and
+              preemptions are printed
+
+Usage:
+    python bench_continuous.py --model HuggingFaceTB/SmolLM2-135M-Instruct --check
+    python bench_continuous.py --model Qwen/Qwen2.5-0.5B-Instruct --requests 64 --batch 16 --kv-mb 64
+"""
+
+import argparse
+import random
+import sys
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+import torch
+from transformers import AutoModelForCausalLM, AutoTokenizer
+
+from continuous_batching import ContinuousBatcher, Sequence, StepRunner
+from paged_kv_cache import KVPagePool, PagedKVCache
+from scheduler import InferenceScheduler
+
+SCENES = [
+    "an empty parking lot at night", "two people talking at a shop counter", "a delivery van at a gate",
+    "a corridor with a wet floor sign", "a person lying on the ground next to a bicycle",
+    "smoke coming out of a kitchen window", "a crowded train platform", "a cat walking across a driveway",
+]
+SHORT = 'Answer only with JSON {{"person": true or false, "fire": true or false}} for this scene: {scene}'
+LONG = "Describe this security camera scene in detail, with everything a guard should know: {scene}"
+
+
+class TextStepRunner(StepRunner):
+    """Prefill and decode steps of a text-only causal LM over the paged KV cache."""
+
+    def __init__(self, model, tokenizer):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.pool: Optional[KVPagePool] = None
+        eos = model.generation_config.eos_token_id
+        self._eos = set(eos if isinstance(eos, list) else [eos])
+        self.batch_sizes: List[int] = []
+
+    def open(self, page_size: int, memory_bytes: int) -> int:
+        if self.pool is None:
+            self.pool = KVPagePool.for_model(self.model, page_size, memory_bytes)
+        return self.pool.pages
+
+    def prepare(self, messages: List[Dict[str, Any]], trace) -> Tuple[torch.Tensor, int]:
+        ids = self.tokenizer.apply_chat_template(messages, add_generation_prompt=True, return_tensors="pt")
+        return ids, int(ids.shape[-1])
+
+    def prefill(self, seq: Sequence) -> int:
+        ids = seq.prompt
+        if len(seq.generated) > 1:
+            ids = torch.cat([ids, torch.tensor([seq.generated[:-1]], dtype=ids.dtype)], dim=-1)
+        cache = PagedKVCache(self.pool, [seq.pages], [0], ids.shape[-1])
+        with torch.inference_mode():
+            logits = self.model(
+                input_ids=ids, attention_mask=cache.attention_mask,
+                position_ids=torch.arange(ids.shape[-1]).unsqueeze(0),
+                past_key_values=cache, cache_position=cache.cache_position, use_cache=True,
+            ).logits
+        return int(torch.argmax(logits[0, -1]))
+
+    def decode(self, seqs: List[Sequence]) -> List[int]:
+        self.batch_sizes.append(len(seqs))
+        cache = PagedKVCache(self.pool, [seq.pages for seq in seqs], [seq.cached for seq in seqs], 1)
+        with torch.inference_mode():
+            logits = self.model(
+                input_ids=torch.tensor([[seq.generated[-1]] for seq in seqs]),
+                attention_mask=cache.attention_mask,
+                position_ids=torch.tensor([[seq.cached] for seq in seqs]),
+                past_key_values=cache, cache_position=cache.cache_position, use_cache=True,
+            ).logits
+        return torch.argmax(logits[:, -1], dim=-1).tolist()
+
+    def is_end(self, token: int) -> bool:
+        return token in self._eos
+
+    def result(self, seq: Sequence) -> Dict[str, Any]:
+        return {
+            "output_texts": [self.tokenizer.decode(seq.generated, skip_special_tokens=True)],
+            "prompt_tokens": seq.prompt_tokens,
+            "completion_tokens": len(seq.generated),
+            "tokens": list(seq.generated),
+        }
+
+
+def make_requests(count: int, short_tokens: int, long_tokens: int, seed: int) -> List[Tuple[list, int]]:
+    """Chat messages and max_tokens; three short answers for every long one, as from cameras."""
+    rng = random.Random(seed)
+    requests = []
+    for i in range(count):
+        scene = rng.choice(SCENES)
+        if i % 4 == 3:
+            requests.append(([{"role": "user", "content": LONG.format(scene=scene)}], long_tokens))
+        else:
+            requests.append(([{"role": "user", "content": SHORT.format(scene=scene)}], short_tokens))
+    return requests
+
+
+def run_engine(engine: ContinuousBatcher, requests) -> Tuple[List[Dict[str, Any]], float]:
+    scheduler = InferenceScheduler(name="bench", max_queue_per_stream=len(requests))
+    started = time.perf_counter()
+    jobs = [scheduler.submit(engine.run, messages, max_tokens, 0.0, None, None,
+                             batch_key="bench", continuous=True, expected_tokens=max_tokens)
+            for messages, max_tokens in requests]
+    results = [job.future.result() for job in jobs]
+    return results, time.perf_counter() - started
+
+
+def run_static(model, tokenizer, requests, batch: int) -> Tuple[List[int], float]:
+    """Padded batches of ``batch`` requests in arrival order, each run until its longest answer is done."""
+    tokenizer.padding_side = "left"
+    if tokenizer.pad_token is None:
+        tokenizer.pad_token = tokenizer.eos_token
+    completion_tokens = []
+    started = time.perf_counter()
+    for start in range(0, len(requests), batch):
+        chunk = requests[start:start + batch]
+        texts = [tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
+                 for messages, _ in chunk]
+        inputs = tokenizer(texts, return_tensors="pt", padding=True)
+        # One max_new_tokens per batch: the static batch has to serve its longest request
+        max_tokens = max(max_tokens for _, max_tokens in chunk)
+        with torch.inference_mode():
+            output = model.generate(**inputs, max_new_tokens=max_tokens, do_sample=False,
+                                    pad_token_id=tokenizer.pad_token_id)
+        new = output[:, inputs["input_ids"].shape[-1]:]
+        for row, (_, limit) in enumerate(chunk):
+            completion_tokens.append(min(int((new[row] != tokenizer.pad_token_id).sum()), limit))
+    return completion_tokens, time.perf_counter() - started
+
+
+def check(model, tokenizer, args) -> int:
+    """Greedy engine answers against model.generate per prompt; the number of mismatches."""
+    requests = make_requests(args.requests, args.short_tokens, args.long_tokens, args.seed)
+    runner = TextStepRunner(model, tokenizer)
+    # A small pool, so sequences are preempted and prefilled again
+    page_bytes = KVPagePool.for_model(model, args.page_size, 0).memory_bytes
+    engine = ContinuousBatcher(runner, max_sequences=args.batch, page_size=args.page_size,
+                               memory_bytes=page_bytes * args.check_pages)
+    results, _ = run_engine(engine, requests)
+    mismatches = 0
+    for i, ((messages, max_tokens), result) in enumerate(zip(requests, results)):
+        ids = tokenizer.apply_chat_template(messages, add_generation_prompt=True, return_tensors="pt")
+        with torch.inference_mode():
+            expected = model.generate(ids, attention_mask=torch.ones_like(ids), max_new_tokens=max_tokens,
+                                      do_sample=False)[0, ids.shape[-1]:].tolist()
+        if result["tokens"] != expected:
+            mismatches += 1
+            same = next((n for n, (a, b) in enumerate(zip(result["tokens"], expected)) if a != b),
+                        min(len(result["tokens"]), len(expected)))
+            print(f"request {i}: differs from token {same} of {len(expected)}", file=sys.stderr)
+    stats = engine.stats()
+    print(f"{len(requests) - mismatches}/{len(requests)} answers identical to generate; "
+          f"{stats['preemptions']} preemptions in a pool of {stats['kv_pages']} pages")
+    return mismatches
+
+
+def bench(model, tokenizer, args) -> None:
+    requests = make_requests(args.requests, args.short_tokens, args.long_tokens, args.seed)
+    print(f"{len(requests)} requests, batch {args.batch}, {torch.get_num_threads()} threads", file=sys.stderr)
+
+    print("Static batches...", file=sys.stderr)
+    static_tokens, static_seconds = run_static(model, tokenizer, requests, args.batch)
+
+    print("Continuous batching...", file=sys.stderr)
+    runner = TextStepRunner(model, tokenizer)
+    engine = ContinuousBatcher(runner, max_sequences=args.batch, page_size=args.page_size,
+                               memory_bytes=int(args.kv_mb * 2**20))
+    results, engine_seconds = run_engine(engine, requests)
+    engine_tokens = sum(result["completion_tokens"] for result in results)
+    stats = engine.stats()
+
+    print(f"\n{'':<12} {'seconds':>9} {'tokens':>8} {'tokens/s':>9} {'batch':>7}")
+    print(f"{'static':<12} {static_seconds:>9.2f} {sum(static_tokens):>8} "
+          f"{sum(static_tokens) / static_seconds:>9.1f} {args.batch:>7}")
+    mean_batch = sum(runner.batch_sizes) / len(runner.batch_sizes) if runner.batch_sizes else 0
+    print(f"{'continuous':<12} {engine_seconds:>9.2f} {engine_tokens:>8} "
+          f"{engine_tokens / engine_seconds:>9.1f} {mean_batch:>7.1f}")
+    print(f"\nKV pool {stats['kv_pages']} pages of {args.page_size} tokens, "
+          f"{stats['preemptions']} preemptions, {stats['steps']} decode steps")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Continuous batching with a paged KV cache on a small model")
+    parser.add_argument("--model", default="HuggingFaceTB/SmolLM2-135M-Instruct", help="small causal LM")
+    parser.add_argument("--check", action="store_true", help="compare greedy answers with model.generate")
+    parser.add_argument("--requests", type=int, default=32)
+    parser.add_argument("--batch", type=int, default=8, help="static batch size and engine sequences")
+    parser.add_argument("--short-tokens", type=int, default=24, help="max_tokens of short answers")
+    parser.add_argument("--long-tokens", type=int, default=192, help="max_tokens of descriptions")
+    parser.add_argument("--page-size", type=int, default=16)
+    parser.add_argument("--kv-mb", type=float, default=256, help="KV page pool of the benchmark")
+    parser.add_argument("--check-pages", type=int, default=48, help="KV pool of --check, in pages")
+    parser.add_argument("--threads", type=int, help="torch CPU threads")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    print(f"Loading {args.model}...", file=sys.stderr)
+    tokenizer = AutoTokenizer.from_pretrained(args.model)
+    model = AutoModelForCausalLM.from_pretrained(args.model, torch_dtype=torch.float32).eval()
+
+    if args.check:
+        sys.exit(1 if check(model, tokenizer, args) else 0)
+    bench(model, tokenizer, args)
+
+
+if __name__ == "__main__":
+    main()
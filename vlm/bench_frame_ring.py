@@ -0,0 +1,238 @@
+# vlm/bench_frame_ring.py
+"""
+Benchmark frame handoff between two processes.
+
+A producer process hands synthetic camera frames to a consumer process
+that needs them as decoded images, the way the capture daemon hands
+frames to the VLM server. Three paths are compared:
+
+    ring-rgb24   raw RGB frames through a shared-memory ring (frame_ring.py)
+    ring-jpeg    JPEG frames through a shared-memory ring
+    base64-json  JPEG, base64 and JSON over a local socket, like an HTTP request body
+
+For each path the consumer measures the handoff latency (frame written
+until the consumer holds it, before decoding), the total latency (until
+the decoded image is ready) and both sides their CPU time per frame. The copy table counts the full-frame copies each path makes
+between the producer's decoded frame and the consumer's image, with the
+bytes moved per frame.
+
+Usage:
+    python bench_frame_ring.py
+    python bench_frame_ring.py --size 4k --frames 200 --rate 15 --paths ring-jpeg base64-json
+"""
+
+import argparse
+import base64
+import io
+import json
+import multiprocessing
+import socket
+import struct
+import sys
+import time
+from typing import Any, Dict, List
+
+import numpy as np
+from PIL import Image
+
+from frame_ring import FrameOverwritten, FrameRingReader, FrameRingWriter
+
+PATHS = ("ring-rgb24", "ring-jpeg", "base64-json")
+SIZES = {"720p": (1280, 720), "1080p": (1920, 1080), "4k": (3840, 2160)}
+PREFIX = "bench-frame-ring"
+CAMERA = "bench"
+NOTIFY_PATH = "/tmp/bench-frame-ring.sock"
+
+
+def synthetic_frame(width: int, height: int, seed: int) -> np.ndarray:
+    """Gradient, blocks and sensor noise, so JPEG works about as hard as on camera footage."""
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:height, 0:width].astype(np.float32)
+    frame = np.stack([x / width * 180, y / height * 160, (x + y) / (width + height) * 200], axis=-1)
+    for _ in range(12):
+        x0, y0 = rng.integers(0, width), rng.integers(0, height)
+        frame[y0:y0 + height // 8, x0:x0 + width // 8] = rng.integers(0, 255, 3)
+    frame += rng.normal(0, 6, frame.shape)
+    return np.clip(frame, 0, 255).astype(np.uint8)
+
+
+def ring_consumer(ready, results, frames: int, idle_timeout: float) -> None:
+    reader = FrameRingReader(PREFIX)
+    reader.listen(NOTIFY_PATH)
+    ready.set()
+    latencies, handoffs, cpu, received, last = [], [], 0.0, 0, 0
+    while True:
+        try:
+            seq = reader.wait(CAMERA, last, idle_timeout)
+        except FrameOverwritten:
+            seq = None
+        if seq is None:
+            break
+        start = time.process_time()
+        try:
+            with reader.frame(CAMERA, seq) as frame:
+                handoffs.append(time.time() - frame.timestamp)
+                img = frame.image()
+                img.load()
+                timestamp = frame.timestamp
+        except FrameOverwritten:
+            last = seq
+            continue
+        cpu += time.process_time() - start
+        latencies.append(time.time() - timestamp)
+        received += 1
+        last = seq
+        if seq >= frames:
+            break
+    reader.close()
+    results.put({"latencies": latencies, "handoffs": handoffs[:len(latencies)], "consumer_cpu": cpu,
+                 "received": received})
+
+
+def socket_consumer(ready, results, port_queue, frames: int, idle_timeout: float) -> None:
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(("127.0.0.1", 0))
+    server.listen(1)
+    port_queue.put(server.getsockname()[1])
+    ready.set()
+    connection, _ = server.accept()
+    connection.settimeout(idle_timeout)
+    stream = connection.makefile("rb")
+    latencies, handoffs, cpu, received = [], [], 0.0, 0
+    while received < frames:
+        try:
+            header = stream.read(4)
+        except socket.timeout:
+            break
+        if len(header) < 4:
+            break
+        body = stream.read(struct.unpack("<I", header)[0])
+        start = time.process_time()
+        message = json.loads(body)
+        handoffs.append(time.time() - message["timestamp"])
+        img = Image.open(io.BytesIO(base64.b64decode(message["image"].split(",", 1)[1])))
+        img.load()
+        cpu += time.process_time() - start
+        latencies.append(time.time() - message["timestamp"])
+        received += 1
+    connection.close()
+    server.close()
+    results.put({"latencies": latencies, "handoffs": handoffs, "consumer_cpu": cpu, "received": received})
+
+
+def produce(path: str, pool: List[np.ndarray], args, send) -> float:
+    """Send the frames at the requested rate; returns the producer's CPU seconds."""
+    cpu = 0.0
+    period = 1.0 / args.rate if args.rate > 0 else 0.0
+    started = time.time()
+    for i in range(args.frames):
+        due = started + i * period
+        if due > time.time():
+            time.sleep(due - time.time())
+        frame = pool[i % len(pool)]
+        start = time.process_time()
+        send(frame)
+        cpu += time.process_time() - start
+    return cpu
+
+
+def encode_jpeg(frame: np.ndarray) -> bytes:
+    buffer = io.BytesIO()
+    Image.fromarray(frame).save(buffer, format="JPEG", quality=90)
+    return buffer.getvalue()
+
+
+def run_path(path: str, pool: List[np.ndarray], args) -> Dict[str, Any]:
+    height, width = pool[0].shape[:2]
+    ready, results = multiprocessing.Event(), multiprocessing.Queue()
+    if path.startswith("ring"):
+        writer = FrameRingWriter(PREFIX, slots=args.slots, slot_bytes=width * height * 3, notify_path=NOTIFY_PATH)
+        consumer = multiprocessing.Process(target=ring_consumer, args=(ready, results, args.frames, 2.0))
+        consumer.start()
+        ready.wait()
+        if path == "ring-rgb24":
+            def send(frame):
+                writer.write(CAMERA, frame, width, height, "rgb24")
+        else:
+            def send(frame):
+                writer.write(CAMERA, encode_jpeg(frame), width, height, "jpeg")
+        producer_cpu = produce(path, pool, args, send)
+        outcome = results.get(timeout=60)
+        writer.close()
+    else:
+        port_queue = multiprocessing.Queue()
+        consumer = multiprocessing.Process(target=socket_consumer,
+                                           args=(ready, results, port_queue, args.frames, 2.0))
+        consumer.start()
+        ready.wait()
+        connection = socket.create_connection(("127.0.0.1", port_queue.get()))
+
+        def send(frame):
+            data = base64.b64encode(encode_jpeg(frame)).decode("ascii")
+            body = json.dumps({"timestamp": time.time(), "image": f"data:image/jpeg;base64,{data}"}).encode("utf-8")
+            connection.sendall(struct.pack("<I", len(body)) + body)
+
+        producer_cpu = produce(path, pool, args, send)
+        outcome = results.get(timeout=60)
+        connection.close()
+    consumer.join(timeout=10)
+    outcome["producer_cpu"] = producer_cpu
+    return outcome
+
+
+def copy_table(frame: np.ndarray) -> Dict[str, List[tuple]]:
+    """Full-frame copies between the producer's frame and the consumer's image, with their sizes."""
+    raw = frame.nbytes
+    jpeg = len(encode_jpeg(frame))
+    b64 = (jpeg + 2) // 3 * 4
+    return {
+        "ring-rgb24": [("frame -> slot", raw), ("slot -> image", raw)],
+        "ring-jpeg": [("encode", jpeg), ("jpeg -> slot", jpeg), ("slot -> decoder", jpeg), ("decode", raw)],
+        "base64-json": [("encode", jpeg), ("base64", b64), ("json body", b64), ("socket send", b64),
+                        ("socket receive", b64), ("json parse", b64), ("base64 decode", jpeg),
+                        ("decoder input", jpeg), ("decode", raw)],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Frame handoff benchmark: shared-memory ring vs base64 JSON")
+    parser.add_argument("--size", choices=list(SIZES), default="1080p")
+    parser.add_argument("--frames", type=int, default=300, help="frames sent per path")
+    parser.add_argument("--rate", type=float, default=30.0, help="frames per second; 0 sends as fast as possible")
+    parser.add_argument("--slots", type=int, default=4, help="ring slots")
+    parser.add_argument("--paths", nargs="+", choices=PATHS, default=list(PATHS))
+    args = parser.parse_args()
+
+    width, height = SIZES[args.size]
+    print(f"Generating {args.size} frames...", file=sys.stderr)
+    pool = [synthetic_frame(width, height, seed) for seed in range(4)]
+
+    copies = copy_table(pool[0])
+    print(f"\n{args.frames} frames of {width}x{height} at "
+          f"{'full speed' if args.rate <= 0 else f'{args.rate:g} fps'}\n")
+    print(f"{'':<22} {'handoff':^19} {'decoded image':^19} {'cpu per frame':^27}")
+    print(f"{'path':<12} {'received':>9} {'p50 ms':>9} {'p99 ms':>9} {'p50 ms':>9} {'p99 ms':>9} "
+          f"{'producer ms':>13} {'consumer ms':>13} {'copies':>7} {'MB copied':>10}")
+    for path in args.paths:
+        outcome = run_path(path, pool, args)
+        latencies = np.asarray(outcome["latencies"]) * 1000
+        received = outcome["received"]
+        copied = sum(size for _, size in copies[path]) / 1e6
+        if not received:
+            print(f"{path:<12} {0:>9}")
+            continue
+        handoff_p50, handoff_p99 = np.percentile(np.asarray(outcome["handoffs"]) * 1000, [50, 99])
+        p50, p99 = np.percentile(latencies, [50, 99])
+        print(f"{path:<12} {received:>9} {handoff_p50:>9.3f} {handoff_p99:>9.3f} {p50:>9.3f} {p99:>9.3f} "
+              f"{outcome['producer_cpu'] / args.frames * 1000:>13.3f} "
+              f"{outcome['consumer_cpu'] / received * 1000:>13.3f} {len(copies[path]):>7} {copied:>10.2f}")
+
+    print("\nCopies per frame:")
+    for path in args.paths:
+        steps = ", ".join(f"{name} {size / 1e6:.2f} MB" for name, size in copies[path])
+        print(f"  {path:<12} {steps}")
+    print("\nRing readers that fall behind skip to the newest frame; 'received' counts the frames they took.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,165 @@
+# vlm/bench_mosaic.py
+"""
+Benchmark mosaic packing against per-frame analysis.
+
+Sends the same frames to a running VLM server twice: once one frame per
+request, and once in mosaic mode, with each frame posing as a different
+camera so the server packs them into grids. Both passes send
+``--concurrency`` requests at a time. Reports the throughput of each
+pass and how often the mosaic answers agree with the per-frame ones on
+every boolean flag of the JSON answers (e.g. ``{"fire": false,
+"person": true}``); nested objects are compared by key path.
+
+Usage:
+    python bench_mosaic.py --frames ../server/public/captures --prompt-file prompt.txt
+    python bench_mosaic.py --frames frames/ --prompt "Return JSON with boolean flags person, vehicle, fire" \\
+        --limit 90 --concurrency 9 --url http://localhost:8000/v1/chat/completions
+"""
+
+import argparse
+import base64
+import json
+import os
+import re
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple
+
+import requests
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".webp")
+
+
+def find_frames(root: str, limit: int) -> List[str]:
+    paths = []
+    for directory, _, files in os.walk(root):
+        paths.extend(os.path.join(directory, f) for f in files if f.lower().endswith(IMAGE_EXTENSIONS))
+    return sorted(paths)[:limit]
+
+
+def parse_json(text: str) -> Optional[Any]:
+    """The JSON object of an answer, tolerating code fences and surrounding prose."""
+    text = re.sub(r"^```(?:json)?\s*|\s*```$", "", text.strip())
+    start, end = text.find("{"), text.rfind("}")
+    if start < 0 or end <= start:
+        return None
+    try:
+        return json.loads(text[start:end + 1])
+    except json.JSONDecodeError:
+        return None
+
+
+def flags(value: Any, prefix: str = "") -> Dict[str, bool]:
+    """Boolean leaves of a parsed answer by key path."""
+    found = {}
+    if isinstance(value, dict):
+        for key, item in value.items():
+            found.update(flags(item, f"{prefix}{key}."))
+    elif isinstance(value, bool):
+        found[prefix.rstrip(".")] = value
+    return found
+
+
+def analyse(url: str, path: str, prompt: str, args, mosaic: bool, stream: str) -> Dict[str, Any]:
+    with open(path, "rb") as f:
+        data = base64.b64encode(f.read()).decode("ascii")
+    body = {
+        "model": args.model,
+        "messages": [{"role": "user", "content": [
+            {"type": "text", "text": prompt},
+            {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{data}"}},
+        ]}],
+        "max_tokens": args.max_tokens,
+        "temperature": args.temperature,
+        "stream_id": stream,
+        "mosaic": mosaic,
+        # Both passes send the same frames; a cached answer would time nothing
+        "cache": False,
+    }
+    start = time.time()
+    response = requests.post(url, json=body, timeout=args.timeout)
+    response.raise_for_status()
+    text = response.json()["choices"][0]["message"]["content"]
+    return {"text": text, "seconds": time.time() - start}
+
+
+def run_pass(frames: List[str], prompt: str, args, mosaic: bool) -> Tuple[List[Optional[Dict[str, Any]]], float]:
+    label = "mosaic" if mosaic else "per-frame"
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        futures = [pool.submit(analyse, args.url, path, prompt, args, mosaic, f"bench-{i % args.concurrency}")
+                   for i, path in enumerate(frames)]
+        results = []
+        for path, future in zip(frames, futures):
+            try:
+                results.append(future.result())
+            except Exception as e:
+                print(f"{label}: {path} failed: {e}")
+                results.append(None)
+    elapsed = time.time() - start
+    done = sum(1 for r in results if r is not None)
+    print(f"{label:>9}: {done}/{len(frames)} frames in {elapsed:.1f} s, {done / elapsed:.2f} frames/s")
+    return results, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Mosaic packing benchmark")
+    parser.add_argument("--frames", required=True, help="directory of frame images (searched recursively)")
+    prompt_group = parser.add_mutually_exclusive_group(required=True)
+    prompt_group.add_argument("--prompt", help="prompt text; it should ask for JSON with boolean flags")
+    prompt_group.add_argument("--prompt-file", help="file holding the prompt")
+    parser.add_argument("--url", default="http://localhost:8000/v1/chat/completions")
+    parser.add_argument("--model", default="Qwen2.5-VL-3B-Instruct")
+    parser.add_argument("--limit", type=int, default=36, help="frames to analyse")
+    parser.add_argument("--concurrency", type=int, default=9,
+                        help="requests in flight, i.e. the cameras that can share a grid")
+    parser.add_argument("--max-tokens", type=int, default=256)
+    parser.add_argument("--temperature", type=float, default=0.0)
+    parser.add_argument("--timeout", type=float, default=600.0)
+    args = parser.parse_args()
+
+    prompt = args.prompt
+    if args.prompt_file:
+        with open(args.prompt_file, "r", encoding="utf-8") as f:
+            prompt = f.read().strip()
+    frames = find_frames(args.frames, args.limit)
+    if not frames:
+        parser.error(f"No images under {args.frames}")
+    print(f"{len(frames)} frames, {args.concurrency} in flight")
+
+    single, single_seconds = run_pass(frames, prompt, args, mosaic=False)
+    packed, packed_seconds = run_pass(frames, prompt, args, mosaic=True)
+
+    per_flag = defaultdict(lambda: [0, 0])  # flag -> [agreeing, compared]
+    frames_compared = frames_agreeing = unparsed = 0
+    for reference, candidate in zip(single, packed):
+        if reference is None or candidate is None:
+            continue
+        expected = flags(parse_json(reference["text"]))
+        actual = flags(parse_json(candidate["text"]))
+        if not expected:
+            continue
+        if not actual:
+            unparsed += 1
+        frames_compared += 1
+        frames_agreeing += all(actual.get(name) == value for name, value in expected.items())
+        for name, value in expected.items():
+            per_flag[name][0] += actual.get(name) == value
+            per_flag[name][1] += 1
+
+    print(f"\nspeedup: {single_seconds / packed_seconds:.2f}x")
+    if not frames_compared:
+        print("No boolean flags in the per-frame answers; ask for JSON with true/false fields.")
+        return
+    agreeing = sum(a for a, _ in per_flag.values())
+    compared = sum(c for _, c in per_flag.values())
+    print(f"flag agreement: {agreeing}/{compared} ({agreeing / compared:.1%})")
+    print(f"frames with every flag equal: {frames_agreeing}/{frames_compared} ({frames_agreeing / frames_compared:.1%})")
+    print(f"mosaic answers without flags: {unparsed}")
+    for name, (a, c) in sorted(per_flag.items()):
+        print(f"  {name:<30} {a}/{c} ({a / c:.1%})")
+
+
+if __name__ == "__main__":
+    main()
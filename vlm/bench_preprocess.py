@@ -0,0 +1,302 @@
+# vlm/bench_preprocess.py
+"""
+Microbenchmarks of the request path outside ``generate``.
+
+Times every preprocessing stage of a Qwen request on its own, for
+synthetic camera frames of several sizes and formats and for several
+message shapes:
+
+    b64decode            base64 payload to bytes
+    image_open           Image.open and full decode
+    resize_image         qwen_backend.resize_image of a frame file
+    convert_messages     qwen_backend.convert_messages (decode, temp file, resize)
+    apply_chat_template  processor.apply_chat_template
+    process_vision_info  qwen_vl_utils.process_vision_info
+    processor            processor(text, images) to tensors
+    batch_decode         processor.batch_decode of a 256-token answer
+
+Only the processor (tokenizer and image processor) is loaded, never the
+model weights, so it runs on any machine with the model directory.
+``--no-processor`` times the image stages only and needs neither the
+model directory nor torch; resize_image is skipped when qwen_backend
+cannot be imported.
+
+Results can be saved as a baseline file; a later run with ``--check``
+compares its medians against it and exits with status 1 when a stage got
+slower than the tolerance allows, e.g. after a Pillow or transformers
+upgrade or a change to the conversion code. Compare runs from the same
+machine only.
+
+Usage:
+    python bench_preprocess.py --save bench_preprocess_baseline.json
+    python bench_preprocess.py --check bench_preprocess_baseline.json --tolerance 0.2
+    python bench_preprocess.py --sizes 1080p 4k --formats jpeg --repeat 50
+"""
+
+import argparse
+import base64
+import io
+import json
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from typing import Any, Callable, Dict, List, Tuple
+
+import numpy as np
+from PIL import Image
+
+
+SIZES = {"720p": (1280, 720), "1080p": (1920, 1080), "4k": (3840, 2160)}
+FORMATS = ("jpeg", "png")
+SHAPES = ("single", "two_frames", "multi_turn")
+PROMPT = ("Analyse this camera frame. Return JSON with boolean fields person, vehicle, fire, smoke "
+          "and a short description of anything unusual.")
+
+
+def synthetic_frame(width: int, height: int, fmt: str, seed: int = 0) -> bytes:
+    """A frame with smooth regions, edges and sensor noise, so codecs work about as hard as on real footage."""
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:height, 0:width].astype(np.float32)
+    base = np.stack([x / width * 180, y / height * 160, (x + y) / (width + height) * 200], axis=-1)
+    for _ in range(12):
+        x0, y0 = rng.integers(0, width), rng.integers(0, height)
+        w, h = rng.integers(width // 20, width // 4), rng.integers(height // 20, height // 4)
+        base[y0:y0 + h, x0:x0 + w] = rng.integers(0, 255, 3)
+    base += rng.normal(0, 6, base.shape)
+    img = Image.fromarray(np.clip(base, 0, 255).astype(np.uint8))
+    buffer = io.BytesIO()
+    if fmt == "jpeg":
+        img.save(buffer, format="JPEG", quality=85)
+    else:
+        img.save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+def build_messages(shape: str, data_url: str) -> List[Dict[str, Any]]:
+    image = {"type": "image_url", "image_url": {"url": data_url}}
+    if shape == "single":
+        return [{"role": "user", "content": [image, {"type": "text", "text": PROMPT}]}]
+    if shape == "two_frames":
+        return [{"role": "user", "content": [image, image, {"type": "text", "text": "What changed between these frames?"}]}]
+    return [
+        {"role": "system", "content": "You are a security camera analyst."},
+        {"role": "user", "content": [image, {"type": "text", "text": PROMPT}]},
+        {"role": "assistant", "content": '{"person": true, "vehicle": false, "fire": false, "smoke": false}'},
+        {"role": "user", "content": "Describe the person in more detail."},
+    ]
+
+
+def measure(fn: Callable[[], Any], repeat: int, warmup: int) -> Dict[str, float]:
+    for _ in range(warmup):
+        fn()
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - start) * 1000)
+    samples.sort()
+    return {
+        "median_ms": round(statistics.median(samples), 3),
+        "p90_ms": round(samples[min(len(samples) - 1, int(len(samples) * 0.9))], 3),
+        "min_ms": round(samples[0], 3),
+    }
+
+
+def frame_cases(args, workdir: str, backend) -> List[Tuple[str, Dict[str, Callable[[], Any]]]]:
+    """Stages that depend only on the frame: decoding and resizing (with ``backend``, qwen_backend)."""
+    cases = []
+    for size in args.sizes:
+        for fmt in args.formats:
+            raw = synthetic_frame(*SIZES[size], fmt)
+            encoded = base64.b64encode(raw).decode("ascii")
+            source = os.path.join(workdir, f"{size}.{fmt}")
+            with open(source, "wb") as f:
+                f.write(raw)
+            target = os.path.join(workdir, "resize-target")
+
+            def resize(source=source, target=target):
+                # resize_image rewrites the file in place, so every run starts from a fresh copy
+                shutil.copyfile(source, target)
+                backend.resize_image(target)
+
+            stages = {
+                "b64decode": lambda encoded=encoded: base64.b64decode(encoded),
+                "image_open": lambda raw=raw: Image.open(io.BytesIO(raw)).load(),
+            }
+            if backend is not None:
+                stages["resize_image"] = resize
+            cases.append((f"{size}/{fmt}", stages))
+            print(f"  {size}/{fmt}: {len(raw) / 1024:.0f} KB", file=sys.stderr)
+    return cases
+
+
+def message_cases(args, backend, processor, temp_files: List[str]) -> List[Tuple[str, Dict[str, Callable[[], Any]]]]:
+    """
+    Stages that depend on the message shape: conversion, template and processor.
+
+    The converted frames the later stages read are added to ``temp_files``.
+    """
+    from qwen_vl_utils import process_vision_info
+
+    cases = []
+    for size in args.sizes:
+        for fmt in args.formats:
+            data_url = f"data:image/{fmt};base64," + base64.b64encode(synthetic_frame(*SIZES[size], fmt)).decode("ascii")
+            for shape in args.shapes:
+                messages = build_messages(shape, data_url)
+
+                def convert(messages=messages):
+                    _, files = backend.convert_messages(messages)
+                    backend.remove_temp_files(files)
+
+                # Later stages work on converted messages, like on the inference thread
+                qwen_messages, files = backend.convert_messages(messages)
+                temp_files.extend(files)
+                text = processor.apply_chat_template(qwen_messages, tokenize=False, add_generation_prompt=True)
+                images, videos = process_vision_info(qwen_messages)
+
+                cases.append((f"{size}/{fmt}/{shape}", {
+                    "convert_messages": convert,
+                    "apply_chat_template": lambda q=qwen_messages: processor.apply_chat_template(
+                        q, tokenize=False, add_generation_prompt=True),
+                    "process_vision_info": lambda q=qwen_messages: process_vision_info(q),
+                    "processor": lambda t=text, i=images, v=videos: processor(
+                        text=[t], images=i, videos=v, padding=True, return_tensors="pt"),
+                }))
+    return cases
+
+
+def decode_case(processor) -> Tuple[str, Dict[str, Callable[[], Any]]]:
+    answer = ('{"person": true, "vehicle": false, "fire": false, "smoke": false, "description": '
+              '"A person in a dark jacket walks past the parked cars towards the entrance. " }') * 6
+    ids = processor.tokenizer(answer, return_tensors="pt")["input_ids"][:, :256]
+    return ("answer/256", {"batch_decode": lambda: processor.batch_decode(
+        ids, skip_special_tokens=True, clean_up_tokenization_spaces=False)})
+
+
+def run(args) -> Dict[str, Any]:
+    workdir = tempfile.mkdtemp(prefix="bench-preprocess-")
+    # convert_messages writes its temporary files to the working directory
+    previous_dir = os.getcwd()
+    os.chdir(workdir)
+    results: Dict[str, Dict[str, Dict[str, float]]] = {}
+    temp_files: List[str] = []
+    # qwen_backend imports torch, which the image stages alone do not need
+    backend = None
+    if args.no_processor:
+        try:
+            import qwen_backend as backend
+        except ImportError as e:
+            print(f"qwen_backend unavailable ({e}), resize_image skipped", file=sys.stderr)
+    else:
+        import qwen_backend as backend
+    try:
+        print("Generating frames...", file=sys.stderr)
+        cases = frame_cases(args, workdir, backend)
+        if not args.no_processor:
+            from transformers import AutoProcessor
+
+            print(f"Loading processor of {backend.MODEL_PATH} (no weights)...", file=sys.stderr)
+            processor = AutoProcessor.from_pretrained(backend.MODEL_PATH)
+            backend.processor = processor
+            cases.extend(message_cases(args, backend, processor, temp_files))
+            cases.append(decode_case(processor))
+
+        for case, stages in cases:
+            for stage, fn in stages.items():
+                results.setdefault(stage, {})[case] = measure(fn, args.repeat, args.warmup)
+                print(f"{stage:>20} {case:<26} {results[stage][case]['median_ms']:>9.2f} ms", file=sys.stderr)
+    finally:
+        if backend is not None:
+            backend.remove_temp_files(temp_files)
+        os.chdir(previous_dir)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    import PIL
+    return {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "environment": {
+            "python": platform.python_version(),
+            "pillow": PIL.__version__,
+            "machine": platform.machine(),
+            "processor": platform.processor(),
+            "cpus": os.cpu_count(),
+            "model_path": backend.MODEL_PATH if backend is not None else None,
+            "image_max_width": backend.IMAGE_MAX_WIDTH if backend is not None else None,
+        },
+        "repeat": args.repeat,
+        "results": results,
+    }
+
+
+def check(current: Dict[str, Any], baseline: Dict[str, Any], tolerance: float, min_delta_ms: float) -> List[str]:
+    """Stages whose median got slower than the baseline by more than the tolerance."""
+    regressions = []
+    for key in ("python", "pillow", "machine", "cpus", "image_max_width"):
+        if baseline["environment"].get(key) != current["environment"].get(key):
+            print(f"warning: baseline {key} was {baseline['environment'].get(key)}, "
+                  f"now {current['environment'].get(key)}", file=sys.stderr)
+    print(f"\n{'stage':>20} {'case':<26} {'baseline':>10} {'now':>10} {'change':>8}")
+    for stage, cases in current["results"].items():
+        for case, now in cases.items():
+            before = baseline["results"].get(stage, {}).get(case)
+            if before is None:
+                continue
+            old, new = before["median_ms"], now["median_ms"]
+            change = (new - old) / old if old else 0.0
+            # Sub-millisecond stages jitter by more than any sensible tolerance
+            regressed = change > tolerance and new - old > min_delta_ms
+            flag = "  REGRESSION" if regressed else ""
+            print(f"{stage:>20} {case:<26} {old:>8.2f}ms {new:>8.2f}ms {change:>+7.0%}{flag}")
+            if regressed:
+                regressions.append(f"{stage} {case}: {old:.2f} ms -> {new:.2f} ms ({change:+.0%})")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Preprocessing microbenchmarks")
+    parser.add_argument("--sizes", nargs="+", choices=list(SIZES), default=list(SIZES))
+    parser.add_argument("--formats", nargs="+", choices=FORMATS, default=list(FORMATS))
+    parser.add_argument("--shapes", nargs="+", choices=SHAPES, default=list(SHAPES))
+    parser.add_argument("--repeat", type=int, default=20, help="timed runs per stage and case")
+    parser.add_argument("--warmup", type=int, default=2, help="untimed runs before timing")
+    parser.add_argument("--no-processor", action="store_true",
+                        help="only the image stages, without loading the processor")
+    parser.add_argument("--save", help="write the results to this baseline file")
+    parser.add_argument("--check", help="compare against this baseline file")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed slowdown of a median (0.2 = 20%%)")
+    parser.add_argument("--min-delta-ms", type=float, default=0.5,
+                        help="slowdowns smaller than this are never reported")
+    args = parser.parse_args()
+
+    baseline = None
+    if args.check:
+        with open(args.check, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+
+    current = run(args)
+
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump(current, f, indent=2)
+        print(f"Baseline written to {args.save}", file=sys.stderr)
+
+    if baseline is not None:
+        regressions = check(current, baseline, args.tolerance, args.min_delta_ms)
+        if regressions:
+            print(f"\n{len(regressions)} stage(s) slower than the baseline by more than {args.tolerance:.0%}:")
+            for line in regressions:
+                print(f"  {line}")
+            sys.exit(1)
+        print("\nNo regressions.")
+    elif not args.save:
+        json.dump(current["results"], sys.stdout, indent=2)
+        print()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+# vlm/bench_vector_index.py
+"""
+Benchmark the vector index against brute force.
+
+Builds an index of synthetic clustered embeddings (descriptions of the
+same scene land close together, like real ones), then reports insert
+throughput, training time, and query latency and recall@k of IVF search
+for several nprobe values next to an exact scan.
+
+Usage:
+    python bench_vector_index.py --count 1000000 --dim 768
+    python bench_vector_index.py --count 100000 --dim 384 --nprobe 8 16 32 64
+    python bench_vector_index.py --count 1000000 --dim 512 --dtype float16   # CLIP frame embeddings
+"""
+
+import argparse
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+from vector_index import VectorIndex
+
+
+def synthetic_embeddings(count: int, centres: np.ndarray, rng: np.random.Generator, batch: int):
+    """Yield batches of vectors scattered around the cluster centres."""
+    dim = centres.shape[1]
+    clusters = len(centres)
+    for start in range(0, count, batch):
+        n = min(batch, count - start)
+        picks = rng.integers(0, clusters, n)
+        yield centres[picks] + 0.5 * rng.standard_normal((n, dim)).astype(np.float32)
+
+
+def percentile(values, q):
+    return float(np.percentile(np.asarray(values) * 1000, q))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Vector index benchmark")
+    parser.add_argument("--count", type=int, default=1_000_000, help="vectors in the index")
+    parser.add_argument("--dim", type=int, default=768, help="vector dimension")
+    parser.add_argument("--clusters", type=int, default=5000, help="synthetic scene clusters")
+    parser.add_argument("--nlist", type=int, default=1024, help="IVF cells")
+    parser.add_argument("--nprobe", type=int, nargs="+", default=[8, 16, 32, 64], help="cells probed per query")
+    parser.add_argument("--queries", type=int, default=200, help="queries per configuration")
+    parser.add_argument("--k", type=int, default=10, help="results per query")
+    parser.add_argument("--streams", type=int, default=16, help="distinct stream ids")
+    parser.add_argument("--dtype", choices=["float32", "float16"], default="float32", help="vector storage type")
+    parser.add_argument("--path", help="index directory (default: temporary, removed afterwards)")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(42)
+    centres = rng.standard_normal((args.clusters, args.dim)).astype(np.float32)
+    path = args.path or tempfile.mkdtemp(prefix="vector-index-bench-")
+    try:
+        index = VectorIndex(path, dim=args.dim, nlist=args.nlist, train_after=args.count + 1, dtype=args.dtype)
+
+        print(f"Inserting {args.count} {args.dtype} vectors of dimension {args.dim}...")
+        start = time.time()
+        row = 0
+        for vectors in synthetic_embeddings(args.count, centres, rng, 10000):
+            ids = [str(i) for i in range(row, row + len(vectors))]
+            streams = [f"cam{i % args.streams}" for i in range(row, row + len(vectors))]
+            timestamps = [float(i) for i in range(row, row + len(vectors))]
+            index.add(ids, vectors, streams, timestamps)
+            row += len(vectors)
+        elapsed = time.time() - start
+        print(f"  {args.count / elapsed:,.0f} vectors/s")
+
+        start = time.time()
+        index.train()
+        print(f"Trained {args.nlist} cells in {time.time() - start:.1f}s")
+
+        start = time.time()
+        index.save()
+        print(f"Saved in {time.time() - start:.1f}s")
+        start = time.time()
+        index = VectorIndex(path)
+        print(f"Reloaded in {time.time() - start:.1f}s")
+
+        # Queries are new descriptions of already indexed scenes
+        queries = next(synthetic_embeddings(args.queries, centres, np.random.default_rng(7), args.queries))
+
+        def run(label, **kwargs):
+            latencies = []
+            results = []
+            for query in queries:
+                t = time.time()
+                results.append([hit["id"] for hit in index.search(query, args.k, **kwargs)])
+                latencies.append(time.time() - t)
+            return label, latencies, results
+
+        configurations = [run("exact", exact=True)]
+        truth = configurations[0][2]
+        for nprobe in args.nprobe:
+            configurations.append(run(f"ivf nprobe={nprobe}", nprobe=nprobe))
+        stream_filter = {"stream": "cam3", "since": args.count * 0.5}
+        configurations.append(run("exact + filter", exact=True, **stream_filter))
+        filtered_truth = configurations[-1][2]
+        configurations.append(run(f"ivf nprobe={args.nprobe[-1]} + filter", nprobe=args.nprobe[-1], **stream_filter))
+
+        print(f"\n{'configuration':<28}{'p50 ms':>10}{'p95 ms':>10}{'recall@' + str(args.k):>12}")
+        for label, latencies, results in configurations:
+            reference = filtered_truth if "filter" in label else truth
+            recall = np.mean([
+                len(set(found) & set(expected)) / max(len(expected), 1)
+                for found, expected in zip(results, reference)
+            ])
+            print(f"{label:<28}{percentile(latencies, 50):>10.2f}{percentile(latencies, 95):>10.2f}{recall:>12.3f}")
+    finally:
+        if not args.path:
+            shutil.rmtree(path, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,527 @@
+# vlm/capture_daemon.py
+"""
+Persistent frame capture daemon for many cameras.
+
+The Node server used to spawn one ffmpeg process per captured frame:
+every capture paid for process start-up, the RTSP handshake and decoding
+up to the next keyframe. This daemon keeps one demuxer and decoder open
+per camera instead, on a thread of its own, and always holds the most
+recent frame of every camera in memory. A capture is then a dictionary
+lookup plus a JPEG encode (cached per frame), usually well under 10 ms.
+
+Only what is needed is decoded:
+
+    keyframes   decode keyframes only; the rest of the packets are read and dropped
+    interval    decode one frame every ``interval`` seconds: the next keyframe once a
+                frame is due, or, when the camera's keyframes are further apart than
+                the interval, every frame with only the due ones kept
+    all         decode every frame (motion-sensitive consumers)
+
+Frames can also be pushed: with a ``push_url`` every kept frame (at most
+one per ``interval``) is POSTed there as image/jpeg with the headers
+X-Stream-Id and X-Frame-Timestamp. A push still in flight when the next
+frame arrives makes the daemon skip that frame rather than queue it.
+
+Lost connections are retried with exponential backoff and jitter, and at
+most CAPTURE_CONNECT_CONCURRENCY cameras connect at the same time, so a
+restart or a network blip across dozens of cameras does not flood the
+NVR with handshakes. Any input PyAV can open works: a path or file://
+URL to a video file plays back in real time and loops, which stands in
+for an RTSP camera in tests.
+
+With CAPTURE_FRAME_RING set, every kept frame is also written to the
+camera's shared-memory ring (frame_ring.py), so a VLM server on the same
+host can take it as ``ring://<id>`` without any HTTP or base64 hop.
+
+Endpoints:
+    PUT    /streams/{id}            register or update a camera: {url, mode, interval, push_url}
+    DELETE /streams/{id}            stop a camera
+    GET    /streams                 state of every camera
+    GET    /streams/{id}            state of one camera
+    GET    /streams/{id}/frame.jpg  latest frame; ?max_age=seconds, ?width=pixels
+    GET    /health, GET /metrics
+
+Configuration (environment variables):
+    CAPTURE_PORT                 listen port (default: 8891)
+    CAPTURE_STREAMS_FILE         JSON file {id: {url, mode, interval, push_url}} loaded at start (default: empty)
+    CAPTURE_DEFAULT_MODE         mode of cameras registered without one (default: interval)
+    CAPTURE_DEFAULT_INTERVAL     seconds between kept frames in interval mode (default: 1.0)
+    CAPTURE_MAX_AGE              frames older than this are not served (default: 30)
+    CAPTURE_CONNECT_CONCURRENCY  cameras connecting at the same time (default: 4)
+    CAPTURE_CONNECT_TIMEOUT      seconds to open a stream (default: 10)
+    CAPTURE_READ_TIMEOUT         seconds without data before reconnecting (default: 10)
+    CAPTURE_BACKOFF_MAX          longest wait between reconnects in seconds (default: 60)
+    CAPTURE_JPEG_QUALITY         JPEG quality of served frames (default: 90)
+    CAPTURE_PUSH_WORKERS         threads posting pushed frames (default: 8)
+    CAPTURE_FRAME_RING           write kept frames to shared-memory rings (default: false)
+    CAPTURE_RING_FORMAT          rgb24 (no encoding) or jpeg (default: rgb24)
+"""
+
+import io
+import json
+import logging
+import os
+import random
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from typing import Any, Dict, Optional
+
+import av
+import httpx
+import uvicorn
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import Response
+
+from frame_ring import FrameRingWriter
+from metrics import metrics
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    handlers=[logging.StreamHandler()]
+)
+logger = logging.getLogger("capture-daemon")
+logging.getLogger("libav").setLevel(logging.ERROR)
+
+CAPTURE_PORT = int(os.environ.get("CAPTURE_PORT", "8891"))
+CAPTURE_STREAMS_FILE = os.environ.get("CAPTURE_STREAMS_FILE", "")
+CAPTURE_DEFAULT_MODE = os.environ.get("CAPTURE_DEFAULT_MODE", "interval")
+CAPTURE_DEFAULT_INTERVAL = float(os.environ.get("CAPTURE_DEFAULT_INTERVAL", "1.0"))
+CAPTURE_MAX_AGE = float(os.environ.get("CAPTURE_MAX_AGE", "30"))
+CAPTURE_CONNECT_CONCURRENCY = int(os.environ.get("CAPTURE_CONNECT_CONCURRENCY", "4"))
+CAPTURE_CONNECT_TIMEOUT = float(os.environ.get("CAPTURE_CONNECT_TIMEOUT", "10"))
+CAPTURE_READ_TIMEOUT = float(os.environ.get("CAPTURE_READ_TIMEOUT", "10"))
+CAPTURE_BACKOFF_MAX = float(os.environ.get("CAPTURE_BACKOFF_MAX", "60"))
+CAPTURE_JPEG_QUALITY = int(os.environ.get("CAPTURE_JPEG_QUALITY", "90"))
+CAPTURE_PUSH_WORKERS = int(os.environ.get("CAPTURE_PUSH_WORKERS", "8"))
+CAPTURE_FRAME_RING = os.environ.get("CAPTURE_FRAME_RING", "false").lower() in ("1", "true", "yes")
+CAPTURE_RING_FORMAT = os.environ.get("CAPTURE_RING_FORMAT", "rgb24")
+
+MODES = ("keyframes", "interval", "all")
+BACKOFF_MIN = 1.0
+# A connection that delivered frames this long counts as healthy and resets the backoff
+HEALTHY_SECONDS = 30.0
+
+
+def mask_url(url: str) -> str:
+    """The URL with its credentials hidden, for logs and status."""
+    return re.sub(r"//[^/@]*@", "//***:***@", url)
+
+
+def is_file(url: str) -> bool:
+    return url.startswith("file://") or "://" not in url
+
+
+class CameraStream:
+    """
+    Capture loop of one camera on its own thread.
+
+    Args:
+        stream_id: Camera id, as used by the Node server.
+        url: RTSP URL, or any input PyAV can open (a video file loops in real time).
+        mode: One of MODES.
+        interval: Seconds between kept frames in interval mode, and between pushes.
+        push_url: Where kept frames are POSTed, or None.
+        connect_slots: Semaphore shared by every camera to bound concurrent connects.
+        pusher: Thread pool posting pushed frames.
+        ring: Shared-memory rings kept frames are written to, or None.
+    """
+
+    def __init__(self, stream_id: str, url: str, mode: str, interval: float, push_url: Optional[str],
+                 connect_slots: threading.Semaphore, pusher: ThreadPoolExecutor, client: httpx.Client,
+                 ring: Optional[FrameRingWriter] = None):
+        self.stream_id = stream_id
+        self.url = url
+        self.mode = mode
+        self.interval = interval
+        self.push_url = push_url
+        self._connect_slots = connect_slots
+        self._pusher = pusher
+        self._client = client
+        self._ring = ring
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._frame = None
+        self._frame_time = 0.0
+        self._jpeg: Dict[Optional[int], bytes] = {}
+        self._push_busy = False
+        self._last_push = 0.0
+
+        self.state = "starting"
+        self.error: Optional[str] = None
+        self.connects = 0
+        self.frames_decoded = 0
+        self.packets_read = 0
+        self.resolution: Optional[str] = None
+        self.gop_seconds: Optional[float] = None
+        self.ring_seq: Optional[int] = None
+
+        self._thread = threading.Thread(target=self._run, name=f"capture-{stream_id}", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+
+    def join(self, timeout: float) -> None:
+        self._thread.join(timeout)
+
+    def latest_jpeg(self, width: Optional[int] = None):
+        """(JPEG bytes, capture time) of the latest frame, or None before the first one."""
+        with self._lock:
+            frame, captured, cache = self._frame, self._frame_time, self._jpeg
+        if frame is None:
+            return None
+        if width is not None and width >= frame.width:
+            width = None
+        jpeg = cache.get(width)
+        if jpeg is None:
+            jpeg = self._encode(frame, width)
+            with self._lock:
+                # The frame may have been replaced meanwhile; only cache for the one encoded
+                if self._frame is frame:
+                    self._jpeg[width] = jpeg
+        return jpeg, captured
+
+    @staticmethod
+    def _encode(frame, width: Optional[int]) -> bytes:
+        if width:
+            height = max(2, round(frame.height * width / frame.width / 2) * 2)
+            frame = frame.reformat(width=width, height=height)
+        buffer = io.BytesIO()
+        frame.to_image().save(buffer, format="JPEG", quality=CAPTURE_JPEG_QUALITY)
+        metrics.inc("capture_jpeg_encodes_total")
+        return buffer.getvalue()
+
+    def info(self) -> Dict[str, Any]:
+        age = time.time() - self._frame_time if self._frame_time else None
+        return {
+            "id": self.stream_id,
+            "url": mask_url(self.url),
+            "mode": self.mode,
+            "interval": self.interval,
+            "push_url": self.push_url,
+            "state": self.state,
+            "error": self.error,
+            "connects": self.connects,
+            "frames_decoded": self.frames_decoded,
+            "packets_read": self.packets_read,
+            "resolution": self.resolution,
+            "gop_seconds": round(self.gop_seconds, 2) if self.gop_seconds else None,
+            "frame_age_seconds": round(age, 2) if age is not None else None,
+            "ring_seq": self.ring_seq,
+        }
+
+    def _run(self) -> None:
+        # Spread the first connects of a freshly started daemon
+        if self._stop.wait(random.uniform(0, 0.5)):
+            return
+        backoff = BACKOFF_MIN
+        while not self._stop.is_set():
+            started = time.time()
+            try:
+                self._capture()
+            except Exception as e:
+                self.error = mask_url(f"{type(e).__name__}: {e}")
+                metrics.inc("capture_errors_total", stream=self.stream_id)
+                logger.warning(f"Stream {self.stream_id} ({mask_url(self.url)}): {self.error}")
+            if self._stop.is_set():
+                break
+            if time.time() - started > HEALTHY_SECONDS and self.frames_decoded:
+                backoff = BACKOFF_MIN
+            self.state = "backoff"
+            delay = backoff * random.uniform(0.5, 1.0)
+            backoff = min(backoff * 2, CAPTURE_BACKOFF_MAX)
+            metrics.inc("capture_reconnects_total", stream=self.stream_id)
+            self._stop.wait(delay)
+        self.state = "stopped"
+
+    def _open(self):
+        self.state = "connecting"
+        options = {}
+        if self.url.startswith("rtsp://"):
+            options["rtsp_transport"] = "tcp"
+        with self._connect_slots:
+            if self._stop.is_set():
+                return None
+            container = av.open(self.url[len("file://"):] if self.url.startswith("file://") else self.url,
+                                options=options, timeout=(CAPTURE_CONNECT_TIMEOUT, CAPTURE_READ_TIMEOUT))
+        self.connects += 1
+        return container
+
+    def _capture(self) -> None:
+        """Read the stream until it ends, fails or the camera is stopped."""
+        container = self._open()
+        if container is None:
+            return
+        try:
+            video = container.streams.video[0]
+            # Frame threading holds back several frames, too many when only keyframes are decoded
+            video.thread_type = "AUTO" if self.mode == "all" else "SLICE"
+            if self.mode != "all":
+                # Inter frames are only parsed, which costs next to nothing
+                video.codec_context.skip_frame = "NONKEY"
+            self.state = "running"
+            self.error = None
+            logger.info(f"Stream {self.stream_id} connected ({mask_url(self.url)}, {self.mode})")
+
+            file_input = is_file(self.url)
+            clock_start = time.time()
+            first_pts = None
+            last_keyframe = None
+            full_decode = False
+
+            for packet in container.demux(video):
+                if self._stop.is_set():
+                    return
+                if packet.size == 0:
+                    continue
+                self.packets_read += 1
+                seconds = float(packet.pts * packet.time_base) if packet.pts is not None else None
+                if file_input and seconds is not None:
+                    # Play files back at their own pace, like a live camera
+                    if first_pts is None:
+                        first_pts = seconds
+                    ahead = clock_start + seconds - first_pts - time.time()
+                    if ahead > 0 and self._stop.wait(ahead):
+                        return
+                if packet.is_keyframe and seconds is not None:
+                    if last_keyframe is not None and seconds > last_keyframe:
+                        self.gop_seconds = seconds - last_keyframe
+                    last_keyframe = seconds
+
+                if self.mode == "interval" and not full_decode:
+                    if self.gop_seconds is not None and self.gop_seconds > self.interval * 1.5:
+                        # Keyframes come too rarely: decode every frame from here, keep only due ones
+                        if not packet.is_keyframe:
+                            continue
+                        full_decode = True
+                        video.codec_context.skip_frame = "DEFAULT"
+                        logger.info(f"Stream {self.stream_id} has keyframes every {self.gop_seconds:.1f} s, "
+                                    f"decoding every frame")
+                    elif packet.is_keyframe and time.time() - self._frame_time < self.interval:
+                        continue
+                for frame in packet.decode():
+                    self.frames_decoded += 1
+                    metrics.inc("capture_frames_decoded_total", stream=self.stream_id)
+                    if self.mode != "interval" or time.time() - self._frame_time >= self.interval:
+                        self._keep(frame)
+            if file_input:
+                logger.info(f"Stream {self.stream_id} reached the end of its file, looping")
+                self._stop.wait(0.1)
+            else:
+                raise EOFError("stream ended")
+        finally:
+            container.close()
+
+    def _keep(self, frame) -> None:
+        now = time.time()
+        with self._lock:
+            self._frame = frame
+            self._frame_time = now
+            self._jpeg = {}
+        self.resolution = f"{frame.width}x{frame.height}"
+        metrics.inc("capture_frames_kept_total", stream=self.stream_id)
+        if self._ring is not None and not self._stop.is_set():
+            self._write_ring(frame, now)
+        if self.push_url and not self._push_busy and now - self._last_push >= self.interval:
+            self._push_busy = True
+            self._last_push = now
+            self._pusher.submit(self._push)
+        elif self.push_url:
+            metrics.inc("capture_push_skipped_total", stream=self.stream_id)
+
+    def _write_ring(self, frame, captured: float) -> None:
+        try:
+            if CAPTURE_RING_FORMAT == "rgb24" and self._ring.fits(frame.width * frame.height * 3):
+                self.ring_seq = self._ring.write(self.stream_id, frame.to_ndarray(format="rgb24"),
+                                                 frame.width, frame.height, "rgb24", captured)
+            else:
+                jpeg, _ = self.latest_jpeg()
+                self.ring_seq = self._ring.write(self.stream_id, jpeg, frame.width, frame.height, "jpeg", captured)
+        except Exception as e:
+            metrics.inc("capture_ring_errors_total", stream=self.stream_id)
+            logger.warning(f"Could not write frame of stream {self.stream_id} to its ring: {e}")
+
+    def _push(self) -> None:
+        try:
+            latest = self.latest_jpeg()
+            if latest is None:
+                return
+            jpeg, captured = latest
+            response = self._client.post(self.push_url, content=jpeg, headers={
+                "Content-Type": "image/jpeg",
+                "X-Stream-Id": self.stream_id,
+                "X-Frame-Timestamp": f"{captured:.3f}",
+            })
+            response.raise_for_status()
+            metrics.inc("capture_pushes_total", stream=self.stream_id)
+        except Exception as e:
+            metrics.inc("capture_push_errors_total", stream=self.stream_id)
+            logger.warning(f"Push of stream {self.stream_id} to {self.push_url} failed: {e}")
+        finally:
+            self._push_busy = False
+
+
+class CaptureDaemon:
+    """The set of captured cameras."""
+
+    def __init__(self, connect_concurrency: int = CAPTURE_CONNECT_CONCURRENCY):
+        self.streams: Dict[str, CameraStream] = {}
+        self._lock = threading.Lock()
+        self._connect_slots = threading.Semaphore(connect_concurrency)
+        self._pusher = ThreadPoolExecutor(max_workers=CAPTURE_PUSH_WORKERS, thread_name_prefix="capture-push")
+        self._client = httpx.Client(timeout=10.0)
+        self._ring = FrameRingWriter() if CAPTURE_FRAME_RING else None
+
+    def put(self, stream_id: str, config: Dict[str, Any]) -> CameraStream:
+        """Start capturing a camera, restarting it if its settings changed."""
+        url = config.get("url")
+        if not url or not isinstance(url, str):
+            raise ValueError("url is required")
+        mode = config.get("mode") or CAPTURE_DEFAULT_MODE
+        if mode not in MODES:
+            raise ValueError(f"mode must be one of {', '.join(MODES)}")
+        interval = float(config.get("interval") or CAPTURE_DEFAULT_INTERVAL)
+        if interval <= 0:
+            raise ValueError("interval must be positive")
+        push_url = config.get("push_url") or None
+        with self._lock:
+            current = self.streams.get(stream_id)
+            if current is not None:
+                if (current.url, current.mode, current.interval, current.push_url) == (url, mode, interval, push_url):
+                    return current
+                current.stop()
+            stream = CameraStream(stream_id, url, mode, interval, push_url,
+                                  self._connect_slots, self._pusher, self._client, self._ring)
+            self.streams[stream_id] = stream
+            metrics.set("capture_streams", len(self.streams))
+        logger.info(f"Capturing stream {stream_id} from {mask_url(url)} ({mode}, {interval}s)")
+        return stream
+
+    def remove(self, stream_id: str) -> bool:
+        with self._lock:
+            stream = self.streams.pop(stream_id, None)
+            metrics.set("capture_streams", len(self.streams))
+        if stream is None:
+            return False
+        stream.stop()
+        if self._ring is not None:
+            self._ring.remove(stream_id)
+        logger.info(f"Stopped capturing stream {stream_id}")
+        return True
+
+    def get(self, stream_id: str) -> Optional[CameraStream]:
+        return self.streams.get(stream_id)
+
+    def load(self, path: str) -> None:
+        with open(path, "r", encoding="utf-8") as f:
+            config = json.load(f)
+        for stream_id, settings in config.items():
+            try:
+                self.put(str(stream_id), settings)
+            except ValueError as e:
+                logger.error(f"Stream {stream_id} in {path} ignored: {e}")
+
+    def close(self) -> None:
+        streams = list(self.streams.values())
+        for stream in streams:
+            stream.stop()
+        for stream in streams:
+            stream.join(timeout=CAPTURE_READ_TIMEOUT)
+        self._pusher.shutdown(wait=False)
+        self._client.close()
+        if self._ring is not None:
+            self._ring.close()
+
+
+daemon = CaptureDaemon()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    if CAPTURE_STREAMS_FILE:
+        daemon.load(CAPTURE_STREAMS_FILE)
+    yield
+    daemon.close()
+
+
+app = FastAPI(title="Frame capture daemon", lifespan=lifespan)
+
+
+@app.put("/streams/{stream_id}")
+async def put_stream(stream_id: str, request: Request):
+    try:
+        body = await request.json()
+    except json.JSONDecodeError:
+        raise HTTPException(status_code=400, detail="Body must be JSON")
+    if not isinstance(body, dict):
+        raise HTTPException(status_code=400, detail="Body must be a JSON object")
+    try:
+        stream = daemon.put(stream_id, body)
+    except (ValueError, TypeError) as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return stream.info()
+
+
+@app.delete("/streams/{stream_id}")
+async def delete_stream(stream_id: str):
+    if not daemon.remove(stream_id):
+        raise HTTPException(status_code=404, detail=f"Unknown stream {stream_id}")
+    return {"id": stream_id, "removed": True}
+
+
+@app.get("/streams")
+async def list_streams():
+    return {"streams": [stream.info() for stream in list(daemon.streams.values())]}
+
+
+@app.get("/streams/{stream_id}")
+async def get_stream(stream_id: str):
+    stream = daemon.get(stream_id)
+    if stream is None:
+        raise HTTPException(status_code=404, detail=f"Unknown stream {stream_id}")
+    return stream.info()
+
+
+@app.get("/streams/{stream_id}/frame.jpg")
+def get_frame(stream_id: str, max_age: float = CAPTURE_MAX_AGE, width: Optional[int] = None):
+    # A plain def: FastAPI runs it on its thread pool, so JPEG encoding never blocks the event loop
+    stream = daemon.get(stream_id)
+    if stream is None:
+        raise HTTPException(status_code=404, detail=f"Unknown stream {stream_id}")
+    latest = stream.latest_jpeg(width)
+    if latest is None:
+        metrics.inc("capture_frame_misses_total", reason="no_frame")
+        raise HTTPException(status_code=503, detail=f"No frame yet for stream {stream_id} ({stream.state})",
+                            headers={"Retry-After": "1"})
+    jpeg, captured = latest
+    age = time.time() - captured
+    if age > max_age:
+        metrics.inc("capture_frame_misses_total", reason="stale")
+        raise HTTPException(status_code=503, detail=f"Latest frame of stream {stream_id} is {age:.0f} s old "
+                                                    f"({stream.state}: {stream.error})",
+                            headers={"Retry-After": "1"})
+    metrics.inc("capture_frames_served_total")
+    return Response(content=jpeg, media_type="image/jpeg", headers={
+        "X-Frame-Timestamp": f"{captured:.3f}",
+        "X-Frame-Age": f"{age:.3f}",
+        "Cache-Control": "no-store",
+    })
+
+
+@app.get("/health")
+async def health_check():
+    states = [stream.state for stream in list(daemon.streams.values())]
+    return {"status": "ok", "streams": len(states), "running": states.count("running")}
+
+
+@app.get("/metrics")
+async def get_metrics():
+    return metrics.snapshot()
+
+
+if __name__ == "__main__":
+    uvicorn.run(app, host="0.0.0.0", port=CAPTURE_PORT)
@@ -0,0 +1,103 @@
+# vlm/clip_encoder.py
+"""
+Small image-text encoder (CLIP) that runs next to the VLM.
+
+Images and texts are mapped into one normalised vector space, so an
+image can be compared with text prompts (zero-shot classification) or
+with other images. It runs on the CPU by default, leaving the GPU to the
+VLM: ViT-B/32 takes a few tens of milliseconds per frame on a few cores.
+
+Configuration (environment variables):
+    CLIP_MODEL_PATH  model directory or hub id (default: openai/clip-vit-base-patch32)
+    CLIP_DEVICE      cpu or cuda (default: cpu)
+    CLIP_THREADS     torch CPU threads, 0 keeps torch's default (default: 4)
+"""
+
+import base64
+import io
+import logging
+import os
+import threading
+from typing import List
+
+import numpy as np
+from PIL import Image
+
+logger = logging.getLogger("clip-encoder")
+
+CLIP_MODEL_PATH = os.environ.get("CLIP_MODEL_PATH", "openai/clip-vit-base-patch32")
+CLIP_DEVICE = os.environ.get("CLIP_DEVICE", "cpu")
+CLIP_THREADS = int(os.environ.get("CLIP_THREADS", "4"))
+
+
+def decode_image(data: str) -> Image.Image:
+    """RGB image from base64, with or without a data URL prefix, decoded at reduced size."""
+    if "base64," in data:
+        data = data.split("base64,", 1)[1]
+    img = Image.open(io.BytesIO(base64.b64decode(data)))
+    # CLIP sees 224 pixels; JPEG frames are decoded at a fraction of their size
+    img.draft("RGB", (448, 448))
+    return img.convert("RGB")
+
+
+class ClipEncoder:
+    """
+    Lazily loaded CLIP model.
+
+    Args:
+        path: Model directory or hub id.
+        device: Torch device the model runs on.
+    """
+
+    def __init__(self, path: str = CLIP_MODEL_PATH, device: str = CLIP_DEVICE):
+        self.path = path
+        self.device = device
+        self.model = None
+        self.processor = None
+        self._lock = threading.Lock()
+
+    def load(self):
+        with self._lock:
+            if self.model is None:
+                import torch
+                from transformers import CLIPModel, CLIPProcessor
+
+                if CLIP_THREADS and self.device == "cpu":
+                    torch.set_num_threads(CLIP_THREADS)
+                logger.info(f"Loading CLIP model {self.path} on {self.device}...")
+                self.processor = CLIPProcessor.from_pretrained(self.path)
+                self.model = CLIPModel.from_pretrained(self.path).to(self.device).eval()
+                logger.info("CLIP model loaded")
+        return self.model
+
+    @property
+    def name(self) -> str:
+        return os.path.basename(self.path.rstrip("/"))
+
+    @property
+    def dimensions(self) -> int:
+        return self.load().config.projection_dim
+
+    @property
+    def logit_scale(self) -> float:
+        return float(self.load().logit_scale.exp())
+
+    def embed_images(self, images: List[Image.Image]) -> np.ndarray:
+        """Normalised float32 vectors of the images, in input order."""
+        import torch
+
+        self.load()
+        inputs = self.processor(images=images, return_tensors="pt").to(self.device)
+        with torch.inference_mode():
+            features = self.model.get_image_features(**inputs)
+        return torch.nn.functional.normalize(features.float(), dim=-1).cpu().numpy()
+
+    def embed_texts(self, texts: List[str]) -> np.ndarray:
+        """Normalised float32 vectors of the texts, in input order."""
+        import torch
+
+        self.load()
+        inputs = self.processor(text=texts, return_tensors="pt", padding=True, truncation=True).to(self.device)
+        with torch.inference_mode():
+            features = self.model.get_text_features(**inputs)
+        return torch.nn.functional.normalize(features.float(), dim=-1).cpu().numpy()
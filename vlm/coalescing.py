@@ -0,0 +1,175 @@
+# vlm/coalescing.py
+"""
+Single-flight coalescing of identical in-flight requests.
+
+Requests with the same image content, prompt and generation parameters
+attach to the generation that is already running instead of starting a
+new one. Every caller receives the same result, and streaming callers
+receive the same token stream (chunks produced before they joined are
+replayed first).
+
+All bookkeeping happens on the event loop thread; the generation itself
+may run on a worker thread and publish chunks through ``Flight.publish``.
+"""
+
+import asyncio
+import base64
+import hashlib
+import json
+import logging
+from typing import Any, AsyncIterator, Dict, List, Tuple
+
+from metrics import metrics
+
+logger = logging.getLogger("coalescing")
+
+_END = object()
+
+
+def image_digest(data: str) -> str:
+    """Content hash of a base64 image, with or without a data URL prefix."""
+    if "base64," in data:
+        data = data.split("base64,", 1)[1]
+    try:
+        raw = base64.b64decode(data)
+    except Exception:
+        raw = data.encode("utf-8")
+    return "sha256:" + hashlib.sha256(raw).hexdigest()
+
+
+def _normalise_part(part: Dict[str, Any]) -> Dict[str, Any]:
+    part_type = part.get("type")
+    if part_type == "image" and part.get("image"):
+        return {"type": "image", "image": image_digest(part["image"])}
+    if part_type == "image_url":
+        image_url = part.get("image_url", {})
+        url = image_url.get("url", "") if isinstance(image_url, dict) else str(image_url)
+        if url.startswith("data:"):
+            url = image_digest(url)
+        return {"type": "image_url", "url": url}
+    return part
+
+
+def request_key(messages: List[Dict[str, Any]], **params) -> str:
+    """
+    Build the coalescing key of a chat request.
+
+    Args:
+        messages: OpenAI-style messages. Inline images are replaced by the
+            hash of their decoded bytes, so the key stays small.
+        **params: Generation parameters that change the output
+            (model, max_tokens, temperature, ...).
+
+    Returns:
+        Hex digest identifying the request.
+    """
+    normalised = []
+    for message in messages:
+        content = message.get("content")
+        if isinstance(content, list):
+            content = [_normalise_part(part) for part in content]
+        normalised.append({"role": message.get("role"), "content": content})
+    canonical = json.dumps({"messages": normalised, "params": params}, sort_keys=True, default=str)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+class Flight:
+    """One in-flight generation shared by every request with the same key."""
+
+    def __init__(self, key: str, loop: asyncio.AbstractEventLoop):
+        self.key = key
+        self.loop = loop
+        self.chunks: List[str] = []
+        self.followers = 0
+        self.job = None  # scheduler job backing the flight, if any
+        self.future = loop.create_future()
+        self._subscribers: List[asyncio.Queue] = []
+
+    def publish(self, text: str) -> None:
+        """Publish a streamed text chunk. Safe to call from any thread."""
+        self.loop.call_soon_threadsafe(self._publish, text)
+
+    def _publish(self, text: str) -> None:
+        self.chunks.append(text)
+        for queue in self._subscribers:
+            queue.put_nowait(text)
+
+    def _finish(self, source: asyncio.Future) -> None:
+        if source.cancelled():
+            self.future.cancel()
+        elif source.exception() is not None:
+            self.future.set_exception(source.exception())
+        else:
+            self.future.set_result(source.result())
+        for queue in self._subscribers:
+            queue.put_nowait(_END)
+
+    async def wait(self) -> Any:
+        """Wait for the shared result. A cancelled caller does not cancel the generation."""
+        return await asyncio.shield(self.future)
+
+    async def stream(self) -> AsyncIterator[str]:
+        """Yield every chunk of the generation, replaying those already produced."""
+        queue: asyncio.Queue = asyncio.Queue()
+        for chunk in self.chunks:
+            queue.put_nowait(chunk)
+        if self.future.done():
+            queue.put_nowait(_END)
+        else:
+            self._subscribers.append(queue)
+        try:
+            while True:
+                item = await queue.get()
+                if item is _END:
+                    break
+                yield item
+        finally:
+            if queue in self._subscribers:
+                self._subscribers.remove(queue)
+        # Surface a failed generation to the streaming caller as well
+        self.future.result()
+
+
+class SingleFlight:
+    """Registry of in-flight generations keyed by ``request_key``."""
+
+    def __init__(self):
+        self._flights: Dict[str, Flight] = {}
+
+    def join(self, key: str) -> Tuple[Flight, bool]:
+        """
+        Attach to the flight for ``key``, creating it if needed.
+
+        Returns:
+            The flight and ``True`` when the caller is the leader and must
+            start the generation with ``run``.
+        """
+        flight = self._flights.get(key)
+        if flight is not None:
+            flight.followers += 1
+            metrics.inc("coalesced_requests_total")
+            logger.debug(f"Coalesced request onto in-flight generation {key[:12]} ({flight.followers} followers)")
+            return flight, False
+
+        flight = Flight(key, asyncio.get_running_loop())
+        self._flights[key] = flight
+        return flight, True
+
+    def run(self, flight: Flight, future: asyncio.Future) -> None:
+        """Complete ``flight`` with the outcome of ``future`` and retire its key."""
+        def _done(source: asyncio.Future) -> None:
+            self._flights.pop(flight.key, None)
+            flight._finish(source)
+
+        future.add_done_callback(_done)
+
+    def abandon(self, flight: Flight, error: BaseException) -> None:
+        """Retire a flight whose generation could not be started; its followers get ``error``."""
+        self._flights.pop(flight.key, None)
+        if flight.followers:
+            failed = flight.loop.create_future()
+            failed.set_exception(error)
+            flight._finish(failed)
+
+    def __len__(self) -> int:
+        return len(self._flights)
@@ -0,0 +1,397 @@
+# vlm/continuous_batching.py
+"""
+Continuous (iteration-level) batching over a paged KV cache.
+
+A padded batch runs until its longest answer is done: a short JSON
+answer that finished after 20 tokens keeps its slot, and its KV memory,
+while a description in the same batch runs to 300. Here the batch is
+rebuilt at every decode step instead. A sequence that emits its end
+token or reaches ``max_tokens`` leaves at once and its request is
+answered, and a waiting request is prefilled and joins the running
+sequences before the next step, so the GPU always decodes as many
+sequences as there are.
+
+KV memory comes in fixed-size pages (KV_PAGE_SIZE tokens) from one pool
+allocated for the model (KV_CACHE_MEMORY_MB, see paged_kv_cache.py). A
+sequence holds only the pages its tokens fill, and gets another one when
+it crosses a page boundary. Requests are admitted while the free pages
+cover their prompt with one page of headroom per running sequence. When
+the pool runs out anyway, the sequence admitted last is preempted: its
+pages are freed and it goes back to the front of the waiting line, to
+be prefilled again with the tokens it already generated once pages free
+up. For short camera answers recomputing is cheaper than copying pages
+out to host memory and back.
+
+Which request joins next is still the InferenceScheduler's decision (see
+``ContinuousBatch``): priorities, fair share and deadlines apply as
+before, and a job that cannot join (a streamed answer, a session turn,
+another model) makes the engine stop admitting until its batch drains.
+
+The engine is model-agnostic; a ``StepRunner`` does the model work
+(qwen_backend.py has the Qwen2.5-VL one, bench_continuous.py a text-only
+one for small models on the CPU).
+
+Configuration (environment variables):
+    CONTINUOUS_BATCHING       generate non-streamed answers with the engine (default: false)
+    CONTINUOUS_MAX_SEQUENCES  sequences decoded together at most (default: 32)
+    KV_PAGE_SIZE              tokens per KV page (default: 16)
+    KV_CACHE_MEMORY_MB        memory of the KV page pool (default: 2048)
+"""
+
+import logging
+import os
+import time
+from collections import deque
+from typing import Any, Deque, Dict, List, Optional, Tuple
+
+from admission import is_out_of_memory
+from metrics import metrics
+from profiler import profiler
+from scheduler import ContinuousBatch, DeadlineExceeded, Job
+
+logger = logging.getLogger("continuous-batching")
+
+CONTINUOUS_BATCHING = os.environ.get("CONTINUOUS_BATCHING", "false").lower() in ("1", "true", "yes")
+CONTINUOUS_MAX_SEQUENCES = int(os.environ.get("CONTINUOUS_MAX_SEQUENCES", "32"))
+KV_PAGE_SIZE = int(os.environ.get("KV_PAGE_SIZE", "16"))
+KV_CACHE_MEMORY_MB = float(os.environ.get("KV_CACHE_MEMORY_MB", "2048"))
+
+
+class PageAllocator:
+    """Free list of the pages of a pool."""
+
+    def __init__(self, pages: int):
+        self.pages = pages
+        self._free = list(range(pages - 1, -1, -1))
+
+    @property
+    def free(self) -> int:
+        return len(self._free)
+
+    @property
+    def used(self) -> int:
+        return self.pages - len(self._free)
+
+    def allocate(self, count: int) -> Optional[List[int]]:
+        """``count`` pages, or None (and nothing taken) when fewer are free."""
+        if count > len(self._free):
+            return None
+        return [self._free.pop() for _ in range(count)]
+
+    def release(self, pages: List[int]) -> None:
+        self._free.extend(reversed(pages))
+        pages.clear()
+
+
+class Sequence:
+    """One request in the engine: its prompt, generated tokens and pages."""
+
+    def __init__(self, job: Job, prompt: Any, prompt_tokens: int):
+        _, self.max_tokens, self.temperature, self.on_text, self.trace = job.args
+        self.job = job
+        self.prompt = prompt
+        self.prompt_tokens = prompt_tokens
+        self.generated: List[int] = []
+        self.pages: List[int] = []
+        # Tokens whose keys and values are in the pages
+        self.cached = 0
+        self.preemptions = 0
+        self.decode_started: Optional[float] = None
+
+    @property
+    def context_tokens(self) -> int:
+        """Tokens a prefill writes: the prompt, and after a preemption all but the last generated token."""
+        return self.prompt_tokens + max(len(self.generated) - 1, 0)
+
+
+class StepRunner:
+    """
+    The model side of the engine. Every method runs on the inference thread.
+
+    ``prompt`` is whatever ``prepare`` returns for a request; pages and
+    token positions are the engine's.
+    """
+
+    def open(self, page_size: int, memory_bytes: int) -> int:
+        """Allocate (or keep) the page pool for the active model; returns its number of pages."""
+        raise NotImplementedError
+
+    def prepare(self, messages: List[Dict[str, Any]], trace) -> Tuple[Any, int]:
+        """Tokenise a request; returns its prompt and the prompt's length in tokens."""
+        raise NotImplementedError
+
+    def prefill(self, seq: Sequence) -> int:
+        """Write ``seq.context_tokens`` tokens of the sequence into its pages and sample the next token."""
+        raise NotImplementedError
+
+    def decode(self, seqs: List[Sequence]) -> List[int]:
+        """Feed every sequence's last generated token at position ``cached`` and sample the next ones."""
+        raise NotImplementedError
+
+    def is_end(self, token: int) -> bool:
+        raise NotImplementedError
+
+    def result(self, seq: Sequence) -> Dict[str, Any]:
+        """The request's answer, ``{"output_texts", "prompt_tokens", "completion_tokens"}``."""
+        raise NotImplementedError
+
+    def release(self, seq: Sequence) -> None:
+        """Drop what ``prepare`` kept (images, temporary files) once the sequence is done."""
+
+
+class ContinuousBatcher:
+    """
+    Iteration-level scheduler of one model's sequences.
+
+    Args:
+        runner: Model side.
+        max_sequences: Sequences decoded together at most.
+        page_size: Tokens per KV page.
+        memory_bytes: Memory of the page pool.
+    """
+
+    def __init__(self, runner: StepRunner, max_sequences: int = CONTINUOUS_MAX_SEQUENCES,
+                 page_size: int = KV_PAGE_SIZE, memory_bytes: int = int(KV_CACHE_MEMORY_MB * 1024 * 1024)):
+        self.runner = runner
+        self.max_sequences = max_sequences
+        self.page_size = page_size
+        self.memory_bytes = memory_bytes
+        self.allocator: Optional[PageAllocator] = None
+        self._running: List[Sequence] = []
+        self._waiting: Deque[Sequence] = deque()
+        self.completed = 0
+        self.preemptions = 0
+        self.steps = 0
+        self.tokens = 0
+        self.busy_seconds = 0.0
+        self.tokens_per_second = 0.0
+
+    def _pages_for(self, tokens: int) -> int:
+        return -(-tokens // self.page_size)
+
+    # -- the loop ----------------------------------------------------------
+
+    def run(self, batch: ContinuousBatch) -> None:
+        """Serve ``batch.first`` and every job that joins, until none is left. Inference thread only."""
+        pages = self.runner.open(self.page_size, self.memory_bytes)
+        if self.allocator is None or self.allocator.pages != pages:
+            self.allocator = PageAllocator(pages)
+        started = time.time()
+        self._add(batch, batch.first)
+        try:
+            while self._running or self._waiting:
+                # Each step is one profiled job, counting the requests it finished
+                with profiler.job(0) as profiled:
+                    completed = batch.completed
+                    self._join(batch)
+                    self._admit(batch)
+                    if self._running:
+                        self._step(batch)
+                    profiled.count = batch.completed - completed
+                self._publish()
+        except BaseException as e:
+            for seq in self._running + list(self._waiting):
+                self._drop(seq)
+                batch.complete(seq.job, e)
+            self._running, self._waiting = [], deque()
+            raise
+        finally:
+            self.busy_seconds += time.time() - started
+            self._publish()
+
+    def _join(self, batch: ContinuousBatch) -> None:
+        """Take queued jobs while there is room; never while requests wait for pages."""
+        while not self._waiting and len(self._running) < self.max_sequences:
+            job = batch.join()
+            if job is None:
+                return
+            self._add(batch, job)
+
+    def _add(self, batch: ContinuousBatch, job: Job) -> None:
+        messages, max_tokens, _, _, trace = job.args
+        if trace is not None:
+            trace.dequeued()
+        try:
+            prompt, prompt_tokens = self.runner.prepare(messages, trace)
+        except Exception as e:
+            batch.complete(job, e)
+            return
+        seq = Sequence(job, prompt, prompt_tokens)
+        if self._pages_for(prompt_tokens + 1) > self.allocator.pages:
+            self.runner.release(seq)
+            batch.complete(job, MemoryError(
+                f"Prompt of {prompt_tokens} tokens does not fit the KV cache ({self.allocator.pages} pages "
+                f"of {self.page_size} tokens)"
+            ))
+            return
+        self._waiting.append(seq)
+
+    def _admit(self, batch: ContinuousBatch) -> None:
+        """Prefill waiting sequences while their pages, and growth room for the running ones, are free."""
+        self._expire(batch)
+        while self._waiting and len(self._running) < self.max_sequences:
+            seq = self._waiting[0]
+            needed = self._pages_for(seq.context_tokens)
+            headroom = len(self._running) if self._running else 0
+            if self.allocator.free < needed + headroom:
+                return
+            self._waiting.popleft()
+            seq.pages = self.allocator.allocate(needed)
+            try:
+                token = self.runner.prefill(seq)
+            except Exception as e:
+                if is_out_of_memory(e) and self._running:
+                    # Activations, not pages, ran out; try again when the batch is smaller
+                    self.allocator.release(seq.pages)
+                    self._waiting.appendleft(seq)
+                    return
+                self._drop(seq)
+                batch.complete(seq.job, e)
+                continue
+            seq.cached = seq.context_tokens
+            if not seq.generated:
+                seq.generated.append(token)
+            seq.decode_started = seq.decode_started or time.time()
+            self._running.append(seq)
+            if self._finished(seq):
+                self._finish(batch, seq)
+
+    def _expire(self, batch: ContinuousBatch) -> None:
+        """Drop waiting sequences, preempted ones included, whose deadline has passed."""
+        now = time.time()
+        for seq in [seq for seq in self._waiting if seq.job.expired(now)]:
+            self._waiting.remove(seq)
+            self._drop(seq)
+            metrics.inc("scheduler_expired_total", priority=seq.job.priority)
+            logger.info(f"Dropping expired {seq.job.priority} request after {len(seq.generated)} tokens "
+                        f"and {seq.preemptions} preemptions")
+            batch.complete(seq.job, DeadlineExceeded(
+                f"Request deadline passed while waiting for KV pages, after {now - seq.job.enqueued_at:.2f}s"
+            ))
+
+    def _step(self, batch: ContinuousBatch) -> None:
+        """One decode step of every running sequence."""
+        # Every sequence needs a slot for the token it feeds
+        for seq in list(self._running):
+            if seq not in self._running or seq.cached < len(seq.pages) * self.page_size:
+                continue
+            page = self.allocator.allocate(1)
+            while page is None:
+                victim = self._running[-1]
+                if victim is seq and len(self._running) == 1:
+                    break
+                self._preempt(victim)
+                if victim is seq:
+                    break
+                page = self.allocator.allocate(1)
+            if page is not None:
+                seq.pages.extend(page)
+            elif seq in self._running:
+                # Alone and the pool is full: the answer ends here, as at max_tokens
+                self._finish(batch, seq)
+        if not self._running:
+            return
+
+        began = time.perf_counter()
+        try:
+            tokens = self.runner.decode(self._running)
+        except Exception as e:
+            if is_out_of_memory(e) and len(self._running) > 1:
+                self._preempt(self._running[-1])
+                return
+            for seq in self._running:
+                self._drop(seq)
+                batch.complete(seq.job, e)
+            self._running = []
+            return
+        elapsed = time.perf_counter() - began
+
+        self.steps += 1
+        self.tokens += len(tokens)
+        rate = len(tokens) / elapsed if elapsed > 0 else 0.0
+        self.tokens_per_second = rate if self.steps == 1 else self.tokens_per_second + 0.05 * (rate - self.tokens_per_second)
+        metrics.observe("continuous_step_ms", elapsed * 1000)
+        metrics.observe("continuous_batch_size", len(tokens))
+        metrics.inc("continuous_tokens_total", len(tokens))
+
+        for seq, token in zip(list(self._running), tokens):
+            seq.cached += 1
+            seq.generated.append(token)
+            if self._finished(seq):
+                self._finish(batch, seq)
+
+    # -- sequences ---------------------------------------------------------
+
+    def _finished(self, seq: Sequence) -> bool:
+        return self.runner.is_end(seq.generated[-1]) or len(seq.generated) >= seq.max_tokens
+
+    def _finish(self, batch: ContinuousBatch, seq: Sequence) -> None:
+        self._running.remove(seq)
+        try:
+            result = self.runner.result(seq)
+        except Exception as e:
+            result = e
+        finally:
+            self._drop(seq)
+        if isinstance(result, dict):
+            if seq.on_text and result["output_texts"][0]:
+                seq.on_text(result["output_texts"][0])
+            if seq.trace is not None:
+                seq.trace.add_span("decode", seq.decode_started, time.time(),
+                                   completion_tokens=result["completion_tokens"], preemptions=seq.preemptions)
+                seq.trace.set(prompt_tokens=result["prompt_tokens"], completion_tokens=result["completion_tokens"],
+                              batch_size=len(self._running) + 1, preemptions=seq.preemptions)
+        self.completed += 1
+        batch.complete(seq.job, result)
+
+    def _preempt(self, seq: Sequence) -> None:
+        """Free a running sequence's pages; it is prefilled again, generated tokens included, later."""
+        self._running.remove(seq)
+        self.allocator.release(seq.pages)
+        seq.cached = 0
+        seq.preemptions += 1
+        self.preemptions += 1
+        self._waiting.appendleft(seq)
+        metrics.inc("continuous_preemptions_total")
+        logger.debug(f"Preempted a sequence after {len(seq.generated)} tokens, {len(self._running)} still running")
+
+    def _drop(self, seq: Sequence) -> None:
+        if self.allocator is not None:
+            self.allocator.release(seq.pages)
+        self.runner.release(seq)
+
+    # -- statistics --------------------------------------------------------
+
+    def _publish(self) -> None:
+        stats = self.stats()
+        metrics.set("continuous_running", stats["running"])
+        metrics.set("continuous_waiting", stats["waiting"])
+        metrics.set("continuous_tokens_per_second", stats["tokens_per_second"])
+        if self.allocator is not None:
+            metrics.set("kv_pages_used", stats["kv_pages_used"])
+            metrics.set("kv_utilization", stats["kv_utilization"])
+
+    def stats(self) -> Dict[str, Any]:
+        # Read from other threads; copies of the lists are consistent enough for statistics
+        running, waiting = list(self._running), list(self._waiting)
+        allocator = self.allocator
+        used = allocator.used if allocator else 0
+        cached = sum(seq.cached for seq in running)
+        return {
+            "enabled": CONTINUOUS_BATCHING,
+            "max_sequences": self.max_sequences,
+            "running": len(running),
+            "waiting": len(waiting),
+            "completed": self.completed,
+            "preemptions": self.preemptions,
+            "steps": self.steps,
+            "tokens": self.tokens,
+            "tokens_per_second": round(self.tokens_per_second, 1),
+            "average_tokens_per_second": round(self.tokens / self.busy_seconds, 1) if self.busy_seconds else None,
+            "kv_page_size": self.page_size,
+            "kv_pages": allocator.pages if allocator else None,
+            "kv_pages_used": used,
+            # Share of the pool held by sequences, and share of their pages' slots that hold tokens
+            "kv_utilization": round(used / allocator.pages, 4) if allocator else None,
+            "kv_fill": round(cached / (used * self.page_size), 4) if used else None,
+        }
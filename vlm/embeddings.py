@@ -0,0 +1,140 @@
+# vlm/embeddings.py
+"""
+Text embedding model behind the OpenAI-compatible ``/v1/embeddings``.
+
+Inputs are tokenised once, sorted by length and cut into batches that
+respect a token budget, so each batch is padded only to its own longest
+text instead of the longest text of the request. Vectors are returned in
+input order, L2-normalised, and can be packed as base64 float32 the way
+the OpenAI API does for ``encoding_format="base64"``.
+
+Configuration (environment variables):
+    EMBEDDING_MODEL_PATH      model directory or hub id (default: nomic-ai/nomic-embed-text-v1.5)
+    EMBEDDING_POOLING         mean | cls (default: mean)
+    EMBEDDING_MAX_LENGTH      tokens kept per input (default: 512)
+    EMBEDDING_BATCH_TOKENS    padded tokens per forward pass (default: 16384)
+    EMBEDDING_MAX_BATCH       inputs per forward pass (default: 256)
+    EMBEDDING_PREFIX          text prepended to every input, e.g. "search_document: " (default: none)
+"""
+
+import base64
+import logging
+import os
+import threading
+from typing import List, Tuple
+
+import numpy as np
+
+logger = logging.getLogger("embeddings")
+
+MODEL_PATH = os.environ.get("EMBEDDING_MODEL_PATH", "nomic-ai/nomic-embed-text-v1.5")
+POOLING = os.environ.get("EMBEDDING_POOLING", "mean").lower()
+MAX_LENGTH = int(os.environ.get("EMBEDDING_MAX_LENGTH", "512"))
+BATCH_TOKENS = int(os.environ.get("EMBEDDING_BATCH_TOKENS", "16384"))
+MAX_BATCH = int(os.environ.get("EMBEDDING_MAX_BATCH", "256"))
+PREFIX = os.environ.get("EMBEDDING_PREFIX", "")
+
+
+def length_sorted_batches(lengths: List[int], batch_tokens: int = BATCH_TOKENS,
+                          max_batch: int = MAX_BATCH) -> List[List[int]]:
+    """
+    Group input positions into batches of similar length.
+
+    Args:
+        lengths: Token count of every input.
+        batch_tokens: Budget of padded tokens (batch size x longest input).
+        max_batch: Upper bound of inputs per batch.
+
+    Returns:
+        Lists of input positions, shortest inputs first.
+    """
+    order = sorted(range(len(lengths)), key=lambda i: lengths[i])
+    batches = []
+    current: List[int] = []
+    for i in order:
+        # Inputs are ascending, so the newest one sets the padded width
+        if current and ((len(current) + 1) * lengths[i] > batch_tokens or len(current) >= max_batch):
+            batches.append(current)
+            current = []
+        current.append(i)
+    if current:
+        batches.append(current)
+    return batches
+
+
+def encode_base64(vector: np.ndarray) -> str:
+    """Pack a vector as little-endian float32 bytes in base64."""
+    return base64.b64encode(np.asarray(vector, dtype="<f4").tobytes()).decode("ascii")
+
+
+class EmbeddingModel:
+    """
+    Lazily loaded encoder model with length-sorted batching.
+
+    Args:
+        path: Model directory or hub id.
+        pooling: ``mean`` over the attention mask or the ``cls`` token.
+    """
+
+    def __init__(self, path: str = MODEL_PATH, pooling: str = POOLING):
+        self.path = path
+        self.pooling = pooling
+        self.model = None
+        self.tokenizer = None
+        self._lock = threading.Lock()
+
+    def load(self):
+        with self._lock:
+            if self.model is None:
+                import torch
+                from transformers import AutoModel, AutoTokenizer
+
+                logger.info(f"Loading embedding model {self.path}...")
+                self.tokenizer = AutoTokenizer.from_pretrained(self.path, trust_remote_code=True)
+                self.model = AutoModel.from_pretrained(self.path, trust_remote_code=True)
+                if torch.cuda.is_available():
+                    self.model = self.model.to("cuda").half()
+                self.model.eval()
+                logger.info("Embedding model loaded")
+        return self.model
+
+    @property
+    def name(self) -> str:
+        return os.path.basename(self.path.rstrip("/"))
+
+    def embed(self, texts: List[str]) -> Tuple[np.ndarray, int]:
+        """
+        Embed texts on the calling thread.
+
+        Returns:
+            Normalised float32 vectors in input order, and the number of
+            tokens processed (without padding).
+        """
+        import torch
+
+        self.load()
+        texts = [PREFIX + text for text in texts]
+        # Tokenise without padding first, only to learn every input's length
+        encoded = self.tokenizer(texts, truncation=True, max_length=MAX_LENGTH)["input_ids"]
+        lengths = [len(ids) for ids in encoded]
+        device = next(self.model.parameters()).device
+
+        vectors = None
+        for batch in length_sorted_batches(lengths):
+            features = self.tokenizer.pad({"input_ids": [encoded[i] for i in batch]}, return_tensors="pt")
+            features = {k: v.to(device) for k, v in features.items()}
+            with torch.inference_mode():
+                hidden = self.model(**features).last_hidden_state
+            if self.pooling == "cls":
+                pooled = hidden[:, 0]
+            else:
+                mask = features["attention_mask"].unsqueeze(-1).to(hidden.dtype)
+                pooled = (hidden * mask).sum(dim=1) / mask.sum(dim=1).clamp(min=1)
+            pooled = torch.nn.functional.normalize(pooled.float(), dim=-1).cpu().numpy()
+            if vectors is None:
+                vectors = np.empty((len(texts), pooled.shape[1]), dtype=np.float32)
+            vectors[batch] = pooled
+
+        if vectors is None:
+            vectors = np.empty((0, 0), dtype=np.float32)
+        return vectors, sum(lengths)
@@ -0,0 +1,171 @@
+# vlm/eval_prescreen.py
+"""
+Measure the pre-screen against the full model.
+
+``label`` sends a directory of frames to a running VLM server with the
+production prompt and keeps the boolean flags of every answer, e.g.
+``{"fire": false, "gun": false, "medical": true}``, as the reference
+labels (labels.jsonl; an interrupted run resumes where it stopped).
+
+``evaluate`` scores the labelled frames with the CPU pre-screen
+(prescreen.py) and reports, per flag and overall:
+
+    pass rate  share of frames escalated to the VLM
+    recall     share of the frames the full model flagged that were escalated
+
+It also suggests, for each flag, the highest threshold that keeps the
+recall at ``--target-recall``, with the pass rate those thresholds would
+give, as a PRESCREEN_THRESHOLDS line. The periodic description sample is
+left out: it only raises the pass rate.
+
+Usage:
+    python eval_prescreen.py label ../server/public/captures --prompt-file prompt.txt --out labels.jsonl
+    python eval_prescreen.py evaluate labels.jsonl --target-recall 0.98
+"""
+
+import argparse
+import json
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Tuple
+
+import numpy as np
+from PIL import Image
+
+from bench_mosaic import analyse, find_frames, flags, parse_json
+
+
+def label(args) -> None:
+    prompt = args.prompt
+    if args.prompt_file:
+        with open(args.prompt_file, "r", encoding="utf-8") as f:
+            prompt = f.read().strip()
+    done = set()
+    if os.path.exists(args.out):
+        with open(args.out, "r", encoding="utf-8") as f:
+            done = {json.loads(line)["image"] for line in f if line.strip()}
+    frames = [path for path in find_frames(args.frames, args.limit) if path not in done]
+    print(f"{len(frames)} frames to label ({len(done)} already in {args.out})", file=sys.stderr)
+
+    def run(path: str) -> Dict[str, Any]:
+        # Neither mosaic nor a stream id: each frame is analysed exactly as on its own
+        answer = analyse(args.url, path, prompt, args, mosaic=False, stream=None)["text"]
+        return {"image": path, "flags": flags(parse_json(answer)), "answer": answer}
+
+    labelled = 0
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool, open(args.out, "a", encoding="utf-8") as out:
+        for path, future in zip(frames, [pool.submit(run, path) for path in frames]):
+            try:
+                entry = future.result()
+            except Exception as e:
+                print(f"{path} failed: {e}", file=sys.stderr)
+                continue
+            out.write(json.dumps(entry) + "\n")
+            out.flush()
+            labelled += 1
+            if labelled % 50 == 0:
+                print(f"  {labelled}/{len(frames)}", file=sys.stderr)
+    print(f"Labelled {labelled} frames", file=sys.stderr)
+
+
+def score_frames(entries: List[Dict[str, Any]], args) -> Tuple[List[Dict[str, float]], Dict[str, float]]:
+    """Pre-screen scores of every frame, and the configured thresholds."""
+    from clip_encoder import ClipEncoder
+    from prescreen import ZeroShotScorer, load_flags
+
+    scorer = ZeroShotScorer(ClipEncoder(), load_flags(args.flags_file or ""))
+    scores = []
+    for start in range(0, len(entries), args.batch):
+        images = []
+        for entry in entries[start:start + args.batch]:
+            img = Image.open(entry["image"])
+            img.draft("RGB", (448, 448))
+            images.append(img.convert("RGB"))
+        scores.extend(scorer.score(images))
+        print(f"  scored {len(scores)}/{len(entries)}", file=sys.stderr)
+    return scores, {name: settings["threshold"] for name, settings in scorer.flags.items()}
+
+
+def recall_threshold(positive_scores: np.ndarray, target: float) -> float:
+    """Highest threshold that still escalates ``target`` of the positive frames."""
+    if not len(positive_scores):
+        return 1.0
+    ordered = np.sort(positive_scores)[::-1]
+    needed = max(1, int(np.ceil(target * len(ordered))))
+    return float(ordered[needed - 1])
+
+
+def evaluate(args) -> None:
+    with open(args.labels, "r", encoding="utf-8") as f:
+        entries = [json.loads(line) for line in f if line.strip()]
+    entries = [e for e in entries if e.get("flags") and os.path.exists(e["image"])]
+    if not entries:
+        sys.exit(f"No labelled frames with flags in {args.labels}")
+    print(f"Scoring {len(entries)} frames...", file=sys.stderr)
+    scores, thresholds = score_frames(entries, args)
+    names = list(thresholds)
+    matrix = np.asarray([[frame[name] for name in names] for frame in scores])
+    labels = np.asarray([[bool(entry["flags"].get(name)) for name in names] for entry in entries])
+
+    def report(limits: Dict[str, float]) -> None:
+        cut = np.asarray([limits[name] for name in names])
+        escalated = matrix >= cut
+        any_escalated = escalated.any(axis=1)
+        print(f"\n{'flag':<12} {'threshold':>9} {'positives':>9} {'recall':>8} {'escalates':>9}")
+        for i, name in enumerate(names):
+            positives = labels[:, i].sum()
+            recall = escalated[labels[:, i], i].mean() if positives else float("nan")
+            print(f"{name:<12} {cut[i]:>9.3f} {positives:>9} {recall:>8.1%} {escalated[:, i].mean():>9.1%}")
+        flagged = labels.any(axis=1)
+        recall = any_escalated[flagged].mean() if flagged.any() else float("nan")
+        print(f"{'any':<12} {'':>9} {flagged.sum():>9} {recall:>8.1%} {any_escalated.mean():>9.1%}")
+        print(f"\npass rate {any_escalated.mean():.1%} ({any_escalated.sum()}/{len(entries)} frames to the VLM), "
+              f"recall of flagged frames {recall:.1%}")
+
+    print("\nWith the configured thresholds:")
+    report(thresholds)
+
+    suggested = {}
+    for i, name in enumerate(names):
+        suggested[name] = round(recall_threshold(matrix[labels[:, i], i], args.target_recall), 4) \
+            if labels[:, i].any() else thresholds[name]
+    print(f"\nWith thresholds for {args.target_recall:.0%} recall per flag "
+          f"(flags without positives keep theirs):")
+    report(suggested)
+    print("\nPRESCREEN_THRESHOLDS=" + ",".join(f"{name}={value}" for name, value in suggested.items()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Pre-screen pass rate and recall against the full model")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    label_parser = commands.add_parser("label", help="label frames with the full model")
+    label_parser.add_argument("frames", help="directory of frame images (searched recursively)")
+    prompt_group = label_parser.add_mutually_exclusive_group(required=True)
+    prompt_group.add_argument("--prompt", help="prompt text; it should ask for JSON with boolean flags")
+    prompt_group.add_argument("--prompt-file", help="file holding the prompt")
+    label_parser.add_argument("--out", required=True, help="labels file (JSONL), appended to")
+    label_parser.add_argument("--url", default="http://localhost:8000/v1/chat/completions")
+    label_parser.add_argument("--model", default="Qwen2.5-VL-3B-Instruct")
+    label_parser.add_argument("--limit", type=int, default=1000, help="frames to label")
+    label_parser.add_argument("--concurrency", type=int, default=4)
+    label_parser.add_argument("--max-tokens", type=int, default=256)
+    label_parser.add_argument("--temperature", type=float, default=0.0)
+    label_parser.add_argument("--timeout", type=float, default=600.0)
+
+    evaluate_parser = commands.add_parser("evaluate", help="score labelled frames with the pre-screen")
+    evaluate_parser.add_argument("labels", help="labels file written by 'label'")
+    evaluate_parser.add_argument("--target-recall", type=float, default=0.98)
+    evaluate_parser.add_argument("--flags-file", help="flags and prompts, as PRESCREEN_FLAGS_FILE")
+    evaluate_parser.add_argument("--batch", type=int, default=16, help="frames per CLIP forward pass")
+
+    args = parser.parse_args()
+    if args.command == "label":
+        label(args)
+    else:
+        evaluate(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,254 @@
+# vlm/event_aggregator.py
+"""
+Temporal compression of per-frame results into events.
+
+A camera watching a stable scene gets the same answer frame after frame.
+Requests that carry an ``event_key`` (the prompt, for the Node server)
+are folded, per stream and key, into events: a frame whose answer has
+the same boolean flags as the stream's open event and a similar
+description (word-set Jaccard of at least EVENT_SIMILARITY) is merged
+into it, which only moves the event's end time and frame count. Any
+other answer opens a new event at once, so a flag that changes reaches
+storage and the websocket clients with the answer that changed it.
+
+The caller is told per answer (``X-Event-*`` response headers) whether
+it opened an event, which it stores, embeds and broadcasts as before, or
+was merged, which it drops. The end times and frame counts of merged
+frames reach storage in bulk: every change to an event replaces that
+event's pending snapshot, and the storage writer fetches the snapshots
+after its last cursor (``updates``) and applies them in one bulk write.
+Snapshots carry the full state, so applying one twice is harmless, and
+they stay available for EVENT_UPDATE_RETENTION seconds after their
+event closed, so a writer that restarts catches up.
+
+An event closes when its stream sends nothing for EVENT_IDLE_SECONDS or
+after EVENT_MAX_SECONDS, which keeps the stored description and frame of
+a long event current.
+
+Configuration (environment variables):
+    EVENT_SIMILARITY          description similarity that still counts as the same event (default: 0.6)
+    EVENT_IDLE_SECONDS        gap that closes a stream's event (default: 120)
+    EVENT_MAX_SECONDS         longest event before a new one opens (default: 3600)
+    EVENT_UPDATE_RETENTION    seconds a closed event's snapshot stays fetchable (default: 600)
+"""
+
+import json
+import logging
+import os
+import re
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+from metrics import metrics
+
+logger = logging.getLogger("event-aggregator")
+
+EVENT_SIMILARITY = float(os.environ.get("EVENT_SIMILARITY", "0.6"))
+EVENT_IDLE_SECONDS = float(os.environ.get("EVENT_IDLE_SECONDS", "120"))
+EVENT_MAX_SECONDS = float(os.environ.get("EVENT_MAX_SECONDS", "3600"))
+EVENT_UPDATE_RETENTION = float(os.environ.get("EVENT_UPDATE_RETENTION", "600"))
+
+_WORD = re.compile(r"[a-z0-9]+")
+
+
+def parse_answer(text: str) -> Tuple[Dict[str, bool], str]:
+    """Boolean flags and description of an answer; prose answers have no flags and are their own description."""
+    body = re.sub(r"^```(?:json)?\s*|\s*```$", "", text.strip())
+    start, end = body.find("{"), body.rfind("}")
+    parsed = None
+    if 0 <= start < end:
+        candidate = body[start:end + 1]
+        for attempt in (candidate, re.sub(r"\bTrue\b", "true", re.sub(r"\bFalse\b", "false", candidate))):
+            try:
+                parsed = json.loads(attempt)
+                break
+            except json.JSONDecodeError:
+                continue
+    if not isinstance(parsed, dict):
+        return {}, text.strip()
+    flags = {key: value for key, value in parsed.items() if isinstance(value, bool)}
+    description = parsed.get("description")
+    if not isinstance(description, str):
+        description = json.dumps({k: v for k, v in parsed.items() if k not in flags}, sort_keys=True)
+    return flags, description
+
+
+def similarity(a: str, b: str) -> float:
+    """Jaccard similarity of the word sets of two descriptions."""
+    words_a, words_b = set(_WORD.findall(a.lower())), set(_WORD.findall(b.lower()))
+    if not words_a and not words_b:
+        return 1.0
+    return len(words_a & words_b) / len(words_a | words_b)
+
+
+class Event:
+    """Consecutive equivalent results of one stream and key."""
+
+    def __init__(self, event_id: str, stream: str, key: str, timestamp: float, flags: Dict[str, bool],
+                 description: str, reason: str):
+        self.id = event_id
+        self.stream = stream
+        self.key = key
+        self.start = timestamp
+        self.end = timestamp
+        self.frames = 1
+        self.flags = flags
+        self.description = description
+        self.reason = reason
+        self.closed = False
+        # Server time of the last frame; frame timestamps may come from another clock
+        self.seen = time.time()
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "id": self.id,
+            "stream_id": self.stream,
+            "key": self.key,
+            "start": self.start,
+            "end": self.end,
+            "frames": self.frames,
+            "flags": self.flags,
+            "reason": self.reason,
+            "closed": self.closed,
+        }
+
+
+class EventAggregator:
+    """
+    Open events per stream and key, and the snapshots waiting for storage.
+
+    Args:
+        similarity: Description similarity that still counts as the same event.
+        idle_seconds: Gap that closes an event.
+        max_seconds: Longest event.
+        retention: Seconds a closed event's snapshot stays fetchable.
+    """
+
+    def __init__(self, similarity: float = EVENT_SIMILARITY, idle_seconds: float = EVENT_IDLE_SECONDS,
+                 max_seconds: float = EVENT_MAX_SECONDS, retention: float = EVENT_UPDATE_RETENTION):
+        self.similarity = similarity
+        self.idle_seconds = idle_seconds
+        self.max_seconds = max_seconds
+        self.retention = retention
+        self._open: Dict[Tuple[str, str], Event] = {}
+        # Event id -> (sequence, snapshot, time the event closed), oldest change first
+        self._pending: "OrderedDict[str, Tuple[int, Dict[str, Any], Optional[float]]]" = OrderedDict()
+        self._seq = 0
+        self._lock = threading.Lock()
+        self.frames = 0
+        self.events = 0
+
+    def _changed(self, event: Event) -> None:
+        self._seq += 1
+        self._pending[event.id] = (self._seq, event.snapshot(), time.time() if event.closed else None)
+        self._pending.move_to_end(event.id)
+
+    def _close(self, event: Event) -> None:
+        event.closed = True
+        self._open.pop((event.stream, event.key), None)
+        self._changed(event)
+
+    def observe(self, stream: str, key: str, answer: str, timestamp: Optional[float] = None,
+                event_id: Optional[str] = None) -> Dict[str, Any]:
+        """
+        Fold one answer into its stream's events.
+
+        Args:
+            stream: Camera stream.
+            key: What was asked (prompt id); each key has its own events.
+            answer: Model answer text.
+            timestamp: Unix time of the frame, now by default.
+            event_id: Id of the event if this answer opens one, e.g. the
+                id the caller stores the result under.
+
+        Returns:
+            ``{"event_id", "action", "reason", "frames"}``; ``action`` is
+            ``opened`` (store it) or ``merged`` (already covered by the event).
+        """
+        timestamp = timestamp or time.time()
+        flags, description = parse_answer(answer)
+        with self._lock:
+            self.frames += 1
+            event = self._open.get((stream, key))
+            reason = None
+            if event is None:
+                reason = "new"
+            elif timestamp - event.end > self.idle_seconds:
+                reason = "idle"
+            elif event.flags != flags:
+                reason = "flags"
+            elif timestamp - event.start > self.max_seconds:
+                reason = "max_duration"
+            elif similarity(event.description, description) < self.similarity:
+                reason = "description"
+
+            if reason is None:
+                event.end = max(event.end, timestamp)
+                event.frames += 1
+                event.seen = time.time()
+                self._changed(event)
+                action = "merged"
+            else:
+                if event is not None:
+                    self._close(event)
+                event = Event(event_id or uuid.uuid4().hex[:24], stream, key, timestamp, flags, description, reason)
+                self._open[(stream, key)] = event
+                self._changed(event)
+                self.events += 1
+                action = "opened"
+            metrics.inc("event_frames_total", action=action)
+            if reason:
+                metrics.inc("event_opened_total", reason=reason)
+            metrics.set("event_open", len(self._open))
+            metrics.set("event_compression_ratio", round(self.frames / self.events, 2))
+            return {"event_id": event.id, "action": action, "reason": reason, "frames": event.frames}
+
+    def reap(self, now: Optional[float] = None) -> None:
+        """Close idle events and forget closed events' snapshots past retention."""
+        now = now or time.time()
+        with self._lock:
+            for event in [e for e in self._open.values() if now - e.seen > self.idle_seconds]:
+                self._close(event)
+            expired = [event_id for event_id, (_, _, closed_at) in self._pending.items()
+                       if closed_at is not None and now - closed_at > self.retention]
+            for event_id in expired:
+                del self._pending[event_id]
+            metrics.set("event_open", len(self._open))
+
+    def updates(self, after: int = 0, limit: int = 1000) -> Dict[str, Any]:
+        """
+        Snapshots of events changed after the cursor ``after``, oldest change first.
+
+        Returns:
+            ``{"cursor", "events", "more"}``; pass ``cursor`` as ``after``
+            next time. ``after`` of 0 returns everything still retained, as
+            does a cursor from before this server started.
+        """
+        self.reap()
+        with self._lock:
+            if after > self._seq:
+                after = 0
+            changed = [(seq, snapshot) for seq, snapshot, _ in self._pending.values() if seq > after]
+        batch = changed[:limit]
+        return {
+            "cursor": batch[-1][0] if batch else after,
+            "events": [snapshot for _, snapshot in batch],
+            "more": len(changed) > limit,
+        }
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "frames": self.frames,
+                "events": self.events,
+                "open": len(self._open),
+                "pending": len(self._pending),
+                "compression_ratio": round(self.frames / self.events, 2) if self.events else None,
+                "cursor": self._seq,
+            }
+
+
+events = EventAggregator()
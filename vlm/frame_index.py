@@ -0,0 +1,281 @@
+# vlm/frame_index.py
+"""
+Visual search over analysed frames.
+
+Every frame the VLM analyses is also embedded by the CPU CLIP model
+(clip_encoder.py) and appended to a memory-mapped ``VectorIndex`` with
+its camera and time, so frames can be found by what they look like
+instead of by their description: "frames like this one" (an image or an
+indexed frame id) and "a red van at the gate" (text in CLIP's space).
+Neither needs the frames described again.
+
+Frames are queued by the request handler and embedded by one worker
+thread in batches of up to FRAME_INDEX_BATCH, which amortises the CLIP
+forward pass and the index append. When the queue is full new frames are
+dropped (and counted) rather than slowing analysis down. Vectors are
+stored as float16 by default: 1 KB per 512-dimensional CLIP frame, so a
+million frames take 1 GB of page cache, and once the index holds
+VECTOR_INDEX_TRAIN_AFTER frames queries only score the IVF cells near
+the query.
+
+Configuration (environment variables):
+    FRAME_INDEX_ENABLED     embed and index analysed frames (default: false)
+    FRAME_INDEX_PATH        index directory (default: frame_index)
+    FRAME_INDEX_DTYPE       vector storage, float16 or float32 (default: float16)
+    FRAME_INDEX_BATCH       frames per CLIP forward pass (default: 32)
+    FRAME_INDEX_QUEUE       frames waiting to be embedded before new ones are dropped (default: 1024)
+    FRAME_INDEX_SAVE_EVERY  seconds between saves of a changed index (default: 10)
+"""
+
+import logging
+import os
+import queue
+import threading
+import time
+from typing import Any, Dict, List, Optional, Sequence, Tuple, Union
+
+from PIL import Image
+
+from clip_encoder import ClipEncoder, decode_image
+from frame_ring import RING_SCHEME, parse_ref
+from frame_ring import reader as frame_ring_reader
+from metrics import metrics
+from vector_index import VectorIndex
+
+logger = logging.getLogger("frame-index")
+
+FRAME_INDEX_ENABLED = os.environ.get("FRAME_INDEX_ENABLED", "false").lower() in ("1", "true", "yes")
+FRAME_INDEX_PATH = os.environ.get("FRAME_INDEX_PATH", "frame_index")
+FRAME_INDEX_DTYPE = os.environ.get("FRAME_INDEX_DTYPE", "float16")
+FRAME_INDEX_BATCH = int(os.environ.get("FRAME_INDEX_BATCH", "32"))
+FRAME_INDEX_QUEUE = int(os.environ.get("FRAME_INDEX_QUEUE", "1024"))
+FRAME_INDEX_SAVE_EVERY = float(os.environ.get("FRAME_INDEX_SAVE_EVERY", "10"))
+
+# Frames are read at this width at most; CLIP sees 224 pixels
+_READ_WIDTH = 448
+
+
+def frame_source(messages: List[Dict[str, Any]]) -> Optional[str]:
+    """The first image of a request as base64 or a ring:// reference, without decoding it."""
+    for message in messages:
+        content = message.get("content")
+        if not isinstance(content, list):
+            continue
+        for part in content:
+            if part.get("type") == "image" and isinstance(part.get("image"), str):
+                return part["image"]
+            if part.get("type") == "image_url":
+                image_url = part.get("image_url", {})
+                url = image_url.get("url", "") if isinstance(image_url, dict) else ""
+                if url.startswith("data:") or url.startswith(RING_SCHEME):
+                    return url
+    return None
+
+
+def load_frame(source: Union[str, Image.Image]) -> Image.Image:
+    """RGB image of a frame source; a ring frame overwritten since it was pinned raises FrameOverwritten."""
+    if isinstance(source, Image.Image):
+        return source.convert("RGB")
+    if source.startswith(RING_SCHEME):
+        return frame_ring_reader.read_image(*parse_ref(source), max_width=_READ_WIDTH).convert("RGB")
+    return decode_image(source)
+
+
+class FrameIndex:
+    """
+    CLIP embeddings of analysed frames with batched inserts and top-k search.
+
+    Args:
+        encoder: CLIP model shared with the pre-screen.
+        path: Index directory; an existing index is reopened.
+        dtype: Storage type of a new index.
+        batch: Frames per CLIP forward pass.
+        queue_size: Frames waiting to be embedded before new ones are dropped.
+        save_every: Seconds between saves of a changed index.
+    """
+
+    def __init__(self, encoder: ClipEncoder, path: str = FRAME_INDEX_PATH, dtype: str = FRAME_INDEX_DTYPE,
+                 batch: int = FRAME_INDEX_BATCH, queue_size: int = FRAME_INDEX_QUEUE,
+                 save_every: float = FRAME_INDEX_SAVE_EVERY):
+        self.encoder = encoder
+        self.path = path
+        self.dtype = dtype
+        self.batch = batch
+        self.save_every = save_every
+        self.index: Optional[VectorIndex] = None
+        self._queue: "queue.Queue[Optional[Tuple[str, Any, Optional[str], float]]]" = queue.Queue(queue_size)
+        self._ready = threading.Event()
+        self._open_lock = threading.Lock()
+        self._worker: Optional[threading.Thread] = None
+        self._dirty = False
+        self._saved_at = time.time()
+
+    @property
+    def ready(self) -> bool:
+        return self._ready.is_set()
+
+    def start(self) -> None:
+        if self._worker is None:
+            self._worker = threading.Thread(target=self._run, name="frame-index", daemon=True)
+            self._worker.start()
+
+    def open(self) -> VectorIndex:
+        """Load the encoder and open the index; the first call creates it with the encoder's dimension."""
+        with self._open_lock:
+            if self.index is None:
+                if os.path.exists(os.path.join(self.path, "meta.json")):
+                    index = VectorIndex(self.path)
+                else:
+                    index = VectorIndex(self.path, dim=self.encoder.dimensions, dtype=self.dtype)
+                self.encoder.load()
+                self.index = index
+                self._ready.set()
+                logger.info(f"Frame index ready: {index.stats()}")
+        return self.index
+
+    # -- inserts -----------------------------------------------------------
+
+    def submit(self, frame_id: str, source: Union[str, Image.Image], stream: Optional[str] = None,
+               timestamp: Optional[float] = None) -> bool:
+        """Queue a frame to be embedded and indexed; False when the queue is full."""
+        try:
+            self._queue.put_nowait((frame_id, source, stream, float(timestamp) if timestamp else time.time()))
+        except queue.Full:
+            metrics.inc("frame_index_frames_total", outcome="dropped")
+            return False
+        metrics.set("frame_index_queue", self._queue.qsize())
+        return True
+
+    def add(self, items: Sequence[Tuple[str, Any, Optional[str], float]]) -> int:
+        """
+        Embed and index frames now, in batches.
+
+        Args:
+            items: ``(frame_id, source, stream, timestamp)`` tuples; a
+                source is an image, base64 data or a ring:// reference.
+
+        Returns:
+            Number of frames indexed; frames that cannot be read are skipped.
+        """
+        index = self.open()
+        added = 0
+        for start in range(0, len(items), self.batch):
+            chunk = []
+            for frame_id, source, stream, timestamp in items[start:start + self.batch]:
+                try:
+                    chunk.append((frame_id, load_frame(source), stream, timestamp))
+                except Exception as e:
+                    metrics.inc("frame_index_frames_total", outcome="unreadable")
+                    logger.debug(f"Frame {frame_id} not indexed: {e}")
+            if not chunk:
+                continue
+            began = time.perf_counter()
+            vectors = self.encoder.embed_images([img for _, img, _, _ in chunk])
+            index.add([frame_id for frame_id, _, _, _ in chunk], vectors,
+                      [stream for _, _, stream, _ in chunk], [timestamp for _, _, _, timestamp in chunk])
+            metrics.observe("frame_index_batch_ms", (time.perf_counter() - began) * 1000)
+            metrics.inc("frame_index_frames_total", len(chunk), outcome="indexed")
+            added += len(chunk)
+            self._dirty = True
+        return added
+
+    def _run(self) -> None:
+        try:
+            self.open()
+        except Exception as e:
+            logger.error(f"Frame index unavailable: {e}")
+            return
+        stopping = False
+        while not stopping:
+            try:
+                items = [self._queue.get(timeout=self.save_every)]
+            except queue.Empty:
+                items = []
+            # Whatever queued up while the previous batch was embedded goes into this one
+            while items and len(items) < self.batch:
+                try:
+                    items.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            if None in items:
+                stopping = True
+                items = [item for item in items if item is not None]
+            metrics.set("frame_index_queue", self._queue.qsize())
+            if items:
+                try:
+                    self.add(items)
+                except Exception as e:
+                    metrics.inc("frame_index_frames_total", len(items), outcome="failed")
+                    logger.warning(f"Failed to index {len(items)} frames: {e}")
+            if self._dirty and time.time() - self._saved_at >= self.save_every:
+                self.save()
+        self.save()
+
+    def save(self) -> None:
+        if self.index is not None and self._dirty:
+            self._dirty = False
+            self._saved_at = time.time()
+            self.index.save()
+
+    def close(self) -> None:
+        """Index what is queued, stop the worker and save."""
+        if self._worker is not None:
+            self._queue.put(None)
+            self._worker.join(timeout=60)
+            self._worker = None
+        self.save()
+
+    # -- search ------------------------------------------------------------
+
+    def search(self, image: Optional[Union[str, Image.Image]] = None, text: Optional[str] = None,
+               frame_id: Optional[str] = None, k: int = 10, **filters) -> List[Dict[str, Any]]:
+        """
+        Frames most similar to an image, a text or an indexed frame.
+
+        Args:
+            image: Query image, base64 data or a ring:// reference.
+            text: Query text, compared in CLIP's joint space.
+            frame_id: An indexed frame; it is left out of its own results.
+            k: Number of results.
+            **filters: ``stream``, ``since``, ``until``, ``nprobe`` and
+                ``exact``, as for ``VectorIndex.search``.
+
+        Returns:
+            Hits ordered by decreasing cosine similarity, each
+            ``{"id", "score", "stream", "timestamp"}``.
+
+        Raises:
+            RuntimeError: The index is still loading.
+            KeyError: ``frame_id`` is not indexed.
+            ValueError: Not exactly one query was given.
+        """
+        if sum(query is not None for query in (image, text, frame_id)) != 1:
+            raise ValueError("Give exactly one of image, text or frame_id")
+        if not self.ready:
+            raise RuntimeError("Frame index is still loading")
+        if frame_id is not None:
+            vector = self.index.vector(frame_id)
+            if vector is None:
+                raise KeyError(frame_id)
+            hits = self.index.search(vector, k + 1, **filters)
+            return [hit for hit in hits if hit["id"] != frame_id][:k]
+        if text is not None:
+            vector = self.encoder.embed_texts([text])[0]
+        else:
+            vector = self.encoder.embed_images([load_frame(image)])[0]
+        return self.index.search(vector, k, **filters)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "ready": self.ready,
+            "model": self.encoder.name,
+            "queued": self._queue.qsize(),
+            **(self.index.stats() if self.index is not None else {}),
+        }
+
+
+def create_frame_index(encoder: Optional[ClipEncoder] = None) -> Optional[FrameIndex]:
+    """The frame index configured by the environment, or None when it is disabled."""
+    if not FRAME_INDEX_ENABLED:
+        return None
+    return FrameIndex(encoder or ClipEncoder())
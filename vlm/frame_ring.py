@@ -0,0 +1,404 @@
+# vlm/frame_ring.py
+"""
+Shared-memory frame rings between a capture process and the VLM server.
+
+Frames normally reach the model as base64 strings inside JSON, copied and
+re-encoded at every hop. When the capture daemon and the VLM server run
+on the same host, the daemon writes each kept frame once into a ring of
+fixed slots in shared memory, one ring per camera, and a request names
+the frame instead of carrying it:
+
+    {"type": "image_url", "image_url": {"url": "ring://<camera>"}}        latest frame
+    {"type": "image_url", "image_url": {"url": "ring://<camera>/<seq>"}}  a given frame
+
+The server pins ``ring://<camera>`` to the current sequence number when
+the request arrives, so coalescing and the answer refer to the frame that
+was current then. The model reads the pixels straight from the slot.
+
+Ring layout (``/dev/shm/<FRAME_RING_PREFIX>-<camera>``)::
+
+    header  magic, slot count, slot capacity, latest sequence number
+    slot    version, sequence, timestamp, length, width, height, format, data
+
+Each slot is guarded by a sequence lock: the writer makes its version odd
+while it writes and even when done, and a reader checks that the version
+it started with is unchanged after it used the data. The writer never
+waits for readers. A reader that was too slow sees FrameOverwritten and
+the slot count decides how far behind a reader may fall. Memory use is
+fixed: slots x capacity per camera.
+
+New frames are announced on a Unix datagram socket (the control
+channel). Readers that want to be woken rather than poll bind it; the
+writer drops the notification when nobody listens.
+
+Frames are either raw RGB (``rgb24``, no encode or decode at all) or
+JPEG; raw frames too large for a slot are written as JPEG instead.
+
+Configuration (environment variables):
+    FRAME_RING_PREFIX      shared memory name prefix of the rings (default: vlm-frames)
+    FRAME_RING_SLOTS       frames kept per camera (default: 4)
+    FRAME_RING_SLOT_BYTES  capacity of a slot; 6.2 MB holds a raw 1080p frame (default: 8388608)
+    FRAME_RING_NOTIFY      Unix socket path of the control channel; empty disables it
+                           (default: /tmp/vlm-frame-ring.sock)
+"""
+
+import io
+import logging
+import os
+import re
+import socket
+import struct
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
+from multiprocessing import resource_tracker, shared_memory
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from PIL import Image
+
+from metrics import metrics
+
+logger = logging.getLogger("frame-ring")
+
+FRAME_RING_PREFIX = os.environ.get("FRAME_RING_PREFIX", "vlm-frames")
+FRAME_RING_SLOTS = int(os.environ.get("FRAME_RING_SLOTS", "4"))
+FRAME_RING_SLOT_BYTES = int(os.environ.get("FRAME_RING_SLOT_BYTES", str(8 * 1024 * 1024)))
+FRAME_RING_NOTIFY = os.environ.get("FRAME_RING_NOTIFY", "/tmp/vlm-frame-ring.sock")
+
+MAGIC = b"VLMRING1"
+CLOSED = b"CLOSED\0\0"
+# magic, slots, slot capacity, latest sequence number
+HEADER = struct.Struct("<8sIIq")
+HEADER_SIZE = 64
+# version, sequence, timestamp, length, width, height, format
+SLOT = struct.Struct("<QqdIIIB")
+SLOT_HEADER_SIZE = 64
+FORMATS = {0: "jpeg", 1: "rgb24"}
+FORMAT_CODES = {name: code for code, name in FORMATS.items()}
+RING_SCHEME = "ring://"
+
+
+class FrameOverwritten(Exception):
+    """The requested frame is no longer (or not yet) in its ring."""
+
+
+@dataclass
+class RingFrame:
+    camera: str
+    seq: int
+    timestamp: float
+    width: int
+    height: int
+    format: str
+    data: memoryview
+
+    def image(self) -> Image.Image:
+        """The frame as an image; its pixels are copied out of the slot once."""
+        if self.format == "rgb24":
+            return Image.frombuffer("RGB", (self.width, self.height), self.data, "raw", "RGB", 0, 1)
+        return Image.open(io.BytesIO(self.data))
+
+
+def segment_name(camera: str, prefix: str = FRAME_RING_PREFIX) -> str:
+    return f"{prefix}-{re.sub(r'[^A-Za-z0-9_.-]', '_', camera)}"
+
+
+def parse_ref(url: str) -> Tuple[str, Optional[int]]:
+    """Camera and sequence number (None for the latest frame) of a ring:// reference."""
+    rest = url[len(RING_SCHEME):].strip("/")
+    camera, _, seq = rest.partition("/")
+    if not camera:
+        raise ValueError(f"No camera in {url}")
+    return camera, int(seq) if seq else None
+
+
+def _open_segment(name: str, size: int = 0) -> shared_memory.SharedMemory:
+    """Attach to a segment, or create it when ``size`` is given, without the resource tracker."""
+    # The resource tracker unlinks every segment a process opened when it exits (Python < 3.13):
+    # a reader would take the writer's rings with it, and a crashed writer would leave
+    # readers mapped to a ring nobody writes to any more
+    create = size > 0
+    try:
+        return shared_memory.SharedMemory(name=name, create=create, size=size, track=False)
+    except TypeError:
+        segment = shared_memory.SharedMemory(name=name, create=create, size=size)
+        resource_tracker.unregister(segment._name, "shared_memory")
+        return segment
+
+
+def _unlink(segment: shared_memory.SharedMemory) -> None:
+    if not hasattr(segment, "_track"):
+        # Before Python 3.13 unlink() also unregisters, which the tracker rejects for an untracked segment
+        resource_tracker.register(segment._name, "shared_memory")
+    segment.close()
+    segment.unlink()
+
+
+class FrameRingWriter:
+    """
+    Producer side: one ring per camera, created on the camera's first frame.
+
+    A ring left behind by a previous writer with the same geometry is
+    reused, so readers that have it mapped keep working across restarts.
+    """
+
+    def __init__(self, prefix: str = FRAME_RING_PREFIX, slots: int = FRAME_RING_SLOTS,
+                 slot_bytes: int = FRAME_RING_SLOT_BYTES, notify_path: str = FRAME_RING_NOTIFY):
+        self.prefix = prefix
+        self.slots = slots
+        self.slot_bytes = slot_bytes
+        self.notify_path = notify_path
+        self._rings: Dict[str, shared_memory.SharedMemory] = {}
+        self._seqs: Dict[str, int] = {}
+        self._lock = threading.Lock()
+        self._socket = None
+        if notify_path:
+            self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            self._socket.setblocking(False)
+
+    @property
+    def size(self) -> int:
+        return HEADER_SIZE + self.slots * (SLOT_HEADER_SIZE + self.slot_bytes)
+
+    def _ring(self, camera: str) -> shared_memory.SharedMemory:
+        ring = self._rings.get(camera)
+        if ring is not None:
+            return ring
+        name = segment_name(camera, self.prefix)
+        try:
+            ring = _open_segment(name, self.size)
+            seq = 0
+        except FileExistsError:
+            ring = _open_segment(name)
+            magic, slots, slot_bytes, latest = HEADER.unpack_from(ring.buf, 0)
+            if (magic, slots, slot_bytes) == (MAGIC, self.slots, self.slot_bytes) and ring.size >= self.size:
+                seq = latest
+                logger.info(f"Reusing frame ring {name} at sequence {latest}")
+            else:
+                # A different geometry: readers reattach once they see it closed
+                ring.buf[:len(CLOSED)] = CLOSED
+                _unlink(ring)
+                ring = _open_segment(name, self.size)
+                seq = 0
+        HEADER.pack_into(ring.buf, 0, MAGIC, self.slots, self.slot_bytes, seq)
+        self._rings[camera] = ring
+        self._seqs[camera] = seq
+        return ring
+
+    def fits(self, length: int) -> bool:
+        return length <= self.slot_bytes
+
+    def write(self, camera: str, data, width: int, height: int, fmt: str = "jpeg",
+              timestamp: Optional[float] = None) -> int:
+        """
+        Copy one frame into the camera's next slot and announce it.
+
+        Args:
+            data: Frame bytes, or any C-contiguous buffer (e.g. an RGB ndarray).
+            fmt: "jpeg" or "rgb24".
+
+        Returns:
+            The frame's sequence number.
+        """
+        view = memoryview(data).cast("B")
+        if len(view) > self.slot_bytes:
+            raise ValueError(f"Frame of {len(view)} bytes does not fit a {self.slot_bytes} byte slot")
+        with self._lock:
+            ring = self._ring(camera)
+            seq = self._seqs[camera] + 1
+            offset = HEADER_SIZE + (seq % self.slots) * (SLOT_HEADER_SIZE + self.slot_bytes)
+            version = SLOT.unpack_from(ring.buf, offset)[0]
+            # Odd while writing: readers of the old frame see it change and drop their copy
+            struct.pack_into("<Q", ring.buf, offset, version + 1 if version % 2 == 0 else version)
+            start = offset + SLOT_HEADER_SIZE
+            ring.buf[start:start + len(view)] = view
+            SLOT.pack_into(ring.buf, offset, (version | 1) + 1, seq, timestamp or time.time(), len(view),
+                           width, height, FORMAT_CODES[fmt])
+            struct.pack_into("<q", ring.buf, 16, seq)
+            self._seqs[camera] = seq
+        metrics.inc("frame_ring_writes_total")
+        metrics.inc("frame_ring_bytes_total", len(view))
+        self._notify(camera, seq)
+        return seq
+
+    def _notify(self, camera: str, seq: int) -> None:
+        if self._socket is None:
+            return
+        try:
+            self._socket.sendto(f"{camera}\0{seq}".encode("utf-8"), self.notify_path)
+        except (FileNotFoundError, ConnectionRefusedError, BlockingIOError):
+            # Nobody listens, or the listener is behind; readers can still poll
+            pass
+
+    def remove(self, camera: str) -> None:
+        with self._lock:
+            ring = self._rings.pop(camera, None)
+            self._seqs.pop(camera, None)
+        if ring is not None:
+            ring.buf[:len(CLOSED)] = CLOSED
+            _unlink(ring)
+
+    def close(self) -> None:
+        for camera in list(self._rings):
+            self.remove(camera)
+        if self._socket is not None:
+            self._socket.close()
+
+
+class FrameRingReader:
+    """Consumer side: attaches to camera rings on first use."""
+
+    def __init__(self, prefix: str = FRAME_RING_PREFIX):
+        self.prefix = prefix
+        self._rings: Dict[str, shared_memory.SharedMemory] = {}
+        self._lock = threading.Lock()
+        self._changed = threading.Condition()
+        self._listener: Optional[threading.Thread] = None
+
+    def _ring(self, camera: str) -> shared_memory.SharedMemory:
+        with self._lock:
+            ring = self._rings.get(camera)
+            if ring is not None and bytes(ring.buf[:len(MAGIC)]) == MAGIC:
+                return ring
+            if ring is not None:
+                # The writer closed or replaced the ring
+                ring.close()
+                del self._rings[camera]
+            try:
+                ring = _open_segment(segment_name(camera, self.prefix))
+            except FileNotFoundError:
+                raise FrameOverwritten(f"No frame ring for camera {camera}")
+            if bytes(ring.buf[:len(MAGIC)]) != MAGIC:
+                ring.close()
+                raise FrameOverwritten(f"Frame ring of camera {camera} is not ready")
+            self._rings[camera] = ring
+            return ring
+
+    def latest_seq(self, camera: str) -> Optional[int]:
+        seq = HEADER.unpack_from(self._ring(camera).buf, 0)[3]
+        return seq or None
+
+    @contextmanager
+    def frame(self, camera: str, seq: Optional[int] = None) -> Iterator[RingFrame]:
+        """
+        The frame ``seq`` (default: latest) with its data still in the slot.
+
+        Use the data inside the block only. Raises FrameOverwritten when the
+        frame is gone, or when the writer replaced it while the block ran.
+        """
+        ring = self._ring(camera)
+        _, slots, slot_bytes, latest = HEADER.unpack_from(ring.buf, 0)
+        seq = latest if seq is None else seq
+        if not seq or seq > latest or seq <= latest - slots:
+            raise FrameOverwritten(f"Frame {seq} of camera {camera} is not in its ring (latest {latest})")
+        offset = HEADER_SIZE + (seq % slots) * (SLOT_HEADER_SIZE + slot_bytes)
+        version, slot_seq, timestamp, length, width, height, fmt = SLOT.unpack_from(ring.buf, offset)
+        if version % 2 or slot_seq != seq:
+            raise FrameOverwritten(f"Frame {seq} of camera {camera} was overwritten")
+        start = offset + SLOT_HEADER_SIZE
+        data = ring.buf[start:start + length]
+        try:
+            yield RingFrame(camera, seq, timestamp, width, height, FORMATS[fmt], data)
+        finally:
+            try:
+                data.release()
+            except BufferError:
+                # Still exported by the caller; the check below still tells whether it was valid
+                pass
+        if struct.unpack_from("<Q", ring.buf, offset)[0] != version:
+            metrics.inc("frame_ring_overwritten_total")
+            raise FrameOverwritten(f"Frame {seq} of camera {camera} was overwritten while it was read")
+
+    def read_image(self, camera: str, seq: Optional[int] = None, max_width: Optional[int] = None) -> Image.Image:
+        """Frame as an RGB image of its own, downscaled to ``max_width``."""
+        with self.frame(camera, seq) as frame:
+            img = frame.image()
+            if img.mode != "RGB":
+                img = img.convert("RGB")
+            img.load()
+            if max_width and img.width > max_width:
+                img = img.resize((max_width, int(img.height / img.width * max_width)), Image.LANCZOS)
+        metrics.inc("frame_ring_reads_total")
+        return img
+
+    def frame_size(self, camera: str, seq: Optional[int] = None) -> Optional[Tuple[int, int]]:
+        try:
+            with self.frame(camera, seq) as frame:
+                return frame.width, frame.height
+        except FrameOverwritten:
+            return None
+
+    def listen(self, notify_path: str = FRAME_RING_NOTIFY) -> None:
+        """Bind the control channel so ``wait`` wakes on new frames instead of polling."""
+        if self._listener is not None or not notify_path:
+            return
+        if os.path.exists(notify_path):
+            os.remove(notify_path)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sock.bind(notify_path)
+
+        def receive():
+            while True:
+                sock.recv(256)
+                with self._changed:
+                    self._changed.notify_all()
+
+        self._listener = threading.Thread(target=receive, name="frame-ring-notify", daemon=True)
+        self._listener.start()
+
+    def wait(self, camera: str, after_seq: int, timeout: float) -> Optional[int]:
+        """Sequence number of the first frame newer than ``after_seq``, or None on timeout."""
+        deadline = time.monotonic() + timeout
+        with self._changed:
+            while True:
+                try:
+                    latest = self.latest_seq(camera)
+                except FrameOverwritten:
+                    latest = None
+                if latest is not None and latest > after_seq:
+                    return latest
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                # Without the control channel this is a 1 ms poll
+                self._changed.wait(min(remaining, 0.001 if self._listener is None else remaining))
+
+    def close(self) -> None:
+        with self._lock:
+            for ring in self._rings.values():
+                ring.close()
+            self._rings.clear()
+
+
+def pin_refs(messages: List[Dict[str, Any]], ring_reader: FrameRingReader) -> List[Dict[str, Any]]:
+    """
+    Messages whose ``ring://<camera>`` references name the camera's current frame.
+
+    Raises FrameOverwritten when a camera has no ring or no frame yet.
+    """
+    pinned = []
+    changed = False
+    for message in messages:
+        content = message.get("content")
+        if isinstance(content, list):
+            parts = []
+            for part in content:
+                image_url = part.get("image_url") if part.get("type") == "image_url" else None
+                url = image_url.get("url", "") if isinstance(image_url, dict) else ""
+                if url.startswith(RING_SCHEME):
+                    camera, seq = parse_ref(url)
+                    if seq is None:
+                        seq = ring_reader.latest_seq(camera)
+                        if seq is None:
+                            raise FrameOverwritten(f"Camera {camera} has no frame yet")
+                        part = {**part, "image_url": {**image_url, "url": f"{RING_SCHEME}{camera}/{seq}"}}
+                        changed = True
+                parts.append(part)
+            message = {**message, "content": parts}
+        pinned.append(message)
+    return pinned if changed else messages
+
+
+# Shared reader used by the servers in this process
+reader = FrameRingReader()
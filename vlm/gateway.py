@@ -0,0 +1,453 @@
+# vlm/gateway.py
+"""
+Gateway in front of several VLM server replicas.
+
+Requests of one camera go to the same replica, picked by consistent
+hashing on the stream id, so that replica's result cache, coalescing and
+per-camera queue stay warm; adding or losing a replica only moves the
+cameras it owned. When that replica already has too many requests
+outstanding the request goes to the replica with the fewest instead.
+Requests without a camera id always take the least loaded replica, and
+session requests follow the replica that created the session.
+
+Replicas may serve different models: a request goes to the replicas
+that list its ``model`` in ``/v1/models`` (all of them when none does).
+The model lists are asked for again every ``GATEWAY_MODELS_REFRESH``
+seconds, and right away when a replica answers a model request with 404
+or 503, so models loaded or unloaded through ``/admin/models`` are
+followed. Health is tracked passively from real traffic: connection
+errors, timeouts and 502/503/504 answers count as failures, and a
+replica with several failures in a row is left out for a while and then
+tried again with live traffic. A 503 with ``Retry-After`` (a model still
+loading, no room for another model) is the replica answering as
+designed and counts neither way. Connections to the replicas are kept
+alive and reused.
+
+Endpoints:
+    /v1/*               proxied to a replica
+    GET /v1/models      models of every replica
+    GET /gateway/backends  load, latency and health of each replica
+    GET /health, GET /metrics
+
+Configuration (environment variables):
+    GATEWAY_BACKENDS         comma separated replica URLs, "model=url" pins a replica to one model
+                             (default: http://localhost:8881)
+    GATEWAY_MAX_OUTSTANDING  requests in flight before a replica counts as saturated (default: 8)
+    GATEWAY_MAX_FAILS        failures in a row before a replica is ejected (default: 3)
+    GATEWAY_EJECT_SECONDS    how long an ejected replica is left out (default: 10)
+    GATEWAY_TIMEOUT          seconds to wait for a replica's answer (default: 300)
+    GATEWAY_KEEPALIVE        idle connections kept per replica (default: 32)
+    GATEWAY_MODELS_REFRESH   seconds between model list refreshes (default: 30)
+    GATEWAY_PORT             listen port (default: 8800)
+"""
+
+import asyncio
+import bisect
+import hashlib
+import json
+import logging
+import os
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from typing import Dict, Iterator, List, Optional, Set
+
+import httpx
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+
+from metrics import metrics
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    handlers=[logging.StreamHandler()]
+)
+logger = logging.getLogger("vlm-gateway")
+
+BACKENDS = os.environ.get("GATEWAY_BACKENDS", "http://localhost:8881")
+MAX_OUTSTANDING = int(os.environ.get("GATEWAY_MAX_OUTSTANDING", "8"))
+MAX_FAILS = int(os.environ.get("GATEWAY_MAX_FAILS", "3"))
+EJECT_SECONDS = float(os.environ.get("GATEWAY_EJECT_SECONDS", "10"))
+TIMEOUT = float(os.environ.get("GATEWAY_TIMEOUT", "300"))
+KEEPALIVE = int(os.environ.get("GATEWAY_KEEPALIVE", "32"))
+MODELS_REFRESH = float(os.environ.get("GATEWAY_MODELS_REFRESH", "30"))
+PORT = int(os.environ.get("GATEWAY_PORT", "8800"))
+
+# Points per replica on the hash ring; more points spread the cameras more evenly
+VIRTUAL_NODES = 160
+# Sessions remembered for routing follow-up turns to their replica
+MAX_SESSION_ROUTES = 10000
+# Shortest gap between two model list requests to one replica triggered by 404/503 answers
+MIN_REDISCOVER_SECONDS = 5
+
+_HOP_BY_HOP = {"connection", "keep-alive", "transfer-encoding", "content-length", "host",
+               "proxy-connection", "te", "trailer", "upgrade"}
+_FAILURE_STATUS = {502, 503, 504}
+
+
+def _hash(value: str) -> int:
+    return int.from_bytes(hashlib.md5(value.encode("utf-8")).digest()[:8], "big")
+
+
+class HashRing:
+    """Consistent hash ring over replica URLs."""
+
+    def __init__(self, nodes: List[str], virtual_nodes: int = VIRTUAL_NODES):
+        points = sorted((_hash(f"{node}#{i}"), node) for node in nodes for i in range(virtual_nodes))
+        self._hashes = [point for point, _ in points]
+        self._nodes = [node for _, node in points]
+
+    def walk(self, key: str) -> Iterator[str]:
+        """Yield every node once, starting with the owner of ``key``."""
+        if not self._nodes:
+            return
+        start = bisect.bisect(self._hashes, _hash(key))
+        seen = set()
+        for i in range(len(self._nodes)):
+            node = self._nodes[(start + i) % len(self._nodes)]
+            if node not in seen:
+                seen.add(node)
+                yield node
+
+
+@dataclass
+class Backend:
+    """One replica and what the gateway observed about it."""
+
+    url: str
+    models: Optional[Set[str]] = None  # None serves any model
+    outstanding: int = 0
+    failures: int = 0
+    ejected_until: float = 0.0
+    latency_ms: float = 0.0  # moving average of completed requests
+    requests: int = 0
+    errors: int = 0
+    pinned: bool = False  # models given in GATEWAY_BACKENDS, not discovered
+    discovered_at: float = 0.0
+
+    @property
+    def available(self) -> bool:
+        return time.time() >= self.ejected_until
+
+    def serves(self, model: Optional[str]) -> bool:
+        return model is None or self.models is None or model.lower() in self.models
+
+    def started(self) -> None:
+        self.outstanding += 1
+        self.requests += 1
+        metrics.set("gateway_backend_outstanding", self.outstanding, backend=self.url)
+
+    def finished(self, elapsed: float, ok: Optional[bool]) -> None:
+        """Account a request that ended; ``ok=None`` for answers that say nothing about health."""
+        self.outstanding -= 1
+        metrics.set("gateway_backend_outstanding", self.outstanding, backend=self.url)
+        if ok is None:
+            return
+        if not ok:
+            self.errors += 1
+            self.failures += 1
+            metrics.inc("gateway_backend_failures_total", backend=self.url)
+            # Once over the limit every further failure (the trial after an ejection, too) ejects it again
+            if self.failures >= MAX_FAILS:
+                self.ejected_until = time.time() + EJECT_SECONDS
+                metrics.inc("gateway_backend_ejections_total", backend=self.url)
+                logger.warning(f"Ejected {self.url} for {EJECT_SECONDS:.0f}s after {self.failures} failures in a row")
+            return
+        if self.failures >= MAX_FAILS:
+            logger.info(f"{self.url} is answering again")
+        self.failures = 0
+        elapsed_ms = elapsed * 1000
+        self.latency_ms = elapsed_ms if self.latency_ms == 0 else self.latency_ms + 0.2 * (elapsed_ms - self.latency_ms)
+        metrics.set("gateway_backend_latency_ms", round(self.latency_ms, 1), backend=self.url)
+
+    def info(self) -> Dict:
+        return {
+            "url": self.url,
+            "models": sorted(self.models) if self.models is not None else None,
+            "available": self.available,
+            "outstanding": self.outstanding,
+            "failures": self.failures,
+            "latency_ms": round(self.latency_ms, 1),
+            "requests": self.requests,
+            "errors": self.errors,
+        }
+
+
+def parse_backends(spec: str) -> List[Backend]:
+    """Parse ``GATEWAY_BACKENDS``: ``url`` or ``model=url`` entries separated by commas."""
+    backends = []
+    for entry in filter(None, (part.strip() for part in spec.split(","))):
+        model, _, url = entry.partition("=") if "=" in entry.split("://", 1)[0] else ("", "", entry)
+        backend = Backend(url=url.rstrip("/"))
+        if model:
+            backend.models = {model.lower()}
+            backend.pinned = True
+        backends.append(backend)
+    return backends
+
+
+class Router:
+    """
+    Picks a replica per request.
+
+    Args:
+        backends: The replicas.
+        max_outstanding: In-flight requests at which a replica counts as saturated.
+    """
+
+    def __init__(self, backends: List[Backend], max_outstanding: int = MAX_OUTSTANDING):
+        self.backends = {backend.url: backend for backend in backends}
+        self.max_outstanding = max_outstanding
+        self.ring = HashRing(list(self.backends))
+        self.sessions: "OrderedDict[str, str]" = OrderedDict()
+
+    def choose(self, key: Optional[str], model: Optional[str],
+               exclude: Set[str] = frozenset()) -> Optional[Backend]:
+        """
+        The replica for a request.
+
+        Args:
+            key: Camera (or session) id to keep on one replica, if any.
+            model: Requested model.
+            exclude: Replicas that already failed this request.
+        """
+        serving = [b for b in self.backends.values() if b.serves(model)] or list(self.backends.values())
+        candidates = [b for b in serving if b.available and b.url not in exclude]
+        if not candidates:
+            # Everything is ejected: a replica that might be back beats failing outright
+            candidates = [b for b in serving if b.url not in exclude]
+        if not candidates:
+            return None
+
+        if key is not None:
+            eligible = {b.url for b in candidates}
+            owner = next((self.backends[url] for url in self.ring.walk(key) if url in eligible), None)
+            if owner is not None and owner.outstanding < self.max_outstanding:
+                metrics.inc("gateway_routed_total", route="hash")
+                return owner
+            metrics.inc("gateway_routed_total", route="saturated")
+        else:
+            metrics.inc("gateway_routed_total", route="least_outstanding")
+        return min(candidates, key=lambda b: (b.outstanding, b.latency_ms))
+
+    def remember_session(self, session_id: str, url: str) -> None:
+        self.sessions[session_id] = url
+        self.sessions.move_to_end(session_id)
+        while len(self.sessions) > MAX_SESSION_ROUTES:
+            self.sessions.popitem(last=False)
+
+    def session_backend(self, session_id: str) -> Optional[Backend]:
+        url = self.sessions.get(session_id)
+        return self.backends.get(url) if url else None
+
+
+router = Router(parse_backends(BACKENDS))
+client: Optional[httpx.AsyncClient] = None
+
+
+_rediscovering: Set[asyncio.Task] = set()
+
+
+async def discover_models(backend: Backend) -> None:
+    """Ask a replica for its models; without an answer it is assumed to serve any."""
+    refresh, previous = backend.discovered_at > 0, backend.models
+    backend.discovered_at = time.time()
+    try:
+        response = await client.get(f"{backend.url}/v1/models", timeout=2.0)
+        response.raise_for_status()
+        backend.models = {model["id"].lower() for model in response.json().get("data", [])} or None
+    except Exception as e:
+        if not refresh or previous is not None:
+            logger.info(f"No model list from {backend.url} ({e!r}), routing any model to it")
+        backend.models = None
+        return
+    if refresh and backend.models != previous:
+        logger.info(f"Replica {backend.url}: models {sorted(backend.models) if backend.models else 'any'}")
+
+
+def rediscover(backend: Backend) -> None:
+    """Refresh a replica's models in the background, at most every MIN_REDISCOVER_SECONDS."""
+    if backend.pinned or time.time() - backend.discovered_at < MIN_REDISCOVER_SECONDS:
+        return
+    task = asyncio.create_task(discover_models(backend))
+    _rediscovering.add(task)
+    task.add_done_callback(_rediscovering.discard)
+
+
+async def refresh_models() -> None:
+    while True:
+        await asyncio.sleep(MODELS_REFRESH)
+        for backend in router.backends.values():
+            if not backend.pinned:
+                await discover_models(backend)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global client
+    # One pooled client: connections to the replicas stay open between requests
+    client = httpx.AsyncClient(
+        timeout=httpx.Timeout(TIMEOUT, connect=2.0),
+        limits=httpx.Limits(max_connections=None, max_keepalive_connections=KEEPALIVE * len(router.backends),
+                            keepalive_expiry=60.0),
+    )
+    for backend in router.backends.values():
+        if not backend.pinned:
+            await discover_models(backend)
+        logger.info(f"Replica {backend.url}: models {sorted(backend.models) if backend.models else 'any'}")
+    refresher = asyncio.create_task(refresh_models())
+    yield
+    refresher.cancel()
+    await client.aclose()
+
+
+app = FastAPI(title="VLM Gateway", lifespan=lifespan)
+
+
+def routing_key(path: str, payload: Optional[dict], request: Request) -> Optional[str]:
+    """Camera id of a request, from the body, the X-Stream-Id header or a /v1/streams/{id}/... path."""
+    stream_id = (payload or {}).get("stream_id") or request.headers.get("X-Stream-Id")
+    parts = path.split("/")
+    if not stream_id and len(parts) >= 4 and parts[1] == "streams":
+        stream_id = parts[2]
+    return f"stream:{stream_id}" if stream_id else None
+
+
+def _session_id(path: str) -> Optional[str]:
+    parts = path.split("/")
+    if len(parts) >= 3 and parts[0] == "v1" and parts[1] == "sessions":
+        return parts[2]
+    return None
+
+
+def _forward_headers(request: Request) -> Dict[str, str]:
+    headers = {k: v for k, v in request.headers.items() if k.lower() not in _HOP_BY_HOP}
+    if request.client is not None:
+        headers["X-Forwarded-For"] = request.client.host
+    return headers
+
+
+def _response_headers(response: httpx.Response, backend: Backend) -> Dict[str, str]:
+    headers = {k: v for k, v in response.headers.items() if k.lower() not in _HOP_BY_HOP}
+    headers["X-Backend"] = backend.url
+    return headers
+
+
+@app.get("/v1/models")
+async def list_models():
+    """Every model served by some replica"""
+    models = sorted({model for b in router.backends.values() for model in (b.models or ())})
+    return {"object": "list", "data": [{"id": model, "object": "model", "owned_by": "gateway"} for model in models]}
+
+
+@app.get("/gateway/backends")
+async def list_backends():
+    return {"backends": [backend.info() for backend in router.backends.values()]}
+
+
+@app.get("/health")
+async def health_check():
+    available = sum(1 for backend in router.backends.values() if backend.available)
+    return {"status": "ok" if available else "degraded", "backends": len(router.backends), "available": available}
+
+
+@app.get("/metrics")
+async def get_metrics():
+    return metrics.snapshot()
+
+
+@app.api_route("/v1/{rest:path}", methods=["GET", "POST", "PUT", "DELETE"])
+async def proxy(rest: str, request: Request):
+    """Forward a request to the replica chosen for it"""
+    path = f"v1/{rest}"
+    body = await request.body()
+    payload = None
+    if body and "json" in request.headers.get("content-type", ""):
+        try:
+            payload = json.loads(body)
+        except ValueError:
+            payload = None
+    if not isinstance(payload, dict):
+        payload = None
+    model = payload.get("model") if payload else None
+
+    # Sessions unknown here (e.g. after a gateway restart) are routed like any request; a 404 tells the client to start over
+    session_id = _session_id(path)
+    pinned = router.session_backend(session_id) if session_id else None
+    key = routing_key(path, payload, request)
+    headers = _forward_headers(request)
+
+    tried: Set[str] = set()
+    while True:
+        backend = pinned if pinned is not None else router.choose(key, model, tried)
+        if backend is None:
+            return JSONResponse(status_code=503, content={"error": {"message": "No replica available", "type": "no_backend"}})
+        tried.add(backend.url)
+        backend.started()
+        started = time.time()
+        upstream = client.build_request(request.method, f"{backend.url}/{path}", params=request.query_params,
+                                        headers=headers, content=body)
+        try:
+            response = await client.send(upstream, stream=True)
+            break
+        except (httpx.ConnectError, httpx.ConnectTimeout) as e:
+            # The replica never saw the request, so another one may take it
+            backend.finished(time.time() - started, ok=False)
+            logger.warning(f"Cannot reach {backend.url}: {e!r}")
+            if pinned is not None:
+                return JSONResponse(status_code=502, content={"error": {"message": f"Session replica unreachable: {e!r}", "type": "bad_gateway"}})
+            metrics.inc("gateway_retries_total")
+        except httpx.HTTPError as e:
+            backend.finished(time.time() - started, ok=False)
+            logger.warning(f"Request to {backend.url} failed: {e!r}")
+            return JSONResponse(status_code=504 if isinstance(e, httpx.TimeoutException) else 502,
+                                content={"error": {"message": f"Replica error: {e!r}", "type": "bad_gateway"}})
+
+    if response.status_code == 503 and "retry-after" in response.headers:
+        # Loading a model or at its model limit: alive and answering, so no health failure
+        ok = None
+    else:
+        ok = response.status_code not in _FAILURE_STATUS
+    if model and response.status_code in (404, 503):
+        rediscover(backend)
+    metrics.inc("gateway_requests_total", backend=backend.url)
+
+    if response.headers.get("content-type", "").startswith("text/event-stream"):
+        async def relay():
+            completed = False
+            try:
+                async for chunk in response.aiter_raw():
+                    yield chunk
+                completed = True
+            finally:
+                await response.aclose()
+                backend.finished(time.time() - started, ok=ok if ok is None else ok and completed)
+
+        return StreamingResponse(relay(), status_code=response.status_code,
+                                 headers=_response_headers(response, backend))
+
+    try:
+        content = b"".join([chunk async for chunk in response.aiter_raw()])
+    except httpx.HTTPError as e:
+        backend.finished(time.time() - started, ok=False)
+        return JSONResponse(status_code=502, content={"error": {"message": f"Replica error: {e!r}", "type": "bad_gateway"}})
+    finally:
+        await response.aclose()
+    backend.finished(time.time() - started, ok=ok)
+
+    if path == "v1/sessions" and request.method == "POST" and response.status_code == 200:
+        try:
+            router.remember_session(json.loads(content)["id"], backend.url)
+        except (ValueError, KeyError):
+            pass
+    elif session_id and request.method == "DELETE":
+        router.sessions.pop(session_id, None)
+    return Response(content=content, status_code=response.status_code, headers=_response_headers(response, backend))
+
+
+if __name__ == "__main__":
+    logger.info(f"Starting VLM gateway on port {PORT} for {', '.join(router.backends)}")
+    uvicorn.run("gateway:app", host="0.0.0.0", port=PORT, log_level="info")
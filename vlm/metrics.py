@@ -0,0 +1,75 @@
+# vlm/metrics.py
+"""
+Process-wide metrics registry shared by the VLM servers.
+
+Counters only go up, gauges hold the latest value and summaries keep
+count/sum/max of observed values. Everything is exposed as plain JSON
+through the servers' /metrics endpoint.
+"""
+
+import threading
+import time
+from collections import defaultdict
+from typing import Dict
+
+
+def _key(name: str, labels: Dict[str, str]) -> str:
+    """Build a flat metric key such as ``requests_total{stream=cam1}``."""
+    if not labels:
+        return name
+    rendered = ",".join(f"{k}={labels[k]}" for k in sorted(labels))
+    return f"{name}{{{rendered}}}"
+
+
+class Metrics:
+    """Thread-safe counters, gauges and summaries."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = defaultdict(float)
+        self._gauges = {}
+        self._summaries = {}
+        self._started = time.time()
+
+    def inc(self, name: str, value: float = 1, **labels) -> None:
+        """Increase a counter."""
+        with self._lock:
+            self._counters[_key(name, labels)] += value
+
+    def set(self, name: str, value: float, **labels) -> None:
+        """Set a gauge to its current value."""
+        with self._lock:
+            self._gauges[_key(name, labels)] = value
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        """Record one observation into a count/sum/max summary."""
+        with self._lock:
+            key = _key(name, labels)
+            summary = self._summaries.get(key)
+            if summary is None:
+                summary = self._summaries[key] = {"count": 0, "sum": 0.0, "max": value}
+            summary["count"] += 1
+            summary["sum"] += value
+            summary["max"] = max(summary["max"], value)
+
+    def counter(self, name: str, **labels) -> float:
+        with self._lock:
+            return self._counters.get(_key(name, labels), 0.0)
+
+    def snapshot(self) -> dict:
+        """Return a JSON-serialisable copy of every metric."""
+        with self._lock:
+            summaries = {
+                key: {**s, "avg": s["sum"] / s["count"] if s["count"] else 0.0}
+                for key, s in self._summaries.items()
+            }
+            return {
+                "uptime_seconds": round(time.time() - self._started, 3),
+                "counters": dict(self._counters),
+                "gauges": dict(self._gauges),
+                "summaries": summaries,
+            }
+
+
+# Shared registry used by every module in the process
+metrics = Metrics()
@@ -0,0 +1,410 @@
+# vlm/model_manager.py
+"""
+Resident models, background loading and hot swaps.
+
+Every Qwen2.5-VL checkpoint the server may use is listed in
+``MODEL_REGISTRY`` (``id=path`` entries). Several can stay loaded at
+once. A request selects one through its ``model`` field, and names the
+server does not know go to the default model, so existing clients keep
+working. A registered model that is not loaded yet is loaded in the
+background; until it is warm, its requests are answered with 503 and
+``Retry-After``.
+
+Loading happens on its own thread while the current models keep
+serving. The new model then runs a warm-up generation through the
+scheduler, like any request. Only once that has passed does a swap (a
+load with ``default``) switch the default in one step. Requests already
+queued finish on the model they were submitted for.
+
+All GPU work stays on the scheduler's inference thread: every job
+activates its model right before it runs, and jobs of different models
+are never batched together. After a load, the least recently used models
+are unloaded until at most ``MODEL_MAX_RESIDENT`` are resident and their
+weights fit ``MODEL_MEMORY_BUDGET_MB``. The default model, the model just
+loaded and models with queued jobs are never unloaded, so a load that
+would leave more than ``MODEL_MAX_RESIDENT`` models resident is refused
+(503 with ``Retry-After`` for requests, 409 on the admin endpoint) until
+one of the others can go.
+
+Configuration (environment variables):
+    MODEL_REGISTRY          comma-separated id=path entries (default: Qwen2.5-VL-3B-Instruct=$QWEN_MODEL_PATH)
+    MODEL_DEFAULT           id of the model loaded at startup (default: first registry entry)
+    MODEL_MAX_RESIDENT      models kept loaded at once (default: 1, i.e. swap)
+    MODEL_MEMORY_BUDGET_MB  weight memory of all resident models, 0 for no limit (default: 0)
+    MODEL_WARMUP_TIMEOUT    seconds the warm-up generation may take (default: 600)
+"""
+
+import logging
+import os
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List, Optional
+
+from fastapi import HTTPException
+
+from metrics import metrics
+
+logger = logging.getLogger("model-manager")
+
+DEFAULT_MODEL_ID = "Qwen2.5-VL-3B-Instruct"
+MODEL_REGISTRY = os.environ.get(
+    "MODEL_REGISTRY", f"{DEFAULT_MODEL_ID}={os.environ.get('QWEN_MODEL_PATH', DEFAULT_MODEL_ID)}"
+)
+MODEL_DEFAULT = os.environ.get("MODEL_DEFAULT", "")
+MODEL_MAX_RESIDENT = int(os.environ.get("MODEL_MAX_RESIDENT", "1"))
+MODEL_MEMORY_BUDGET_MB = float(os.environ.get("MODEL_MEMORY_BUDGET_MB", "0"))
+MODEL_WARMUP_TIMEOUT = float(os.environ.get("MODEL_WARMUP_TIMEOUT", "600"))
+
+RETRY_AFTER_SECONDS = 30
+
+
+class AtCapacity(ValueError):
+    """No resident model can make room for another one now."""
+
+
+def parse_registry(spec: str) -> Dict[str, str]:
+    """``id=path`` entries; an entry without ``=`` uses its last path component as id."""
+    registry = {}
+    for entry in spec.split(","):
+        entry = entry.strip()
+        if not entry:
+            continue
+        model_id, sep, path = entry.partition("=")
+        if not sep:
+            path, model_id = entry, os.path.basename(entry.rstrip("/"))
+        registry[model_id.strip()] = path.strip()
+    return registry
+
+
+@dataclass
+class ResidentModel:
+    id: str
+    path: str
+    model: Any
+    processor: Any
+    bytes: int
+    loaded_at: float = field(default_factory=time.time)
+    last_used: float = field(default_factory=time.time)
+    ready: bool = False  # set once the warm-up generation passed
+    queued: int = 0  # jobs submitted and not finished
+
+    def info(self, default: bool) -> Dict[str, Any]:
+        return {
+            "id": self.id,
+            "object": "model",
+            "created": int(self.loaded_at),
+            "owned_by": "alibaba",
+            "permission": [],
+            "root": self.path,
+            "parent": None,
+            "status": "ready" if self.ready else "warming",
+            "default": default,
+            "memory_mb": round(self.bytes / 2**20),
+            "last_used": int(self.last_used),
+        }
+
+
+class ModelManager:
+    """
+    Models resident on this server and the one requests use by default.
+
+    Args:
+        scheduler: The ``InferenceScheduler`` all model work runs on.
+        backend: Module with ``load_weights(path)``, ``activate(model, processor)``
+            and ``warm_up()``; qwen_backend when omitted.
+    """
+
+    def __init__(self, scheduler, backend=None, registry: Optional[Dict[str, str]] = None,
+                 default: str = MODEL_DEFAULT, max_resident: int = MODEL_MAX_RESIDENT,
+                 budget_mb: float = MODEL_MEMORY_BUDGET_MB):
+        if backend is None:
+            import qwen_backend as backend
+        self.scheduler = scheduler
+        self.backend = backend
+        self.registry = dict(registry if registry is not None else parse_registry(MODEL_REGISTRY))
+        self.default = default or next(iter(self.registry))
+        self.max_resident = max(1, max_resident)
+        self.budget_bytes = int(budget_mb * 2**20) if budget_mb > 0 else None
+        self._models: Dict[str, ResidentModel] = {}
+        # Background loads by model id: "loading", "warming", or the error of a failed load
+        self._loads: Dict[str, str] = {}
+        self._lock = threading.Lock()
+        self._active: Optional[str] = None
+
+    def start(self) -> None:
+        """Load the default model in the foreground; called once at startup."""
+        path = self.registry.setdefault(self.default, self.default)
+        logger.info(f"Loading default model {self.default} from {path}...")
+        model, processor = self.backend.load_weights(path)
+        with self._lock:
+            self._models[self.default] = ResidentModel(self.default, path, model, processor,
+                                                       self._footprint(model), ready=True)
+        self.backend.activate(model, processor)
+        self._active = self.default
+        self._update_gauges()
+        logger.info(f"Model {self.default} loaded")
+
+    # Requests
+
+    def resolve(self, name: Optional[str]) -> str:
+        """
+        Model id that serves a request's ``model`` field.
+
+        Raises:
+            HTTPException: 503 while the requested model is loading.
+        """
+        with self._lock:
+            model_id = self._match(name)
+            if model_id is None:
+                return self.default
+            resident = self._models.get(model_id)
+            if resident is not None and resident.ready:
+                return model_id
+            state = self._loads.get(model_id)
+        if state is not None and state.startswith("failed"):
+            # Failed loads are retried through the admin endpoint, not by every request
+            raise HTTPException(status_code=503, detail=f"Model '{model_id}' {state}")
+        if state is None:
+            # Registered but not resident (never loaded, or unloaded): load it now
+            try:
+                self.load(model_id)
+            except AtCapacity as e:
+                raise HTTPException(status_code=503, detail=str(e),
+                                    headers={"Retry-After": str(RETRY_AFTER_SECONDS)})
+            except ValueError:
+                pass  # another request started the load first
+        raise HTTPException(
+            status_code=503,
+            detail=f"Model '{model_id}' is loading, retry later",
+            headers={"Retry-After": str(RETRY_AFTER_SECONDS)},
+        )
+
+    def _match(self, name: Optional[str]) -> Optional[str]:
+        if not name:
+            return None
+        known = set(self.registry) | set(self._models)
+        if name in known:
+            return name
+        lowered = {model_id.lower(): model_id for model_id in known}
+        return lowered.get(name.lower())
+
+    def is_resident(self, model_id: Optional[str]) -> bool:
+        with self._lock:
+            resident = self._models.get(model_id)
+            return resident is not None and resident.ready
+
+    def submit(self, model_id: str, fn: Callable, *args, batch_key=None, **kwargs):
+        """
+        ``scheduler.submit`` for a job that runs on ``model_id``.
+
+        The job activates its model before running, batches only with jobs
+        of the same model, and keeps the model resident while it is queued.
+        """
+        with self._lock:
+            resident = self._models.get(model_id)
+            if resident is None:
+                raise HTTPException(status_code=503, detail=f"Model '{model_id}' was unloaded",
+                                    headers={"Retry-After": str(RETRY_AFTER_SECONDS)})
+            resident.queued += 1
+        job = self.scheduler.submit(
+            self._bound(model_id, fn), *args,
+            batch_key=None if batch_key is None else (model_id, batch_key), **kwargs,
+        )
+        job.future.add_done_callback(lambda _: self._release(model_id))
+        return job
+
+    def _release(self, model_id: str) -> None:
+        with self._lock:
+            resident = self._models.get(model_id)
+            if resident is not None:
+                resident.queued -= 1
+
+    def _bound(self, model_id: str, fn: Callable) -> Callable:
+        def run(*args):
+            self.activate(model_id)
+            return fn(*args)
+        return run
+
+    def activate(self, model_id: str) -> None:
+        """Make ``model_id`` the model the backend uses. Inference thread only."""
+        with self._lock:
+            resident = self._models.get(model_id)
+            if resident is None:
+                raise HTTPException(status_code=503, detail=f"Model '{model_id}' was unloaded",
+                                    headers={"Retry-After": str(RETRY_AFTER_SECONDS)})
+            resident.last_used = time.time()
+        if self._active != model_id:
+            self.backend.activate(resident.model, resident.processor)
+            self._active = model_id
+            metrics.inc("model_activations_total", model=model_id)
+
+    # Loading and unloading
+
+    def load(self, model_id: str, path: Optional[str] = None, make_default: bool = False) -> str:
+        """
+        Start loading a model in the background.
+
+        Args:
+            model_id: Id requests select the model by.
+            path: Checkpoint directory or hub id; required for ids not in the registry.
+            make_default: Switch the default to this model once it is warm.
+
+        Returns:
+            ``"loading"``, or ``"resident"`` when the model was already loaded
+            (a requested default switch then happens immediately).
+
+        Raises:
+            ValueError: Unknown id without a path, or a load of it is already running.
+            AtCapacity: MODEL_MAX_RESIDENT models are resident or loading and
+                none of them could be unloaded for this one.
+        """
+        with self._lock:
+            if path:
+                self.registry[model_id] = path
+            elif model_id not in self.registry:
+                raise ValueError(f"Unknown model '{model_id}'; give the path of its checkpoint")
+            if self._loads.get(model_id) in ("loading", "warming"):
+                raise ValueError(f"Model '{model_id}' is already loading")
+            resident = self._models.get(model_id)
+            if resident is not None and resident.ready:
+                if make_default:
+                    self._switch_default(model_id)
+                return "resident"
+            if not self._has_room(make_default):
+                raise AtCapacity(f"Model '{model_id}' is not loaded and none of the {self.max_resident} "
+                                 f"resident models can be unloaded for it now")
+            self._loads[model_id] = "loading"
+        threading.Thread(target=self._load, args=(model_id, self.registry[model_id], make_default),
+                         name=f"model-load-{model_id}", daemon=True).start()
+        return "loading"
+
+    def _has_room(self, make_default: bool) -> bool:
+        # Called with the lock held. Models still loading count as resident;
+        # the default can only go when the new model takes its place.
+        loading = sum(1 for state in self._loads.values() if state == "loading")
+        excess = len(self._models) + loading + 1 - self.max_resident
+        if excess <= 0:
+            return True
+        evictable = [m for m in self._models.values()
+                     if m.ready and not m.queued and (make_default or m.id != self.default)]
+        return len(evictable) >= excess
+
+    def _load(self, model_id: str, path: str, make_default: bool) -> None:
+        start = time.time()
+        try:
+            logger.info(f"Loading model {model_id} from {path} in the background...")
+            model, processor = self.backend.load_weights(path)
+            with self._lock:
+                self._models[model_id] = ResidentModel(model_id, path, model, processor, self._footprint(model))
+                self._loads[model_id] = "warming"
+            load_seconds = time.time() - start
+
+            # The warm-up runs on the inference thread between requests, like any job
+            job = self.submit(model_id, self.backend.warm_up, priority="live")
+            job.future.result(timeout=MODEL_WARMUP_TIMEOUT)
+
+            with self._lock:
+                self._models[model_id].ready = True
+                self._loads.pop(model_id, None)
+                if make_default:
+                    self._switch_default(model_id)
+            metrics.observe("model_load_seconds", time.time() - start)
+            logger.info(f"Model {model_id} ready: loaded in {load_seconds:.0f} s, "
+                        f"warm after {time.time() - start:.0f} s")
+        except Exception as e:
+            with self._lock:
+                self._models.pop(model_id, None)
+                self._loads[model_id] = f"failed: {type(e).__name__}: {e}"
+            metrics.inc("model_load_failures_total")
+            logger.error(f"Loading model {model_id} failed: {e}", exc_info=True)
+            return
+        finally:
+            self._update_gauges()
+        self._evict(protect=model_id)
+
+    def _switch_default(self, model_id: str) -> None:
+        previous, self.default = self.default, model_id
+        if previous != model_id:
+            metrics.inc("model_swaps_total")
+            logger.info(f"Default model switched from {previous} to {model_id}")
+
+    def unload(self, model_id: str) -> bool:
+        """
+        Unload a resident model.
+
+        Raises:
+            ValueError: It is the default model or has queued jobs.
+        """
+        with self._lock:
+            resident = self._models.get(model_id)
+            if resident is None or not resident.ready:
+                return False
+            if model_id == self.default:
+                raise ValueError(f"Model '{model_id}' is the default; make another model the default first")
+            if resident.queued:
+                raise ValueError(f"Model '{model_id}' has {resident.queued} queued jobs")
+            self._unload(model_id, "requested")
+        self._update_gauges()
+        return True
+
+    def _evict(self, protect: str) -> None:
+        with self._lock:
+            while True:
+                resident = list(self._models.values())
+                total = sum(m.bytes for m in resident)
+                over_count = len(resident) > self.max_resident
+                over_budget = self.budget_bytes is not None and total > self.budget_bytes
+                if not (over_count or over_budget):
+                    break
+                candidates = sorted(
+                    (m for m in resident if m.ready and not m.queued and m.id not in (self.default, protect)),
+                    key=lambda m: m.last_used,
+                )
+                if not candidates:
+                    logger.warning(f"{len(resident)} models use {total / 2**30:.1f} GB, "
+                                   "but none of them can be unloaded now")
+                    break
+                self._unload(candidates[0].id, "memory" if over_budget else "count")
+        self._update_gauges()
+
+    def _unload(self, model_id: str, reason: str) -> None:
+        # Called with the lock held. The weights are freed once the inference
+        # thread activates another model and no job holds them any more.
+        self._models.pop(model_id)
+        metrics.inc("model_unloads_total", reason=reason)
+        logger.info(f"Unloaded model {model_id} ({reason})")
+
+    # Introspection
+
+    @staticmethod
+    def _footprint(model) -> int:
+        try:
+            return int(model.get_memory_footprint())
+        except Exception:
+            return 0
+
+    def models(self) -> List[Dict[str, Any]]:
+        """Resident models in the OpenAI list format, default first."""
+        with self._lock:
+            resident = sorted(self._models.values(), key=lambda m: (m.id != self.default, m.id))
+            return [m.info(m.id == self.default) for m in resident]
+
+    def status(self) -> Dict[str, Any]:
+        with self._lock:
+            loads = dict(self._loads)
+            registry = dict(self.registry)
+        return {
+            "default": self.default,
+            "resident": self.models(),
+            "loading": {k: v for k, v in loads.items() if v in ("loading", "warming")},
+            "failed": {k: v for k, v in loads.items() if v not in ("loading", "warming")},
+            "registry": registry,
+            "max_resident": self.max_resident,
+            "memory_budget_mb": round(self.budget_bytes / 2**20) if self.budget_bytes else None,
+        }
+
+    def _update_gauges(self) -> None:
+        with self._lock:
+            metrics.set("models_resident", len(self._models))
+            metrics.set("models_resident_bytes", sum(m.bytes for m in self._models.values()))
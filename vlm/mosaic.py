@@ -0,0 +1,280 @@
+# vlm/mosaic.py
+"""
+Multi-camera mosaic packing.
+
+For low-detail cameras, one full analysis per frame is wasteful. Frames
+of cameras in mosaic mode wait up to ``MOSAIC_WAIT_MS`` for company and
+are packed into one labelled grid image (2x2, or 3x3 when more are
+waiting). The grid is analysed in a single inference with a prompt that
+asks for one JSON answer per cell; the answer is split back into one
+result per request. Each cell only gets ``1/grid`` of the image width,
+which trades per-camera detail for several times the throughput.
+
+A cell missing from the answer (or an answer that is not JSON) is
+analysed again on its own, so callers always get a result.
+
+Configuration (environment variables):
+    MOSAIC_STREAMS      comma-separated stream ids always analysed in mosaic mode (default: none)
+    MOSAIC_WAIT_MS      time the first frame waits for others (default: 500)
+    MOSAIC_MAX_GRID     largest grid, 2 (2x2) or 3 (3x3) (default: 3)
+    MOSAIC_MAX_TOKENS   token limit of a combined answer (default: 1024)
+"""
+
+import asyncio
+import base64
+import io
+import json
+import logging
+import os
+import re
+import time
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from PIL import Image, ImageDraw, ImageFont
+
+from metrics import metrics
+from scheduler import PRIORITY_CLASSES
+
+logger = logging.getLogger("mosaic")
+
+MOSAIC_STREAMS = {s.strip() for s in os.environ.get("MOSAIC_STREAMS", "").split(",") if s.strip()}
+WAIT_SECONDS = float(os.environ.get("MOSAIC_WAIT_MS", "500")) / 1000.0
+MAX_GRID = int(os.environ.get("MOSAIC_MAX_GRID", "3"))
+MAX_TOKENS = int(os.environ.get("MOSAIC_MAX_TOKENS", "1024"))
+
+CELL_ASPECT = 9 / 16
+GAP = 4
+JPEG_QUALITY = 90
+
+# run(messages, max_tokens, temperature, priority, deadline, stream, model) -> result dict
+Runner = Callable[[List[Dict[str, Any]], int, float, str, Optional[float], str, str], Awaitable[Dict[str, Any]]]
+
+
+def mosaic_frame(messages: List[Dict[str, Any]]) -> Optional[Tuple[Image.Image, str]]:
+    """
+    The frame and prompt of a request that can go into a mosaic.
+
+    Returns:
+        ``(image, prompt)``, or None unless the request is a single user
+        message with exactly one inline image.
+    """
+    if len(messages) != 1 or messages[0].get("role") != "user" or not isinstance(messages[0].get("content"), list):
+        return None
+    images, texts = [], []
+    for part in messages[0]["content"]:
+        if part.get("type") == "text":
+            texts.append(part.get("text", ""))
+        elif part.get("type") == "image":
+            images.append(part.get("image"))
+        elif part.get("type") == "image_url":
+            image_url = part.get("image_url", {})
+            url = image_url.get("url", "") if isinstance(image_url, dict) else ""
+            images.append(url.split(",", 1)[1] if url.startswith("data:") else None)
+    if len(images) != 1 or not images[0]:
+        return None
+    try:
+        img = Image.open(io.BytesIO(base64.b64decode(images[0])))
+        img.draft("RGB", (800, 800))
+        return img.convert("RGB"), "\n".join(texts).strip()
+    except Exception as e:
+        logger.debug(f"Frame not usable for a mosaic: {e}")
+        return None
+
+
+def _font(size: int):
+    try:
+        return ImageFont.load_default(size=size)
+    except TypeError:
+        # Pillow < 10.1 has a single fixed-size default font
+        return ImageFont.load_default()
+
+
+def build_mosaic(frames: List[Image.Image], width: int) -> Image.Image:
+    """Frames in a labelled square grid, numbered from 1 left to right, top to bottom."""
+    grid = 2 if len(frames) <= 4 else 3
+    cell_w = (width - GAP * (grid - 1)) // grid
+    cell_h = int(cell_w * CELL_ASPECT)
+    rows = (len(frames) + grid - 1) // grid
+    canvas = Image.new("RGB", (width, rows * cell_h + GAP * (rows - 1)), (64, 64, 64))
+    draw = ImageDraw.Draw(canvas)
+    font = _font(max(12, cell_h // 8))
+    for i, frame in enumerate(frames):
+        x = (i % grid) * (cell_w + GAP)
+        y = (i // grid) * (cell_h + GAP)
+        cell = Image.new("RGB", (cell_w, cell_h), (0, 0, 0))
+        scale = min(cell_w / frame.width, cell_h / frame.height)
+        fitted = frame.resize((max(1, int(frame.width * scale)), max(1, int(frame.height * scale))), Image.BILINEAR)
+        cell.paste(fitted, ((cell_w - fitted.width) // 2, (cell_h - fitted.height) // 2))
+        canvas.paste(cell, (x, y))
+        label = str(i + 1)
+        left, top, right, bottom = draw.textbbox((x + 4, y + 2), label, font=font)
+        draw.rectangle([x, y, right + 4, bottom + 4], fill=(255, 255, 0))
+        draw.text((x + 4, y + 2), label, fill=(0, 0, 0), font=font)
+    return canvas
+
+
+def mosaic_prompt(prompts: List[str]) -> str:
+    n = len(prompts)
+    lines = [
+        f"The image is a grid of {n} separate camera frames, numbered 1 to {n} from left to right and "
+        "top to bottom. Each number is printed in the top-left corner of its cell.",
+        "Analyse every cell on its own, looking only at that cell.",
+    ]
+    if len(set(prompts)) == 1:
+        lines.append(f"Instructions for every cell:\n{prompts[0]}")
+    else:
+        lines.extend(f"Instructions for cell {i + 1}:\n{prompt}" for i, prompt in enumerate(prompts))
+    example = ", ".join(f'"{i + 1}": ...' for i in range(min(n, 3)))
+    lines.append("Reply with a single JSON object that maps each cell number to the answer for that cell, "
+                 f"like {{{example}}}, and nothing else.")
+    return "\n\n".join(lines)
+
+
+def split_answer(text: str, cells: int) -> Dict[int, str]:
+    """Per-cell answers of a combined reply; cells it does not contain are left out."""
+    text = re.sub(r"^```(?:json)?\s*|\s*```$", "", text.strip())
+    start, end = text.find("{"), text.rfind("}")
+    if start < 0 or end <= start:
+        return {}
+    try:
+        parsed = json.loads(text[start:end + 1])
+    except json.JSONDecodeError:
+        return {}
+    if not isinstance(parsed, dict):
+        return {}
+    answers = {}
+    for key, value in parsed.items():
+        match = re.search(r"\d+", str(key))
+        if match and 1 <= int(match.group()) <= cells:
+            answers[int(match.group())] = value if isinstance(value, str) else json.dumps(value)
+    return answers
+
+
+@dataclass
+class _Cell:
+    frame: Image.Image
+    prompt: str
+    messages: List[Dict[str, Any]]
+    stream: str
+    max_tokens: int
+    priority: str
+    deadline: Optional[float]
+    future: asyncio.Future
+    added: float = field(default_factory=time.time)
+
+
+class MosaicPacker:
+    """
+    Packs concurrent frames into grids and answers each frame from the combined result.
+
+    Args:
+        run: Coroutine that runs one request through the scheduler.
+        width: Width of the grid image; every cell gets ``width / grid``.
+        wait: Seconds the first frame of a grid waits for others.
+        max_grid: 2 or 3; a grid holds up to ``max_grid ** 2`` frames.
+    """
+
+    def __init__(self, run: Runner, width: int, wait: float = WAIT_SECONDS, max_grid: int = MAX_GRID):
+        self.run = run
+        self.width = width
+        self.wait = wait
+        self.capacity = max(2, min(3, max_grid)) ** 2
+        # Frames waiting for a grid, by model and temperature
+        self._pending: Dict[Tuple[str, float], List[_Cell]] = {}
+        self._timers: Dict[Tuple[str, float], asyncio.TimerHandle] = {}
+
+    @staticmethod
+    def enabled(stream: Optional[str], requested: Optional[bool]) -> bool:
+        """Whether a request goes into a mosaic: its own ``mosaic`` flag, else the MOSAIC_STREAMS list."""
+        if requested is not None:
+            return bool(requested) and stream is not None
+        return stream in MOSAIC_STREAMS
+
+    async def submit(self, frame: Tuple[Image.Image, str], messages: List[Dict[str, Any]], stream: str,
+                     max_tokens: int, temperature: float, priority: str, deadline: Optional[float],
+                     model: str) -> Dict[str, Any]:
+        """Wait for the frame's share of a mosaic analysis."""
+        loop = asyncio.get_running_loop()
+        cell = _Cell(frame[0], frame[1], messages, stream, max_tokens, priority, deadline, loop.create_future())
+        key = (model, temperature)
+        cells = self._pending.setdefault(key, [])
+        cells.append(cell)
+        if len(cells) >= self.capacity:
+            self._flush(key)
+        elif len(cells) == 1:
+            self._timers[key] = loop.call_later(self.wait, self._flush, key)
+        return await cell.future
+
+    def _flush(self, key: Tuple[str, float]) -> None:
+        timer = self._timers.pop(key, None)
+        if timer is not None:
+            timer.cancel()
+        cells = self._pending.pop(key, [])
+        if cells:
+            asyncio.ensure_future(self._analyse(cells, *key))
+
+    async def _analyse(self, cells: List[_Cell], model: str, temperature: float) -> None:
+        if len(cells) == 1:
+            await self._single(cells[0], model, temperature)
+            return
+
+        # The grid runs as urgently as its most urgent frame and until its last deadline
+        priority = min((cell.priority for cell in cells), key=PRIORITY_CLASSES.__getitem__)
+        deadlines = [cell.deadline for cell in cells]
+        deadline = None if None in deadlines else max(deadlines)
+        metrics.inc("mosaic_grids_total")
+        metrics.observe("mosaic_cells", len(cells))
+        metrics.observe("mosaic_wait_seconds", time.time() - cells[0].added)
+        try:
+            image = await asyncio.to_thread(build_mosaic, [cell.frame for cell in cells], self.width)
+            buffer = io.BytesIO()
+            image.save(buffer, format="JPEG", quality=JPEG_QUALITY)
+            messages = [{"role": "user", "content": [
+                {"type": "image_url", "image_url": {"url": "data:image/jpeg;base64," + base64.b64encode(buffer.getvalue()).decode("ascii")}},
+                {"type": "text", "text": mosaic_prompt([cell.prompt for cell in cells])},
+            ]}]
+            max_tokens = min(MAX_TOKENS, sum(cell.max_tokens for cell in cells))
+            result = await self.run(messages, max_tokens, temperature, priority, deadline, "mosaic", model)
+        except BaseException as e:
+            for cell in cells:
+                if not cell.future.done():
+                    cell.future.set_exception(e)
+            if not isinstance(e, Exception):
+                raise
+            return
+
+        answers = split_answer(result["output_texts"][0], len(cells))
+        prompt_share = result["prompt_tokens"] // len(cells)
+        completion_share = result["completion_tokens"] // len(cells)
+        retries = []
+        for i, cell in enumerate(cells, start=1):
+            if i not in answers:
+                retries.append(cell)
+                continue
+            if cell.future.done():
+                continue
+            cell.future.set_result({
+                "output_texts": [answers[i]],
+                "prompt_tokens": prompt_share,
+                "completion_tokens": completion_share,
+                "mosaic": {"cells": len(cells), "cell": i},
+            })
+        if retries:
+            metrics.inc("mosaic_cell_retries_total", len(retries))
+            logger.warning(f"Mosaic answer covered {len(cells) - len(retries)} of {len(cells)} cells, "
+                           "analysing the rest on their own")
+            await asyncio.gather(*(self._single(cell, model, temperature) for cell in retries))
+
+    async def _single(self, cell: _Cell, model: str, temperature: float) -> None:
+        try:
+            result = await self.run(cell.messages, cell.max_tokens, temperature, cell.priority, cell.deadline,
+                                    cell.stream, model)
+        except BaseException as e:
+            if not cell.future.done():
+                cell.future.set_exception(e)
+            if not isinstance(e, Exception):
+                raise
+            return
+        if not cell.future.done():
+            cell.future.set_result(result)
@@ -0,0 +1,189 @@
+# vlm/pacing.py
+"""
+Recommended capture interval per camera.
+
+Producers capture frames on a timer. Instead of a fixed rate, they can
+follow the interval this module recommends. It splits the frames per
+second the inference thread can sustain between the active cameras:
+
+    target rate = capacity * PACING_UTILISATION - backlog / PACING_DRAIN_SECONDS
+    camera rate = target rate * share of the camera
+
+Capacity is the inverse of the measured inference time per job. Backlog
+is what is already queued, so a growing queue slows every camera down
+until it drains. A camera's share is its fair-share weight times
+``PACING_STATIC_SHARE + change rate``. The change rate is a moving
+average of how much consecutive frames of the camera differ (mean
+absolute difference of small grayscale thumbnails). It fades while the
+camera sends nothing, because producers skip frames they find
+unchanged. Static cameras thus slow down, busy ones speed up, and the
+total stays just under capacity.
+
+Configuration (environment variables):
+    PACING_UTILISATION       fraction of capacity to fill (default: 0.85)
+    PACING_DRAIN_SECONDS     time to work off the current backlog (default: 30)
+    PACING_MIN_INTERVAL      shortest recommended interval in seconds (default: 2)
+    PACING_MAX_INTERVAL      longest recommended interval in seconds (default: 120)
+    PACING_STATIC_SHARE      share a completely static camera keeps, relative to a fully changing one (default: 0.1)
+    PACING_ACTIVE_WINDOW     seconds without a frame before a camera stops counting (default: 300)
+"""
+
+import base64
+import io
+import logging
+import os
+import threading
+import time
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+from PIL import Image
+
+from metrics import metrics
+
+logger = logging.getLogger("pacing")
+
+UTILISATION = float(os.environ.get("PACING_UTILISATION", "0.85"))
+DRAIN_SECONDS = float(os.environ.get("PACING_DRAIN_SECONDS", "30"))
+MIN_INTERVAL = float(os.environ.get("PACING_MIN_INTERVAL", "2"))
+MAX_INTERVAL = float(os.environ.get("PACING_MAX_INTERVAL", "120"))
+STATIC_SHARE = float(os.environ.get("PACING_STATIC_SHARE", "0.1"))
+ACTIVE_WINDOW = float(os.environ.get("PACING_ACTIVE_WINDOW", "300"))
+
+THUMBNAIL_SIZE = (32, 32)
+# Mean absolute thumbnail difference (0-1) that counts as a complete scene change
+FULL_CHANGE = 0.08
+# Change rate assumed for a camera until two of its frames were compared
+INITIAL_CHANGE = 0.5
+CHANGE_ALPHA = 0.3
+# The change rate halves over this many seconds without frames
+CHANGE_HALF_LIFE = 300.0
+
+
+def frame_thumbnail(messages: List[Dict[str, Any]]) -> Optional[np.ndarray]:
+    """Small grayscale thumbnail of the first inline image of a request, or None."""
+    for message in messages:
+        content = message.get("content")
+        if not isinstance(content, list):
+            continue
+        for part in content:
+            data = None
+            if part.get("type") == "image":
+                data = part.get("image")
+            elif part.get("type") == "image_url":
+                image_url = part.get("image_url", {})
+                url = image_url.get("url", "") if isinstance(image_url, dict) else ""
+                if url.startswith("data:"):
+                    data = url.split(",", 1)[1]
+            if not data:
+                continue
+            try:
+                img = Image.open(io.BytesIO(base64.b64decode(data)))
+                # JPEG frames are decoded at reduced scale, which is much faster than a full decode
+                img.draft("L", (THUMBNAIL_SIZE[0] * 4, THUMBNAIL_SIZE[1] * 4))
+                img = img.convert("L").resize(THUMBNAIL_SIZE, Image.BILINEAR)
+                return np.asarray(img, dtype=np.float32) / 255.0
+            except Exception as e:
+                logger.debug(f"No thumbnail for pacing: {e}")
+                return None
+    return None
+
+
+@dataclass
+class CameraActivity:
+    change: float = INITIAL_CHANGE
+    last_seen: float = 0.0
+    thumbnail: Optional[np.ndarray] = None
+    frames: int = 0
+
+    def current_change(self, now: float) -> float:
+        idle = max(0.0, now - self.last_seen)
+        return self.change * 0.5 ** (idle / CHANGE_HALF_LIFE)
+
+
+class CapturePacer:
+    """
+    Tracks camera activity and recommends capture intervals.
+
+    Args:
+        scheduler: The ``InferenceScheduler`` whose capacity is shared.
+    """
+
+    def __init__(self, scheduler, utilisation: float = UTILISATION, drain_seconds: float = DRAIN_SECONDS,
+                 min_interval: float = MIN_INTERVAL, max_interval: float = MAX_INTERVAL):
+        self.scheduler = scheduler
+        self.utilisation = utilisation
+        self.drain_seconds = drain_seconds
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self._cameras: Dict[str, CameraActivity] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, stream: str, thumbnail: Optional[np.ndarray]) -> None:
+        """Record a frame of ``stream`` and update its change rate."""
+        now = time.time()
+        with self._lock:
+            camera = self._cameras.get(stream)
+            if camera is None:
+                camera = self._cameras[stream] = CameraActivity()
+            camera.change = camera.current_change(now) if camera.frames else camera.change
+            if thumbnail is not None:
+                if camera.thumbnail is not None and camera.thumbnail.shape == thumbnail.shape:
+                    difference = float(np.abs(thumbnail - camera.thumbnail).mean())
+                    changed = min(1.0, difference / FULL_CHANGE)
+                    camera.change += CHANGE_ALPHA * (changed - camera.change)
+                camera.thumbnail = thumbnail
+            camera.last_seen = now
+            camera.frames += 1
+
+    def _plan(self) -> Dict[str, Any]:
+        now = time.time()
+        with self._lock:
+            for name in [name for name, camera in self._cameras.items() if now - camera.last_seen > ACTIVE_WINDOW]:
+                del self._cameras[name]
+            changes = {name: camera.current_change(now) for name, camera in self._cameras.items()}
+
+        seconds_per_job = self.scheduler.seconds_per_job
+        backlog = self.scheduler.backlog()
+        plan = {"capacity_fps": None, "target_fps": None, "backlog": backlog, "cameras": {}}
+        if not seconds_per_job or not changes:
+            return plan
+
+        capacity = 1.0 / seconds_per_job
+        # Never plan below a trickle, or a long backlog would stop every camera
+        target = max(capacity * self.utilisation - backlog / self.drain_seconds, capacity * 0.05)
+        shares = {name: self.scheduler.weights.get(name, 1.0) * (STATIC_SHARE + change)
+                  for name, change in changes.items()}
+        total = sum(shares.values())
+        for name, share in shares.items():
+            rate = target * share / total
+            plan["cameras"][name] = {
+                "interval": round(min(self.max_interval, max(self.min_interval, 1.0 / rate)), 1),
+                "change_rate": round(changes[name], 3),
+            }
+        plan["capacity_fps"] = round(capacity, 3)
+        plan["target_fps"] = round(target, 3)
+        metrics.set("pacing_capacity_fps", capacity)
+        metrics.set("pacing_target_fps", target)
+        return plan
+
+    def recommend(self, stream: str) -> Optional[float]:
+        """Recommended seconds between captures of ``stream``; None until capacity is known."""
+        camera = self._plan()["cameras"].get(stream)
+        return camera["interval"] if camera else None
+
+    def info(self, stream: str) -> Dict[str, Any]:
+        plan = self._plan()
+        camera = plan["cameras"].get(stream, {"interval": None, "change_rate": None})
+        return {
+            "stream_id": stream,
+            **camera,
+            "capacity_fps": plan["capacity_fps"],
+            "target_fps": plan["target_fps"],
+            "backlog": plan["backlog"],
+            "active_cameras": len(plan["cameras"]),
+        }
+
+    def snapshot(self) -> Dict[str, Any]:
+        return self._plan()
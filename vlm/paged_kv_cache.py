@@ -0,0 +1,131 @@
+# vlm/paged_kv_cache.py
+"""
+KV cache in fixed-size pages of one shared pool.
+
+The keys and values of every layer live in one preallocated tensor pair,
+``[layers, pages * page_size, kv_heads, head_dim]``, allocated once for the
+model. A sequence owns a list of pages (its block table) and token ``i``
+of the sequence sits in slot ``page[i // page_size] * page_size +
+i % page_size``; pages are handed out and taken back by
+``continuous_batching.PageAllocator``. Nothing is allocated per request
+and a finished sequence returns its pages at once, whatever the lengths
+of the sequences around it.
+
+``PagedKVCache`` presents the pool to a transformers model for one
+forward pass over several sequences of different lengths: ``update``
+writes the new keys and values of each layer into the sequences' slots
+and returns every sequence's keys and values gathered from its pages,
+left-padded to the longest, with ``attention_mask`` masking the padding.
+The gather copies each sequence's context once per layer and step,
+which is what standard attention kernels need without a paged-attention
+kernel.
+"""
+
+from typing import Optional, Sequence, Tuple
+
+import torch
+from transformers import DynamicCache
+
+
+class KVPagePool:
+    """
+    Preallocated key and value pages of every layer.
+
+    Args:
+        pages: Pages in the pool.
+        page_size: Tokens per page.
+        layers: Decoder layers of the model.
+        kv_heads: Key/value heads per layer.
+        head_dim: Size of one head.
+    """
+
+    def __init__(self, pages: int, page_size: int, layers: int, kv_heads: int, head_dim: int,
+                 dtype: torch.dtype, device):
+        self.pages = pages
+        self.page_size = page_size
+        self.keys = torch.zeros((layers, pages * page_size, kv_heads, head_dim), dtype=dtype, device=device)
+        self.values = torch.zeros_like(self.keys)
+
+    @staticmethod
+    def bytes_per_page(page_size: int, layers: int, kv_heads: int, head_dim: int, dtype: torch.dtype) -> int:
+        return 2 * page_size * layers * kv_heads * head_dim * torch.tensor([], dtype=dtype).element_size()
+
+    @classmethod
+    def for_model(cls, model, page_size: int, memory_bytes: int) -> "KVPagePool":
+        """A pool shaped for a transformers decoder, as large as ``memory_bytes`` allows."""
+        config = model.config
+        config = getattr(config, "text_config", None) or config
+        layers = config.num_hidden_layers
+        kv_heads = getattr(config, "num_key_value_heads", None) or config.num_attention_heads
+        head_dim = getattr(config, "head_dim", None) or config.hidden_size // config.num_attention_heads
+        dtype = model.dtype
+        pages = max(1, memory_bytes // cls.bytes_per_page(page_size, layers, kv_heads, head_dim, dtype))
+        return cls(int(pages), page_size, layers, kv_heads, head_dim, dtype, next(model.parameters()).device)
+
+    @property
+    def memory_bytes(self) -> int:
+        return 2 * self.keys.numel() * self.keys.element_size()
+
+
+class PagedKVCache(DynamicCache):
+    """
+    The page pool as the cache of one forward pass.
+
+    Args:
+        pool: Page pool.
+        block_tables: Pages of each sequence in the batch, in token order.
+        cached: Tokens of each sequence already in its pages.
+        new_tokens: Tokens every sequence appends in this pass (its prompt
+            for a prefill, 1 for a decode step).
+    """
+
+    def __init__(self, pool: KVPagePool, block_tables: Sequence[Sequence[int]], cached: Sequence[int],
+                 new_tokens: int):
+        super().__init__()
+        self.pool = pool
+        device = pool.keys.device
+        size = pool.page_size
+        self.batch = len(block_tables)
+        self.new_tokens = new_tokens
+        self.length = max(cached) + new_tokens
+        self.past = self.length - new_tokens
+        write, gather, mask = [], [], []
+        for pages, past in zip(block_tables, cached):
+            slots = [pages[i // size] * size + i % size for i in range(past + new_tokens)]
+            pad = self.length - len(slots)
+            write.extend(slots[past:])
+            # Padding reads slot 0, whatever it holds; the mask hides it
+            gather.extend([0] * pad + slots)
+            mask.append([0] * pad + [1] * len(slots))
+        self._write = torch.tensor(write, dtype=torch.long, device=device)
+        self._gather = torch.tensor(gather, dtype=torch.long, device=device)
+        self.attention_mask = torch.tensor(mask, dtype=torch.long, device=device)
+
+    @property
+    def cache_position(self) -> torch.Tensor:
+        """Positions of the new tokens in the padded cache."""
+        return torch.arange(self.past, self.length, device=self.pool.keys.device)
+
+    def update(self, key_states: torch.Tensor, value_states: torch.Tensor, layer_idx: int,
+               cache_kwargs: Optional[dict] = None) -> Tuple[torch.Tensor, torch.Tensor]:
+        # [batch, heads, new, dim] -> one row per written slot
+        heads, dim = key_states.shape[1], key_states.shape[-1]
+        keys, values = self.pool.keys[layer_idx], self.pool.values[layer_idx]
+        keys.index_copy_(0, self._write, key_states.transpose(1, 2).reshape(-1, heads, dim).to(keys.dtype))
+        values.index_copy_(0, self._write, value_states.transpose(1, 2).reshape(-1, heads, dim).to(values.dtype))
+        shape = (self.batch, self.length, heads, dim)
+        return (keys.index_select(0, self._gather).view(shape).transpose(1, 2),
+                values.index_select(0, self._gather).view(shape).transpose(1, 2))
+
+    def get_seq_length(self, layer_idx: Optional[int] = 0) -> int:
+        return self.past
+
+    def get_mask_sizes(self, cache_position: torch.Tensor, layer_idx: int = 0) -> Tuple[int, int]:
+        return self.length, 0
+
+    def get_max_cache_shape(self, layer_idx: int = 0) -> int:
+        return -1
+
+    def get_max_length(self) -> Optional[int]:
+        return None
+
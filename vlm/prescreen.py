@@ -0,0 +1,207 @@
+# vlm/prescreen.py
+"""
+CPU pre-screen in front of the VLM.
+
+Most frames that reach the VLM show nothing of interest. Before a frame
+is queued for the full model, a zero-shot CLIP scorer (clip_encoder.py)
+rates it against a few text prompts per flag, e.g. "flames" or "a person
+lying on the ground" versus everyday scenes. The frame is escalated to
+the VLM when any flag's suspicion score reaches its threshold, or when
+the camera has not had a frame escalated for PRESCREEN_SAMPLE_SECONDS, so
+descriptions stay current. Every other frame is answered here, on the
+CPU, without touching the GPU.
+
+The scorer errs towards escalation: when it is disabled or fails, every
+frame is escalated. Thresholds trade recall against the pass rate; use
+eval_prescreen.py to set them from a set of frames labelled by the full
+model.
+
+Flags and prompts can be replaced with a JSON file::
+
+    {"fire": {"prompts": ["flames", "a burning building"], "threshold": 0.3}, ...}
+
+Configuration (environment variables):
+    PRESCREEN_ENABLED         score frames at all; false escalates everything (default: false)
+    PRESCREEN_FLAGS_FILE      JSON file with flags, prompts and thresholds (default: built-in flags)
+    PRESCREEN_THRESHOLD       threshold of flags without their own (default: 0.2)
+    PRESCREEN_THRESHOLDS      per-flag overrides, e.g. "fire=0.15,gun=0.3" (default: empty)
+    PRESCREEN_SAMPLE_SECONDS  escalate a camera's frame at least this often; 0 disables (default: 300)
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+from PIL import Image
+
+from clip_encoder import ClipEncoder
+from metrics import metrics
+
+logger = logging.getLogger("prescreen")
+
+PRESCREEN_ENABLED = os.environ.get("PRESCREEN_ENABLED", "false").lower() in ("1", "true", "yes")
+PRESCREEN_FLAGS_FILE = os.environ.get("PRESCREEN_FLAGS_FILE", "")
+PRESCREEN_THRESHOLD = float(os.environ.get("PRESCREEN_THRESHOLD", "0.2"))
+PRESCREEN_THRESHOLDS = os.environ.get("PRESCREEN_THRESHOLDS", "")
+PRESCREEN_SAMPLE_SECONDS = float(os.environ.get("PRESCREEN_SAMPLE_SECONDS", "300"))
+
+# The flags the Node server stores (theft and gun become "intrusion" there)
+DEFAULT_FLAGS = {
+    "fire": {"prompts": ["a photo of fire", "flames", "thick smoke from a fire", "a burning building"]},
+    "gun": {"prompts": ["a person holding a gun", "a handgun", "a person aiming a rifle"]},
+    "theft": {"prompts": ["a person breaking into a car", "a burglar breaking a window",
+                          "a person stealing from a shop"]},
+    "medical": {"prompts": ["a person lying on the ground", "a person collapsed on the floor",
+                            "an injured person", "a person who fainted"]},
+}
+# Everyday scenes every flag's prompts compete with
+NEUTRAL_PROMPTS = [
+    "a normal scene from a security camera", "an empty room", "an empty corridor", "a parking lot with cars",
+    "a street with traffic", "people walking", "people standing and talking", "an office with desks",
+    "a shop with customers", "a person sitting on a chair", "a dark night scene",
+]
+
+
+def parse_thresholds(spec: str) -> Dict[str, float]:
+    thresholds = {}
+    for item in spec.split(","):
+        if "=" in item:
+            flag, value = item.split("=", 1)
+            thresholds[flag.strip()] = float(value)
+    return thresholds
+
+
+def load_flags(path: str = PRESCREEN_FLAGS_FILE) -> Dict[str, Dict[str, Any]]:
+    """Flags with their prompts and thresholds, from the file or the built-in set."""
+    if path:
+        with open(path, "r", encoding="utf-8") as f:
+            flags = json.load(f)
+    else:
+        flags = {name: dict(settings) for name, settings in DEFAULT_FLAGS.items()}
+    overrides = parse_thresholds(PRESCREEN_THRESHOLDS)
+    for name, settings in flags.items():
+        if not settings.get("prompts"):
+            raise ValueError(f"Flag {name} has no prompts")
+        settings["threshold"] = overrides.get(name, settings.get("threshold", PRESCREEN_THRESHOLD))
+    return flags
+
+
+class ZeroShotScorer:
+    """
+    Suspicion score per flag: how much of the softmax over the flag's
+    prompts and the neutral prompts goes to the flag's prompts.
+    """
+
+    def __init__(self, encoder: ClipEncoder, flags: Dict[str, Dict[str, Any]]):
+        self.encoder = encoder
+        self.flags = flags
+        self._prompts = None
+
+    @property
+    def ready(self) -> bool:
+        return self._prompts is not None
+
+    def prepare(self):
+        if self._prompts is None:
+            texts, slices = [], {}
+            for name, settings in self.flags.items():
+                slices[name] = slice(len(texts), len(texts) + len(settings["prompts"]))
+                texts.extend(settings["prompts"])
+            neutral = slice(len(texts), len(texts) + len(NEUTRAL_PROMPTS))
+            texts.extend(NEUTRAL_PROMPTS)
+            self._prompts = (self.encoder.embed_texts(texts), slices, neutral, self.encoder.logit_scale)
+        return self._prompts
+
+    def score(self, images: List[Image.Image]) -> List[Dict[str, float]]:
+        vectors, slices, neutral, scale = self.prepare()
+        logits = scale * self.encoder.embed_images(images) @ vectors.T
+        scores = []
+        for row in logits:
+            neutral_logits = row[neutral]
+            frame_scores = {}
+            for name, positives in slices.items():
+                candidates = np.concatenate([row[positives], neutral_logits])
+                probabilities = np.exp(candidates - candidates.max())
+                probabilities /= probabilities.sum()
+                frame_scores[name] = round(float(probabilities[:positives.stop - positives.start].sum()), 4)
+            scores.append(frame_scores)
+        return scores
+
+
+class PreScreen:
+    """
+    Decides which frames go on to the VLM.
+
+    Args:
+        scorer: Zero-shot scorer, or None to escalate every frame.
+        sample_seconds: A camera's frame is escalated at least this often.
+    """
+
+    def __init__(self, scorer: Optional[ZeroShotScorer], sample_seconds: float = PRESCREEN_SAMPLE_SECONDS):
+        self.scorer = scorer
+        self.sample_seconds = sample_seconds
+        self._last_escalated: Dict[str, float] = {}
+        self._lock = threading.Lock()
+        self.frames = 0
+        self.escalated = 0
+
+    @property
+    def thresholds(self) -> Dict[str, float]:
+        return {name: settings["threshold"] for name, settings in self.scorer.flags.items()} if self.scorer else {}
+
+    def screen(self, image: Image.Image, stream_id: Optional[str] = None) -> Dict[str, Any]:
+        """Scores of one frame and whether it goes to the VLM; runs on the calling thread."""
+        if self.scorer is None:
+            return {"escalate": True, "reasons": ["disabled"], "scores": {}}
+        if not self.scorer.ready:
+            # Still loading at startup
+            return {"escalate": True, "reasons": ["loading"], "scores": {}}
+        start = time.perf_counter()
+        try:
+            scores = self.scorer.score([image])[0]
+        except Exception as e:
+            metrics.inc("prescreen_errors_total")
+            logger.warning(f"Pre-screen failed, escalating the frame: {e}")
+            return {"escalate": True, "reasons": ["error"], "scores": {}}
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        metrics.observe("prescreen_ms", elapsed_ms)
+
+        thresholds = self.thresholds
+        reasons = [name for name, score in scores.items() if score >= thresholds[name]]
+        now = time.time()
+        with self._lock:
+            last = self._last_escalated.get(stream_id) if stream_id else None
+            if not reasons and stream_id and self.sample_seconds > 0 and (last is None or now - last >= self.sample_seconds):
+                reasons = ["sample"]
+            escalate = bool(reasons)
+            if escalate and stream_id:
+                self._last_escalated[stream_id] = now
+            self.frames += 1
+            self.escalated += escalate
+        metrics.inc("prescreen_frames_total", outcome="escalated" if escalate else "screened_out")
+        for reason in reasons:
+            metrics.inc("prescreen_escalations_total", reason=reason)
+        metrics.set("prescreen_pass_rate", round(self.escalated / self.frames, 4))
+        return {"escalate": escalate, "reasons": reasons, "scores": scores, "elapsed_ms": round(elapsed_ms, 1)}
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": self.scorer is not None,
+            "model": self.scorer.encoder.name if self.scorer else None,
+            "thresholds": self.thresholds,
+            "sample_seconds": self.sample_seconds,
+            "frames": self.frames,
+            "escalated": self.escalated,
+            "pass_rate": round(self.escalated / self.frames, 4) if self.frames else None,
+        }
+
+
+def create_prescreen(encoder: Optional[ClipEncoder] = None) -> PreScreen:
+    """The pre-screen configured by the environment."""
+    if not PRESCREEN_ENABLED:
+        return PreScreen(None)
+    return PreScreen(ZeroShotScorer(encoder or ClipEncoder(), load_flags()))
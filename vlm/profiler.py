@@ -0,0 +1,486 @@
+# vlm/profiler.py
+"""
+On-demand profiling of a running VLM server.
+
+An admin starts a bounded capture window, for the next N inference jobs
+or S seconds, whichever ends first. While it is open:
+
+- every model job (``Profiler.job``, wrapped around the work the
+  inference thread runs) is recorded by the torch profiler: operators on
+  the CPU and, on a GPU, their kernels;
+- a sampling thread records the Python stack of every thread inside a job
+  every PROFILE_INTERVAL_MS, which shows the Python glue between the
+  operators (preprocessing, the generate loop, the scheduler) that the
+  operator view cannot.
+
+When the window closes two files are written to PROFILE_DIR:
+
+    profile-<id>.json          Chrome trace (chrome://tracing, Perfetto): operator
+                               and kernel spans per job and a flame chart of the
+                               Python samples per thread, on one time axis
+    profile-<id>-summary.txt   where the time went: share of samples per phase
+                               (vision tower, attention, other model layers,
+                               sampling, preprocessing, Python glue), the top-N
+                               Python functions (self and inclusive) and the
+                               top-N operators by self time
+
+The summary is also returned as JSON by the admin endpoint. Outside a
+window ``Profiler.job`` costs one attribute check; the torch profiler and
+the sampling thread only exist while a window is open. Exporting a job's
+operator trace adds some milliseconds to that job.
+
+Admin endpoints accept requests carrying ``ADMIN_TOKEN`` (``Authorization:
+Bearer <token>`` or ``X-Admin-Token``). Without a token configured only
+clients on the loopback interface are admitted.
+
+Configuration (environment variables):
+    ADMIN_TOKEN            token for the admin endpoints (default: none, loopback only)
+    PROFILE_DIR            directory for trace and summary files (default: profiles)
+    PROFILE_MAX_SECONDS    longest capture window (default: 300)
+    PROFILE_INTERVAL_MS    Python sampling interval (default: 5)
+    PROFILE_TOP            entries per hotspot table (default: 25)
+"""
+
+import hmac
+import json
+import logging
+import os
+import re
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from collections import Counter
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from metrics import metrics
+
+logger = logging.getLogger("profiler")
+
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN", "")
+PROFILE_DIR = os.environ.get("PROFILE_DIR", "profiles")
+PROFILE_MAX_SECONDS = float(os.environ.get("PROFILE_MAX_SECONDS", "300"))
+PROFILE_INTERVAL_MS = float(os.environ.get("PROFILE_INTERVAL_MS", "5"))
+PROFILE_TOP = int(os.environ.get("PROFILE_TOP", "25"))
+
+# Samples kept per window, bounds memory whatever the interval and thread count
+_MAX_SAMPLES = 2_000_000
+_LOOPBACK = ("127.0.0.1", "::1", "localhost")
+# Trace process of the Python samples, apart from the torch processes (OS pid and GPU devices)
+_PYTHON_PID = 999999
+
+# Phase of a Python sample, checked in this order against its whole stack:
+# attention inside the vision tower counts as vision tower
+_VISION = re.compile(r"Vision|visual|vpm|PatchEmbed|PatchMerger|Resampler|Siglip")
+_ATTENTION = re.compile(r"Attention|attention_forward|sdpa|flash_attn")
+_PREPROCESS = re.compile(r"processing_|image_processing|qwen_vl_utils|PIL/|fetch_image|process_vision_info")
+
+Frame = Tuple[str, str, int]  # qualified name, file, first line
+
+
+def is_admin(client_host: Optional[str], headers) -> bool:
+    """Whether a request may use the admin endpoints."""
+    if not ADMIN_TOKEN:
+        return client_host in _LOOPBACK
+    supplied = headers.get("X-Admin-Token") or ""
+    authorization = headers.get("Authorization") or ""
+    if authorization.startswith("Bearer "):
+        supplied = supplied or authorization[len("Bearer "):]
+    return hmac.compare_digest(supplied.encode(), ADMIN_TOKEN.encode())
+
+
+def parse_options(body: Dict[str, Any]) -> Dict[str, Any]:
+    """Arguments of ``Profiler.start`` from an admin request body; raises ValueError."""
+    try:
+        return {
+            "requests": int(body["requests"]) if body.get("requests") is not None else None,
+            "seconds": float(body["seconds"]) if body.get("seconds") is not None else None,
+            "torch": bool(body.get("torch", True)),
+            "python": bool(body.get("python", True)),
+            "interval_ms": float(body.get("interval_ms", PROFILE_INTERVAL_MS)),
+            "top": int(body.get("top", PROFILE_TOP)),
+        }
+    except (TypeError, ValueError) as e:
+        raise ValueError(f"Invalid profile options: {e}")
+
+
+def phase(stack: Tuple[Frame, ...]) -> str:
+    """Where a Python sample spends its time, from the frames of its stack (outermost first)."""
+    names = [name for name, _, _ in stack]
+    files = [path for _, path, _ in stack]
+    if any(_VISION.search(name) for name in names):
+        return "vision_tower"
+    if any(_ATTENTION.search(name) for name in names):
+        return "attention"
+    if any(name.endswith("forward") and ("modeling_" in path or "torch/nn/modules" in path)
+           for name, path, _ in stack):
+        return "other_model_layers"
+    if any("transformers/generation" in path for path in files):
+        # The generate loop outside a forward pass: logits processing, token choice, stopping, cache updates
+        return "sampling"
+    if any(_PREPROCESS.search(name) or _PREPROCESS.search(path) for name, path, _ in stack):
+        return "preprocessing"
+    return "python_glue"
+
+
+def _label(frame: Frame) -> str:
+    name, path, line = frame
+    return f"{name} ({'/'.join(path.split(os.sep)[-2:])}:{line})"
+
+
+class ProfiledJob:
+    """Handle of a wrapped job; ``count`` may be set inside the block, e.g. to the requests a step finished."""
+
+    __slots__ = ("count",)
+
+    def __init__(self, count: int):
+        self.count = count
+
+
+class ProfileSession:
+    """One capture window and the data recorded in it."""
+
+    def __init__(self, requests: Optional[int], seconds: float, torch_ops: bool, python: bool,
+                 interval_ms: float, top: int):
+        self.id = time.strftime("%Y%m%d-%H%M%S-") + uuid.uuid4().hex[:6]
+        self.requests = requests
+        self.seconds = seconds
+        self.torch_ops = torch_ops
+        self.python = python
+        self.interval = interval_ms / 1000
+        self.top = top
+        self.started_at = time.time()
+        self.ended_at: Optional[float] = None
+        self.state = "running"
+        self.jobs = 0
+        self.active = 0
+        # Threads inside a job now, and the name of every thread that ran one
+        self.threads: Dict[int, str] = {}
+        self.thread_names: Dict[int, str] = {}
+        self.sample_count = 0
+        self.samples: List[Tuple[float, int, Tuple[Frame, ...]]] = []
+        self.torch_events: List[Dict[str, Any]] = []
+        self.operators: Dict[str, Dict[str, float]] = {}
+        self.summary: Optional[Dict[str, Any]] = None
+        self.files: Dict[str, str] = {}
+        self.error: Optional[str] = None
+        self.lock = threading.Condition()
+        self.done = threading.Event()
+
+    def elapsed_us(self, at: Optional[float] = None) -> float:
+        return ((at or time.time()) - self.started_at) * 1e6
+
+    def info(self) -> Dict[str, Any]:
+        return {
+            "id": self.id,
+            "state": self.state,
+            "requests": self.requests,
+            "seconds": self.seconds,
+            "torch": self.torch_ops,
+            "python": self.python,
+            "jobs": self.jobs,
+            "samples": self.sample_count,
+            "started_at": self.started_at,
+            "ended_at": self.ended_at,
+            "files": self.files,
+            "error": self.error,
+            "summary": self.summary,
+        }
+
+
+class Profiler:
+    """
+    Capture windows over the model jobs of one server.
+
+    Args:
+        directory: Where trace and summary files are written.
+    """
+
+    def __init__(self, directory: str = PROFILE_DIR):
+        self.directory = directory
+        self.session: Optional[ProfileSession] = None
+        self.last: Optional[ProfileSession] = None
+        self._lock = threading.Lock()
+
+    def start(self, requests: Optional[int] = None, seconds: Optional[float] = None, torch: bool = True,
+              python: bool = True, interval_ms: float = PROFILE_INTERVAL_MS, top: int = PROFILE_TOP) -> ProfileSession:
+        """
+        Open a capture window.
+
+        Args:
+            requests: Close after this many jobs.
+            seconds: Close after this long, at most PROFILE_MAX_SECONDS
+                (also the limit when only ``requests`` is given).
+            torch: Record operators with the torch profiler.
+            python: Sample Python stacks.
+            interval_ms: Python sampling interval.
+            top: Entries per hotspot table.
+
+        Raises:
+            ValueError: Invalid bounds.
+            RuntimeError: A window is already open.
+        """
+        if requests is not None and requests < 1:
+            raise ValueError("requests must be at least 1")
+        if seconds is not None and not 0 < seconds <= PROFILE_MAX_SECONDS:
+            raise ValueError(f"seconds must be between 0 and {PROFILE_MAX_SECONDS:g}")
+        if interval_ms < 1:
+            raise ValueError("interval_ms must be at least 1")
+        if not (torch or python):
+            raise ValueError("Nothing to record: enable torch or python")
+        with self._lock:
+            if self.session is not None:
+                raise RuntimeError(f"Profile {self.session.id} is already running")
+            session = ProfileSession(requests, seconds or PROFILE_MAX_SECONDS, torch, python, interval_ms, top)
+            self.session = session
+        metrics.set("profiler_active", 1)
+        logger.info(f"Profile {session.id} started: {requests or 'any number of'} jobs, up to {session.seconds:g}s")
+        if python:
+            threading.Thread(target=self._sample, args=(session,), name="profiler-sampler", daemon=True).start()
+        timer = threading.Timer(session.seconds, self.stop, args=(session,))
+        timer.daemon = True
+        timer.start()
+        return session
+
+    def stop(self, session: Optional[ProfileSession] = None) -> Optional[ProfileSession]:
+        """Close the window (the current one by default) and write its files; jobs in progress are finished first."""
+        with self._lock:
+            session = session or self.session
+            if session is None or session is not self.session:
+                return session
+            self.session = None
+        metrics.set("profiler_active", 0)
+        with session.lock:
+            session.state = "writing"
+            # Operators of a job still running arrive when it ends
+            session.lock.wait_for(lambda: session.active == 0, timeout=120)
+        session.ended_at = time.time()
+        try:
+            self._write(session)
+            session.state = "done"
+        except Exception as e:
+            session.state = "failed"
+            session.error = str(e)
+            logger.error(f"Profile {session.id} could not be written: {e}")
+        self.last = session
+        session.done.set()
+        logger.info(f"Profile {session.id} finished: {session.jobs} jobs, {len(session.samples)} samples")
+        return session
+
+    def status(self) -> Optional[Dict[str, Any]]:
+        session = self.session or self.last
+        return session.info() if session else None
+
+    # -- recording ---------------------------------------------------------
+
+    @contextmanager
+    def job(self, count: int = 1) -> Iterator[ProfiledJob]:
+        """
+        Wrap one model job (``count`` requests when batched); recorded while a window is open.
+
+        Runs on the thread that does the work, so the torch profiler sees its operators.
+        """
+        profiled = ProfiledJob(count)
+        session = self.session
+        if session is None:
+            yield profiled
+            return
+        with session.lock:
+            if session.state != "running":
+                session = None
+            else:
+                session.active += 1
+                session.threads[threading.get_ident()] = threading.current_thread().name
+                session.thread_names[threading.get_ident()] = threading.current_thread().name
+        if session is None:
+            yield profiled
+            return
+        started = time.time()
+        profile = self._torch_profile() if session.torch_ops else None
+        try:
+            if profile is not None:
+                with profile:
+                    yield profiled
+            else:
+                yield profiled
+        finally:
+            # Not sampled from here on: exporting the operators is the profiler's own cost
+            session.threads.pop(threading.get_ident(), None)
+            if profile is not None:
+                try:
+                    self._collect(session, profile, started)
+                except Exception as e:
+                    logger.warning(f"Operator trace of a job dropped: {e}")
+            with session.lock:
+                session.active -= 1
+                session.jobs += profiled.count
+                finished = session.requests is not None and session.jobs >= session.requests
+                session.lock.notify_all()
+            if finished:
+                # Written off the inference thread
+                threading.Thread(target=self.stop, args=(session,), name="profiler-writer", daemon=True).start()
+
+    @staticmethod
+    def _torch_profile():
+        try:
+            import torch
+        except ImportError:
+            return None
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if torch.cuda.is_available():
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        return torch.profiler.profile(activities=activities, record_shapes=False)
+
+    def _collect(self, session: ProfileSession, profile, started: float) -> None:
+        """Fold a job's operators into the window: trace events on the window's time axis and per-operator totals."""
+        for event in profile.key_averages():
+            totals = session.operators.setdefault(event.key, {"calls": 0, "self_cpu_us": 0.0, "self_device_us": 0.0})
+            totals["calls"] += event.count
+            totals["self_cpu_us"] += event.self_cpu_time_total
+            device = getattr(event, "self_device_time_total", None)
+            if device is None:
+                device = getattr(event, "self_cuda_time_total", 0.0)
+            totals["self_device_us"] += device
+        with tempfile.NamedTemporaryFile(suffix=".json", delete=False) as f:
+            path = f.name
+        try:
+            profile.export_chrome_trace(path)
+            with open(path, "r", encoding="utf-8") as f:
+                events = json.load(f).get("traceEvents", [])
+        finally:
+            os.unlink(path)
+        spans = [e["ts"] for e in events if e.get("ph") == "X" and isinstance(e.get("ts"), (int, float))]
+        if not spans:
+            return
+        # The torch clock has its own origin: the job's first span is placed at the job's start
+        shift = session.elapsed_us(started) - min(spans)
+        for event in events:
+            if isinstance(event.get("ts"), (int, float)):
+                event["ts"] += shift
+        with session.lock:
+            session.torch_events.extend(events)
+
+    def _sample(self, session: ProfileSession) -> None:
+        me = threading.get_ident()
+        while session.state == "running" and len(session.samples) < _MAX_SAMPLES:
+            now = time.time()
+            threads = dict(session.threads)
+            if threads:
+                frames = sys._current_frames()
+                for ident in threads:
+                    frame = frames.get(ident)
+                    if frame is None or ident == me:
+                        continue
+                    stack = []
+                    while frame is not None:
+                        code = frame.f_code
+                        stack.append((getattr(code, "co_qualname", code.co_name), code.co_filename,
+                                      code.co_firstlineno))
+                        frame = frame.f_back
+                    session.samples.append((now, ident, tuple(reversed(stack))))
+                    session.sample_count += 1
+            time.sleep(max(0.0, session.interval - (time.time() - now)))
+
+    # -- output ------------------------------------------------------------
+
+    def _python_events(self, session: ProfileSession) -> List[Dict[str, Any]]:
+        """Flame chart of the samples: one span per frame for as long as consecutive samples contain it."""
+        events: List[Dict[str, Any]] = [{"name": "process_name", "ph": "M", "pid": _PYTHON_PID,
+                                         "args": {"name": "Python samples"}}]
+        open_frames: Dict[int, List[Tuple[Frame, float]]] = {}
+        last_seen: Dict[int, float] = {}
+        tids: Dict[int, int] = {}
+
+        def close(ident: int, keep: int, at: float) -> None:
+            frames = open_frames.get(ident, [])
+            while len(frames) > keep:
+                frame, began = frames.pop()
+                events.append({"name": _label(frame), "cat": "python", "ph": "X", "pid": _PYTHON_PID,
+                               "tid": tids[ident], "ts": session.elapsed_us(began),
+                               "dur": max(1.0, (at - began) * 1e6)})
+
+        for at, ident, stack in session.samples:
+            if ident not in tids:
+                tids[ident] = len(tids) + 1
+                events.append({"name": "thread_name", "ph": "M", "pid": _PYTHON_PID, "tid": tids[ident],
+                               "args": {"name": session.thread_names.get(ident, f"thread {ident}")}})
+            frames = open_frames.setdefault(ident, [])
+            # A gap of several intervals means the thread left the job in between
+            if ident in last_seen and at - last_seen[ident] > session.interval * 4:
+                close(ident, 0, last_seen[ident] + session.interval)
+            common = 0
+            while common < min(len(frames), len(stack)) and frames[common][0] == stack[common]:
+                common += 1
+            close(ident, common, at)
+            frames.extend((frame, at) for frame in stack[common:])
+            last_seen[ident] = at
+        for ident in open_frames:
+            close(ident, 0, last_seen[ident] + session.interval)
+        return events
+
+    def _summary(self, session: ProfileSession) -> Dict[str, Any]:
+        total = len(session.samples)
+        phases = Counter(phase(stack) for _, _, stack in session.samples)
+        own = Counter(stack[-1] for _, _, stack in session.samples if stack)
+        inclusive = Counter()
+        for _, _, stack in session.samples:
+            inclusive.update(set(stack))
+
+        def share(count: int) -> float:
+            return round(count / total, 4) if total else 0.0
+
+        operators = sorted(session.operators.items(),
+                           key=lambda item: (item[1]["self_device_us"], item[1]["self_cpu_us"]), reverse=True)
+        return {
+            "id": session.id,
+            "window_seconds": round((session.ended_at or time.time()) - session.started_at, 3),
+            "jobs": session.jobs,
+            "samples": total,
+            "phases": {name: share(count) for name, count in phases.most_common()},
+            "python_self": [{"function": _label(frame), "samples": count, "share": share(count)}
+                            for frame, count in own.most_common(session.top)],
+            "python_inclusive": [{"function": _label(frame), "samples": count, "share": share(count)}
+                                 for frame, count in inclusive.most_common(session.top)],
+            "operators": [{"name": name, "calls": int(totals["calls"]),
+                           "self_cpu_ms": round(totals["self_cpu_us"] / 1000, 3),
+                           "self_device_ms": round(totals["self_device_us"] / 1000, 3)}
+                          for name, totals in operators[:session.top]],
+        }
+
+    @staticmethod
+    def _summary_text(summary: Dict[str, Any]) -> str:
+        lines = [f"Profile {summary['id']}: {summary['jobs']} jobs in {summary['window_seconds']}s, "
+                 f"{summary['samples']} Python samples", "", "Phases (share of Python samples in jobs):"]
+        lines += [f"  {name:<20} {value:>7.1%}" for name, value in summary["phases"].items()]
+        for key, title in (("python_self", "Python functions, self"), ("python_inclusive", "Python functions, inclusive")):
+            lines += ["", f"{title}:"]
+            lines += [f"  {row['share']:>7.1%} {row['samples']:>8}  {row['function']}" for row in summary[key]]
+        lines += ["", "Operators by self time:", f"  {'device ms':>10} {'cpu ms':>10} {'calls':>8}  name"]
+        lines += [f"  {row['self_device_ms']:>10.2f} {row['self_cpu_ms']:>10.2f} {row['calls']:>8}  {row['name']}"
+                  for row in summary["operators"]]
+        return "\n".join(lines) + "\n"
+
+    def _write(self, session: ProfileSession) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+        session.summary = self._summary(session)
+        trace_path = os.path.join(self.directory, f"profile-{session.id}.json")
+        summary_path = os.path.join(self.directory, f"profile-{session.id}-summary.txt")
+        trace = {
+            "traceEvents": session.torch_events + self._python_events(session),
+            "displayTimeUnit": "ms",
+            "otherData": {"id": session.id, "started_at": session.started_at, "jobs": session.jobs},
+        }
+        with open(trace_path, "w", encoding="utf-8") as f:
+            json.dump(trace, f)
+        with open(summary_path, "w", encoding="utf-8") as f:
+            f.write(self._summary_text(session.summary))
+        session.files = {"trace": trace_path, "summary": summary_path}
+        # The raw data is in the files now
+        session.samples = []
+        session.torch_events = []
+        metrics.inc("profiler_captures_total")
+
+
+profiler = Profiler()
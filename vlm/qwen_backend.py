@@ -0,0 +1,799 @@
+# vlm/qwen_backend.py
+"""
+Qwen2.5-VL model code shared by the API server and offline tools.
+
+Everything here runs on the inference thread: message conversion (images
+are written to temporary files and resized, frames from shared-memory
+rings are read straight into memory), a single streamed
+generation with speculative decoding, a padded batch generation for
+requests that share their generation parameters, the step runner of the
+continuous batching engine (continuous_batching.py), and session turns
+that continue a retained KV cache.
+
+Configuration (environment variables):
+    QWEN_MODEL_PATH   model directory or hub id (default: Qwen2.5-VL-3B-Instruct)
+    IMAGE_MAX_WIDTH   images wider than this are downscaled (default: 800)
+"""
+
+import base64
+import inspect
+import io
+import logging
+import os
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Any, Dict, List, Optional, Tuple
+
+import requests
+import torch
+from fastapi import HTTPException
+from PIL import Image
+from transformers import AutoProcessor, DynamicCache, Qwen2_5_VLForConditionalGeneration, TextStreamer
+from qwen_vl_utils import process_vision_info
+
+import speculative
+from continuous_batching import ContinuousBatcher, Sequence, StepRunner
+from frame_ring import RING_SCHEME, FrameOverwritten, parse_ref
+from frame_ring import reader as frame_ring_reader
+from admission import estimate_request_bytes, is_out_of_memory
+from paged_kv_cache import KVPagePool, PagedKVCache
+from scheduler import ContinuousBatch
+from sessions import SESSION_MAX_TOKENS, Session
+from tracing import GenerateTimer, Trace, span
+
+logger = logging.getLogger("qwen-backend")
+
+MODEL_PATH = os.environ.get("QWEN_MODEL_PATH", "Qwen2.5-VL-3B-Instruct")
+IMAGE_MAX_WIDTH = int(os.environ.get("IMAGE_MAX_WIDTH", "800"))
+
+# Assumed size of images that cannot be inspected before download
+_UNKNOWN_IMAGE_SIZE = (IMAGE_MAX_WIDTH, IMAGE_MAX_WIDTH * 3 // 4)
+
+model = None
+processor = None
+
+
+def load_weights(path: str):
+    """Load a Qwen2.5-VL checkpoint and its processor without making them the active model."""
+    loaded_model = Qwen2_5_VLForConditionalGeneration.from_pretrained(
+        path, torch_dtype="auto", device_map="auto"
+    )
+    loaded_processor = AutoProcessor.from_pretrained(path)
+    # Batched prompts are padded on the left so generation continues every row
+    loaded_processor.tokenizer.padding_side = "left"
+    return loaded_model, loaded_processor
+
+
+def activate(loaded_model, loaded_processor) -> None:
+    """Make a loaded checkpoint the one every function here uses. Inference thread only."""
+    global model, processor
+    model, processor = loaded_model, loaded_processor
+
+
+def load_model():
+    """Load the model and processor once; later calls are no-ops."""
+    global model, processor
+    if model is None:
+        logger.info(f"Loading {MODEL_PATH} model...")
+        model, processor = load_weights(MODEL_PATH)
+        speculative.load_draft_model()
+        logger.info("Model loaded successfully!")
+    return model, processor
+
+
+def warm_up() -> None:
+    """A tiny generation with an image, so a newly activated model is checked and its kernels are ready."""
+    image = Image.new("RGB", (224, 224), (128, 128, 128))
+    generate_batch([[{"role": "user", "content": [
+        {"type": "image", "image": image},
+        {"type": "text", "text": "Describe the image in one word."},
+    ]}]], 4, 0.0)
+
+
+def resize_image(image_path, trace: Optional[Trace] = None):
+    """Downscale an image file in place to IMAGE_MAX_WIDTH, keeping the aspect ratio."""
+    try:
+        with span(trace, "resize") as attrs:
+            return _resize(image_path, attrs)
+    except Exception as e:
+        logger.error(f"Error resizing image {image_path}: {e}")
+        return None
+
+
+def _resize(image_path, attrs):
+    img = Image.open(image_path)
+    # Convert to RGB if needed
+    if img.mode in ('P', 'RGBA', 'LA'):
+        img = img.convert('RGB')
+
+    width, height = img.size
+    new_width = IMAGE_MAX_WIDTH
+    attrs["from"] = [width, height]
+
+    # Only resize if the image is larger than the target width
+    if width > new_width:
+        new_height = int((height / width) * new_width)
+        resized_img = img.resize((new_width, new_height), Image.LANCZOS)
+        resized_img.save(image_path, format="JPEG")
+        attrs["to"] = [new_width, new_height]
+    else:
+        attrs["to"] = [width, height]
+
+    return image_path
+
+
+class CallbackStreamer(TextStreamer):
+    """Text streamer that hands every decoded chunk to a callback"""
+
+    def __init__(self, tokenizer, callback):
+        super().__init__(tokenizer, skip_prompt=True, skip_special_tokens=True)
+        self.callback = callback
+
+    def on_finalized_text(self, text: str, stream_end: bool = False):
+        if text:
+            self.callback(text)
+
+
+def _temp_image_path() -> str:
+    # Unique even when several requests of one batch are converted in the same tick
+    return f"temp_img_{time.time()}_{uuid.uuid4().hex[:8]}.jpg"
+
+
+def _save_image(data: str, trace: Optional[Trace]) -> str:
+    temp_img_path = _temp_image_path()
+    with span(trace, "decode") as attrs:
+        raw = base64.b64decode(data)
+        attrs["bytes"] = len(raw)
+        with open(temp_img_path, "wb") as img_file:
+            img_file.write(raw)
+    return resize_image(temp_img_path, trace)
+
+
+def convert_messages(messages: List[Dict[str, Any]],
+                     trace: Optional[Trace] = None) -> Tuple[List[Dict[str, Any]], List[str]]:
+    """
+    Convert OpenAI-style messages to the Qwen format.
+
+    Returns:
+        The Qwen messages and the temporary image files to remove afterwards.
+    """
+    qwen_messages = []
+    temp_files = []
+
+    for message in messages:
+        role = message.get("role")
+        content = message.get("content")
+
+        if isinstance(content, str):
+            qwen_messages.append({"role": role, "content": [{"type": "text", "text": content}]})
+            continue
+
+        qwen_content = []
+        for part in content:
+            part_type = part.get("type")
+
+            if part_type == "text":
+                qwen_content.append({"type": "text", "text": part.get("text", "")})
+
+            elif part_type == "image":
+                image_data = part.get("image", None)
+                if image_data:
+                    temp_img_path = _save_image(image_data, trace)
+                    temp_files.append(temp_img_path)
+                    qwen_content.append({"type": "image", "image": temp_img_path})
+
+            elif part_type == "image_url":
+                image_url = part.get("image_url", {})
+                if not isinstance(image_url, dict):
+                    continue
+                url = image_url.get("url", "")
+
+                if url.startswith("data:"):
+                    try:
+                        temp_img_path = _save_image(url.split(",", 1)[1], trace)
+                    except Exception as e:
+                        logger.error(f"Error processing base64 image: {e}", exc_info=True)
+                        raise HTTPException(status_code=400, detail=f"Invalid base64 image: {str(e)}")
+                    temp_files.append(temp_img_path)
+                    qwen_content.append({"type": "image", "image": temp_img_path})
+                elif url.startswith(RING_SCHEME):
+                    with span(trace, "ring", url=url) as attrs:
+                        try:
+                            camera, seq = parse_ref(url)
+                            img = frame_ring_reader.read_image(camera, seq, max_width=IMAGE_MAX_WIDTH)
+                        except (FrameOverwritten, ValueError) as e:
+                            raise HTTPException(status_code=410, detail=str(e))
+                        attrs["size"] = list(img.size)
+                    qwen_content.append({"type": "image", "image": img})
+                else:
+                    try:
+                        if url.startswith(("http://", "https://")):
+                            temp_img_path = _temp_image_path()
+                            with span(trace, "fetch", url=url) as attrs:
+                                response = requests.get(url, stream=True)
+                                attrs["status"] = response.status_code
+                                if response.status_code != 200:
+                                    logger.error(f"Failed to download image, status code: {response.status_code}")
+                                    raise HTTPException(status_code=400, detail=f"Failed to download image from URL: {url}")
+                                with open(temp_img_path, "wb") as img_file:
+                                    for chunk in response.iter_content(1024):
+                                        img_file.write(chunk)
+                                attrs["bytes"] = os.path.getsize(temp_img_path)
+                            temp_files.append(temp_img_path)
+                            temp_img_path = resize_image(temp_img_path, trace)
+                            qwen_content.append({"type": "image", "image": temp_img_path})
+                        else:
+                            # Local file path
+                            qwen_content.append({"type": "image", "image": resize_image(url, trace)})
+                    except Exception as e:
+                        logger.error(f"Error processing image URL: {e}", exc_info=True)
+                        raise HTTPException(status_code=400, detail=f"Error processing image URL: {str(e)}")
+
+        qwen_messages.append({"role": role, "content": qwen_content})
+
+    return qwen_messages, temp_files
+
+
+def remove_temp_files(temp_files: List[str]) -> None:
+    for temp_file in temp_files:
+        try:
+            os.remove(temp_file)
+        except Exception as e:
+            logger.warning(f"Error removing temp file {temp_file}: {e}")
+
+
+def _image_size(part: Dict[str, Any]) -> Optional[Tuple[int, int]]:
+    """Size of an inline image from its header, without decoding the pixels."""
+    data = None
+    if part.get("type") == "image":
+        data = part.get("image")
+    elif part.get("type") == "image_url":
+        image_url = part.get("image_url", {})
+        url = image_url.get("url", "") if isinstance(image_url, dict) else ""
+        if url.startswith(RING_SCHEME):
+            try:
+                return frame_ring_reader.frame_size(*parse_ref(url)) or _UNKNOWN_IMAGE_SIZE
+            except ValueError:
+                return _UNKNOWN_IMAGE_SIZE
+        if not url.startswith("data:"):
+            return _UNKNOWN_IMAGE_SIZE
+        data = url.split(",", 1)[1]
+    if not data:
+        return None
+    try:
+        return Image.open(io.BytesIO(base64.b64decode(data))).size
+    except Exception:
+        return _UNKNOWN_IMAGE_SIZE
+
+
+def estimate_memory(messages: List[Dict[str, Any]], max_tokens: int) -> int:
+    """Estimated peak bytes of a request, from its resized image sizes and prompt length."""
+    pixels = 0
+    text_chars = 0
+    for message in messages:
+        content = message.get("content")
+        if isinstance(content, str):
+            text_chars += len(content)
+            continue
+        for part in content or []:
+            if part.get("type") == "text":
+                text_chars += len(part.get("text", ""))
+                continue
+            size = _image_size(part)
+            if size is None:
+                continue
+            width, height = size
+            if width > IMAGE_MAX_WIDTH:
+                height = int(height / width * IMAGE_MAX_WIDTH)
+                width = IMAGE_MAX_WIDTH
+            pixels += width * height
+    # Roughly four characters per text token
+    return estimate_request_bytes(pixels, text_chars // 4, max_tokens)
+
+
+@contextmanager
+def _shared_span(traces: List[Optional[Trace]], name: str, **attributes):
+    """Time one step of a batch and record it in the trace of every member."""
+    start = time.time()
+    yield attributes
+    end = time.time()
+    for trace in traces:
+        if trace is not None:
+            trace.add_span(name, start, end, **attributes)
+
+
+def _prepare(conversations: List[List[Dict[str, Any]]], traces: List[Optional[Trace]]):
+    with _shared_span(traces, "template"):
+        texts = [
+            processor.apply_chat_template(conversation, tokenize=False, add_generation_prompt=True)
+            for conversation in conversations
+        ]
+    with _shared_span(traces, "processor") as attrs:
+        image_inputs, video_inputs = process_vision_info(conversations)
+        inputs = processor(
+            text=texts,
+            images=image_inputs,
+            videos=video_inputs,
+            padding=True,
+            return_tensors="pt",
+        )
+        device = next(model.parameters()).device
+        inputs = {k: v.to(device) for k, v in inputs.items()}
+        attrs["images"] = len(image_inputs or [])
+        attrs["input_tokens"] = int(inputs["input_ids"].shape[-1])
+    return inputs
+
+
+def sampling_kwargs(temperature: float) -> Dict[str, Any]:
+    """``generate`` sampling arguments of a request, the same whether it runs alone or batched."""
+    if temperature > 0:
+        return {"do_sample": True, "temperature": temperature}
+    return {"do_sample": False}
+
+
+def run_completion(messages, max_tokens, temperature, on_text=None, trace=None):
+    """Run one generation on the inference thread, passing streamed text to on_text"""
+    temp_files = []
+    if trace is not None:
+        trace.dequeued()
+    try:
+        qwen_messages, temp_files = convert_messages(messages, trace)
+        inputs = _prepare([qwen_messages], [trace])
+
+        # Generate response, drafting tokens speculatively for greedy requests
+        spec_kwargs = speculative.generate_kwargs(temperature, model)
+        sampling = {**sampling_kwargs(temperature), **spec_kwargs}
+        spec_mode = speculative.active_mode(spec_kwargs)
+        logger.debug(f"Generating response with max_new_tokens={max_tokens}, temperature={temperature}, speculative={spec_mode}")
+        with GenerateTimer(model) as timer, \
+                speculative.SpeculationStats(model, inputs["input_ids"].shape[-1], spec_mode) as spec_stats:
+            generated_ids = model.generate(
+                **inputs,
+                max_new_tokens=max_tokens,
+                streamer=CallbackStreamer(processor.tokenizer, on_text) if on_text else None,
+                **sampling
+            )
+
+        generated_ids_trimmed = [
+            out_ids[len(in_ids):] for in_ids, out_ids in zip(inputs["input_ids"], generated_ids)
+        ]
+        output_texts = processor.batch_decode(
+            generated_ids_trimmed, skip_special_tokens=True, clean_up_tokenization_spaces=False
+        )
+
+        prompt_tokens = len(inputs["input_ids"][0])
+        completion_tokens = sum(len(ids) for ids in generated_ids_trimmed)
+        spec_stats.finish(completion_tokens)
+        timer.record(trace, completion_tokens=completion_tokens, speculative=spec_mode,
+                     accepted_tokens=spec_stats.accepted)
+        if trace is not None:
+            trace.set(prompt_tokens=prompt_tokens, completion_tokens=completion_tokens, batch_size=1)
+
+        # Tensors are freed when they go out of scope; the caching allocator
+        # reuses the blocks for the next request, so the cache is not emptied here
+        return {
+            "output_texts": output_texts,
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+        }
+
+    except Exception as e:
+        if isinstance(e, HTTPException) or is_out_of_memory(e):
+            # Out-of-memory errors reach the scheduler unwrapped so it can retry smaller batches
+            raise
+        logger.error(f"Error generating completion: {str(e)}", exc_info=True)
+        raise HTTPException(status_code=500, detail=f"Error generating completion: {str(e)}")
+    finally:
+        remove_temp_files(temp_files)
+
+
+def generate_batch(conversations: List[List[Dict[str, Any]]], max_tokens: int, temperature: float,
+                   traces: Optional[List[Optional[Trace]]] = None) -> List[Dict[str, Any]]:
+    """
+    Generate answers for Qwen-format conversations in one padded ``generate`` call.
+
+    Image parts may hold file paths or PIL images.
+
+    Returns:
+        ``{"text", "prompt_tokens", "completion_tokens"}`` per conversation.
+    """
+    traces = traces or [None] * len(conversations)
+    inputs = _prepare(conversations, traces)
+    sampling = sampling_kwargs(temperature)
+    logger.debug(f"Generating batch of {len(conversations)} with max_new_tokens={max_tokens}, temperature={temperature}")
+    with GenerateTimer(model) as timer:
+        generated_ids = model.generate(**inputs, max_new_tokens=max_tokens, **sampling)
+
+    pad_id = processor.tokenizer.pad_token_id
+    prompt_len = inputs["input_ids"].shape[-1]
+    new_ids = generated_ids[:, prompt_len:]
+    output_texts = processor.batch_decode(
+        new_ids, skip_special_tokens=True, clean_up_tokenization_spaces=False
+    )
+    prompt_lengths = inputs["attention_mask"].sum(dim=-1).tolist()
+    completion_lengths = (new_ids != pad_id).sum(dim=-1).tolist()
+
+    outputs = []
+    for row, trace in enumerate(traces):
+        timer.record(trace, completion_tokens=int(completion_lengths[row]))
+        outputs.append({
+            "text": output_texts[row],
+            "prompt_tokens": int(prompt_lengths[row]),
+            "completion_tokens": int(completion_lengths[row]),
+        })
+    return outputs
+
+
+def run_batch(batch: List[tuple]) -> List[Any]:
+    """
+    Generate the answers of several requests in one padded forward pass.
+
+    Args:
+        batch: ``(messages, max_tokens, temperature, on_text, trace)`` per request.
+            All requests share ``max_tokens`` and ``temperature``.
+
+    Returns:
+        One result dict, or the exception that request failed with, per entry.
+    """
+    if len(batch) == 1:
+        return [run_completion(*batch[0])]
+
+    _, max_tokens, temperature, _, _ = batch[0]
+    results: List[Any] = [None] * len(batch)
+    conversations = []
+    members = []
+    temp_files = []
+    for entry in batch:
+        if entry[4] is not None:
+            entry[4].dequeued()
+    try:
+        for i, (messages, _, _, _, trace) in enumerate(batch):
+            try:
+                qwen_messages, files = convert_messages(messages, trace)
+            except Exception as e:
+                results[i] = e
+                continue
+            temp_files.extend(files)
+            conversations.append(qwen_messages)
+            members.append(i)
+
+        if not members:
+            return results
+
+        outputs = generate_batch(conversations, max_tokens, temperature, [batch[i][4] for i in members])
+
+        for output, i in zip(outputs, members):
+            on_text, trace = batch[i][3], batch[i][4]
+            if on_text and output["text"]:
+                on_text(output["text"])
+            if trace is not None:
+                trace.set(prompt_tokens=output["prompt_tokens"],
+                          completion_tokens=output["completion_tokens"], batch_size=len(members))
+            results[i] = {
+                "output_texts": [output["text"]],
+                "prompt_tokens": output["prompt_tokens"],
+                "completion_tokens": output["completion_tokens"],
+            }
+        return results
+
+    except Exception as e:
+        if is_out_of_memory(e):
+            raise
+        logger.error(f"Error generating batch: {str(e)}", exc_info=True)
+        error = HTTPException(status_code=500, detail=f"Error generating completion: {str(e)}")
+        return [result if result is not None else error for result in results]
+    finally:
+        remove_temp_files(temp_files)
+
+
+def load_session_messages(messages: List[Dict[str, Any]],
+                          trace: Optional[Trace] = None) -> List[Dict[str, Any]]:
+    """
+    Convert OpenAI-style messages to the Qwen format with the images held in memory.
+
+    Sessions keep their images to rebuild a dropped KV cache, so the
+    temporary files are read back right away and removed.
+    """
+    qwen_messages, temp_files = convert_messages(messages, trace)
+    try:
+        for message in qwen_messages:
+            for part in message["content"]:
+                if part.get("type") == "image":
+                    with Image.open(part["image"]) as img:
+                        part["image"] = img.convert("RGB")
+    finally:
+        remove_temp_files(temp_files)
+    return qwen_messages
+
+
+def _logits_kwargs() -> Dict[str, int]:
+    """Ask the model for the logits of the last position only, under this transformers version's name."""
+    parameters = inspect.signature(model.forward).parameters
+    for name in ("logits_to_keep", "num_logits_to_keep"):
+        if name in parameters:
+            return {name: 1}
+    return {}
+
+
+def _rope_index(input_ids: torch.Tensor, image_grid_thw: Optional[torch.Tensor]):
+    """Multimodal rope positions of a whole conversation and the offset of the tokens after it."""
+    get_rope_index = getattr(model, "get_rope_index", None) or model.model.get_rope_index
+    return get_rope_index(input_ids, image_grid_thw=image_grid_thw, attention_mask=torch.ones_like(input_ids))
+
+
+def _forward(input_ids: torch.Tensor, position_ids: torch.Tensor, cache, start: int,
+             logits_kwargs: Dict[str, int], **vision) -> torch.Tensor:
+    """Append ``input_ids`` at cache position ``start`` and return the logits of the last one."""
+    length = input_ids.shape[-1]
+    device = input_ids.device
+    outputs = model(
+        input_ids=input_ids,
+        attention_mask=torch.ones((1, start + length), dtype=torch.long, device=device),
+        position_ids=position_ids,
+        past_key_values=cache,
+        cache_position=torch.arange(start, start + length, device=device),
+        use_cache=True,
+        **vision,
+        **logits_kwargs,
+    )
+    return outputs.logits[0, -1]
+
+
+def _sample(logits: torch.Tensor, temperature: float) -> int:
+    if temperature > 0:
+        probs = torch.softmax(logits.float() / temperature, dim=-1)
+        return int(torch.multinomial(probs, 1))
+    return int(torch.argmax(logits))
+
+
+def run_session_turn(session: Session, message: Dict[str, Any], max_tokens: int, temperature: float,
+                     on_text=None, trace: Optional[Trace] = None) -> Dict[str, Any]:
+    """
+    Answer the next user message of a session, prefilling only what its cache lacks.
+
+    With a cache only the end of the previous answer and the new message
+    are run through the model, so a turn costs the same however long the
+    conversation is. Without one (first turn, or the cache was dropped)
+    the whole conversation is prefilled and the cache is kept.
+
+    Args:
+        session: Session checked out for this turn.
+        message: The new user message, OpenAI-style.
+
+    Returns:
+        The ``run_completion`` result plus ``cached_tokens``, the prompt
+        tokens that were not prefilled again.
+    """
+    if trace is not None:
+        trace.dequeued()
+    try:
+        user = load_session_messages([message], trace)[0]
+        history = session.messages
+        conversation = history + [user]
+        cached = session.cached_tokens
+        with span(trace, "template"):
+            text = processor.apply_chat_template(conversation, tokenize=False, add_generation_prompt=True)
+            if cached:
+                previous = processor.apply_chat_template(history, tokenize=False)
+                if text.startswith(previous):
+                    text = text[len(previous):]
+                else:
+                    logger.warning(f"Session {session.id} history no longer renders as a prefix, prefilling it again")
+                    session.drop_cache()
+                    cached = 0
+
+        new_messages = [user] if cached else conversation
+        images = [part["image"] for m in new_messages for part in m["content"] if part.get("type") == "image"]
+        device = next(model.parameters()).device
+        with span(trace, "processor") as attrs:
+            inputs = processor(text=[text], images=images or None, return_tensors="pt")
+            new_ids = inputs["input_ids"].to(device)
+            grids = [inputs["image_grid_thw"].to(device)] if images else []
+            if cached:
+                # The end of the previous answer was sampled but never fed to the model
+                pending = torch.tensor([session.pending], dtype=new_ids.dtype, device=device)
+                new_ids = torch.cat([pending, new_ids], dim=-1)
+                input_ids = torch.cat([session.input_ids, new_ids], dim=-1)
+                if session.image_grid_thw is not None:
+                    grids.insert(0, session.image_grid_thw)
+            else:
+                input_ids = new_ids
+            image_grid_thw = torch.cat(grids) if grids else None
+            attrs["images"] = len(images)
+            attrs["input_tokens"] = int(new_ids.shape[-1])
+            attrs["cached_tokens"] = cached
+
+        total = int(input_ids.shape[-1])
+        if total + max_tokens > SESSION_MAX_TOKENS:
+            raise HTTPException(
+                status_code=400,
+                detail=f"Session would grow to {total + max_tokens} tokens, the limit is {SESSION_MAX_TOKENS}; start a new session",
+            )
+
+        cache = session.cache if cached else DynamicCache()
+        # Positions of the new tokens depend on every image before them, so they are computed over the whole conversation
+        position_ids, rope_deltas = _rope_index(input_ids, image_grid_thw)
+        vision = {}
+        if images:
+            vision = {"pixel_values": inputs["pixel_values"].to(device), "image_grid_thw": grids[-1]}
+        logits_kwargs = _logits_kwargs()
+
+        eos = model.generation_config.eos_token_id
+        eos = set(eos if isinstance(eos, list) else [eos])
+        streamer = None
+        if on_text:
+            streamer = CallbackStreamer(processor.tokenizer, on_text)
+            streamer.next_tokens_are_prompt = False
+
+        generated = []
+        with torch.inference_mode():
+            with span(trace, "prefill", tokens=int(new_ids.shape[-1]), cached_tokens=cached):
+                logits = _forward(new_ids, position_ids[:, :, cached:], cache, cached, logits_kwargs, **vision)
+            with span(trace, "decode") as attrs:
+                length = total
+                token = _sample(logits, temperature)
+                while True:
+                    generated.append(token)
+                    if token in eos:
+                        break
+                    if streamer is not None:
+                        streamer.put(torch.tensor([token]))
+                    if len(generated) >= max_tokens:
+                        break
+                    # After the prompt all three rope sections advance together
+                    position = (rope_deltas + length).view(1, 1, 1).expand(3, 1, 1)
+                    logits = _forward(torch.tensor([[token]], device=device), position, cache, length, logits_kwargs)
+                    length += 1
+                    token = _sample(logits, temperature)
+                attrs["completion_tokens"] = len(generated)
+        if streamer is not None:
+            streamer.end()
+
+        reply = processor.tokenizer.decode(
+            [t for t in generated if t not in eos], skip_special_tokens=True, clean_up_tokenization_spaces=False
+        )
+        # The chat template closes the answer with "<|im_end|>\n"; the last sampled token was not fed either
+        tail = processor.tokenizer.encode("<|im_end|>\n", add_special_tokens=False)
+        session.pending = ([] if generated[-1] in eos else [generated[-1]]) + tail
+        fed = torch.tensor([generated[:-1]], dtype=input_ids.dtype, device=device)
+        session.input_ids = torch.cat([input_ids, fed], dim=-1)
+        session.image_grid_thw = image_grid_thw
+        session.cache = cache
+        session.messages = conversation + [{"role": "assistant", "content": [{"type": "text", "text": reply}]}]
+        session.turns += 1
+
+        if trace is not None:
+            trace.set(prompt_tokens=total, completion_tokens=len(generated), cached_tokens=cached, batch_size=1)
+        return {
+            "output_texts": [reply],
+            "prompt_tokens": total,
+            "completion_tokens": len(generated),
+            "cached_tokens": cached,
+        }
+
+    except Exception as e:
+        if isinstance(e, HTTPException):
+            raise
+        # A failed forward pass may have appended part of the turn to the cache
+        session.drop_cache()
+        if is_out_of_memory(e):
+            raise
+        logger.error(f"Error generating session turn: {str(e)}", exc_info=True)
+        raise HTTPException(status_code=500, detail=f"Error generating completion: {str(e)}")
+
+
+class QwenStepRunner(StepRunner):
+    """Prefill and batched decode steps of Qwen2.5-VL over the paged KV cache."""
+
+    def __init__(self):
+        self.pool: Optional[KVPagePool] = None
+        self._model = None
+        self._eos = set()
+
+    def open(self, page_size: int, memory_bytes: int) -> int:
+        if self._model is not model or self.pool is None or self.pool.page_size != page_size:
+            # A swapped-in model gets a pool of its own shape; the old one is freed first
+            self.pool = None
+            self.pool = KVPagePool.for_model(model, page_size, memory_bytes)
+            self._model = model
+            eos = model.generation_config.eos_token_id
+            self._eos = set(eos if isinstance(eos, list) else [eos])
+            logger.info(f"KV page pool: {self.pool.pages} pages of {page_size} tokens, "
+                        f"{self.pool.memory_bytes / 2**20:.0f} MiB")
+        return self.pool.pages
+
+    def prepare(self, messages: List[Dict[str, Any]], trace: Optional[Trace]) -> Tuple[Dict[str, Any], int]:
+        qwen_messages, temp_files = convert_messages(messages, trace)
+        try:
+            inputs = _prepare([qwen_messages], [trace])
+        finally:
+            remove_temp_files(temp_files)
+        inputs.pop("attention_mask", None)
+        return inputs, int(inputs["input_ids"].shape[-1])
+
+    def prefill(self, seq: Sequence) -> int:
+        inputs = seq.prompt
+        input_ids = inputs["input_ids"]
+        if len(seq.generated) > 1:
+            # Prefilled again after a preemption: the answer so far is part of the context
+            fed = torch.tensor([seq.generated[:-1]], dtype=input_ids.dtype, device=input_ids.device)
+            input_ids = torch.cat([input_ids, fed], dim=-1)
+        vision = {k: v for k, v in inputs.items() if k in ("pixel_values", "image_grid_thw")}
+        position_ids, rope_deltas = _rope_index(input_ids, vision.get("image_grid_thw"))
+        inputs["rope_deltas"] = rope_deltas
+        cache = PagedKVCache(self.pool, [seq.pages], [0], input_ids.shape[-1])
+        try:
+            with torch.inference_mode(), span(seq.trace, "prefill", tokens=int(input_ids.shape[-1]),
+                                              preempted=seq.preemptions):
+                logits = model(
+                    input_ids=input_ids,
+                    attention_mask=cache.attention_mask,
+                    position_ids=position_ids,
+                    past_key_values=cache,
+                    cache_position=cache.cache_position,
+                    use_cache=True,
+                    **vision,
+                    **_logits_kwargs(),
+                ).logits
+        except Exception as e:
+            raise self._error(e)
+        return _sample(logits[0, -1], seq.temperature)
+
+    def decode(self, seqs: List[Sequence]) -> List[int]:
+        device = next(model.parameters()).device
+        input_ids = torch.tensor([[seq.generated[-1]] for seq in seqs], device=device)
+        # After the prompt all three rope sections advance together
+        positions = torch.cat([seq.prompt["rope_deltas"].view(1).to(device) + seq.cached for seq in seqs])
+        position_ids = positions.view(1, -1, 1).expand(3, -1, 1)
+        cache = PagedKVCache(self.pool, [seq.pages for seq in seqs], [seq.cached for seq in seqs], 1)
+        try:
+            with torch.inference_mode():
+                logits = model(
+                    input_ids=input_ids,
+                    attention_mask=cache.attention_mask,
+                    position_ids=position_ids,
+                    past_key_values=cache,
+                    cache_position=cache.cache_position,
+                    use_cache=True,
+                    **_logits_kwargs(),
+                ).logits[:, -1]
+        except Exception as e:
+            raise self._error(e)
+        greedy = torch.argmax(logits, dim=-1).tolist()
+        return [_sample(logits[row], seq.temperature) if seq.temperature > 0 else greedy[row]
+                for row, seq in enumerate(seqs)]
+
+    def is_end(self, token: int) -> bool:
+        return token in self._eos
+
+    def result(self, seq: Sequence) -> Dict[str, Any]:
+        text = processor.tokenizer.decode(
+            [t for t in seq.generated if t not in self._eos], skip_special_tokens=True,
+            clean_up_tokenization_spaces=False,
+        )
+        return {
+            "output_texts": [text],
+            "prompt_tokens": seq.prompt_tokens,
+            "completion_tokens": len(seq.generated),
+        }
+
+    def release(self, seq: Sequence) -> None:
+        seq.prompt = None
+
+    @staticmethod
+    def _error(e: Exception) -> Exception:
+        # Out-of-memory errors reach the engine unwrapped so it can preempt
+        if isinstance(e, HTTPException) or is_out_of_memory(e):
+            return e
+        logger.error(f"Error in continuous batch step: {str(e)}", exc_info=True)
+        return HTTPException(status_code=500, detail=f"Error generating completion: {str(e)}")
+
+
+# Iteration-level batching of non-streamed answers, on when CONTINUOUS_BATCHING is set
+continuous = ContinuousBatcher(QwenStepRunner())
+
+
+def run_continuous(batch: ContinuousBatch) -> None:
+    """Serve a continuous batch of ``(messages, max_tokens, temperature, on_text, trace)`` jobs."""
+    continuous.run(batch)
@@ -0,0 +1,463 @@
+# vlm/reanalyze.py
+"""
+Offline bulk re-analysis of recorded footage.
+
+Walks the capture directory of the Node server and runs the VLM over
+every stored frame image and, optionally, over frames sampled from the
+HLS recordings. It runs apart from the live API server, loading the model
+itself and feeding it full batches, and writes one result row per frame
+to JSONL or Parquet.
+
+Layout read from --source (server/public/captures):
+    <stream>/<YYYYMMDD>/<unix ms>.jpg                     frames saved with results
+    <stream>/HLS/recording_<unix ms>/playlist.m3u8        recordings, segment_NNN.ts
+
+The output doubles as the checkpoint: on start, frames already present in
+it are skipped, so an interrupted run continues where it stopped. A
+``run.json`` next to the output records the prompt and model, and a run
+with a different prompt refuses to resume into it (use a new --out).
+
+Usage:
+    python reanalyze.py --source ../server/public/captures --prompt-file prompt.txt --out reanalysis.jsonl
+    python reanalyze.py --source ../server/public/captures --prompt "Describe the scene" \\
+        --hls --interval 5 --stream 65f0c... --since 2025-03-01 --format parquet --out reanalysis/
+"""
+
+import argparse
+import hashlib
+import json
+import logging
+import math
+import os
+import queue
+import re
+import sys
+import threading
+import time
+from datetime import datetime
+from typing import Dict, Iterator, List, Optional, Set
+
+from PIL import Image
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    handlers=[logging.StreamHandler()]
+)
+logger = logging.getLogger("reanalyze")
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".webp")
+
+
+class WorkItem:
+    """A frame image, or an HLS segment that expands into sampled frames."""
+
+    __slots__ = ("path", "stream", "timestamp", "kind", "duration", "start")
+
+    def __init__(self, path: str, stream: str, timestamp: float, kind: str, duration: float = 0.0,
+                 start: float = 0.0):
+        self.path = path
+        self.stream = stream
+        self.timestamp = timestamp
+        self.kind = kind
+        self.duration = duration
+        # Start of an HLS segment on its recording's timeline
+        self.start = start
+
+    def frame_offsets(self, interval: float) -> List[float]:
+        """
+        Offsets in seconds, from the segment start, of the frames sampled from
+        an HLS segment. Frames are taken at multiples of ``interval`` on the
+        recording's timeline, so an interval longer than a segment skips
+        segments instead of sampling each one; a segment may have none.
+        """
+        if self.kind != "hls":
+            return [0.0]
+        offsets = []
+        step = math.ceil(self.start / interval - 1e-9)
+        while step * interval < self.start + self.duration - 1e-9:
+            offsets.append(round(step * interval - self.start, 3))
+            step += 1
+        return offsets
+
+    def frame_id(self, source: str, offset: float = 0.0) -> str:
+        relative = os.path.relpath(self.path, source).replace(os.sep, "/")
+        return relative if self.kind == "image" else f"{relative}@{offset:.3f}"
+
+
+def parse_time(value: Optional[str]) -> Optional[float]:
+    """Unix seconds from a number or an ISO date/time."""
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.fromisoformat(value).timestamp()
+
+
+def _stem_time(name: str) -> Optional[float]:
+    match = re.search(r"(\d{12,})", name)
+    return int(match.group(1)) / 1000 if match else None
+
+
+def read_playlist(path: str) -> List[tuple]:
+    """``(segment file, start offset, duration)`` of every segment in an HLS playlist."""
+    segments = []
+    offset = 0.0
+    duration = None
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith("#EXTINF:"):
+                duration = float(line[len("#EXTINF:"):].split(",")[0])
+            elif line and not line.startswith("#") and duration is not None:
+                segments.append((line, offset, duration))
+                offset += duration
+                duration = None
+    return segments
+
+
+def discover(source: str, include_images: bool, include_hls: bool, streams: Optional[Set[str]],
+             since: Optional[float], until: Optional[float]) -> List[WorkItem]:
+    """Every frame image and HLS segment under ``source``, ordered by stream and time."""
+    items = []
+    for stream in sorted(os.listdir(source)):
+        stream_dir = os.path.join(source, stream)
+        if not os.path.isdir(stream_dir) or (streams and stream not in streams):
+            continue
+        for root, dirs, files in os.walk(stream_dir):
+            dirs.sort()
+            if include_hls and "playlist.m3u8" in files:
+                start = _stem_time(os.path.basename(root)) or os.path.getmtime(os.path.join(root, "playlist.m3u8"))
+                for segment, offset, duration in read_playlist(os.path.join(root, "playlist.m3u8")):
+                    path = os.path.join(root, segment)
+                    if os.path.exists(path):
+                        items.append(WorkItem(path, stream, start + offset, "hls", duration, offset))
+                continue
+            if include_images and os.path.basename(os.path.dirname(root)) != "HLS":
+                for name in sorted(files):
+                    if name.lower().endswith(IMAGE_EXTENSIONS):
+                        path = os.path.join(root, name)
+                        timestamp = _stem_time(name) or os.path.getmtime(path)
+                        items.append(WorkItem(path, stream, timestamp, "image"))
+
+    items = [
+        item for item in items
+        if (since is None or item.timestamp + item.duration >= since)
+        and (until is None or item.timestamp <= until)
+    ]
+    items.sort(key=lambda item: (item.stream, item.timestamp, item.path))
+    return items
+
+
+def decode_segment(path: str, offsets: List[float]) -> Iterator[tuple]:
+    """
+    Yield ``(offset, PIL image)`` for the first frame at or after each offset
+    of a segment, and ``(offset, None)`` for offsets past its last frame (the
+    playlist durations are rounded).
+    """
+    import av
+
+    wanted = list(offsets)
+    with av.open(path) as container:
+        video = container.streams.video[0]
+        first_time = None
+        for frame in container.decode(video):
+            if frame.time is None:
+                continue
+            if first_time is None:
+                first_time = frame.time
+            while wanted and frame.time - first_time >= wanted[0] - 1e-3:
+                yield wanted.pop(0), frame.to_image()
+            if not wanted:
+                break
+    for offset in wanted:
+        yield offset, None
+
+
+def prepare_image(image: Image.Image, max_width: int) -> Image.Image:
+    """Match the live path: RGB, downscaled to ``max_width``. Always returns a new image."""
+    image = image.convert("RGB")
+    if image.width > max_width:
+        image = image.resize((max_width, int(image.height / image.width * max_width)), Image.LANCZOS)
+    return image
+
+
+class JsonlWriter:
+    """Appends result rows to a JSONL file, fsynced per batch."""
+
+    def __init__(self, path: str):
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+    def done_ids(self) -> Set[str]:
+        if not os.path.exists(self.path):
+            return set()
+        done = set()
+        good_bytes = 0
+        with open(self.path, "rb") as f:
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break  # torn last line of an interrupted run
+                try:
+                    done.add(json.loads(line)["id"])
+                except (ValueError, KeyError):
+                    break
+                good_bytes += len(line)
+        if good_bytes != os.path.getsize(self.path):
+            with open(self.path, "r+b") as f:
+                f.truncate(good_bytes)
+        return done
+
+    def write(self, rows: List[Dict]) -> None:
+        with open(self.path, "a", encoding="utf-8") as f:
+            for row in rows:
+                f.write(json.dumps(row, ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def close(self) -> None:
+        pass
+
+
+class ParquetWriter:
+    """Writes result rows as numbered Parquet part files in a directory."""
+
+    def __init__(self, directory: str, rows_per_part: int = 2000):
+        import pyarrow  # noqa: F401  fail early when pyarrow is missing
+
+        self.directory = directory
+        self.rows_per_part = rows_per_part
+        self._rows: List[Dict] = []
+        os.makedirs(directory, exist_ok=True)
+        self._next_part = len(self._parts())
+
+    def _parts(self) -> List[str]:
+        return sorted(name for name in os.listdir(self.directory) if name.endswith(".parquet"))
+
+    def done_ids(self) -> Set[str]:
+        import pyarrow.parquet as pq
+
+        done = set()
+        for name in self._parts():
+            done.update(pq.read_table(os.path.join(self.directory, name), columns=["id"]).column("id").to_pylist())
+        return done
+
+    def write(self, rows: List[Dict]) -> None:
+        self._rows.extend(rows)
+        if len(self._rows) >= self.rows_per_part:
+            self._flush()
+
+    def _flush(self) -> None:
+        if not self._rows:
+            return
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        table = pa.Table.from_pylist(self._rows)
+        path = os.path.join(self.directory, f"part-{self._next_part:05d}.parquet")
+        pq.write_table(table, path + ".tmp")
+        os.replace(path + ".tmp", path)
+        self._next_part += 1
+        self._rows = []
+
+    def close(self) -> None:
+        self._flush()
+
+
+def check_run_config(path: str, config: Dict, force: bool) -> None:
+    """Refuse to mix results of different prompts or models in one output."""
+    if os.path.exists(path) and not force:
+        with open(path, encoding="utf-8") as f:
+            previous = json.load(f)
+        if previous != config:
+            changed = sorted(k for k in set(previous) | set(config) if previous.get(k) != config.get(k))
+            raise SystemExit(f"{path} belongs to another run (differs in {', '.join(changed)}); "
+                             f"use a new --out or pass --force")
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(config, f, indent=2)
+
+
+class Progress:
+    """Frames per second over a sliding window and the ETA of the remaining frames."""
+
+    def __init__(self, total: int, every: float = 10.0):
+        self.total = total
+        self.every = every
+        self.done = 0
+        self.start = time.time()
+        self._window = [(self.start, 0)]
+        self._last_report = self.start
+
+    def advance(self, frames: int) -> None:
+        now = time.time()
+        self.done += frames
+        self._window.append((now, self.done))
+        while len(self._window) > 2 and now - self._window[0][0] > 60:
+            self._window.pop(0)
+        if now - self._last_report >= self.every or self.done >= self.total:
+            self._last_report = now
+            logger.info(self.report())
+
+    @property
+    def rate(self) -> float:
+        (t0, d0), (t1, d1) = self._window[0], self._window[-1]
+        return (d1 - d0) / (t1 - t0) if t1 > t0 else 0.0
+
+    def report(self) -> str:
+        rate = self.rate
+        remaining = self.total - self.done
+        eta = time.strftime("%H:%M:%S", time.gmtime(remaining / rate)) if rate > 0 else "--:--:--"
+        percent = 100.0 * self.done / self.total if self.total else 100.0
+        return f"{self.done}/{self.total} frames ({percent:.1f}%), {rate:.2f} frames/s, ETA {eta}"
+
+
+def produce(items: List[WorkItem], source: str, done: Set[str], interval: float, max_width: int,
+            out: queue.Queue, stop: threading.Event) -> None:
+    """Decode pending frames on a background thread so the GPU never waits for the disk."""
+    try:
+        for item in items:
+            if stop.is_set():
+                break
+            offsets = [o for o in item.frame_offsets(interval) if item.frame_id(source, o) not in done]
+            if not offsets:
+                continue
+            try:
+                if item.kind == "image":
+                    with Image.open(item.path) as image:
+                        frames = [(0.0, prepare_image(image, max_width))]
+                else:
+                    frames = ((offset, prepare_image(image, max_width) if image is not None else None)
+                              for offset, image in decode_segment(item.path, offsets))
+                for offset, image in frames:
+                    out.put((item, offset, image))
+            except Exception as e:
+                logger.warning(f"Skipping unreadable {item.path}: {e}")
+    finally:
+        out.put(None)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Re-run the VLM over recorded frames")
+    parser.add_argument("--source", required=True, help="captures directory of the Node server")
+    parser.add_argument("--out", required=True, help="JSONL file, or directory for --format parquet")
+    parser.add_argument("--format", choices=["jsonl", "parquet"], default="jsonl")
+    prompt_group = parser.add_mutually_exclusive_group(required=True)
+    prompt_group.add_argument("--prompt", help="prompt text")
+    prompt_group.add_argument("--prompt-file", help="file holding the prompt")
+    parser.add_argument("--images", action=argparse.BooleanOptionalAction, default=True,
+                        help="analyse stored frame images (default: yes)")
+    parser.add_argument("--hls", action="store_true", help="also sample frames from HLS recordings")
+    parser.add_argument("--interval", type=float, default=2.0, help="seconds between HLS frames")
+    parser.add_argument("--stream", action="append", help="only these stream ids (repeatable)")
+    parser.add_argument("--since", help="only frames at or after this time (ISO or unix)")
+    parser.add_argument("--until", help="only frames at or before this time (ISO or unix)")
+    parser.add_argument("--batch-size", type=int, default=16, help="frames per generate call")
+    parser.add_argument("--max-tokens", type=int, default=256)
+    parser.add_argument("--temperature", type=float, default=0.0)
+    parser.add_argument("--force", action="store_true", help="resume even if the prompt or model changed")
+    parser.add_argument("--progress-every", type=float, default=10.0, help="seconds between progress lines")
+    args = parser.parse_args()
+
+    prompt = args.prompt if args.prompt is not None else open(args.prompt_file, encoding="utf-8").read()
+
+    import qwen_backend
+    from admission import is_out_of_memory, release_cached_memory
+
+    writer = ParquetWriter(args.out) if args.format == "parquet" else JsonlWriter(args.out)
+    prompt_sha = hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+    run_config = os.path.join(args.out, "run.json") if args.format == "parquet" else args.out + ".run.json"
+    check_run_config(run_config, {
+        "prompt_sha256": prompt_sha,
+        "model": qwen_backend.MODEL_PATH,
+        "max_tokens": args.max_tokens,
+        "temperature": args.temperature,
+        "interval": args.interval if args.hls else None,
+        "image_max_width": qwen_backend.IMAGE_MAX_WIDTH,
+    }, args.force)
+
+    items = discover(args.source, args.images, args.hls, set(args.stream or []) or None,
+                     parse_time(args.since), parse_time(args.until))
+    done = writer.done_ids()
+    total = sum(
+        1 for item in items for offset in item.frame_offsets(args.interval)
+        if item.frame_id(args.source, offset) not in done
+    )
+    logger.info(f"{len(items)} files, {len(done)} frames already analysed, {total} to go")
+    if total == 0:
+        return
+
+    qwen_backend.load_model()
+    frames: queue.Queue = queue.Queue(maxsize=args.batch_size * 4)
+    stop = threading.Event()
+    threading.Thread(
+        target=produce,
+        args=(items, args.source, done, args.interval, qwen_backend.IMAGE_MAX_WIDTH, frames, stop),
+        daemon=True,
+    ).start()
+
+    def result_row(item: WorkItem, offset: float, output: Optional[Dict]) -> Dict:
+        return {
+            "id": item.frame_id(args.source, offset),
+            "stream": item.stream,
+            "timestamp": round(item.timestamp + offset, 3),
+            "source": item.kind,
+            "path": item.path,
+            "offset": offset,
+            "prompt_sha256": prompt_sha,
+            "model": qwen_backend.MODEL_PATH,
+            # past_end: the segment ended before this offset, recorded so a resume does not retry it
+            "status": "ok" if output is not None else "past_end",
+            "output": output["text"] if output is not None else None,
+            "prompt_tokens": output["prompt_tokens"] if output is not None else 0,
+            "completion_tokens": output["completion_tokens"] if output is not None else 0,
+        }
+
+    progress = Progress(total, args.progress_every)
+    batch_size = args.batch_size
+    pending: List[tuple] = []
+    exhausted = False
+    try:
+        while pending or not exhausted:
+            while not exhausted and len(pending) < batch_size:
+                entry = frames.get()
+                if entry is None:
+                    exhausted = True
+                elif entry[2] is None:
+                    writer.write([result_row(entry[0], entry[1], None)])
+                    progress.advance(1)
+                else:
+                    pending.append(entry)
+            if not pending:
+                break
+
+            batch, pending = pending[:batch_size], pending[batch_size:]
+            conversations = [
+                [{"role": "user", "content": [{"type": "image", "image": image}, {"type": "text", "text": prompt}]}]
+                for _, _, image in batch
+            ]
+            try:
+                outputs = qwen_backend.generate_batch(conversations, args.max_tokens, args.temperature)
+            except Exception as e:
+                if not is_out_of_memory(e) or batch_size == 1:
+                    raise
+                # Retry the same frames in smaller batches
+                batch_size = max(1, batch_size // 2)
+                logger.warning(f"Out of memory, batch size lowered to {batch_size}")
+                release_cached_memory()
+                pending = batch + pending
+                continue
+
+            rows = [result_row(item, offset, output) for (item, offset, _), output in zip(batch, outputs)]
+            writer.write(rows)
+            progress.advance(len(rows))
+    except KeyboardInterrupt:
+        logger.info("Interrupted, run the same command again to resume")
+    finally:
+        stop.set()
+        writer.close()
+    logger.info(f"Finished: {progress.report()}")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
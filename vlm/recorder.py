@@ -0,0 +1,266 @@
+# vlm/recorder.py
+"""
+Opt-in recorder of production traffic, for replay with replay.py.
+
+Every finished request whose trace carries its body is appended to a
+compact archive: one JSON line per request in gzip segments, with the
+arrival time, duration, outcome, token counts, scheduling attributes and
+the answer text. Images are taken out of the bodies and stored once per
+content hash, so a camera's unchanged frames (and frames sent to several
+prompts) cost their bytes only once. In the body an image is replaced by
+``recorded:sha256:<hex>``. Requests whose frames are ``ring://``
+references to shared memory are not recorded: the frame is gone by the
+time of a replay, and usually by the time the request finished.
+
+Archive layout::
+
+    <RECORD_DIR>/requests-<unix time>.jsonl.gz   rotated after RECORD_SEGMENT_REQUESTS lines
+    <RECORD_DIR>/images/<hex[:2]>/<hex>.<ext>
+
+Hashing and writing happen on a background thread. When it cannot keep
+up, requests are dropped from the recording (``recorder_dropped_total``),
+never delayed.
+
+Configuration (environment variables):
+    RECORD_DIR                archive directory; empty disables recording (default: empty)
+    RECORD_SAMPLE_RATE        fraction of requests recorded (default: 1.0)
+    RECORD_OPERATIONS         comma-separated trace names recorded (default: chat.completions)
+    RECORD_SEGMENT_REQUESTS   requests per gzip segment (default: 10000)
+"""
+
+import base64
+import copy
+import gzip
+import hashlib
+import json
+import logging
+import os
+import queue
+import random
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Iterator, Optional, Tuple
+
+from frame_ring import RING_SCHEME
+from metrics import metrics
+
+logger = logging.getLogger("recorder")
+
+RECORD_DIR = os.environ.get("RECORD_DIR", "")
+RECORD_SAMPLE_RATE = float(os.environ.get("RECORD_SAMPLE_RATE", "1.0"))
+RECORD_OPERATIONS = {s.strip() for s in os.environ.get("RECORD_OPERATIONS", "chat.completions").split(",") if s.strip()}
+RECORD_SEGMENT_REQUESTS = int(os.environ.get("RECORD_SEGMENT_REQUESTS", "10000"))
+
+IMAGE_REF = "recorded:sha256:"
+# Trace attributes worth keeping next to the body
+KEPT_ATTRIBUTES = ("stream_id", "priority", "stream", "cache", "coalesced", "prompt_tokens",
+                   "completion_tokens", "queue_wait_ms", "batch_size", "error")
+QUEUE_SIZE = 1000
+# Digests of images known to be stored; older ones are checked on disk again
+KNOWN_IMAGES = 100000
+_MAGIC = ((b"\xff\xd8", "jpg"), (b"\x89PNG", "png"), (b"RIFF", "webp"), (b"GIF8", "gif"))
+
+
+def _extension(raw: bytes) -> str:
+    for magic, extension in _MAGIC:
+        if raw.startswith(magic):
+            return extension
+    return "bin"
+
+
+def image_path(directory: str, digest: str) -> Optional[str]:
+    """File of a recorded image, whatever its extension, or None."""
+    folder = os.path.join(directory, "images", digest[:2])
+    for extension in [e for _, e in _MAGIC] + ["bin"]:
+        path = os.path.join(folder, f"{digest}.{extension}")
+        if os.path.exists(path):
+            return path
+    return None
+
+
+class TrafficRecorder:
+    """
+    Appends finished requests to a record-and-replay archive.
+
+    Args:
+        directory: Archive directory, created when missing.
+        sample_rate: Fraction of requests recorded.
+        operations: Trace names that are recorded.
+    """
+
+    def __init__(self, directory: str, sample_rate: float = RECORD_SAMPLE_RATE,
+                 operations=RECORD_OPERATIONS, segment_requests: int = RECORD_SEGMENT_REQUESTS):
+        self.directory = directory
+        self.sample_rate = sample_rate
+        self.operations = set(operations)
+        self.segment_requests = segment_requests
+        self._queue: "queue.Queue[Optional[Dict[str, Any]]]" = queue.Queue(maxsize=QUEUE_SIZE)
+        self._known_images: "OrderedDict[str, None]" = OrderedDict()
+        self._warned_ring = False
+        self._segment = None
+        self._segment_lines = 0
+        os.makedirs(os.path.join(directory, "images"), exist_ok=True)
+        self._thread = threading.Thread(target=self._write_loop, name="traffic-recorder", daemon=True)
+        self._thread.start()
+        logger.info(f"Recording {', '.join(sorted(self.operations))} requests to {directory}")
+
+    def record(self, trace, duration_ms: float) -> None:
+        """Queue a finished request; called from ``TraceSink.finish``."""
+        if trace.name not in self.operations or trace.request_body is None:
+            return
+        if self.sample_rate < 1.0 and random.random() >= self.sample_rate:
+            return
+        if _has_ring_refs(trace.request_body):
+            metrics.inc("recorder_skipped_total", reason="ring")
+            if not self._warned_ring:
+                self._warned_ring = True
+                logger.warning("Requests with ring:// frames cannot be replayed and are not recorded")
+            return
+        entry = {
+            "t": round(trace.start, 3),
+            "op": trace.name,
+            "trace_id": trace.trace_id,
+            "duration_ms": round(duration_ms, 1),
+            "attributes": {k: trace.attributes[k] for k in KEPT_ATTRIBUTES if k in trace.attributes},
+            "body": trace.request_body,
+            "output": trace.response_texts,
+        }
+        try:
+            self._queue.put_nowait(entry)
+        except queue.Full:
+            metrics.inc("recorder_dropped_total")
+
+    def close(self) -> None:
+        self._queue.put(None)
+        self._thread.join(timeout=10)
+
+    def _write_loop(self) -> None:
+        while True:
+            entry = self._queue.get()
+            if entry is None:
+                break
+            try:
+                entry["body"] = self._store_images(entry["body"])
+                self._append(json.dumps(entry, separators=(",", ":"), default=str))
+                metrics.inc("recorder_requests_total")
+            except Exception as e:
+                metrics.inc("recorder_errors_total")
+                logger.warning(f"Could not record request {entry.get('trace_id')}: {e}")
+        if self._segment is not None:
+            self._segment.close()
+
+    def _store_images(self, body: Dict[str, Any]) -> Dict[str, Any]:
+        """Copy of ``body`` with inline images replaced by references to their stored files."""
+        body = copy.deepcopy(body)
+        for message in body.get("messages") or []:
+            content = message.get("content")
+            if not isinstance(content, list):
+                continue
+            for part in content:
+                if part.get("type") == "image" and part.get("image"):
+                    part["image"] = self._store(part["image"])
+                elif part.get("type") == "image_url" and isinstance(part.get("image_url"), dict):
+                    url = part["image_url"].get("url", "")
+                    if url.startswith("data:") and "," in url:
+                        part["image_url"]["url"] = self._store(url.split(",", 1)[1])
+        return body
+
+    def _store(self, data: str) -> str:
+        raw = base64.b64decode(data)
+        digest = hashlib.sha256(raw).hexdigest()
+        if digest in self._known_images:
+            self._known_images.move_to_end(digest)
+        else:
+            folder = os.path.join(self.directory, "images", digest[:2])
+            path = os.path.join(folder, f"{digest}.{_extension(raw)}")
+            if not os.path.exists(path):
+                os.makedirs(folder, exist_ok=True)
+                temp_path = f"{path}.tmp"
+                with open(temp_path, "wb") as f:
+                    f.write(raw)
+                os.replace(temp_path, path)
+                metrics.inc("recorder_image_bytes_total", len(raw))
+            self._known_images[digest] = None
+            if len(self._known_images) > KNOWN_IMAGES:
+                self._known_images.popitem(last=False)
+        return IMAGE_REF + digest
+
+    def _append(self, line: str) -> None:
+        if self._segment is None or self._segment_lines >= self.segment_requests:
+            if self._segment is not None:
+                self._segment.close()
+            path = os.path.join(self.directory, f"requests-{time.time():.3f}.jsonl.gz")
+            self._segment = gzip.open(path, "at", encoding="utf-8")
+            self._segment_lines = 0
+        self._segment.write(line + "\n")
+        # A sync flush keeps everything written so far readable if the server dies
+        self._segment.flush()
+        self._segment_lines += 1
+
+
+def _has_ring_refs(body: Dict[str, Any]) -> bool:
+    for message in body.get("messages") or []:
+        content = message.get("content")
+        if not isinstance(content, list):
+            continue
+        for part in content:
+            image_url = part.get("image_url") if part.get("type") == "image_url" else None
+            url = image_url.get("url", "") if isinstance(image_url, dict) else ""
+            image = part.get("image") if part.get("type") == "image" else None
+            if url.startswith(RING_SCHEME) or (isinstance(image, str) and image.startswith(RING_SCHEME)):
+                return True
+    return False
+
+
+def read_archive(directory: str) -> Iterator[Dict[str, Any]]:
+    """Recorded requests of an archive in arrival order, images still as references."""
+    entries = []
+    for name in sorted(os.listdir(directory)):
+        if not (name.startswith("requests-") and name.endswith(".jsonl.gz")):
+            continue
+        try:
+            with gzip.open(os.path.join(directory, name), "rt", encoding="utf-8") as f:
+                for line in f:
+                    if line.strip():
+                        entries.append(json.loads(line))
+        except (EOFError, gzip.BadGzipFile, json.JSONDecodeError) as e:
+            # The segment the server was writing when it stopped ends abruptly
+            logger.warning(f"{name} is truncated, using the requests before the damage: {e}")
+    entries.sort(key=lambda entry: entry["t"])
+    return iter(entries)
+
+
+def restore_images(directory: str, body: Dict[str, Any], cache: Dict[str, str]) -> Dict[str, Any]:
+    """Copy of a recorded body with its image references replaced by the base64 images."""
+
+    def load(ref: str) -> Tuple[str, str]:
+        digest = ref[len(IMAGE_REF):]
+        if digest not in cache:
+            path = image_path(directory, digest)
+            if path is None:
+                raise FileNotFoundError(f"Image {digest} is missing from {directory}")
+            with open(path, "rb") as f:
+                cache[digest] = base64.b64encode(f.read()).decode("ascii")
+            extension = os.path.splitext(path)[1].lstrip(".")
+            cache[f"{digest}:mime"] = "image/jpeg" if extension == "jpg" else f"image/{extension}"
+        return cache[digest], cache[f"{digest}:mime"]
+
+    body = copy.deepcopy(body)
+    for message in body.get("messages") or []:
+        content = message.get("content")
+        if not isinstance(content, list):
+            continue
+        for part in content:
+            if part.get("type") == "image" and str(part.get("image", "")).startswith(IMAGE_REF):
+                part["image"] = load(part["image"])[0]
+            elif part.get("type") == "image_url" and isinstance(part.get("image_url"), dict):
+                url = part["image_url"].get("url", "")
+                if url.startswith(IMAGE_REF):
+                    data, mime = load(url)
+                    part["image_url"]["url"] = f"data:{mime};base64,{data}"
+    return body
+
+
+# Shared recorder used by the servers in this process, or None when recording is off
+recorder = TrafficRecorder(RECORD_DIR) if RECORD_DIR else None
@@ -0,0 +1,218 @@
+# vlm/replay.py
+"""
+Replay recorded traffic and compare runs.
+
+``run`` re-issues the requests of an archive written by the recorder
+(RECORD_DIR) against any OpenAI-compatible server, the gateway or
+another backend, keeping their original spacing at ``--speed`` times the
+recorded rate (``--speed 0`` sends everything at once). Deadlines move
+with the requests, so a frame keeps the time budget it had. Every answer
+is written to a result file with its latency.
+
+``compare`` puts two runs side by side: latency distributions, errors,
+and how often the answers differ. An archive directory can stand in for
+a run, to compare a replay with what production answered.
+
+Usage:
+    python replay.py run recordings/ --url http://localhost:8000 --speed 2 --out run-a.jsonl
+    python replay.py run recordings/ --url http://localhost:8800 --speed 0 --limit 500 --out run-b.jsonl
+    python replay.py compare run-a.jsonl run-b.jsonl
+    python replay.py compare recordings/ run-b.jsonl --show 10
+"""
+
+import argparse
+import asyncio
+import difflib
+import json
+import os
+import sys
+import time
+from typing import Any, Dict, List, Optional
+
+import httpx
+import numpy as np
+
+from recorder import read_archive, restore_images
+
+PATHS = {"chat.completions": "/v1/chat/completions"}
+
+
+async def send(client: httpx.AsyncClient, url: str, entry: Dict[str, Any], body: Dict[str, Any]) -> Dict[str, Any]:
+    """Issue one request; streamed answers are collected from their events."""
+    result = {"trace_id": entry["trace_id"], "recorded_ms": entry["duration_ms"]}
+    start = time.perf_counter()
+    try:
+        if body.get("stream"):
+            texts = []
+            async with client.stream("POST", url, json=body) as response:
+                result["status"] = response.status_code
+                async for line in response.aiter_lines():
+                    if not line.startswith("data: ") or line == "data: [DONE]":
+                        continue
+                    event = json.loads(line[len("data: "):])
+                    if "error" in event:
+                        result["error"] = event["error"].get("type")
+                        continue
+                    delta = event["choices"][0].get("delta", {})
+                    if delta.get("content"):
+                        if not texts:
+                            result["ttft_ms"] = round((time.perf_counter() - start) * 1000, 1)
+                        texts.append(delta["content"])
+            result["output"] = ["".join(texts)]
+        else:
+            response = await client.post(url, json=body)
+            result["status"] = response.status_code
+            if response.status_code == 200:
+                data = response.json()
+                result["output"] = [choice["message"]["content"] for choice in data["choices"]]
+                result["usage"] = data.get("usage")
+                result["cache"] = response.headers.get("x-cache")
+            else:
+                result["error"] = response.text[:200]
+    except httpx.HTTPError as e:
+        result["status"] = None
+        result["error"] = f"{type(e).__name__}: {e}"
+    result["latency_ms"] = round((time.perf_counter() - start) * 1000, 1)
+    return result
+
+
+async def run(args) -> None:
+    entries = [e for e in read_archive(args.archive) if e["op"] in PATHS]
+    if args.skip:
+        entries = entries[args.skip:]
+    if args.limit:
+        entries = entries[:args.limit]
+    if not entries:
+        sys.exit(f"No replayable requests in {args.archive}")
+    span = entries[-1]["t"] - entries[0]["t"]
+    print(f"Replaying {len(entries)} requests recorded over {span:.0f} s at "
+          f"{'full speed' if args.speed <= 0 else f'{args.speed}x'} against {args.url}", file=sys.stderr)
+
+    images: Dict[str, str] = {}
+    semaphore = asyncio.Semaphore(args.concurrency)
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    results: List[Optional[Dict[str, Any]]] = [None] * len(entries)
+    first = entries[0]["t"]
+    done = 0
+
+    async with httpx.AsyncClient(timeout=args.timeout, limits=limits) as client:
+        started = time.time()
+
+        async def replay(i: int, entry: Dict[str, Any]) -> None:
+            nonlocal done
+            offset = (entry["t"] - first) / args.speed if args.speed > 0 else 0.0
+            await asyncio.sleep(max(0.0, started + offset - time.time()))
+            sent = time.time()
+            body = restore_images(args.archive, entry["body"], images)
+            if body.get("deadline") is not None:
+                # The deadline keeps its distance from the request's arrival
+                body["deadline"] = sent + float(body["deadline"]) - entry["t"]
+            if args.model:
+                body["model"] = args.model
+            async with semaphore:
+                result = await send(client, args.url.rstrip("/") + PATHS[entry["op"]], entry, body)
+            result["index"] = i
+            result["lag_ms"] = round((sent - started - offset) * 1000, 1)
+            results[i] = result
+            done += 1
+            if done % args.progress_every == 0:
+                print(f"  {done}/{len(entries)}", file=sys.stderr)
+
+        await asyncio.gather(*(replay(i, entry) for i, entry in enumerate(entries)))
+        elapsed = time.time() - started
+
+    with open(args.out, "w", encoding="utf-8") as f:
+        for result in results:
+            f.write(json.dumps(result) + "\n")
+    errors = sum(1 for r in results if r.get("status") != 200 or r.get("error"))
+    print(f"Done in {elapsed:.1f} s ({len(entries) / elapsed:.2f} req/s), {errors} errors, results in {args.out}",
+          file=sys.stderr)
+
+
+def load_run(path: str) -> Dict[str, Dict[str, Any]]:
+    """Results of a run file, or of an archive as production answered it, by trace id."""
+    if os.path.isdir(path):
+        return {e["trace_id"]: {"latency_ms": e["duration_ms"], "output": e.get("output"),
+                                "status": 200 if "error" not in e["attributes"] else None,
+                                "error": e["attributes"].get("error")}
+                for e in read_archive(path)}
+    with open(path, "r", encoding="utf-8") as f:
+        return {r["trace_id"]: r for r in map(json.loads, f) if r}
+
+
+def describe(latencies: List[float]) -> str:
+    if not latencies:
+        return "no successful requests"
+    values = np.asarray(latencies)
+    p50, p90, p99 = np.percentile(values, [50, 90, 99])
+    return f"mean {values.mean():8.0f}  p50 {p50:8.0f}  p90 {p90:8.0f}  p99 {p99:8.0f}  max {values.max():8.0f} ms"
+
+
+def compare(args) -> None:
+    a, b = load_run(args.a), load_run(args.b)
+    common = [trace_id for trace_id in a if trace_id in b]
+    if not common:
+        sys.exit("The runs have no requests in common")
+
+    def ok(result):
+        return result.get("status") == 200 and not result.get("error")
+
+    print(f"{len(common)} requests in both runs ({len(a)} in A, {len(b)} in B)\n")
+    for label, run_results in (("A", a), ("B", b)):
+        results = [run_results[t] for t in common]
+        errors = sum(1 for r in results if not ok(r))
+        print(f"{label}: {describe([r['latency_ms'] for r in results if ok(r)])}  errors {errors}")
+    both = [t for t in common if ok(a[t]) and ok(b[t])]
+    if both:
+        ratios = np.asarray([b[t]["latency_ms"] / max(a[t]["latency_ms"], 1e-3) for t in both])
+        print(f"\nB/A latency per request: median {np.median(ratios):.2f}x, "
+              f"p90 {np.percentile(ratios, 90):.2f}x")
+
+    compared = [t for t in both if a[t].get("output") and b[t].get("output")]
+    if not compared:
+        print("\nNo answers to compare")
+        return
+    similarity = {t: difflib.SequenceMatcher(None, a[t]["output"][0], b[t]["output"][0]).ratio() for t in compared}
+    identical = sum(1 for s in similarity.values() if s == 1.0)
+    print(f"\nanswers: {identical}/{len(compared)} identical ({identical / len(compared):.1%}), "
+          f"mean similarity {np.mean(list(similarity.values())):.3f}")
+    for t in sorted(similarity, key=similarity.get)[:args.show]:
+        if similarity[t] == 1.0:
+            break
+        print(f"\n--- {t} (similarity {similarity[t]:.2f})")
+        print(f"A: {a[t]['output'][0][:args.width]}")
+        print(f"B: {b[t]['output'][0][:args.width]}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay recorded VLM traffic and compare runs")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run", help="replay an archive against a server")
+    run_parser.add_argument("archive", help="directory written by the recorder (RECORD_DIR)")
+    run_parser.add_argument("--url", default="http://localhost:8000", help="server or gateway base URL")
+    run_parser.add_argument("--speed", type=float, default=1.0,
+                            help="multiple of the recorded rate; 0 sends everything at once")
+    run_parser.add_argument("--out", required=True, help="JSONL result file")
+    run_parser.add_argument("--skip", type=int, default=0, help="skip the first N requests")
+    run_parser.add_argument("--limit", type=int, help="replay at most N requests")
+    run_parser.add_argument("--model", help="send every request to this model instead")
+    run_parser.add_argument("--concurrency", type=int, default=64, help="requests in flight at most")
+    run_parser.add_argument("--timeout", type=float, default=600.0)
+    run_parser.add_argument("--progress-every", type=int, default=100)
+
+    compare_parser = commands.add_parser("compare", help="compare latencies and answers of two runs")
+    compare_parser.add_argument("a", help="result file of a run, or an archive directory")
+    compare_parser.add_argument("b", help="result file of a run, or an archive directory")
+    compare_parser.add_argument("--show", type=int, default=5, help="most different answers to print")
+    compare_parser.add_argument("--width", type=int, default=300, help="characters of each answer printed")
+
+    args = parser.parse_args()
+    if args.command == "run":
+        asyncio.run(run(args))
+    else:
+        compare(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,335 @@
+# vlm/result_cache.py
+"""
+Two-tier cache of finished chat completions.
+
+A replica first looks in its own in-process LRU, then in Redis, which is
+shared by every replica behind the balancer, so a frame one replica just
+analysed is not analysed again by another. Entries are keyed by model,
+prompt hash (text and generation parameters) and image hash, and stored
+as compact JSON (zlib-compressed when large) with a TTL.
+
+Redis never slows down a request by more than the lookup budget: lookups
+run on a small thread pool and count as a miss when they are late, and
+after repeated failures Redis is skipped for a while. Writes are queued
+and sent in pipelines by a background thread; when the queue is full the
+write is dropped. A Lua script stores each entry and trims the oldest
+ones beyond the entry cap, so the cache stays bounded whatever the Redis
+eviction policy is.
+
+Configuration (environment variables):
+    RESULT_CACHE_ENTRIES              entries in the local LRU, 0 disables the cache (default: 1024)
+    RESULT_CACHE_TTL                  seconds an entry stays valid (default: 3600)
+    RESULT_CACHE_REDIS_URL            e.g. redis://localhost:6379/0 (default: none, local only)
+    RESULT_CACHE_REDIS_BUDGET_MS      longest a Redis lookup may take (default: 10)
+    RESULT_CACHE_REDIS_MAX_ENTRIES    entries kept in Redis (default: 100000)
+    RESULT_CACHE_MAX_VALUE_BYTES      larger serialized results are not sent to Redis (default: 65536)
+"""
+
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import queue
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple
+
+from coalescing import image_digest
+from metrics import metrics
+
+logger = logging.getLogger("result-cache")
+
+CACHE_ENTRIES = int(os.environ.get("RESULT_CACHE_ENTRIES", "1024"))
+CACHE_TTL = float(os.environ.get("RESULT_CACHE_TTL", "3600"))
+REDIS_URL = os.environ.get("RESULT_CACHE_REDIS_URL", "")
+REDIS_BUDGET_MS = float(os.environ.get("RESULT_CACHE_REDIS_BUDGET_MS", "10"))
+REDIS_MAX_ENTRIES = int(os.environ.get("RESULT_CACHE_REDIS_MAX_ENTRIES", "100000"))
+MAX_VALUE_BYTES = int(os.environ.get("RESULT_CACHE_MAX_VALUE_BYTES", "65536"))
+
+KEY_PREFIX = "vlm:result:"
+INDEX_KEY = "vlm:result-index"
+
+# Consecutive Redis failures before it is skipped, and for how long
+_FAILURES_BEFORE_BACKOFF = 3
+_BACKOFF_SECONDS = 5.0
+_WRITE_QUEUE = 1024
+_WRITE_BATCH = 64
+_COMPRESS_ABOVE = 256
+
+# Store one entry and drop expired and excess entries, oldest first
+_STORE_SCRIPT = """
+redis.call('SET', KEYS[1], ARGV[1], 'PX', ARGV[2])
+redis.call('ZADD', KEYS[2], ARGV[3], KEYS[1])
+redis.call('ZREMRANGEBYSCORE', KEYS[2], '-inf', tonumber(ARGV[3]) - tonumber(ARGV[2]))
+local excess = redis.call('ZCARD', KEYS[2]) - tonumber(ARGV[4])
+if excess > 0 then
+    local oldest = redis.call('ZRANGE', KEYS[2], 0, excess - 1)
+    redis.call('ZREMRANGEBYRANK', KEYS[2], 0, excess - 1)
+    redis.call('DEL', unpack(oldest))
+end
+return excess
+"""
+
+
+def _digest(value: Any) -> str:
+    canonical = json.dumps(value, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()[:32]
+
+
+def result_key(messages: List[Dict[str, Any]], model: str, **params) -> Optional[str]:
+    """
+    Cache key of a chat request.
+
+    Args:
+        messages: OpenAI-style messages.
+        model: Model name; results of different models never mix.
+        **params: Generation parameters that change the output.
+
+    Returns:
+        ``vlm:result:<model>:<prompt hash>:<image hash>``, or ``None`` when
+        an image is referenced by URL or path and its content is unknown.
+    """
+    prompt = []
+    images = []
+    for message in messages:
+        content = message.get("content")
+        if isinstance(content, list):
+            parts = []
+            for part in content:
+                part_type = part.get("type")
+                if part_type == "image":
+                    if part.get("image"):
+                        images.append(image_digest(part["image"]))
+                    parts.append({"type": "image"})
+                elif part_type == "image_url":
+                    image_url = part.get("image_url", {})
+                    url = image_url.get("url", "") if isinstance(image_url, dict) else str(image_url)
+                    if not url.startswith("data:"):
+                        return None
+                    images.append(image_digest(url))
+                    parts.append({"type": "image"})
+                else:
+                    parts.append(part)
+            content = parts
+        prompt.append({"role": message.get("role"), "content": content})
+    return f"{KEY_PREFIX}{model}:{_digest({'messages': prompt, 'params': params})}:{_digest(images)}"
+
+
+def encode_result(result: Dict[str, Any]) -> bytes:
+    """Serialize a completion as compact JSON, compressed when it is long."""
+    payload = json.dumps(
+        [result["output_texts"], result["prompt_tokens"], result["completion_tokens"]],
+        separators=(",", ":"), ensure_ascii=False,
+    ).encode("utf-8")
+    if len(payload) > _COMPRESS_ABOVE:
+        return b"z" + zlib.compress(payload)
+    return b"j" + payload
+
+
+def decode_result(raw: bytes) -> Dict[str, Any]:
+    payload = zlib.decompress(raw[1:]) if raw[:1] == b"z" else raw[1:]
+    output_texts, prompt_tokens, completion_tokens = json.loads(payload)
+    return {"output_texts": output_texts, "prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens}
+
+
+class LocalLRU:
+    """In-process LRU with per-entry expiry. Only used from the event loop thread."""
+
+    def __init__(self, max_entries: int = CACHE_ENTRIES, ttl: float = CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries: "OrderedDict[str, Tuple[float, Dict[str, Any]]]" = OrderedDict()
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires, result = entry
+        if expires < time.time():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return result
+
+    def put(self, key: str, result: Dict[str, Any]) -> None:
+        self._entries[key] = (time.time() + self.ttl, result)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class RedisTier:
+    """
+    Shared tier in Redis with budgeted lookups and pipelined background writes.
+
+    Args:
+        url: Redis URL.
+        ttl: Seconds an entry stays valid.
+        budget_ms: Longest a lookup may take before it counts as a miss.
+        max_entries: Entries kept in Redis.
+        max_value_bytes: Larger serialized results are not stored.
+    """
+
+    def __init__(self, url: str = REDIS_URL, ttl: float = CACHE_TTL, budget_ms: float = REDIS_BUDGET_MS,
+                 max_entries: int = REDIS_MAX_ENTRIES, max_value_bytes: int = MAX_VALUE_BYTES):
+        import redis
+
+        self.ttl_ms = int(ttl * 1000)
+        self.budget = budget_ms / 1000
+        self.max_entries = max_entries
+        self.max_value_bytes = max_value_bytes
+        # Socket timeouts only bound the background threads; the hot path waits for the budget at most
+        self.client = redis.Redis.from_url(url, socket_timeout=1.0, socket_connect_timeout=1.0)
+        self._store = self.client.register_script(_STORE_SCRIPT)
+        self._lookups = ThreadPoolExecutor(max_workers=4, thread_name_prefix="result-cache-get")
+        self._writes: queue.Queue = queue.Queue(maxsize=_WRITE_QUEUE)
+        self._failures = 0
+        self._skip_until = 0.0
+        self._writer = threading.Thread(target=self._write_loop, name="result-cache-put", daemon=True)
+        self._writer.start()
+
+    @property
+    def available(self) -> bool:
+        return time.time() >= self._skip_until
+
+    def _failed(self, error: Exception) -> None:
+        self._failures += 1
+        if self._failures >= _FAILURES_BEFORE_BACKOFF:
+            self._skip_until = time.time() + _BACKOFF_SECONDS
+            self._failures = 0
+            logger.warning(f"Redis result cache skipped for {_BACKOFF_SECONDS:.0f}s after repeated failures: {error!r}")
+
+    async def get(self, key: str) -> Optional[Dict[str, Any]]:
+        """Look an entry up, giving up after the budget."""
+        if not self.available:
+            return None
+        future = asyncio.wrap_future(self._lookups.submit(self.client.get, key))
+        try:
+            raw = await asyncio.wait_for(future, self.budget)
+        except asyncio.TimeoutError as e:
+            metrics.inc("result_cache_redis_timeouts_total")
+            self._failed(e)
+            return None
+        except Exception as e:
+            metrics.inc("result_cache_redis_errors_total")
+            self._failed(e)
+            return None
+        self._failures = 0
+        if raw is None:
+            return None
+        try:
+            return decode_result(raw)
+        except Exception as e:
+            logger.warning(f"Discarding unreadable cache entry {key}: {e}")
+            return None
+
+    def put(self, key: str, value: bytes) -> None:
+        """Queue an entry for the writer thread; never blocks."""
+        if len(value) > self.max_value_bytes or not self.available:
+            return
+        try:
+            self._writes.put_nowait((key, value))
+        except queue.Full:
+            metrics.inc("result_cache_writes_dropped_total")
+
+    def _write_loop(self) -> None:
+        while True:
+            item = self._writes.get()
+            if item is None:
+                return
+            batch = [item]
+            while len(batch) < _WRITE_BATCH:
+                try:
+                    item = self._writes.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    self._flush(batch)
+                    return
+                batch.append(item)
+            self._flush(batch)
+
+    def _flush(self, batch: List[Tuple[str, bytes]]) -> None:
+        try:
+            pipe = self.client.pipeline(transaction=False)
+            now_ms = int(time.time() * 1000)
+            for key, value in batch:
+                self._store(keys=[key, INDEX_KEY], args=[value, self.ttl_ms, now_ms, self.max_entries], client=pipe)
+            pipe.execute()
+            metrics.inc("result_cache_redis_writes_total", len(batch))
+        except Exception as e:
+            metrics.inc("result_cache_writes_dropped_total", len(batch))
+            metrics.inc("result_cache_redis_errors_total")
+            self._failed(e)
+
+    def close(self, timeout: float = 2.0) -> None:
+        """Send the queued writes and stop the threads."""
+        try:
+            self._writes.put(None, timeout=timeout)
+        except queue.Full:
+            pass
+        self._writer.join(timeout)
+        self._lookups.shutdown(wait=False, cancel_futures=True)
+
+
+class ResultCache:
+    """
+    Local LRU in front of an optional Redis tier.
+
+    Args:
+        max_entries: Entries in the local LRU; 0 disables the cache.
+        redis_url: Redis URL of the shared tier; empty for local only.
+    """
+
+    def __init__(self, max_entries: int = CACHE_ENTRIES, redis_url: str = REDIS_URL):
+        self.enabled = max_entries > 0
+        self.local = LocalLRU(max_entries)
+        self.redis: Optional[RedisTier] = None
+        if self.enabled and redis_url:
+            try:
+                self.redis = RedisTier(redis_url)
+                logger.info(f"Shared result cache at {redis_url}")
+            except ImportError:
+                logger.warning("RESULT_CACHE_REDIS_URL is set but the redis package is missing (pip install redis); using the local cache only")
+
+    async def get(self, key: str) -> Tuple[Optional[Dict[str, Any]], Optional[str]]:
+        """
+        Look a result up in both tiers.
+
+        Returns:
+            The cached result and the tier that had it (``local`` or
+            ``redis``), or ``(None, None)``.
+        """
+        if not self.enabled:
+            return None, None
+        result = self.local.get(key)
+        if result is not None:
+            metrics.inc("result_cache_hits_total", tier="local")
+            return result, "local"
+        if self.redis is not None:
+            result = await self.redis.get(key)
+            if result is not None:
+                self.local.put(key, result)
+                metrics.inc("result_cache_hits_total", tier="redis")
+                return result, "redis"
+        metrics.inc("result_cache_misses_total")
+        return None, None
+
+    def put(self, key: str, result: Dict[str, Any]) -> None:
+        if not self.enabled:
+            return
+        self.local.put(key, result)
+        metrics.set("result_cache_local_entries", len(self.local))
+        if self.redis is not None:
+            self.redis.put(key, encode_result(result))
+
+    def close(self) -> None:
+        if self.redis is not None:
+            self.redis.close()
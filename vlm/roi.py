@@ -0,0 +1,332 @@
+# vlm/roi.py
+"""
+Per-camera regions of interest and high-resolution tiling.
+
+Most of a CCTV frame is sky, walls or parking lot. For a camera with
+regions of interest, every region (a rectangle or a polygon, in
+coordinates relative to the frame, 0-1) is cut out of the frame before
+encoding; pixels of a polygon's bounding box that are outside the
+polygon are filled with gray. Each region becomes its own image, so only
+the relevant areas turn into visual tokens, and they keep more detail
+than the whole frame downscaled would.
+
+Tiling is meant for 4K cameras. The frame is sent as a small overview,
+followed by full-detail tiles, i.e. tiles small enough that the server
+does not downscale them. A tile is included only if it changed since the
+camera's previous frame or lies inside a region of interest, at most
+``ROI_MAX_TILES`` of them.
+
+Regions are scaled like the whole frame would have been, so cropping
+saves the tokens of everything outside them. Visual tokens are counted
+the way Qwen2.5-VL counts them, one per 28x28 pixels after the server's
+resize. Every transformed frame reports the count before and after;
+"before" is the whole frame as the server would have sent it, or at full
+resolution in tiling mode, which is what the tiles stand in for.
+
+Configuration (environment variables):
+    ROI_CONFIG          JSON file with the regions of every camera (default: roi.json)
+    ROI_TILE_SIZE       edge of a full-detail tile in pixels (default: 784)
+    ROI_MAX_TILES       full-detail tiles per frame (default: 6)
+    ROI_TILE_CHANGE     mean thumbnail difference (0-1) that marks a tile as changed (default: 0.04)
+    ROI_OVERVIEW_WIDTH  width of the overview sent with tiles (default: 448)
+
+The file maps stream ids to settings::
+
+    {"cam1": {"regions": [{"rect": [0.0, 0.4, 0.6, 1.0]},
+                          {"polygon": [[0.5, 0.5], [0.9, 0.5], [0.9, 0.95]]}],
+              "tiling": false}}
+"""
+
+import base64
+import io
+import json
+import logging
+import math
+import os
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+from metrics import metrics
+
+logger = logging.getLogger("roi")
+
+ROI_CONFIG = os.environ.get("ROI_CONFIG", "roi.json")
+TILE_SIZE = int(os.environ.get("ROI_TILE_SIZE", "784"))
+MAX_TILES = int(os.environ.get("ROI_MAX_TILES", "6"))
+TILE_CHANGE = float(os.environ.get("ROI_TILE_CHANGE", "0.04"))
+OVERVIEW_WIDTH = int(os.environ.get("ROI_OVERVIEW_WIDTH", "448"))
+
+# Qwen2.5-VL: 14 px patches merged 2x2, so one visual token per 28x28 pixels
+TOKEN_PATCH = 28
+MIN_PIXELS = 4 * TOKEN_PATCH * TOKEN_PATCH
+MAX_PIXELS = 16384 * TOKEN_PATCH * TOKEN_PATCH
+# Tile thumbnails compared between frames
+TILE_THUMBNAIL = (16, 16)
+MASK_FILL = (128, 128, 128)
+JPEG_QUALITY = 90
+
+
+def visual_tokens(width: int, height: int, max_width: Optional[int] = None) -> int:
+    """Visual tokens of an image after the server's resize to ``max_width``."""
+    if max_width and width > max_width:
+        height = int(height / width * max_width)
+        width = max_width
+    # Same rounding as qwen_vl_utils.smart_resize
+    h = max(TOKEN_PATCH, round(height / TOKEN_PATCH) * TOKEN_PATCH)
+    w = max(TOKEN_PATCH, round(width / TOKEN_PATCH) * TOKEN_PATCH)
+    if h * w > MAX_PIXELS:
+        beta = math.sqrt(height * width / MAX_PIXELS)
+        h = math.floor(height / beta / TOKEN_PATCH) * TOKEN_PATCH
+        w = math.floor(width / beta / TOKEN_PATCH) * TOKEN_PATCH
+    elif h * w < MIN_PIXELS:
+        beta = math.sqrt(MIN_PIXELS / (height * width))
+        h = math.ceil(height * beta / TOKEN_PATCH) * TOKEN_PATCH
+        w = math.ceil(width * beta / TOKEN_PATCH) * TOKEN_PATCH
+    return (h // TOKEN_PATCH) * (w // TOKEN_PATCH)
+
+
+def validate(settings: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Check the ROI settings of one camera.
+
+    Raises:
+        ValueError: The settings are malformed.
+    """
+    regions = settings.get("regions", [])
+    if not isinstance(regions, list):
+        raise ValueError("regions must be a list")
+    clean = []
+    for region in regions:
+        if "rect" in region:
+            x0, y0, x1, y1 = (float(v) for v in region["rect"])
+            if not (0 <= x0 < x1 <= 1 and 0 <= y0 < y1 <= 1):
+                raise ValueError(f"rect {region['rect']} must be [x0, y0, x1, y1] with 0 <= x0 < x1 <= 1 and 0 <= y0 < y1 <= 1")
+            clean.append({"rect": [x0, y0, x1, y1]})
+        elif "polygon" in region:
+            points = [(float(x), float(y)) for x, y in region["polygon"]]
+            if len(points) < 3 or not all(0 <= v <= 1 for point in points for v in point):
+                raise ValueError("polygon needs at least three [x, y] points between 0 and 1")
+            clean.append({"polygon": [list(point) for point in points]})
+        else:
+            raise ValueError("every region needs a rect or a polygon")
+    tiling = bool(settings.get("tiling", False))
+    if not clean and not tiling:
+        raise ValueError("give at least one region or enable tiling")
+    return {"regions": clean, "tiling": tiling}
+
+
+def _bounds(region: Dict[str, Any], width: int, height: int) -> Tuple[int, int, int, int]:
+    if "rect" in region:
+        x0, y0, x1, y1 = region["rect"]
+    else:
+        xs = [x for x, _ in region["polygon"]]
+        ys = [y for _, y in region["polygon"]]
+        x0, y0, x1, y1 = min(xs), min(ys), max(xs), max(ys)
+    return (int(x0 * width), int(y0 * height), max(int(x0 * width) + 1, math.ceil(x1 * width)),
+            max(int(y0 * height) + 1, math.ceil(y1 * height)))
+
+
+def _crop(img: Image.Image, region: Dict[str, Any]) -> Image.Image:
+    box = _bounds(region, *img.size)
+    crop = img.crop(box)
+    if "polygon" in region:
+        mask = Image.new("L", crop.size, 0)
+        points = [(x * img.width - box[0], y * img.height - box[1]) for x, y in region["polygon"]]
+        ImageDraw.Draw(mask).polygon(points, fill=255)
+        crop = Image.composite(crop, Image.new("RGB", crop.size, MASK_FILL), mask)
+    return crop
+
+
+def _region_mask(regions: List[Dict[str, Any]], size: Tuple[int, int]) -> Image.Image:
+    """Regions rasterised into a mask of ``size``."""
+    width, height = size
+    mask = Image.new("L", size, 0)
+    draw = ImageDraw.Draw(mask)
+    for region in regions:
+        if "rect" in region:
+            x0, y0, x1, y1 = region["rect"]
+            draw.rectangle([x0 * width, y0 * height, x1 * width, y1 * height], fill=255)
+        else:
+            draw.polygon([(x * width, y * height) for x, y in region["polygon"]], fill=255)
+    return mask
+
+
+def _encode(img: Image.Image) -> str:
+    buffer = io.BytesIO()
+    img.save(buffer, format="JPEG", quality=JPEG_QUALITY)
+    return "data:image/jpeg;base64," + base64.b64encode(buffer.getvalue()).decode("ascii")
+
+
+def _image_part(url: str) -> Dict[str, Any]:
+    return {"type": "image_url", "image_url": {"url": url}}
+
+
+class RoiStore:
+    """
+    ROI settings of every camera, persisted to a JSON file, and the tile
+    thumbnails of each camera's previous frame.
+
+    Args:
+        path: JSON file with the settings; created on the first change.
+    """
+
+    def __init__(self, path: str = ROI_CONFIG):
+        self.path = path
+        self._settings: Dict[str, Dict[str, Any]] = {}
+        self._previous_tiles: Dict[str, np.ndarray] = {}
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                for stream, settings in json.load(f).items():
+                    try:
+                        self._settings[stream] = validate(settings)
+                    except (ValueError, TypeError, KeyError) as e:
+                        logger.error(f"Ignoring ROI settings of {stream} in {path}: {e}")
+            logger.info(f"Loaded regions of interest for {len(self._settings)} cameras from {path}")
+
+    def get(self, stream: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            return self._settings.get(stream)
+
+    def set(self, stream: str, settings: Optional[Dict[str, Any]]) -> None:
+        """Replace (or with ``None`` remove) the settings of a camera and save the file."""
+        with self._lock:
+            if settings is None:
+                self._settings.pop(stream, None)
+            else:
+                self._settings[stream] = validate(settings)
+            self._previous_tiles.pop(stream, None)
+            snapshot = dict(self._settings)
+        temp_path = f"{self.path}.tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump(snapshot, f, indent=2)
+        os.replace(temp_path, self.path)
+
+    def apply(self, stream: str, messages: List[Dict[str, Any]],
+              max_width: int) -> Tuple[List[Dict[str, Any]], Optional[Dict[str, int]]]:
+        """
+        Replace the inline frame images of a request by their regions or tiles.
+
+        Args:
+            stream: Camera the frame comes from.
+            messages: OpenAI-style messages.
+            max_width: Width the server downscales images to.
+
+        Returns:
+            The new messages and ``{"before", "after"}`` visual tokens, or the
+            unchanged messages and ``None`` when the camera has no settings.
+        """
+        settings = self.get(stream)
+        if settings is None:
+            return messages, None
+        before = after = 0
+        converted = []
+        for message in messages:
+            content = message.get("content")
+            if not isinstance(content, list):
+                converted.append(message)
+                continue
+            parts = []
+            for part in content:
+                img = self._decode(part)
+                if img is None:
+                    parts.append(part)
+                    continue
+                if settings["tiling"] and img.width > 2 * min(TILE_SIZE, max_width):
+                    # Tiles replace the frame at full detail, so that is what they are compared with
+                    before += visual_tokens(img.width, img.height)
+                    new_parts, sizes = self._tiles(stream, img, settings["regions"], max_width)
+                else:
+                    before += visual_tokens(img.width, img.height, max_width)
+                    new_parts, sizes = self._regions(img, settings["regions"], max_width)
+                after += sum(visual_tokens(w, h, max_width) for w, h in sizes)
+                parts.extend(new_parts)
+            converted.append({**message, "content": parts})
+
+        if before:
+            metrics.observe("visual_tokens_before", before)
+            metrics.observe("visual_tokens_after", after)
+        return converted, {"before": before, "after": after}
+
+    @staticmethod
+    def _decode(part: Dict[str, Any]) -> Optional[Image.Image]:
+        data = None
+        if part.get("type") == "image":
+            data = part.get("image")
+        elif part.get("type") == "image_url":
+            image_url = part.get("image_url", {})
+            url = image_url.get("url", "") if isinstance(image_url, dict) else ""
+            if url.startswith("data:"):
+                data = url.split(",", 1)[1]
+        if not data:
+            return None
+        try:
+            return Image.open(io.BytesIO(base64.b64decode(data))).convert("RGB")
+        except Exception as e:
+            logger.warning(f"Sending undecodable image unchanged: {e}")
+            return None
+
+    def _regions(self, img: Image.Image, regions: List[Dict[str, Any]], max_width: int):
+        if not regions:
+            return [_image_part(_encode(img))], [img.size]
+        # Regions keep the scale the whole frame would have been sent at
+        scale = min(1.0, max_width / img.width)
+        crops = []
+        for region in regions:
+            crop = _crop(img, region)
+            if scale < 1.0:
+                crop = crop.resize((max(1, round(crop.width * scale)), max(1, round(crop.height * scale))), Image.BILINEAR)
+            crops.append(crop)
+        return [_image_part(_encode(crop)) for crop in crops], [crop.size for crop in crops]
+
+    def _tiles(self, stream: str, img: Image.Image, regions: List[Dict[str, Any]], max_width: int):
+        tile = min(TILE_SIZE, max_width)
+        columns = math.ceil(img.width / tile)
+        rows = math.ceil(img.height / tile)
+
+        # One small grayscale thumbnail per tile, to find the tiles that changed
+        gray = img.convert("L").resize((columns * TILE_THUMBNAIL[0], rows * TILE_THUMBNAIL[1]), Image.BILINEAR)
+        thumbnails = np.asarray(gray, dtype=np.float32).reshape(
+            rows, TILE_THUMBNAIL[1], columns, TILE_THUMBNAIL[0]).transpose(0, 2, 1, 3) / 255.0
+        with self._lock:
+            previous = self._previous_tiles.get(stream)
+            self._previous_tiles[stream] = thumbnails
+        if previous is not None and previous.shape == thumbnails.shape:
+            change = np.abs(thumbnails - previous).mean(axis=(2, 3))
+        else:
+            # Nothing to compare with yet: only the regions of interest count
+            change = np.zeros((rows, columns), dtype=np.float32)
+
+        inside = np.zeros((rows, columns), dtype=bool)
+        if regions:
+            mask = np.asarray(_region_mask(regions, (columns * 8, rows * 8)), dtype=bool)
+            inside = mask.reshape(rows, 8, columns, 8).any(axis=(1, 3))
+
+        # Regions of interest first, then the tiles that changed most
+        candidates = [(bool(inside[r, c]), float(change[r, c]), r, c)
+                      for r in range(rows) for c in range(columns)
+                      if inside[r, c] or change[r, c] >= TILE_CHANGE]
+        candidates.sort(reverse=True)
+        chosen = sorted((r, c) for _, _, r, c in candidates[:MAX_TILES])
+
+        overview_width = min(OVERVIEW_WIDTH, max_width)
+        overview = img.resize((overview_width, max(1, int(img.height / img.width * overview_width))), Image.BILINEAR)
+        parts = [_image_part(_encode(overview))]
+        sizes = [overview.size]
+        if chosen:
+            labels = []
+            for r, c in chosen:
+                box = (c * tile, r * tile, min(img.width, (c + 1) * tile), min(img.height, (r + 1) * tile))
+                crop = img.crop(box)
+                parts.append(_image_part(_encode(crop)))
+                sizes.append(crop.size)
+                labels.append(f"({box[0] / img.width:.2f}, {box[1] / img.height:.2f})")
+            parts.insert(1, {"type": "text", "text": (
+                "The first image is the whole frame. The next images are full-resolution "
+                f"details at these relative top-left positions: {', '.join(labels)}."
+            )})
+        metrics.inc("roi_tiles_sent_total", len(chosen))
+        return parts, sizes
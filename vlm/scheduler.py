@@ -0,0 +1,539 @@
+# vlm/scheduler.py
+"""
+Deadline-aware priority scheduler for the inference thread.
+
+Every request carries a priority class and an optional deadline:
+
+    alert   - re-checks of frames that raised an alert, served first
+    live    - regular live camera analysis (default)
+    report  - background work such as reports and backfills
+
+Within a class, requests are served least-slack first: the slack of a
+request is its deadline minus the time its generation is expected to take,
+so among equally urgent frames the short JSON answers go before long
+descriptions. Requests without a deadline come after those with one and
+are served shortest-expected-job first.
+
+A request whose deadline has passed by the time it reaches the head of the
+queue is dropped with ``DeadlineExceeded`` before any inference work.
+
+Requests are also queued per camera stream, and streams share the GPU by
+start-time fair queuing: each stream has a virtual start tag that advances
+by the cost of every job it is served (expected tokens plus a fixed prefill
+charge) divided by its weight, and the backlogged stream with the smallest
+tag is served next. A flooding camera therefore only delays itself. With
+each stream's backlog capped at ``max_queue_per_stream`` (the oldest,
+least urgent job is superseded beyond that; jobs submitted with
+``supersede=False``, such as embedding backfills, are never superseded
+and do not count against the cap), a request waits for at most
+about ``max_queue_per_stream * sum(weights) / weight`` jobs, whatever the
+other cameras send.
+
+Jobs submitted with a ``batch_key`` may run together: after the next job
+is chosen, the heads of other streams' queues with the same key and
+priority class join it for as long as the admission controller finds
+room in the memory budget and the adaptive batch size allows.
+
+Continuous jobs (``continuous=True``, see continuous_batching.py) are
+batched per decode step instead: the first one starts an engine that
+keeps running on the inference thread and pulls further jobs with the
+same key through a ``ContinuousBatch`` while it has room, each finishing
+on its own. A job joins only when it is the one the scheduler would run
+next, so priorities, fair share and deadlines decide the order as
+before, and when the next job cannot join, the engine stops taking new
+ones until its batch has drained and that job runs.
+
+Configuration (environment variables):
+    STREAM_WEIGHTS        comma separated stream=weight pairs (default weight 1)
+    STREAM_MAX_QUEUE      backlog cap per stream (default: 8)
+"""
+
+import concurrent.futures
+import hashlib
+import heapq
+import itertools
+import logging
+import os
+import threading
+import time
+from collections import deque
+from typing import Any, Callable, Dict, Hashable, List, Optional
+
+from admission import AdmissionController, is_out_of_memory
+from metrics import metrics
+from profiler import profiler
+
+logger = logging.getLogger("scheduler")
+
+PRIORITY_CLASSES = {"alert": 0, "live": 1, "report": 2}
+DEFAULT_PRIORITY = "live"
+DEFAULT_STREAM = "unassigned"
+
+# Flat charge per job on top of its expected tokens, for prefill and image encoding
+PREFILL_COST_TOKENS = 64
+
+STREAM_MAX_QUEUE = int(os.environ.get("STREAM_MAX_QUEUE", "8"))
+
+
+def parse_weights(spec: str) -> Dict[str, float]:
+    """Parse ``cam1=2,cam2=0.5`` into a weight mapping."""
+    weights = {}
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        name, _, value = item.partition("=")
+        weights[name.strip()] = float(value)
+    return weights
+
+
+class DeadlineExceeded(Exception):
+    """Raised for requests that expired while waiting in the queue."""
+
+
+class Superseded(DeadlineExceeded):
+    """Raised for requests shed because their stream's backlog is full."""
+
+
+class ContinuousBatch:
+    """
+    What a continuous engine gets from the scheduler: the job that started
+    it, further jobs that may join it, and a way to finish each one.
+    """
+
+    def __init__(self, scheduler: "InferenceScheduler", first: "Job"):
+        self.scheduler = scheduler
+        self.first = first
+        self.completed = 0
+        # Outstanding job -> time it started running
+        self._outstanding = {first: time.time()}
+
+    def join(self) -> Optional["Job"]:
+        """The next job if it may join the running batch now; None otherwise. Never waits."""
+        job = self.scheduler._join(self.first)
+        if job is not None:
+            self._outstanding[job] = time.time()
+        return job
+
+    def complete(self, job: "Job", result: Any) -> None:
+        """Finish one job with its result, or with the exception instance it failed with."""
+        started = self._outstanding.pop(job, None)
+        self.completed += 1
+        self.scheduler._complete(job, result)
+        if started is not None and not isinstance(result, BaseException):
+            self.scheduler._learn([result], time.time() - started)
+
+    def fail(self, error: BaseException) -> None:
+        """Finish every job that has not finished with ``error``."""
+        for job in list(self._outstanding):
+            self.complete(job, error)
+
+
+class LengthEstimator:
+    """
+    Expected completion length per prompt.
+
+    Keeps an exponentially weighted average of the completion tokens that
+    each prompt actually produced, capped by the request's ``max_tokens``.
+    Unknown prompts are assumed to use all of ``max_tokens``.
+    """
+
+    def __init__(self, alpha: float = 0.2, max_prompts: int = 1024):
+        self.alpha = alpha
+        self.max_prompts = max_prompts
+        self._averages: Dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def prompt_key(prompt: str) -> str:
+        return hashlib.sha1(prompt.encode("utf-8")).hexdigest()
+
+    def expected(self, prompt: str, max_tokens: int) -> int:
+        with self._lock:
+            average = self._averages.get(self.prompt_key(prompt))
+        if average is None:
+            return max_tokens
+        return int(min(average, max_tokens))
+
+    def update(self, prompt: str, completion_tokens: int) -> None:
+        key = self.prompt_key(prompt)
+        with self._lock:
+            average = self._averages.get(key)
+            if average is None:
+                if len(self._averages) >= self.max_prompts:
+                    self._averages.pop(next(iter(self._averages)))
+                self._averages[key] = float(completion_tokens)
+            else:
+                self._averages[key] = average + self.alpha * (completion_tokens - average)
+
+
+class Job:
+    """A unit of work waiting for the inference thread."""
+
+    __slots__ = ("fn", "args", "priority", "deadline", "expected_tokens", "stream",
+                 "batch_key", "memory", "continuous", "supersede", "future", "enqueued_at", "seq", "removed")
+
+    def __init__(self, fn: Callable, args: tuple, priority: str, deadline: Optional[float],
+                 expected_tokens: int, stream: str, seq: int,
+                 batch_key: Optional[Hashable] = None, memory: int = 0, continuous: bool = False,
+                 supersede: bool = True):
+        self.fn = fn
+        self.args = args
+        self.priority = priority
+        self.deadline = deadline
+        self.expected_tokens = expected_tokens
+        self.stream = stream
+        self.batch_key = batch_key
+        self.memory = memory
+        self.continuous = continuous
+        self.supersede = supersede
+        self.future: concurrent.futures.Future = concurrent.futures.Future()
+        self.enqueued_at = time.time()
+        self.seq = seq
+        self.removed = False
+
+    @property
+    def cost(self) -> int:
+        return self.expected_tokens + PREFILL_COST_TOKENS
+
+    def expired(self, now: float) -> bool:
+        return self.deadline is not None and now > self.deadline
+
+
+class StreamQueue:
+    """Pending jobs of one camera stream and its fair-share state."""
+
+    def __init__(self, name: str, weight: float):
+        self.name = name
+        self.weight = weight
+        self.jobs = []  # heap of (sort key, counter, job)
+        self.pending = 0
+        # Pending jobs that may be superseded, the ones the backlog cap counts
+        self.capped = 0
+        self.start_tag = 0.0
+        self.served = deque()  # completion times within the rate window
+
+    def head(self) -> Optional[Job]:
+        while self.jobs and self.jobs[0][2].removed:
+            heapq.heappop(self.jobs)
+        return self.jobs[0][2] if self.jobs else None
+
+
+class InferenceScheduler:
+    """
+    Single worker thread that runs submitted jobs in scheduling order.
+
+    Args:
+        seconds_per_token: Initial estimate of decode time per token, used
+            to turn expected output length into expected duration. It is
+            refined from measured generations.
+        weights: Fair-share weight per stream, default ``STREAM_WEIGHTS``.
+        max_queue_per_stream: Backlog cap per stream.
+        admission: Memory admission controller; without one every job runs alone.
+    """
+
+    RATE_WINDOW = 60.0
+
+    def __init__(self, name: str = "inference", seconds_per_token: float = 0.03,
+                 weights: Optional[Dict[str, float]] = None,
+                 max_queue_per_stream: int = STREAM_MAX_QUEUE,
+                 admission: Optional[AdmissionController] = None):
+        self.name = name
+        self.seconds_per_token = seconds_per_token
+        # Inference time per job, batching included; None until a job has run
+        self.seconds_per_job: Optional[float] = None
+        self.lengths = LengthEstimator()
+        self.weights = weights if weights is not None else parse_weights(os.environ.get("STREAM_WEIGHTS", ""))
+        self.max_queue_per_stream = max_queue_per_stream
+        self.admission = admission
+        self._streams: Dict[str, StreamQueue] = {}
+        self._virtual_time = 0.0
+        self._counter = itertools.count()
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    def _sort_key(self, job: Job):
+        rank = PRIORITY_CLASSES.get(job.priority, PRIORITY_CLASSES[DEFAULT_PRIORITY])
+        if job.deadline is not None:
+            slack = job.deadline - job.expected_tokens * self.seconds_per_token
+        else:
+            slack = float("inf")
+        return (rank, slack, job.expected_tokens, job.seq)
+
+    def _stream(self, name: str) -> StreamQueue:
+        queue = self._streams.get(name)
+        if queue is None:
+            queue = self._streams[name] = StreamQueue(name, self.weights.get(name, 1.0))
+        return queue
+
+    def set_weight(self, stream: str, weight: float) -> None:
+        """Change the fair-share weight of a stream."""
+        if weight <= 0:
+            raise ValueError("Stream weight must be positive")
+        with self._cond:
+            self.weights[stream] = weight
+            self._stream(stream).weight = weight
+
+    def _push(self, queue: StreamQueue, job: Job) -> None:
+        if queue.pending == 0:
+            # A stream that was idle does not get credit for the time it sent nothing
+            queue.start_tag = max(queue.start_tag, self._virtual_time)
+        heapq.heappush(queue.jobs, (self._sort_key(job), next(self._counter), job))
+        queue.pending += 1
+        queue.capped += job.supersede
+
+    def _shed(self, queue: StreamQueue) -> None:
+        """Supersede the oldest of the least urgent jobs of an over-full stream."""
+        live = [job for _, _, job in queue.jobs if not job.removed and job.supersede]
+        victim = max(live, key=lambda job: (PRIORITY_CLASSES[job.priority], -job.enqueued_at))
+        victim.removed = True
+        queue.pending -= 1
+        queue.capped -= 1
+        metrics.inc("scheduler_superseded_total", stream=queue.name)
+        if victim.future.set_running_or_notify_cancel():
+            victim.future.set_exception(Superseded(
+                f"Superseded by newer requests of stream '{queue.name}' after "
+                f"{time.time() - victim.enqueued_at:.2f}s in queue"
+            ))
+
+    def submit(self, fn: Callable, *args, priority: str = DEFAULT_PRIORITY,
+               deadline: Optional[float] = None, expected_tokens: int = 256,
+               stream: Optional[str] = None, batch_key: Optional[Hashable] = None,
+               memory: int = 0, continuous: bool = False, supersede: bool = True) -> Job:
+        """
+        Queue ``fn(*args)`` for the inference thread.
+
+        Args:
+            fn: Callable to run on the inference thread. With a ``batch_key``
+                it is called as ``fn([args, ...])`` for the whole batch and
+                returns one result (or exception instance) per job.
+            priority: One of ``PRIORITY_CLASSES``.
+            deadline: Unix time after which the result is useless.
+            expected_tokens: Expected number of generated tokens.
+            stream: Camera stream the request belongs to.
+            batch_key: Jobs with equal keys may run in one batch.
+            memory: Estimated bytes the job needs while running.
+            continuous: ``fn`` is a continuous engine; it is called as
+                ``fn(batch)`` with a ``ContinuousBatch`` and finishes the
+                jobs of that batch itself.
+            supersede: Whether the job may be superseded when its stream's
+                backlog is over the cap; background work that must not be
+                lost, like embedding backfills, passes False.
+
+        Returns:
+            The queued job; its ``future`` holds the outcome.
+        """
+        if priority not in PRIORITY_CLASSES:
+            raise ValueError(f"Unknown priority class '{priority}', expected one of {list(PRIORITY_CLASSES)}")
+        job = Job(fn, args, priority, deadline, expected_tokens, stream or DEFAULT_STREAM,
+                  next(self._counter), batch_key, memory, continuous, supersede)
+        with self._cond:
+            queue = self._stream(job.stream)
+            self._push(queue, job)
+            if queue.capped > self.max_queue_per_stream:
+                self._shed(queue)
+            metrics.inc("scheduler_submitted_total", priority=priority)
+            self._update_gauges()
+            self._cond.notify()
+        return job
+
+    def promote(self, job: Job, priority: str, deadline: Optional[float]) -> Job:
+        """
+        Merge the urgency of another request into a queued job, e.g. when a
+        more urgent request coalesces onto it. The job takes the more urgent
+        class and the later deadline, so it is not dropped while one of its
+        callers still wants the result.
+
+        Returns:
+            The job that now represents the request in the queue.
+        """
+        with self._cond:
+            if job.removed or job.future.done():
+                return job
+            merged_priority = min(job.priority, priority, key=PRIORITY_CLASSES.__getitem__)
+            merged_deadline = None if deadline is None or job.deadline is None else max(deadline, job.deadline)
+            if merged_priority == job.priority and merged_deadline == job.deadline:
+                return job
+            # Lazy deletion: the old heap entry is skipped when it reaches the head
+            job.removed = True
+            replacement = Job(job.fn, job.args, merged_priority, merged_deadline,
+                              job.expected_tokens, job.stream, job.seq, job.batch_key, job.memory,
+                              job.continuous, job.supersede)
+            replacement.future = job.future
+            replacement.enqueued_at = job.enqueued_at
+            queue = self._stream(job.stream)
+            queue.pending -= 1
+            queue.capped -= job.supersede
+            self._push(queue, replacement)
+            self._update_gauges()
+            self._cond.notify()
+        return replacement
+
+    def backlog(self) -> int:
+        """Jobs waiting for the inference thread."""
+        with self._cond:
+            return sum(queue.pending for queue in self._streams.values())
+
+    def _update_gauges(self) -> None:
+        depth = {name: 0 for name in PRIORITY_CLASSES}
+        now = time.time()
+        for queue in self._streams.values():
+            for _, _, job in queue.jobs:
+                if not job.removed:
+                    depth[job.priority] += 1
+            while queue.served and now - queue.served[0] > self.RATE_WINDOW:
+                queue.served.popleft()
+            metrics.set("stream_queue_depth", queue.pending, stream=queue.name)
+            metrics.set("stream_served_per_minute", len(queue.served) * 60.0 / self.RATE_WINDOW, stream=queue.name)
+        for name, count in depth.items():
+            metrics.set("scheduler_queue_depth", count, priority=name)
+
+    def _select(self, like: Optional[Job] = None) -> Optional[StreamQueue]:
+        """Stream queue to serve next, optionally only among heads batchable with ``like``."""
+        best = None
+        best_key = None
+        for queue in self._streams.values():
+            head = queue.head()
+            if head is None:
+                continue
+            if like is not None and (head.batch_key != like.batch_key or head.priority != like.priority):
+                continue
+            # Strict priority between classes, fair share within a class
+            key = (PRIORITY_CLASSES[head.priority], queue.start_tag, head.seq)
+            if best_key is None or key < best_key:
+                best, best_key = queue, key
+        return best
+
+    def _take(self, queue: StreamQueue) -> Job:
+        _, _, job = heapq.heappop(queue.jobs)
+        job.removed = True
+        queue.pending -= 1
+        queue.capped -= job.supersede
+        self._virtual_time = queue.start_tag
+        queue.start_tag += job.cost / queue.weight
+        queue.served.append(time.time())
+        metrics.inc("stream_served_total", stream=queue.name)
+        return job
+
+    def _next_batch(self) -> List[Job]:
+        with self._cond:
+            queue = self._select()
+            while queue is None:
+                self._cond.wait()
+                queue = self._select()
+            first = self._take(queue)
+            batch = [first]
+
+            if first.batch_key is not None and not first.continuous and self.admission is not None:
+                committed = first.memory
+                while len(batch) < self.admission.batch_size:
+                    queue = self._select(like=first)
+                    if queue is None:
+                        break
+                    candidate = queue.head()
+                    if not candidate.expired(time.time()) and not self.admission.fits(committed + candidate.memory):
+                        metrics.inc("admission_deferred_total")
+                        break
+                    # Expired candidates are taken too; they are dropped below without running
+                    committed += candidate.memory
+                    batch.append(self._take(queue))
+
+            self._update_gauges()
+            return batch
+
+    def _start(self, job: Job, now: float) -> bool:
+        """Mark a dequeued job running; False when it was cancelled or has expired."""
+        waited = now - job.enqueued_at
+        metrics.observe("scheduler_queue_wait_seconds", waited, priority=job.priority)
+
+        if not job.future.set_running_or_notify_cancel():
+            return False
+        if job.expired(now):
+            metrics.inc("scheduler_expired_total", priority=job.priority)
+            logger.info(f"Dropping expired {job.priority} request after {waited:.2f}s in queue")
+            job.future.set_exception(DeadlineExceeded(
+                f"Request deadline passed after {waited:.2f}s in queue"
+            ))
+            return False
+        return True
+
+    def _run(self) -> None:
+        while True:
+            now = time.time()
+            runnable = [job for job in self._next_batch() if self._start(job, now)]
+            if runnable:
+                self._execute(runnable)
+
+    def _join(self, first: Job) -> Optional[Job]:
+        """Take the next job if it can join ``first``'s continuous batch; skips expired ones."""
+        while True:
+            with self._cond:
+                queue = self._select()
+                head = queue.head() if queue is not None else None
+                if head is None or not head.continuous or head.batch_key != first.batch_key:
+                    return None
+                job = self._take(queue)
+                self._update_gauges()
+            if self._start(job, time.time()):
+                return job
+
+    def _complete(self, job: Job, result: Any) -> None:
+        if isinstance(result, BaseException):
+            job.future.set_exception(result)
+        else:
+            job.future.set_result(result)
+        metrics.inc("scheduler_completed_total", priority=job.priority)
+
+    def _run_continuous(self, first: Job) -> None:
+        """Run a continuous engine until its batch has drained."""
+        batch = ContinuousBatch(self, first)
+        started = time.time()
+        try:
+            # The engine records its steps with the profiler itself
+            first.fn(batch)
+        except BaseException as e:
+            logger.error(f"Continuous batch failed: {e}", exc_info=True)
+            batch.fail(e)
+        if batch.completed:
+            per_job = (time.time() - started) / batch.completed
+            self.seconds_per_job = per_job if self.seconds_per_job is None else self.seconds_per_job + 0.1 * (per_job - self.seconds_per_job)
+
+    def _execute(self, jobs: List[Job]) -> None:
+        """Run a batch; after an out-of-memory failure retry it in halves."""
+        if jobs[0].continuous:
+            self._run_continuous(jobs[0])
+            return
+        metrics.observe("scheduler_batch_size", len(jobs))
+        started = time.time()
+        try:
+            # Recorded only while an admin capture window is open
+            with profiler.job(len(jobs)):
+                if jobs[0].batch_key is None:
+                    results = [jobs[0].fn(*jobs[0].args)]
+                else:
+                    results = jobs[0].fn([job.args for job in jobs])
+        except BaseException as e:
+            if self.admission is not None and is_out_of_memory(e):
+                self.admission.record_oom(len(jobs))
+                if len(jobs) > 1:
+                    half = len(jobs) // 2
+                    self._execute(jobs[:half])
+                    self._execute(jobs[half:])
+                    return
+            for job in jobs:
+                job.future.set_exception(e)
+                metrics.inc("scheduler_completed_total", priority=job.priority)
+            return
+
+        if self.admission is not None:
+            self.admission.record_success()
+        per_job = (time.time() - started) / len(jobs)
+        self.seconds_per_job = per_job if self.seconds_per_job is None else self.seconds_per_job + 0.1 * (per_job - self.seconds_per_job)
+        for job, result in zip(jobs, results):
+            self._complete(job, result)
+        self._learn(results, time.time() - started)
+
+    def _learn(self, results: List[Any], elapsed: float) -> None:
+        """Refine the per-token time estimate from a finished generation."""
+        tokens = max((result.get("completion_tokens") or 0 for result in results
+                      if isinstance(result, dict)), default=0)
+        if tokens:
+            self.seconds_per_token += 0.1 * (elapsed / tokens - self.seconds_per_token)
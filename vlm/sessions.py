@@ -0,0 +1,185 @@
+# vlm/sessions.py
+"""
+Server-side conversation sessions.
+
+A session keeps the conversation in the Qwen format with its images
+already decoded, and the KV cache of every token the model has seen so
+far. A follow-up turn then only prefills the new user message instead
+of re-decoding, re-encoding and re-prefilling the whole conversation.
+
+The KV cache is the expensive part (about 36 KB per token for the 3B
+model), so only the most recently used sessions keep one. A session
+whose cache was dropped keeps its messages and images and rebuilds the
+cache on its next turn. Sessions idle for longer than the TTL are removed
+completely.
+
+The cache fields are only touched on the inference thread, while a turn
+runs; the store itself may be used from the event loop.
+
+Configuration (environment variables):
+    SESSION_IDLE_TTL     seconds without a turn before a session is removed (default: 900)
+    SESSION_MAX          sessions kept at once, least recently used are removed first (default: 64)
+    SESSION_MAX_CACHED   sessions that keep their KV cache (default: 8)
+    SESSION_MAX_TOKENS   tokens a conversation may grow to (default: 16384)
+"""
+
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional
+
+from metrics import metrics
+
+logger = logging.getLogger("sessions")
+
+SESSION_IDLE_TTL = float(os.environ.get("SESSION_IDLE_TTL", "900"))
+SESSION_MAX = int(os.environ.get("SESSION_MAX", "64"))
+SESSION_MAX_CACHED = int(os.environ.get("SESSION_MAX_CACHED", "8"))
+SESSION_MAX_TOKENS = int(os.environ.get("SESSION_MAX_TOKENS", "16384"))
+
+
+class SessionBusy(Exception):
+    """A turn of the session is already running."""
+
+
+@dataclass
+class Session:
+    """One conversation and the model state that belongs to it."""
+
+    id: str
+    messages: List[Dict[str, Any]] = field(default_factory=list)  # Qwen format, images as PIL images
+    cache: Any = None  # transformers cache holding every token in input_ids
+    input_ids: Any = None  # token ids in the cache, shape (1, n)
+    image_grid_thw: Any = None  # grids of every image in input_ids, for the rope positions
+    pending: List[int] = field(default_factory=list)  # end of the last answer, not yet in the cache
+    model_id: Optional[str] = None  # model the cache belongs to
+    created: float = field(default_factory=time.time)
+    last_used: float = field(default_factory=time.time)
+    turns: int = 0
+    busy: bool = False
+
+    @property
+    def cached_tokens(self) -> int:
+        return int(self.input_ids.shape[-1]) if self.cache is not None else 0
+
+    def drop_cache(self) -> None:
+        """Forget the model state; the next turn prefills the whole conversation again."""
+        self.cache = None
+        self.input_ids = None
+        self.image_grid_thw = None
+        self.pending = []
+
+    def info(self) -> Dict[str, Any]:
+        return {
+            "id": self.id,
+            "object": "session",
+            "created": int(self.created),
+            "last_used": int(self.last_used),
+            "model": self.model_id,
+            "turns": self.turns,
+            "messages": len(self.messages),
+            "cached_tokens": self.cached_tokens,
+        }
+
+
+class SessionStore:
+    """
+    Sessions by id with idle expiry and a cap on the sessions holding a KV cache.
+
+    Args:
+        idle_ttl: Seconds without a turn before a session is removed.
+        max_sessions: Sessions kept at once.
+        max_cached: Sessions that keep their KV cache.
+    """
+
+    def __init__(self, idle_ttl: float = SESSION_IDLE_TTL, max_sessions: int = SESSION_MAX,
+                 max_cached: int = SESSION_MAX_CACHED):
+        self.idle_ttl = idle_ttl
+        self.max_sessions = max_sessions
+        self.max_cached = max_cached
+        self._lock = threading.Lock()
+        # Least recently used first
+        self._sessions: "OrderedDict[str, Session]" = OrderedDict()
+
+    def create(self, messages: Optional[List[Dict[str, Any]]] = None) -> Session:
+        """Start a session, optionally with earlier messages in the Qwen format."""
+        session = Session(id=f"sess-{uuid.uuid4().hex}", messages=list(messages or []))
+        with self._lock:
+            self._sessions[session.id] = session
+            while len(self._sessions) > self.max_sessions:
+                oldest = next((s for s in self._sessions.values() if not s.busy), None)
+                if oldest is None:
+                    break
+                self._remove(oldest.id, "capacity")
+            self._update_gauges()
+        metrics.inc("sessions_created_total")
+        return session
+
+    def get(self, session_id: str) -> Optional[Session]:
+        with self._lock:
+            return self._sessions.get(session_id)
+
+    def checkout(self, session_id: str) -> Optional[Session]:
+        """
+        Reserve a session for one turn.
+
+        Raises:
+            SessionBusy: A turn of this session is still running.
+        """
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is None:
+                return None
+            if session.busy:
+                raise SessionBusy(f"Session '{session_id}' is answering another message")
+            session.busy = True
+            session.last_used = time.time()
+            self._sessions.move_to_end(session_id)
+            return session
+
+    def checkin(self, session: Session) -> None:
+        """Release a session after its turn and drop the caches of the least recently used ones."""
+        with self._lock:
+            session.busy = False
+            session.last_used = time.time()
+            cached = [s for s in self._sessions.values() if s.cache is not None and not s.busy]
+            for victim in cached[:max(0, len(cached) - self.max_cached)]:
+                victim.drop_cache()
+                metrics.inc("sessions_cache_dropped_total")
+                logger.debug(f"Dropped KV cache of session {victim.id}")
+            self._update_gauges()
+
+    def remove(self, session_id: str) -> bool:
+        with self._lock:
+            if session_id not in self._sessions:
+                return False
+            self._remove(session_id, "deleted")
+            self._update_gauges()
+            return True
+
+    def reap(self) -> int:
+        """Remove sessions idle for longer than the TTL; returns how many were removed."""
+        cutoff = time.time() - self.idle_ttl
+        with self._lock:
+            idle = [s.id for s in self._sessions.values() if not s.busy and s.last_used < cutoff]
+            for session_id in idle:
+                self._remove(session_id, "idle")
+            self._update_gauges()
+        return len(idle)
+
+    def _remove(self, session_id: str, reason: str) -> None:
+        session = self._sessions.pop(session_id)
+        session.drop_cache()
+        metrics.inc("sessions_removed_total", reason=reason)
+        logger.info(f"Removed session {session_id} ({reason}, {session.turns} turns)")
+
+    def _update_gauges(self) -> None:
+        metrics.set("sessions_active", len(self._sessions))
+        metrics.set("sessions_cached", sum(1 for s in self._sessions.values() if s.cache is not None))
+
+    def __len__(self) -> int:
+        return len(self._sessions)
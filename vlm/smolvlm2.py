@@ -8,6 +8,11 @@ from PIL import Image
 import time
 import uuid
 
+import speculative
+from metrics import metrics
+import tracing
+from tracing import GenerateTimer, Trace, input_sizes
+
 app = Flask(__name__)
 
 # Load model and processor
@@ -36,9 +41,21 @@ def process_image_url(url):
 
 @app.route('/v1/chat/completions', methods=['POST'])
 def chat_completions():
-    start_time = time.time()
     data = request.json
+    trace = Trace("chat.completions", request.headers.get("X-Trace-Id"))
+    trace.request_body = data
+    trace.set(**input_sizes(data['messages']))
+    try:
+        response = complete(data, trace)
+        trace.response_texts = [choice["message"]["content"] for choice in response["choices"]]
+    finally:
+        tracing.sink.finish(trace)
     
+    result = jsonify(response)
+    result.headers["X-Trace-Id"] = trace.trace_id
+    return result
+
+def complete(data, trace):
     messages = []
     for msg in data['messages']:
         content = []
@@ -58,10 +75,11 @@ def chat_completions():
                     elif 'base64' in item['image_url']:
                         # Handle base64 images - download and save temporarily or process directly
                         image_data = item['image_url']['base64']
-                        image = process_base64_image(image_data)
-                        # Save image temporarily and use local path
-                        temp_path = f"temp_{uuid.uuid4()}.jpg"
-                        image.save(temp_path)
+                        with trace.span("decode"):
+                            image = process_base64_image(image_data)
+                            # Save image temporarily and use local path
+                            temp_path = f"temp_{uuid.uuid4()}.jpg"
+                            image.save(temp_path)
                         content.append({"type": "image", "url": temp_path})
         
         messages.append({
@@ -70,25 +88,35 @@ def chat_completions():
         })
     
     # Process through model
-    inputs = processor.apply_chat_template(
-        messages,
-        add_generation_prompt=True,
-        tokenize=True,
-        return_dict=True,
-        return_tensors="pt"
-    ).to(model.device, dtype=torch.bfloat16)
+    with trace.span("processor"):
+        inputs = processor.apply_chat_template(
+            messages,
+            add_generation_prompt=True,
+            tokenize=True,
+            return_dict=True,
+            return_tensors="pt"
+        ).to(model.device, dtype=torch.bfloat16)
     
     max_tokens = data.get('max_tokens', 64)
     temperature = data.get('temperature', 0)
     
     do_sample = temperature > 0
     
-    generated_ids = model.generate(
-        **inputs, 
-        do_sample=do_sample,
-        temperature=temperature,
-        max_new_tokens=max_tokens
-    )
+    # Greedy requests use prompt lookup decoding; the draft mode is only
+    # meaningful for the larger models, this one is the draft
+    gen_kwargs = {"do_sample": do_sample, "max_new_tokens": max_tokens}
+    if do_sample:
+        gen_kwargs["temperature"] = temperature
+    spec_kwargs = speculative.generate_kwargs(temperature)
+    gen_kwargs.update(spec_kwargs)
+    
+    prompt_len = inputs['input_ids'].size(1)
+    with GenerateTimer(model) as timer, \
+            speculative.SpeculationStats(model, prompt_len, speculative.active_mode(spec_kwargs)) as spec_stats:
+        generated_ids = model.generate(**inputs, **gen_kwargs)
+    spec_stats.finish(len(generated_ids[0]) - prompt_len)
+    timer.record(trace, completion_tokens=len(generated_ids[0]) - prompt_len)
+    trace.set(prompt_tokens=prompt_len, completion_tokens=len(generated_ids[0]) - prompt_len)
     
     generated_text = processor.batch_decode(
         generated_ids, 
@@ -118,7 +146,11 @@ def chat_completions():
         }
     }
     
-    return jsonify(response)
+    return response
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    return jsonify(metrics.snapshot())
 
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=8000)
\ No newline at end of file
@@ -0,0 +1,205 @@
+# vlm/speculative.py
+"""
+Speculative decoding helpers for the VLM servers.
+
+Two drafting strategies are supported on top of Hugging Face ``generate``:
+
+* ``ngram``  - prompt lookup decoding. Candidate tokens are copied from the
+  prompt whenever the tail of the output matches an n-gram in it, which is
+  exactly what happens when the model echoes the JSON skeleton of the
+  safety prompt ("description", "fire", "gun", ...).
+* ``draft``  - a smaller model of the same family proposes tokens that the
+  large model verifies in a single forward pass, e.g. Qwen2.5-VL-3B for a
+  Qwen2.5-VL-7B server. ``generate`` hands the target's image inputs
+  (``pixel_values``, ``image_grid_thw``) to the draft as they are, so a
+  draft with another vision stack or vocabulary cannot run; requests then
+  decode greedily without a draft and a warning is logged once.
+
+Speculation is only used for greedy requests (temperature == 0). Every
+drafted token is verified against the target model's argmax, so the output
+is identical to plain greedy decoding.
+
+Configuration (environment variables):
+    SPECULATIVE_MODE          off | ngram | draft (default: ngram)
+    SPECULATIVE_NGRAM_TOKENS  tokens proposed per lookup (default: 10)
+    SPECULATIVE_NGRAM_SIZE    max n-gram size matched against the prompt (default: 3)
+    SPECULATIVE_DRAFT_MODEL   path of the draft model, same family as the served model (default: Qwen2.5-VL-3B-Instruct)
+    SPECULATIVE_DRAFT_TOKENS  tokens proposed per draft round (default: 5)
+"""
+
+import logging
+import os
+import time
+from typing import Any, Dict
+
+from metrics import metrics
+
+logger = logging.getLogger("speculative")
+
+SPECULATIVE_MODE = os.environ.get("SPECULATIVE_MODE", "ngram").lower()
+NGRAM_TOKENS = int(os.environ.get("SPECULATIVE_NGRAM_TOKENS", "10"))
+NGRAM_SIZE = int(os.environ.get("SPECULATIVE_NGRAM_SIZE", "3"))
+DRAFT_MODEL_PATH = os.environ.get("SPECULATIVE_DRAFT_MODEL", "Qwen2.5-VL-3B-Instruct")
+DRAFT_TOKENS = int(os.environ.get("SPECULATIVE_DRAFT_TOKENS", "5"))
+
+_draft_model = None
+# Targets already warned about, by model type
+_incompatible = set()
+
+
+def load_draft_model():
+    """Load the draft model when SPECULATIVE_MODE=draft. Safe to call repeatedly."""
+    global _draft_model
+    if SPECULATIVE_MODE != "draft" or _draft_model is not None:
+        return _draft_model
+
+    from transformers import AutoModelForImageTextToText
+
+    logger.info(f"Loading draft model {DRAFT_MODEL_PATH}...")
+    _draft_model = AutoModelForImageTextToText.from_pretrained(
+        DRAFT_MODEL_PATH, torch_dtype="auto", device_map="auto"
+    )
+    _draft_model.generation_config.num_assistant_tokens = DRAFT_TOKENS
+    _draft_model.generation_config.num_assistant_tokens_schedule = "heuristic"
+    logger.info("Draft model loaded")
+    return _draft_model
+
+
+def _text_config(model):
+    return getattr(model.config, "text_config", None) or model.config
+
+
+def draft_compatible(model) -> bool:
+    """Whether the draft model can assist ``model``: same architecture and vocabulary, but another checkpoint."""
+    if _draft_model is None or model is None or _draft_model is model:
+        return False
+    same = (_draft_model.config.model_type == model.config.model_type
+            and _text_config(_draft_model).vocab_size == _text_config(model).vocab_size
+            and _draft_model.name_or_path != model.name_or_path)
+    if not same and model.config.model_type not in _incompatible:
+        _incompatible.add(model.config.model_type)
+        logger.warning(f"Draft model {DRAFT_MODEL_PATH} ({_draft_model.config.model_type}) cannot assist "
+                       f"{model.config.model_type}; decoding without a draft")
+    return same
+
+
+def generate_kwargs(temperature: float, model=None) -> Dict[str, Any]:
+    """
+    Build the extra ``model.generate`` arguments for a request.
+
+    Args:
+        temperature: Requested sampling temperature.
+        model: Target model, which the draft model has to match.
+
+    Returns:
+        Keyword arguments to merge into the ``generate`` call. Empty when
+        speculation is disabled or the request samples.
+    """
+    if temperature > 0 or SPECULATIVE_MODE == "off":
+        return {}
+
+    kwargs: Dict[str, Any] = {"do_sample": False}
+    if SPECULATIVE_MODE == "ngram":
+        kwargs["prompt_lookup_num_tokens"] = NGRAM_TOKENS
+        kwargs["max_matching_ngram_size"] = NGRAM_SIZE
+    elif SPECULATIVE_MODE == "draft" and draft_compatible(model):
+        kwargs["assistant_model"] = _draft_model
+    return kwargs
+
+
+def active_mode(kwargs: Dict[str, Any]) -> str:
+    """Name the drafting strategy selected by ``generate_kwargs``."""
+    if "prompt_lookup_num_tokens" in kwargs:
+        return "ngram"
+    if "assistant_model" in kwargs:
+        return "draft"
+    return "off"
+
+
+class SpeculationStats:
+    """
+    Count drafted and accepted tokens of one ``generate`` call.
+
+    Installs a forward pre-hook on the target model. Every target forward
+    pass is one verification step which emits the accepted draft tokens
+    plus one token of its own, so ``accepted = new_tokens - steps``. The
+    number of drafted tokens is read from the length of the tokens fed to
+    each step.
+
+    Usage:
+        with SpeculationStats(model, prompt_len, active_mode(kwargs)) as stats:
+            output = model.generate(...)
+        stats.finish(new_tokens)
+    """
+
+    def __init__(self, model, prompt_len: int, mode: str = "off"):
+        self.model = model
+        self.prompt_len = prompt_len
+        self.mode = mode
+        self.steps = 0
+        self.drafted = 0
+        self.accepted = 0
+        self.new_tokens = 0
+        self.elapsed = 0.0
+        self._handle = None
+        self._start = 0.0
+
+    def _hook(self, module, args, kwargs):
+        input_ids = kwargs.get("input_ids")
+        if input_ids is None and args:
+            input_ids = args[0]
+        if input_ids is None:
+            return
+        fed = input_ids.shape[-1]
+        already_processed = self.prompt_len if self.steps == 0 else 1
+        self.drafted += max(fed - already_processed, 0)
+        self.steps += 1
+
+    def __enter__(self):
+        self._handle = self.model.register_forward_pre_hook(self._hook, with_kwargs=True)
+        self._start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.elapsed = time.time() - self._start
+        if self._handle is not None:
+            self._handle.remove()
+            self._handle = None
+        return False
+
+    @property
+    def acceptance_rate(self) -> float:
+        return self.accepted / self.drafted if self.drafted else 0.0
+
+    @property
+    def tokens_per_second(self) -> float:
+        return self.new_tokens / self.elapsed if self.elapsed > 0 else 0.0
+
+    def finish(self, new_tokens: int) -> "SpeculationStats":
+        """Record the result of the generate call into the shared metrics."""
+        self.new_tokens = new_tokens
+        self.accepted = max(min(new_tokens - self.steps, self.drafted), 0)
+        mode = self.mode
+
+        metrics.inc("generate_requests_total", mode=mode)
+        metrics.inc("generate_tokens_total", new_tokens, mode=mode)
+        metrics.inc("generate_seconds_total", self.elapsed, mode=mode)
+        metrics.inc("speculative_drafted_tokens_total", self.drafted, mode=mode)
+        metrics.inc("speculative_accepted_tokens_total", self.accepted, mode=mode)
+        drafted_total = metrics.counter("speculative_drafted_tokens_total", mode=mode)
+        if drafted_total:
+            accepted_total = metrics.counter("speculative_accepted_tokens_total", mode=mode)
+            metrics.set("speculative_acceptance_rate", round(accepted_total / drafted_total, 4), mode=mode)
+        metrics.set(
+            "generate_tokens_per_second",
+            round(metrics.counter("generate_tokens_total", mode=mode)
+                  / max(metrics.counter("generate_seconds_total", mode=mode), 1e-9), 2),
+            mode=mode,
+        )
+        metrics.observe("request_tokens_per_second", self.tokens_per_second, mode=mode)
+        logger.debug(
+            f"Speculation ({mode}): {new_tokens} tokens in {self.steps} steps, "
+            f"accepted {self.accepted}/{self.drafted} drafted, "
+            f"{self.tokens_per_second:.1f} tok/s"
+        )
+        return self
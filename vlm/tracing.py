@@ -0,0 +1,293 @@
+# vlm/tracing.py
+"""
+Per-request trace spans for the VLM servers.
+
+Every request gets a ``Trace`` that collects timed spans (fetch, decode,
+resize, template, processor, prefill, decode, response, ...) together
+with attributes such as image sizes, token counts and queue wait. When the
+request finishes the trace is handed to a writer thread, which appends it
+as one JSON line to a rotating file, so no file I/O happens on the event
+loop; traces arriving while the writer is ``TRACE_QUEUE`` behind are
+dropped and counted.
+
+Only a sample of ordinary requests is written. Requests slower than
+``TRACE_SLOW_MS`` are always written, flagged ``"slow": true`` and carry
+their input sizes; their full request body is also saved to
+``TRACE_SLOW_DIR`` so the frame can be replayed against the server. When
+recording is on (``RECORD_DIR``, see recorder.py) every finished request
+is also handed to the traffic recorder.
+
+Configuration (environment variables):
+    TRACE_FILE          JSONL sink (default: traces/traces.jsonl, empty disables)
+    TRACE_SAMPLE_RATE   fraction of ordinary requests written (default: 0.05)
+    TRACE_SLOW_MS       latency above which a request is kept in full (default: 5000)
+    TRACE_SLOW_DIR      directory for the bodies of slow requests (default: traces/slow)
+    TRACE_SLOW_KEEP     slow request bodies kept before the oldest is removed (default: 200)
+    TRACE_MAX_BYTES     size of one trace file before rotation (default: 50 MB)
+    TRACE_BACKUPS       rotated trace files kept (default: 5)
+"""
+
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import re
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Any, Dict, List, Optional
+
+from metrics import metrics
+from recorder import recorder as traffic_recorder
+
+logger = logging.getLogger("tracing")
+
+TRACE_FILE = os.environ.get("TRACE_FILE", os.path.join("traces", "traces.jsonl"))
+TRACE_SAMPLE_RATE = float(os.environ.get("TRACE_SAMPLE_RATE", "0.05"))
+TRACE_SLOW_MS = float(os.environ.get("TRACE_SLOW_MS", "5000"))
+TRACE_SLOW_DIR = os.environ.get("TRACE_SLOW_DIR", os.path.join("traces", "slow"))
+TRACE_SLOW_KEEP = int(os.environ.get("TRACE_SLOW_KEEP", "200"))
+TRACE_MAX_BYTES = int(os.environ.get("TRACE_MAX_BYTES", str(50 * 1024 * 1024)))
+TRACE_BACKUPS = int(os.environ.get("TRACE_BACKUPS", "5"))
+# Finished traces waiting for the writer thread
+TRACE_QUEUE = 1000
+
+# Client trace ids end up in file names (slow request bodies)
+_TRACE_ID = re.compile(r"[A-Za-z0-9_-]{1,64}")
+
+
+class Trace:
+    """
+    Spans and attributes of one request.
+
+    Spans may be recorded from the event loop and the inference thread;
+    each span is appended once, when it ends, so no locking is needed.
+
+    Args:
+        name: Operation name, e.g. ``chat.completions``.
+        trace_id: Identifier returned to the client, random when omitted
+            or not made of 1-64 letters, digits, ``_`` and ``-``.
+    """
+
+    def __init__(self, name: str, trace_id: Optional[str] = None):
+        self.name = name
+        self.trace_id = trace_id if trace_id and _TRACE_ID.fullmatch(trace_id) else uuid.uuid4().hex
+        self.start = time.time()
+        self.attributes: Dict[str, Any] = {}
+        self.spans: List[Dict[str, Any]] = []
+        self.request_body: Optional[dict] = None
+        self.response_texts: Optional[List[str]] = None  # answers, for the traffic recorder
+        self.queued_at: Optional[float] = None  # set when handed to the inference thread
+
+    def set(self, **attributes) -> None:
+        """Attach attributes to the whole request."""
+        self.attributes.update(attributes)
+
+    def add_span(self, name: str, start: float, end: float, **attributes) -> None:
+        """Record a span whose start and end times were measured elsewhere."""
+        span = {
+            "name": name,
+            "start_ms": round((start - self.start) * 1000, 3),
+            "duration_ms": round((end - start) * 1000, 3),
+        }
+        if attributes:
+            span["attributes"] = attributes
+        self.spans.append(span)
+
+    def dequeued(self) -> None:
+        """Close the queue span when the inference thread picks the request up."""
+        if self.queued_at is not None:
+            now = time.time()
+            self.add_span("queue", self.queued_at, now)
+            self.set(queue_wait_ms=round((now - self.queued_at) * 1000, 3))
+            self.queued_at = None
+
+    @contextmanager
+    def span(self, name: str, **attributes):
+        """
+        Time a block as a span. The yielded dict takes attributes known only
+        after the block ran::
+
+            with trace.span("generate") as attrs:
+                ...
+                attrs["completion_tokens"] = n
+        """
+        start = time.time()
+        try:
+            yield attributes
+        except BaseException as e:
+            attributes["error"] = type(e).__name__
+            raise
+        finally:
+            self.add_span(name, start, time.time(), **attributes)
+
+    @property
+    def elapsed_ms(self) -> float:
+        return (time.time() - self.start) * 1000
+
+    def to_dict(self, duration_ms: float, slow: bool) -> Dict[str, Any]:
+        return {
+            "trace_id": self.trace_id,
+            "name": self.name,
+            "timestamp": self.start,
+            "duration_ms": round(duration_ms, 3),
+            "slow": slow,
+            "attributes": self.attributes,
+            "spans": sorted(self.spans, key=lambda span: span["start_ms"]),
+        }
+
+
+@contextmanager
+def span(trace: Optional[Trace], name: str, **attributes):
+    """``trace.span`` that does nothing when the caller has no trace."""
+    if trace is None:
+        yield attributes
+    else:
+        with trace.span(name, **attributes) as attrs:
+            yield attrs
+
+
+class GenerateTimer:
+    """
+    Split a ``generate`` call into prefill and decode.
+
+    The first forward pass of the model processes the whole prompt (and
+    the images), every later one emits new tokens. A forward hook records
+    when the first pass finished.
+    """
+
+    def __init__(self, model):
+        self.model = model
+        self.start = 0.0
+        self.first_forward_end: Optional[float] = None
+        self.end = 0.0
+        self._handle = None
+
+    def _hook(self, module, args, output):
+        if self.first_forward_end is None:
+            self.first_forward_end = time.time()
+
+    def __enter__(self):
+        self._handle = self.model.register_forward_hook(self._hook)
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.end = time.time()
+        if self._handle is not None:
+            self._handle.remove()
+            self._handle = None
+        return False
+
+    def record(self, trace: Optional[Trace], **attributes) -> None:
+        """Add ``prefill`` and ``decode`` spans to ``trace``."""
+        if trace is None:
+            return
+        prefill_end = self.first_forward_end or self.end
+        trace.add_span("prefill", self.start, prefill_end)
+        trace.add_span("decode", prefill_end, self.end, **attributes)
+
+
+class TraceSink:
+    """Writes finished traces, sampling ordinary requests and keeping slow ones."""
+
+    def __init__(self, path: str = TRACE_FILE, sample_rate: float = TRACE_SAMPLE_RATE,
+                 slow_ms: float = TRACE_SLOW_MS, slow_dir: str = TRACE_SLOW_DIR,
+                 slow_keep: int = TRACE_SLOW_KEEP):
+        self.sample_rate = sample_rate
+        self.slow_ms = slow_ms
+        self.slow_dir = slow_dir
+        self.slow_keep = slow_keep
+        self._writer = None
+        if path:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            # A private logger with a rotating handler does the file rotation
+            self._writer = logging.getLogger(f"tracing.sink.{path}")
+            self._writer.propagate = False
+            self._writer.setLevel(logging.INFO)
+            if not self._writer.handlers:
+                handler = logging.handlers.RotatingFileHandler(
+                    path, maxBytes=TRACE_MAX_BYTES, backupCount=TRACE_BACKUPS, encoding="utf-8"
+                )
+                handler.setFormatter(logging.Formatter("%(message)s"))
+                self._writer.addHandler(handler)
+        self._queue: "queue.Queue[Optional[tuple]]" = queue.Queue(maxsize=TRACE_QUEUE)
+        self._thread = threading.Thread(target=self._write_loop, name="trace-sink", daemon=True)
+        self._thread.start()
+
+    def finish(self, trace: Trace) -> None:
+        """Close ``trace`` and write it if it is slow or sampled."""
+        duration_ms = trace.elapsed_ms
+        slow = duration_ms >= self.slow_ms
+        metrics.observe("request_duration_ms", duration_ms, operation=trace.name)
+        if traffic_recorder is not None:
+            traffic_recorder.record(trace, duration_ms)
+        if slow:
+            metrics.inc("slow_requests_total", operation=trace.name)
+            logger.warning(f"Slow request {trace.trace_id}: {duration_ms:.0f} ms")
+        elif random.random() >= self.sample_rate:
+            return
+        try:
+            self._queue.put_nowait((trace, duration_ms, slow))
+        except queue.Full:
+            metrics.inc("traces_dropped_total")
+
+    def close(self) -> None:
+        self._queue.put(None)
+        self._thread.join(timeout=10)
+
+    def _write_loop(self) -> None:
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            trace, duration_ms, slow = item
+            try:
+                if slow:
+                    self._save_body(trace)
+                if self._writer is not None:
+                    self._writer.info(json.dumps(trace.to_dict(duration_ms, slow), default=str))
+            except Exception as e:
+                logger.warning(f"Could not write trace {trace.trace_id}: {e}")
+
+    def _save_body(self, trace: Trace) -> None:
+        if trace.request_body is None or not self.slow_dir:
+            return
+        try:
+            os.makedirs(self.slow_dir, exist_ok=True)
+            path = os.path.join(self.slow_dir, f"{int(trace.start)}_{trace.trace_id}.json")
+            with open(path, "w", encoding="utf-8") as f:
+                json.dump({"trace_id": trace.trace_id, "name": trace.name, "body": trace.request_body}, f)
+            saved = sorted(os.listdir(self.slow_dir))
+            for old in saved[:max(len(saved) - self.slow_keep, 0)]:
+                os.remove(os.path.join(self.slow_dir, old))
+        except OSError as e:
+            logger.warning(f"Could not save slow request {trace.trace_id}: {e}")
+
+
+def input_sizes(messages: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Sizes of a chat request's inputs: text characters and encoded image bytes."""
+    text_chars = 0
+    image_bytes = []
+    for message in messages:
+        content = message.get("content")
+        if isinstance(content, str):
+            text_chars += len(content)
+            continue
+        for part in content or []:
+            if part.get("type") == "text":
+                text_chars += len(part.get("text", ""))
+            elif part.get("type") == "image":
+                image_bytes.append(len(part.get("image") or "") * 3 // 4)
+            elif part.get("type") == "image_url":
+                image_url = part.get("image_url", {})
+                url = image_url.get("url", "") if isinstance(image_url, dict) else str(image_url)
+                image_bytes.append(len(url) * 3 // 4 if url.startswith("data:") else 0)
+    return {"messages": len(messages), "text_chars": text_chars, "image_bytes": image_bytes}
+
+
+# Shared sink used by the servers in this process
+sink = TraceSink()
@@ -0,0 +1,414 @@
+# vlm/vector_index.py
+"""
+Approximate nearest-neighbour index for description embeddings.
+
+Vectors are L2-normalised and stored row by row in one contiguous float32
+(or, at half the size, float16) matrix memory-mapped from ``vectors.f32``
+(``vectors.f16``), so cosine similarity is a dot product and the index can
+grow past RAM. Search uses an inverted file
+(IVF): a spherical k-means splits the space into ``nlist`` cells, every
+vector is filed under its nearest centroid, and a query only scores the
+vectors of the ``nprobe`` closest cells. Until enough vectors exist to
+train the centroids, search is exact.
+
+Each vector carries an external id (the Mongo ``_id``), a stream and a
+timestamp so searches can be restricted to a camera and a time range.
+A filter that keeps fewer rows than the probed cells hold is answered by
+an exact scan of those rows. Otherwise, when the filter leaves fewer than
+``k`` hits in the probed cells, more cells are probed until ``k`` are
+found or the whole index was scanned.
+
+Files in the index directory:
+    vectors.f32     float32 matrix [capacity, dim], grown by doubling (vectors.f16 for float16)
+    centroids.npy   IVF centroids, absent until trained
+    meta.npz        per-row cell, stream code, timestamp and deleted flag
+    meta.json       dimension, storage type, row count, ids and stream names
+
+Configuration (environment variables):
+    VECTOR_INDEX_NLIST        IVF cells once trained (default: 1024)
+    VECTOR_INDEX_NPROBE       cells scored per query (default: 32)
+    VECTOR_INDEX_TRAIN_AFTER  rows needed before the IVF is trained (default: 50000)
+"""
+
+import json
+import logging
+import os
+import threading
+from typing import Any, Dict, List, Optional, Sequence
+
+import numpy as np
+
+logger = logging.getLogger("vector-index")
+
+NLIST = int(os.environ.get("VECTOR_INDEX_NLIST", "1024"))
+NPROBE = int(os.environ.get("VECTOR_INDEX_NPROBE", "32"))
+TRAIN_AFTER = int(os.environ.get("VECTOR_INDEX_TRAIN_AFTER", "50000"))
+
+# Rows scored per matrix product, bounds the temporary memory of scans
+_CHUNK_ROWS = 65536
+_UNASSIGNED = -1
+# Storage type -> vector file suffix
+_DTYPES = {"float32": "f32", "float16": "f16"}
+
+
+def _normalise(vectors: np.ndarray) -> np.ndarray:
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+def spherical_kmeans(sample: np.ndarray, k: int, iterations: int = 10, seed: int = 0) -> np.ndarray:
+    """
+    Cluster unit vectors by cosine similarity.
+
+    Args:
+        sample: Normalised training vectors, shape ``(n, dim)``.
+        k: Number of centroids (clamped to ``n``).
+        iterations: Lloyd iterations.
+
+    Returns:
+        Normalised centroids, shape ``(k, dim)``.
+    """
+    rng = np.random.default_rng(seed)
+    k = min(k, len(sample))
+    centroids = sample[rng.choice(len(sample), k, replace=False)].copy()
+    for _ in range(iterations):
+        assign = np.empty(len(sample), dtype=np.int32)
+        for start in range(0, len(sample), _CHUNK_ROWS):
+            assign[start:start + _CHUNK_ROWS] = np.argmax(sample[start:start + _CHUNK_ROWS] @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assign, sample)
+        counts = np.bincount(assign, minlength=k)
+        empty = counts == 0
+        # Reseed empty cells with random sample points
+        sums[empty] = sample[rng.choice(len(sample), int(empty.sum()))]
+        centroids = _normalise(sums)
+    return centroids
+
+
+class VectorIndex:
+    """
+    Memory-mapped IVF index with metadata filters.
+
+    Args:
+        path: Directory holding the index files; loaded when it exists.
+        dim: Vector dimension, required for a new index.
+        nlist: IVF cells created when the index is trained.
+        train_after: Row count at which the IVF is trained automatically.
+        dtype: Storage type of a new index, ``float32`` (default) or
+            ``float16``; float16 halves the file for a rounding error of
+            about 1e-3 in the scores.
+    """
+
+    def __init__(self, path: str, dim: Optional[int] = None, nlist: int = NLIST,
+                 train_after: int = TRAIN_AFTER, dtype: Optional[str] = None):
+        if dtype is not None and dtype not in _DTYPES:
+            raise ValueError(f"Unsupported vector storage type '{dtype}', expected one of {list(_DTYPES)}")
+        self.path = path
+        self.nlist = nlist
+        self.train_after = train_after
+        self._lock = threading.RLock()
+        os.makedirs(path, exist_ok=True)
+
+        meta_path = os.path.join(path, "meta.json")
+        if os.path.exists(meta_path):
+            self._load(meta_path)
+        else:
+            if not dim:
+                raise ValueError("dim is required to create a new vector index")
+            self.dim = dim
+            self.dtype = dtype or "float32"
+            self.count = 0
+            self.ids: List[str] = []
+            self.streams: List[str] = []
+            self.capacity = 0
+            self.cells = np.empty(0, dtype=np.int32)
+            self.stream_codes = np.empty(0, dtype=np.int32)
+            self.timestamps = np.empty(0, dtype=np.float64)
+            self.deleted = np.empty(0, dtype=bool)
+            self.centroids: Optional[np.ndarray] = None
+            self._vectors = None
+            self._grow(1024)
+        if dim and dim != self.dim:
+            raise ValueError(f"Index at {path} has dimension {self.dim}, not {dim}")
+        if dtype and dtype != self.dtype:
+            raise ValueError(f"Index at {path} stores {self.dtype} vectors, not {dtype}")
+
+        self._rows = {key: row for row, key in enumerate(self.ids) if not self.deleted[row]}
+        self._stream_lookup = {name: code for code, name in enumerate(self.streams)}
+        self._lists: List[np.ndarray] = []
+        self._tails: Dict[int, List[int]] = {}
+        self._tail_rows = 0
+        self._build_lists()
+
+    # -- storage -----------------------------------------------------------
+
+    @property
+    def _vector_file(self) -> str:
+        return os.path.join(self.path, f"vectors.{_DTYPES[self.dtype]}")
+
+    def _grow(self, capacity: int) -> None:
+        """Extend the memory map and the per-row arrays to ``capacity`` rows."""
+        if self._vectors is not None:
+            self._vectors.flush()
+            del self._vectors
+        with open(self._vector_file, "ab") as f:
+            f.truncate(capacity * self.dim * np.dtype(self.dtype).itemsize)
+        self._vectors = np.memmap(self._vector_file, dtype=self.dtype, mode="r+", shape=(capacity, self.dim))
+        extra = capacity - len(self.cells)
+        self.cells = np.concatenate([self.cells, np.full(extra, _UNASSIGNED, dtype=np.int32)])
+        self.stream_codes = np.concatenate([self.stream_codes, np.zeros(extra, dtype=np.int32)])
+        self.timestamps = np.concatenate([self.timestamps, np.zeros(extra, dtype=np.float64)])
+        self.deleted = np.concatenate([self.deleted, np.zeros(extra, dtype=bool)])
+        self.capacity = capacity
+
+    def _load(self, meta_path: str) -> None:
+        with open(meta_path, encoding="utf-8") as f:
+            meta = json.load(f)
+        self.dim = meta["dim"]
+        self.dtype = meta.get("dtype", "float32")
+        self.count = meta["count"]
+        self.ids = meta["ids"]
+        self.streams = meta["streams"]
+        arrays = np.load(os.path.join(self.path, "meta.npz"))
+        self.cells = arrays["cells"]
+        self.stream_codes = arrays["stream_codes"]
+        self.timestamps = arrays["timestamps"]
+        self.deleted = arrays["deleted"]
+        centroids_path = os.path.join(self.path, "centroids.npy")
+        self.centroids = np.load(centroids_path) if os.path.exists(centroids_path) else None
+        self.capacity = len(self.cells)
+        self._vectors = np.memmap(self._vector_file, dtype=self.dtype, mode="r+", shape=(self.capacity, self.dim))
+        logger.info(f"Loaded vector index {self.path}: {self.count} rows, dim {self.dim} {self.dtype}, "
+                    f"{'IVF ' + str(len(self.centroids)) if self.centroids is not None else 'exact'}")
+
+    def save(self) -> None:
+        """Flush vectors and write the metadata atomically."""
+        with self._lock:
+            self._vectors.flush()
+            np.savez(os.path.join(self.path, "meta.tmp.npz"), cells=self.cells,
+                     stream_codes=self.stream_codes, timestamps=self.timestamps, deleted=self.deleted)
+            os.replace(os.path.join(self.path, "meta.tmp.npz"), os.path.join(self.path, "meta.npz"))
+            if self.centroids is not None:
+                np.save(os.path.join(self.path, "centroids.tmp.npy"), self.centroids)
+                os.replace(os.path.join(self.path, "centroids.tmp.npy"), os.path.join(self.path, "centroids.npy"))
+            meta = {"dim": self.dim, "dtype": self.dtype, "count": self.count, "ids": self.ids, "streams": self.streams}
+            with open(os.path.join(self.path, "meta.tmp.json"), "w", encoding="utf-8") as f:
+                json.dump(meta, f)
+            # meta.json last: a crash before this point reloads the previous state
+            os.replace(os.path.join(self.path, "meta.tmp.json"), os.path.join(self.path, "meta.json"))
+
+    # -- IVF ---------------------------------------------------------------
+
+    def _build_lists(self) -> None:
+        """Rebuild the inverted lists, folding in rows appended since the last build."""
+        self._tails = {}
+        self._tail_rows = 0
+        if self.centroids is None:
+            self._lists = []
+            return
+        live = np.flatnonzero(~self.deleted[:self.count])
+        order = live[np.argsort(self.cells[live], kind="stable")]
+        bounds = np.searchsorted(self.cells[order], np.arange(len(self.centroids) + 1))
+        self._lists = [order[bounds[c]:bounds[c + 1]] for c in range(len(self.centroids))]
+
+    def _assign(self, vectors: np.ndarray) -> np.ndarray:
+        return np.argmax(vectors @ self.centroids.T, axis=1).astype(np.int32)
+
+    def train(self, nlist: Optional[int] = None, sample_size: int = 256) -> None:
+        """
+        Train the IVF centroids on a sample and file every row under its cell.
+
+        Args:
+            nlist: Number of cells, ``self.nlist`` by default.
+            sample_size: Training vectors per cell.
+        """
+        with self._lock:
+            nlist = nlist or self.nlist
+            live = np.flatnonzero(~self.deleted[:self.count])
+            if len(live) == 0:
+                return
+            rng = np.random.default_rng(0)
+            sample_rows = np.sort(rng.choice(live, min(len(live), nlist * sample_size), replace=False))
+            logger.info(f"Training IVF with {nlist} cells on {len(sample_rows)} of {len(live)} vectors")
+            self.centroids = spherical_kmeans(np.asarray(self._vectors[sample_rows], dtype=np.float32), nlist)
+            for start in range(0, self.count, _CHUNK_ROWS):
+                end = min(start + _CHUNK_ROWS, self.count)
+                self.cells[start:end] = self._assign(np.asarray(self._vectors[start:end], dtype=np.float32))
+            self._build_lists()
+
+    # -- mutation ----------------------------------------------------------
+
+    def _stream_code(self, stream: Optional[str]) -> int:
+        stream = stream or ""
+        code = self._stream_lookup.get(stream)
+        if code is None:
+            code = self._stream_lookup[stream] = len(self.streams)
+            self.streams.append(stream)
+        return code
+
+    def add(self, ids: Sequence[str], vectors, streams: Optional[Sequence[Optional[str]]] = None,
+            timestamps: Optional[Sequence[float]] = None) -> int:
+        """
+        Insert or replace vectors.
+
+        Args:
+            ids: External ids; an existing id is replaced.
+            vectors: Array-like of shape ``(n, dim)``.
+            streams: Stream of each vector, for filtering.
+            timestamps: Unix time of each vector, for filtering.
+
+        Returns:
+            Number of rows written.
+        """
+        vectors = _normalise(vectors).reshape(len(ids), -1)
+        if vectors.shape[1] != self.dim:
+            raise ValueError(f"Expected vectors of dimension {self.dim}, got {vectors.shape[1]}")
+        streams = streams or [None] * len(ids)
+        timestamps = timestamps or [0.0] * len(ids)
+
+        with self._lock:
+            while self.count + len(ids) > self.capacity:
+                self._grow(self.capacity * 2)
+            start, end = self.count, self.count + len(ids)
+            self._vectors[start:end] = vectors
+            for offset, key in enumerate(ids):
+                row = start + offset
+                previous = self._rows.get(key)
+                if previous is not None:
+                    self.deleted[previous] = True
+                self._rows[key] = row
+                self.ids.append(key)
+                self.stream_codes[row] = self._stream_code(streams[offset])
+                self.timestamps[row] = timestamps[offset] or 0.0
+            self.count = end
+
+            if self.centroids is not None:
+                cells = self._assign(vectors)
+                self.cells[start:end] = cells
+                for offset, cell in enumerate(cells):
+                    self._tails.setdefault(int(cell), []).append(start + offset)
+                self._tail_rows += len(cells)
+                # Appended rows live in small per-cell tails until they are worth compacting
+                if self._tail_rows > max(self.count // 10, 10000):
+                    self._build_lists()
+            elif self.count >= self.train_after:
+                self.train()
+            return len(ids)
+
+    def remove(self, key: str) -> bool:
+        """Delete the vector stored under ``key``."""
+        with self._lock:
+            row = self._rows.pop(key, None)
+            if row is None:
+                return False
+            self.deleted[row] = True
+            return True
+
+    def __len__(self) -> int:
+        return len(self._rows)
+
+    def vector(self, key: str) -> Optional[np.ndarray]:
+        """The stored vector of ``key`` as float32, or None."""
+        with self._lock:
+            row = self._rows.get(key)
+            return None if row is None else np.array(self._vectors[row], dtype=np.float32)
+
+    # -- search ------------------------------------------------------------
+
+    def _filter(self, rows: np.ndarray, stream: Optional[str], since: Optional[float],
+                until: Optional[float]) -> np.ndarray:
+        mask = ~self.deleted[rows]
+        if stream is not None:
+            code = self._stream_lookup.get(stream)
+            if code is None:
+                return rows[:0]
+            mask &= self.stream_codes[rows] == code
+        if since is not None:
+            mask &= self.timestamps[rows] >= since
+        if until is not None:
+            mask &= self.timestamps[rows] <= until
+        return rows[mask]
+
+    def _score(self, rows: np.ndarray, query: np.ndarray, k: int):
+        if len(rows) == 0:
+            return rows, np.empty(0, dtype=np.float32)
+        scores = np.empty(len(rows), dtype=np.float32)
+        for start in range(0, len(rows), _CHUNK_ROWS):
+            chunk = rows[start:start + _CHUNK_ROWS]
+            scores[start:start + len(chunk)] = self._vectors[chunk] @ query
+        if len(rows) > k:
+            top = np.argpartition(-scores, k)[:k]
+            rows, scores = rows[top], scores[top]
+        order = np.argsort(-scores)
+        return rows[order], scores[order]
+
+    def _selective(self, nprobe: int, stream: Optional[str], since: Optional[float],
+                   until: Optional[float]) -> bool:
+        """True when the filter keeps fewer rows than ``nprobe`` cells hold; keeps them in ``_selected``."""
+        self._selected = self._filter(np.arange(self.count), stream, since, until)
+        return len(self._selected) <= nprobe * self.count / len(self.centroids)
+
+    def _cell_rows(self, cells: np.ndarray) -> np.ndarray:
+        parts = [self._lists[c] for c in cells]
+        parts.extend(np.asarray(self._tails[c], dtype=np.int64) for c in cells if c in self._tails)
+        return np.concatenate(parts) if parts else np.empty(0, dtype=np.int64)
+
+    def search(self, query, k: int = 10, nprobe: int = NPROBE, stream: Optional[str] = None,
+               since: Optional[float] = None, until: Optional[float] = None,
+               exact: bool = False) -> List[Dict[str, Any]]:
+        """
+        Find the ``k`` most similar vectors.
+
+        Args:
+            query: Query vector.
+            k: Number of results.
+            nprobe: IVF cells scored, widened when filters leave too few hits.
+            stream: Only vectors of this stream.
+            since: Only vectors with a timestamp at or after this unix time.
+            until: Only vectors with a timestamp at or before this unix time.
+            exact: Score every vector (brute force).
+
+        Returns:
+            Hits ordered by decreasing cosine similarity, each
+            ``{"id", "score", "stream", "timestamp"}``.
+        """
+        query = _normalise(query).reshape(-1)
+        filtered = stream is not None or since is not None or until is not None
+        with self._lock:
+            if exact or self.centroids is None:
+                rows = self._filter(np.arange(self.count), stream, since, until)
+            elif filtered and self._selective(nprobe, stream, since, until):
+                rows = self._selected
+            else:
+                order = np.argsort(-(self.centroids @ query))
+                probed = min(nprobe, len(order))
+                rows = self._filter(self._cell_rows(order[:probed]), stream, since, until)
+                while len(rows) < k and probed < len(order):
+                    more = order[probed:probed * 2]
+                    probed += len(more)
+                    rows = np.concatenate([rows, self._filter(self._cell_rows(more), stream, since, until)])
+            rows, scores = self._score(rows, query, k)
+            return [
+                {
+                    "id": self.ids[row],
+                    "score": float(score),
+                    "stream": self.streams[self.stream_codes[row]] or None,
+                    "timestamp": float(self.timestamps[row]),
+                }
+                for row, score in zip(rows.tolist(), scores.tolist())
+            ]
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "vectors": len(self._rows),
+                "rows": self.count,
+                "capacity": self.capacity,
+                "dim": self.dim,
+                "dtype": self.dtype,
+                "streams": len(self.streams),
+                "nlist": len(self.centroids) if self.centroids is not None else 0,
+                "trained": self.centroids is not None,
+            }
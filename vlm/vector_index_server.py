@@ -0,0 +1,157 @@
+# vlm/vector_index_server.py
+"""
+HTTP service around ``VectorIndex`` for the description embeddings.
+
+The Node server inserts the embedding of every saved vision result and
+asks this service for the nearest ids instead of scoring documents in
+JavaScript. The index is saved every few seconds while it has unsaved
+changes and on shutdown, and reloaded on start.
+
+Endpoints:
+    POST   /v1/vectors          {"items": [{"id", "vector", "stream", "timestamp"}]}
+    DELETE /v1/vectors/{id}
+    POST   /v1/vectors/search   {"vector", "k", "stream", "since", "until", "nprobe", "threshold", "exact"}
+    POST   /v1/vectors/train    {"nlist"}  re-cluster after the data has drifted
+    GET    /v1/vectors/stats
+
+Configuration (environment variables):
+    VECTOR_INDEX_PATH        index directory (default: vector_index)
+    VECTOR_INDEX_DIM         dimension of a new index (default: 768)
+    VECTOR_INDEX_SAVE_EVERY  seconds between saves of a changed index (default: 5)
+    VECTOR_INDEX_PORT        listen port (default: 8890)
+"""
+
+import asyncio
+import logging
+import os
+import threading
+from contextlib import asynccontextmanager
+
+import uvicorn
+from fastapi import FastAPI, HTTPException, Request
+
+from metrics import metrics
+from vector_index import NPROBE, VectorIndex
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    handlers=[logging.StreamHandler()]
+)
+logger = logging.getLogger("vector-index-api")
+
+INDEX_PATH = os.environ.get("VECTOR_INDEX_PATH", "vector_index")
+INDEX_DIM = int(os.environ.get("VECTOR_INDEX_DIM", "768"))
+SAVE_EVERY = float(os.environ.get("VECTOR_INDEX_SAVE_EVERY", "5"))
+PORT = int(os.environ.get("VECTOR_INDEX_PORT", "8890"))
+
+index = None
+_dirty = threading.Event()
+
+
+async def save_periodically():
+    while True:
+        await asyncio.sleep(SAVE_EVERY)
+        if _dirty.is_set():
+            _dirty.clear()
+            await asyncio.to_thread(index.save)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global index
+    index = VectorIndex(INDEX_PATH, dim=INDEX_DIM)
+    logger.info(f"Vector index ready: {index.stats()}")
+    saver = asyncio.create_task(save_periodically())
+    yield
+    saver.cancel()
+    index.save()
+    logger.info("Vector index saved")
+
+
+app = FastAPI(title="Vector Index API", lifespan=lifespan)
+
+
+@app.post("/v1/vectors")
+async def add_vectors(request: Request):
+    """Insert or replace embeddings"""
+    body = await request.json()
+    items = body.get("items", [])
+    if not items:
+        raise HTTPException(status_code=400, detail="items is required")
+    try:
+        added = await asyncio.to_thread(
+            index.add,
+            [str(item["id"]) for item in items],
+            [item["vector"] for item in items],
+            [item.get("stream") for item in items],
+            [item.get("timestamp") for item in items],
+        )
+    except (KeyError, ValueError) as e:
+        raise HTTPException(status_code=400, detail=f"Invalid items: {e}")
+    _dirty.set()
+    metrics.inc("vector_index_inserts_total", added)
+    return {"added": added, "vectors": len(index)}
+
+
+@app.delete("/v1/vectors/{vector_id}")
+async def remove_vector(vector_id: str):
+    if not index.remove(vector_id):
+        raise HTTPException(status_code=404, detail=f"Vector '{vector_id}' not found")
+    _dirty.set()
+    return {"removed": vector_id}
+
+
+@app.post("/v1/vectors/search")
+async def search_vectors(request: Request):
+    """Nearest embeddings by cosine similarity, optionally within a stream and time range"""
+    body = await request.json()
+    vector = body.get("vector")
+    if not vector:
+        raise HTTPException(status_code=400, detail="vector is required")
+    threshold = body.get("threshold")
+    try:
+        hits = await asyncio.to_thread(
+            index.search,
+            vector,
+            int(body.get("k", 10)),
+            nprobe=int(body.get("nprobe", NPROBE)),
+            stream=body.get("stream"),
+            since=body.get("since"),
+            until=body.get("until"),
+            exact=bool(body.get("exact", False)),
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid query: {e}")
+    if threshold is not None:
+        hits = [hit for hit in hits if hit["score"] >= float(threshold)]
+    metrics.inc("vector_index_searches_total")
+    return {"object": "list", "data": hits}
+
+
+@app.post("/v1/vectors/train")
+async def train_index(request: Request):
+    body = await request.json() if await request.body() else {}
+    await asyncio.to_thread(index.train, body.get("nlist"))
+    _dirty.set()
+    return index.stats()
+
+
+@app.get("/v1/vectors/stats")
+async def index_stats():
+    return index.stats()
+
+
+@app.get("/health")
+async def health_check():
+    return {"status": "ok", "vectors": len(index) if index is not None else 0}
+
+
+@app.get("/metrics")
+async def get_metrics():
+    return metrics.snapshot()
+
+
+if __name__ == "__main__":
+    logger.info(f"Starting vector index API server on port {PORT}")
+    uvicorn.run("vector_index_server:app", host="0.0.0.0", port=PORT, log_level="info")